@@ -1,4 +1,5 @@
 import { compressImageFile } from '@/utils/imageUtils'
+import { getAccessToken } from './auth'
 
 export async function uploadImage(
   file: File
@@ -250,6 +251,10 @@ export interface ArrangeLayersRequest {
   targetWidth: number
   targetHeight: number
   apiKey?: string
+  // Streaming progress ('layer_arrangement_progress') goes to socketId, or to viewers of canvasId
+  requestId?: string
+  socketId?: string
+  canvasId?: string
 }
 
 export interface ArrangeLayersResponse {
@@ -257,11 +262,17 @@ export interface ArrangeLayersResponse {
   arrangements: ElementArrangement[]
 }
 export async function arrangeCanvasElements(request: ArrangeLayersRequest): Promise<ArrangeLayersResponse> {
+  // 服務端只把進度推送給同一用戶的連接或其可訪問的畫布，需要帶上登錄令牌
+  const token = getAccessToken()
+  const headers: Record<string, string> = {
+    'Content-Type': 'application/json',
+  }
+  if (token) {
+    headers['Authorization'] = `Bearer ${token}`
+  }
   const response = await fetch('/api/psd/arrange-layers', {
     method: 'POST',
-    headers: {
-      'Content-Type': 'application/json',
-    },
+    headers,
     body: JSON.stringify(request),
   })
   if (!response.ok) {
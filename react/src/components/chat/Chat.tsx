@@ -1,6 +1,7 @@
 import { sendMessages } from '@/api/chat'
 import Blur from '@/components/common/Blur'
 import { ScrollArea } from '@/components/ui/scroll-area'
+import { useSocket } from '@/contexts/socket'
 import { eventBus, TEvents } from '@/lib/event'
 import ChatMagicGenerator from './ChatMagicGenerator'
 import {
@@ -71,6 +72,7 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({
   const [showShareDialog, setShowShareDialog] = useState(false)
   const [isImageQuestionMode, setIsImageQuestionMode] = useState(false)
   const queryClient = useQueryClient()
+  const { socketManager, connected } = useSocket()
 
   useEffect(() => {
     if (sessionList.length > 0) {
@@ -286,6 +288,11 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({
     handleToolCallResult,
   ])
 
+  // 只接收當前畫布和會話的 session_update（新會話的第一條消息通過畫布房間送達）
+  useEffect(() => {
+    socketManager?.subscribe({ canvas_id: canvasId, session_id: sessionId })
+  }, [socketManager, connected, canvasId, sessionId])
+
   const onSelectSession = useCallback(
     (id: string) => {
       window.history.pushState({}, '', `/canvas/${canvasId}?sessionId=${id}`)
@@ -1,4 +1,4 @@
-import { SocketIOManager } from '@/lib/socket'
+import { SocketIOManager, SocketSubscription } from '@/lib/socket'
 import React, { createContext, useContext, useEffect, useRef, useState } from 'react'
 import { useTranslation } from 'react-i18next'
 
@@ -20,6 +20,19 @@ interface SocketProviderProps {
   children: React.ReactNode
 }
 
+// 從當前地址（/canvas/$id?sessionId=...）讀出要訂閱的畫布和會話，讓首次握手就帶上
+const getInitialSubscription = (): SocketSubscription => {
+  const match = window.location.pathname.match(/^\/canvas\/([^/]+)/)
+  if (!match) {
+    return {}
+  }
+  const sessionId = new URLSearchParams(window.location.search).get('sessionId')
+  return {
+    canvas_id: decodeURIComponent(match[1]),
+    ...(sessionId ? { session_id: sessionId } : {}),
+  }
+}
+
 export const SocketProvider: React.FC<SocketProviderProps> = ({ children }) => {
   const { t } = useTranslation()
   const [connected, setConnected] = useState(false)
@@ -47,7 +60,8 @@ export const SocketProvider: React.FC<SocketProviderProps> = ({ children }) => {
             : window.location.origin // 使用相对路径，前端服务器会代理到后端
           socketManagerRef.current = new SocketIOManager({
             serverUrl: backendUrl,
-            autoConnect: false
+            autoConnect: false,
+            subscription: getInitialSubscription(),
           })
         }
 
@@ -154,3 +168,5 @@ export const SocketProvider: React.FC<SocketProviderProps> = ({ children }) => {
     </SocketContext.Provider>
   )
 }
+
+export const useSocket = () => useContext(SocketContext)
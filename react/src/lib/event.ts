@@ -47,6 +47,7 @@ export type TEvents = {
   'Socket::Session::ToolCallArguments': ISocket.SessionToolCallArgumentsEvent
   'Socket::Session::ToolCallResult': ISocket.SessionToolCallResultEvent
   'Socket::Session::AllMessages': ISocket.SessionAllMessagesEvent
+  'Socket::Session::MessagesDelta': ISocket.SessionMessagesDeltaEvent
   'Socket::Session::ToolCallProgress': ISocket.SessionToolCallProgressEvent
   'Socket::Session::ToolCallPendingConfirmation': ISocket.SessionToolCallPendingConfirmationEvent
   'Socket::Session::ToolCallConfirmed': ISocket.SessionToolCallConfirmedEvent
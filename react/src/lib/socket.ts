@@ -1,3 +1,4 @@
+import { getAccessToken } from '@/api/auth'
 import * as ISocket from '@/types/socket'
 import { io, Socket } from 'socket.io-client'
 import { eventBus } from './event'
@@ -5,6 +6,13 @@ import { eventBus } from './event'
 export interface SocketConfig {
   serverUrl?: string
   autoConnect?: boolean
+  // 首次連接前就已知的會話/畫布，隨握手一起發送
+  subscription?: SocketSubscription
+}
+
+export interface SocketSubscription {
+  session_id?: string
+  canvas_id?: string
 }
 
 export class SocketIOManager {
@@ -14,8 +22,11 @@ export class SocketIOManager {
   private maxReconnectAttempts = 3  // 減少重連次數
   private reconnectDelay = 2000  // 增加重連延遲
   private connectionTimeout = 10000  // 10秒連接超時
+  // 當前查看的會話/畫布，服務端只推送這些房間的 session_update
+  private subscription: SocketSubscription = {}
 
   constructor(private config: SocketConfig = {}) {
+    this.subscription = config.subscription || {}
     if (config.autoConnect !== false) {
       this.connect()
     }
@@ -37,6 +48,8 @@ export class SocketIOManager {
         reconnectionAttempts: this.maxReconnectAttempts,
         reconnectionDelay: this.reconnectDelay,
         timeout: this.connectionTimeout,
+        // 每次（重新）連接時攜帶最新的登錄令牌和訂閱
+        auth: (cb) => cb({ token: getAccessToken(), ...this.subscription }),
       })
 
       // 設置連接超時
@@ -143,6 +156,9 @@ export class SocketIOManager {
       case ISocket.SessionEventType.AllMessages:
         eventBus.emit('Socket::Session::AllMessages', data)
         break
+      case ISocket.SessionEventType.MessagesDelta:
+        eventBus.emit('Socket::Session::MessagesDelta', data)
+        break
       case ISocket.SessionEventType.Done:
         eventBus.emit('Socket::Session::Done', data)
         break
@@ -155,11 +171,23 @@ export class SocketIOManager {
       case ISocket.SessionEventType.ToolCallResult:
         eventBus.emit('Socket::Session::ToolCallResult', data)
         break
+      case ISocket.SessionEventType.Batch:
+        for (const event of (data as ISocket.SessionBatchEvent).events) {
+          this.handleSessionUpdate({ ...event, session_id } as ISocket.SessionUpdateEvent)
+        }
+        break
       default:
         console.log('⚠️ Unknown session update type:', type)
     }
   }
 
+  subscribe(subscription: SocketSubscription) {
+    this.subscription = subscription
+    if (this.socket && this.connected) {
+      this.socket.emit('subscribe', subscription)
+    }
+  }
+
   ping(data: unknown) {
     if (this.socket && this.connected) {
       this.socket.emit('ping', data)
@@ -13,10 +13,12 @@ export enum SessionEventType {
   ToolCallArguments = 'tool_call_arguments',
   ToolCallResult = 'tool_call_result',
   AllMessages = 'all_messages',
+  MessagesDelta = 'messages_delta',
   ToolCallProgress = 'tool_call_progress',
   ToolCallPendingConfirmation = 'tool_call_pending_confirmation',
   ToolCallConfirmed = 'tool_call_confirmed',
   ToolCallCancelled = 'tool_call_cancelled',
+  Batch = 'batch',
 }
 
 export interface SessionBaseEvent {
@@ -72,6 +74,13 @@ export interface SessionAllMessagesEvent extends SessionBaseEvent {
   type: SessionEventType.AllMessages
   messages: Message[]
 }
+// 增量消息同步：用 messages.slice(0, start) + messages 替換本地列表，total 為替換後的消息總數
+export interface SessionMessagesDeltaEvent extends SessionBaseEvent {
+  type: SessionEventType.MessagesDelta
+  start: number
+  messages: Message[]
+  total: number
+}
 export interface SessionToolCallProgressEvent extends SessionBaseEvent {
   type: SessionEventType.ToolCallProgress
   tool_call_id: string
@@ -96,6 +105,12 @@ export interface SessionToolCallCancelledEvent extends SessionBaseEvent {
   id: string
 }
 
+// 服務端合併的多個流式片段（delta / tool_call_arguments），按順序處理
+export interface SessionBatchEvent extends SessionBaseEvent {
+  type: SessionEventType.Batch
+  events: Omit<SessionDeltaEvent | SessionToolCallArgumentsEvent, 'session_id'>[]
+}
+
 export type SessionUpdateEvent =
   | SessionDeltaEvent
   | SessionToolCallEvent
@@ -104,6 +119,7 @@ export type SessionUpdateEvent =
   | SessionImageGeneratedEvent
   | SessionVideoGeneratedEvent
   | SessionAllMessagesEvent
+  | SessionMessagesDeltaEvent
   | SessionDoneEvent
   | SessionErrorEvent
   | SessionInfoEvent
@@ -111,3 +127,4 @@ export type SessionUpdateEvent =
   | SessionToolCallPendingConfirmationEvent
   | SessionToolCallConfirmedEvent
   | SessionToolCallCancelledEvent
+  | SessionBatchEvent
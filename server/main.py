@@ -63,6 +63,7 @@ print('Importing config_service')
 from services.config_service import config_service
 print('Importing tool_service')
 from services.tool_service import tool_service
+from services.message_writer import message_writer
 
 async def initialize():
     print('Initializing config_service')
@@ -80,6 +81,11 @@ async def lifespan(app: FastAPI):
     await tool_service.initialize()
     yield
     # onshutdown
+    await message_writer.close()
+    if psd_resize_router:
+        await psd_resize_router.psd_resize_job_service.close()
+    if psd_router:
+        psd_router.psd_raster_engine.shutdown()
 
 print('Creating FastAPI app')
 app = FastAPI(lifespan=lifespan)
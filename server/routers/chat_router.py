@@ -3,6 +3,7 @@ from fastapi import APIRouter, Request
 from services.chat_service import handle_chat
 from services.magic_service import handle_magic
 from services.stream_service import get_stream_task
+from services.langgraph_service.stream_output_buffer import stream_output_metrics
 from typing import Dict
 
 router = APIRouter(prefix="/api")
@@ -45,6 +46,17 @@ async def cancel_chat(session_id: str):
         return {"status": "cancelled"}
     return {"status": "not_found_or_done"}
 
+@router.get("/chat/stream_stats")
+async def chat_stream_stats():
+    """
+    Endpoint to inspect websocket output of chat streams.
+
+    Response:
+        Frames, events and bytes sent per session (active and recent),
+        plus process-wide totals and the batching configuration.
+    """
+    return stream_output_metrics.get_stats()
+
 @router.post("/magic")
 async def magic(request: Request):
     """
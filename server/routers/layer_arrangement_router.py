@@ -11,18 +11,21 @@ import tempfile
 import math
 from pathlib import Path
 from typing import Dict, List, Any, Optional
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import JSONResponse
 import logging
 
 from services.canvas_layer_arrangement_service import CanvasLayerArrangementService
 from services.config_service import config_service
+from services.websocket_service import verified_requester_rooms
+from services.websocket_state import sio
+from utils.auth_dependency import get_current_user_optional
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/psd", tags=["Layer Arrangement"])
 
 @router.post("/arrange-layers")
-async def arrange_layers(request: Request):
+async def arrange_layers(request: Request, current_user: Optional[Dict[str, Any]] = Depends(get_current_user_optional)):
     """
     智能排列选中的画布元素
     
@@ -36,7 +39,11 @@ async def arrange_layers(request: Request):
             "canvasHeight": 800,        # 当前画布高度
             "targetWidth": 800,         # 目标宽度
             "targetHeight": 600,        # 目标高度
-            "apiKey": "optional_gemini_api_key"  # 可选的Gemini API密钥
+            "apiKey": "optional_gemini_api_key",  # 可选的Gemini API密钥
+            "requestId": "optional_request_id",    # 可选，提供时流式生成方案，
+                                                   # 每个元素的方案通过 'layer_arrangement_progress' 事件推送
+            "socketId": "optional_socket_id",      # 可选，接收进度事件的 socket.io 连接
+            "canvasId": "optional_canvas_id"       # 可选，没有可用连接时推送给正在查看该画布的客户端
         }
     
     Returns:
@@ -54,6 +61,9 @@ async def arrange_layers(request: Request):
         target_width = data.get('targetWidth', 0)
         target_height = data.get('targetHeight', 0)
         api_key = data.get('apiKey', None)
+        request_id = data.get('requestId')
+        # 只推送给调用者自己的连接或其有权访问的画布
+        notify_rooms = await verified_requester_rooms(current_user, data.get('socketId'), data.get('canvasId'))
         
         logger.info(f"接收到的图层数量: {len(selected_elements)}")
         for i, element in enumerate(selected_elements):
@@ -108,6 +118,28 @@ async def arrange_layers(request: Request):
             logger.error(f"服务初始化失败: {ve}")
             raise HTTPException(status_code=500, detail=f"服务初始化失败: {str(ve)}")
         
+        # 流式模式：每个元素的方案解析出来后立即推送，前端可以边接收边移动元素；
+        # 重叠检查移动了已推送的元素时以 correction 标记再次推送最终位置
+        on_item = None
+        if request_id and notify_rooms:
+            pushed_ids = set()
+            
+            async def push_progress(arrangement: Dict[str, Any]) -> None:
+                correction = arrangement['id'] in pushed_ids
+                pushed_ids.add(arrangement['id'])
+                try:
+                    await sio.emit('layer_arrangement_progress', {
+                        'requestId': request_id,
+                        'arrangement': arrangement,
+                        'correction': correction,
+                        'arranged': len(pushed_ids),
+                        'total': len(selected_elements),
+                    }, room=notify_rooms)
+                except Exception as e:
+                    logger.warning(f"推送排列方案失败: {e}")
+            
+            on_item = push_progress
+        
         # 执行排列
         try:
             arrangements = await service.arrange_canvas_elements(
@@ -115,7 +147,8 @@ async def arrange_layers(request: Request):
                 canvas_width=canvas_width,
                 canvas_height=canvas_height,
                 target_width=target_width,
-                target_height=target_height
+                target_height=target_height,
+                on_item=on_item
             )
         except ValueError as ve:
             logger.error(f"排列处理失败: {ve}")
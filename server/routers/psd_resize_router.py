@@ -6,17 +6,37 @@ PSD自動縮放API路由
 
 import os
 import json
+import uuid
 import base64
+import shutil
+import asyncio
 import tempfile
+from collections import OrderedDict
 from pathlib import Path
-from typing import Dict, List, Any, Optional
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+from typing import Awaitable, Callable, Dict, List, Any, Optional, Set, Tuple
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse
 import logging
 
-from services.gemini_psd_resize_service import GeminiPSDResizeService
-from utils.psd_layer_info import get_psd_layers_info, draw_detection_boxes
-from utils.resize_psd import resize_psd_with_new_positions
+from services.gemini_psd_resize_service import GeminiPSDResizeService, LayerCallback
+from services.gemini_gateway import gemini_gateway
+from services.psd_composite_cache import psd_composite_cache
+from services.psd_content_store import psd_content_store
+from services.psd_layer_service import psd_layer_service
+from services.psd_metadata_store import psd_metadata_store
+from services.psd_resize_plan_cache import resize_plan_cache
+from services.psd_resize_job_service import ResizeJob, psd_resize_job_service
+from services.websocket_service import verified_requester_rooms
+from services.websocket_state import sio
+from utils.auth_dependency import get_current_user_optional
+from utils.psd_hierarchical_plan import planning_layers
+from utils.psd_local_layout import compute_local_layout
+from utils.psd_layer_info import DetectionImage, get_psd_layers_info, render_detection_image
+from utils.resize_psd import LayerRasterCache, resize_psd_with_new_positions
+from utils.image_encoder import image_encoder
+from utils.upload_stream import stream_upload_to_file, hash_file
+from PIL import Image
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/psd/resize", tags=["PSD Resize"])
@@ -26,13 +46,268 @@ from services.config_service import FILES_DIR
 from common import DEFAULT_PORT
 PSD_DIR = os.path.join(FILES_DIR, "psd")
 
+# 縮放方案模式：gemini（默認）、local（本地佈局引擎）、hybrid（先返回本地方案，後台升級為Gemini方案）
+RESIZE_MODES = ("gemini", "local", "hybrid")
+# 混合模式的升級任務狀態，只保留最近的記錄
+MAX_PLAN_UPGRADES = 256
+_plan_upgrades: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+# 正在運行的升級任務，保留引用以免被垃圾回收
+_plan_upgrade_tasks: Set[asyncio.Task] = set()
+# 批量縮放時同時進行的方案請求數和單次最多目標尺寸數
+BATCH_PLAN_CONCURRENCY = int(os.getenv('PSD_BATCH_PLAN_CONCURRENCY', '4'))
+MAX_BATCH_TARGETS = int(os.getenv('PSD_MAX_BATCH_TARGETS', '50'))
+
+
+async def _get_resize_plan(
+    psd,
+    layers_info: List[Dict[str, Any]],
+    content_hash: str,
+    target_width: int,
+    target_height: int,
+    api_key: Optional[str],
+    base_image_loader: Optional[Callable[[], Image.Image]] = None,
+    detection_image_getter: Optional[Callable[[], Awaitable[DetectionImage]]] = None,
+    on_layer: Optional[LayerCallback] = None
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    獲取圖層調整方案：命中方案緩存時直接返回，否則繪製檢測框圖像並調用Gemini
+    
+    Args:
+        detection_image_getter: 返回已繪製的檢測框圖像（批量縮放時多個目標尺寸共用一張）
+        on_layer: 提供時使用流式響應，每解析出一個圖層方案立即回調（命中緩存時逐個回調緩存的方案）
+    
+    Returns:
+        (new_positions, 是否命中緩存)
+    """
+    plan_key = resize_plan_cache.make_key(content_hash, layers_info, target_width, target_height)
+    cached_plan = await run_in_threadpool(resize_plan_cache.get, plan_key)
+    if cached_plan is not None:
+        logger.info(f"命中縮放方案緩存: {plan_key[:16]} ({target_width}x{target_height})")
+        if on_layer is not None:
+            for item in cached_plan:
+                await on_layer(item)
+        return cached_plan, True
+    
+    # 生成檢測框圖像（縮小到限定最長邊並編碼一次，字節直接交給SDK）
+    if detection_image_getter:
+        detection_image = await detection_image_getter()
+    else:
+        def draw_detection() -> DetectionImage:
+            base_image = base_image_loader() if base_image_loader else None
+            # 分層規劃時只標註規劃單元，與提示詞中的表格一致
+            return render_detection_image(psd, planning_layers(layers_info, psd.width, psd.height),
+                                          base_image=base_image)
+        
+        detection_image = await run_in_threadpool(draw_detection)
+    
+    logger.info("調用Gemini API生成新位置")
+    service = GeminiPSDResizeService(api_key=api_key)
+    new_positions = await service.resize_psd_layers(
+        layers_info=layers_info,
+        detection_image_path=None,
+        original_width=psd.width,
+        original_height=psd.height,
+        target_width=target_width,
+        target_height=target_height,
+        detection_image=detection_image,
+        on_layer=on_layer
+    )
+    
+    await run_in_threadpool(resize_plan_cache.put, plan_key, new_positions)
+    return new_positions, False
+
+
+def _check_mode(mode: str) -> None:
+    if mode not in RESIZE_MODES:
+        raise HTTPException(status_code=400, detail=f"不支持的縮放模式: {mode}，可選: {', '.join(RESIZE_MODES)}")
+
+
+async def _resolve_plan(
+    mode: str,
+    psd,
+    layers_info: List[Dict[str, Any]],
+    content_hash: str,
+    target_width: int,
+    target_height: int,
+    api_key: Optional[str],
+    base_image_loader: Optional[Callable[[], Image.Image]] = None,
+    on_layer: Optional[LayerCallback] = None
+) -> Tuple[List[Dict[str, Any]], str]:
+    """
+    按模式獲取調整方案
+    
+    Args:
+        on_layer: gemini 模式下流式獲取方案，每個圖層方案解析出來後立即回調
+    
+    Returns:
+        (new_positions, 方案來源: gemini / gemini-cache / local)
+    """
+    if mode == "gemini":
+        new_positions, cached = await _get_resize_plan(
+            psd, layers_info, content_hash,
+            target_width, target_height, api_key, base_image_loader,
+            on_layer=on_layer
+        )
+        return new_positions, "gemini-cache" if cached else "gemini"
+    
+    if mode == "hybrid":
+        # 已有Gemini方案時直接使用，無需升級
+        plan_key = resize_plan_cache.make_key(content_hash, layers_info, target_width, target_height)
+        cached_plan = await run_in_threadpool(resize_plan_cache.get, plan_key)
+        if cached_plan is not None:
+            return cached_plan, "gemini-cache"
+    
+    new_positions = compute_local_layout(layers_info, psd.width, psd.height, target_width, target_height)
+    logger.info(f"本地佈局引擎生成 {len(new_positions)} 個圖層的調整方案")
+    return new_positions, "local"
+
+
+def _render_resized_png(
+    psd_path: str,
+    new_positions: List[Dict[str, Any]],
+    work_dir: str,
+    target_width: int,
+    target_height: int,
+    final_png_path: str,
+    raster_cache: Optional[LayerRasterCache] = None
+) -> None:
+    """按調整方案渲染縮放結果並移動到最終路徑"""
+    render_id = uuid.uuid4().hex[:8]
+    positions_file = os.path.join(work_dir, f"new_positions_{render_id}.json")
+    with open(positions_file, 'w', encoding='utf-8') as f:
+        json.dump(new_positions, f, ensure_ascii=False, indent=2)
+    
+    output_png_path = os.path.join(work_dir, f"resized_output_{render_id}.png")
+    resize_psd_with_new_positions(
+        psd_path,
+        positions_file,
+        output_png_path,
+        target_width,
+        target_height,
+        raster_cache=raster_cache
+    )
+    
+    os.makedirs(os.path.dirname(final_png_path), exist_ok=True)
+    shutil.move(output_png_path, final_png_path)
+    image_encoder.remove_variants(final_png_path)
+
+
+def _prewarm_layer(raster_cache: LayerRasterCache, item: Dict[str, Any],
+                   target_width: int, target_height: int) -> None:
+    """提前縮放一個已確定位置的圖層，最終渲染時直接從縮放緩存中取用"""
+    try:
+        coords = item['new_coords']
+        layer_id = item['id']
+        width = coords['right'] - coords['left']
+        height = coords['bottom'] - coords['top']
+    except (KeyError, TypeError):
+        return
+    if (layer_id not in raster_cache.layers or item.get('type') == 'group' or
+            not item.get('visible', True) or width <= 0 or height <= 0 or
+            coords['left'] < 0 or coords['top'] < 0 or
+            coords['right'] > target_width or coords['bottom'] > target_height):
+        return
+    try:
+        raster_cache.get_scaled(layer_id, width, height)
+    except Exception as e:
+        logger.warning(f"預渲染圖層 {layer_id} 失敗: {e}")
+
+
+def _layer_raster_cache(psd, content_hash: str, file_id: Optional[str] = None) -> LayerRasterCache:
+    """
+    已上傳的文件直接使用圖層柵格緩存中的位圖，不再重新合成每個圖層；
+    現場合成的圖層按內容哈希共享縮放變體
+    """
+    if file_id is None:
+        return LayerRasterCache(psd, source_id=content_hash)
+    return LayerRasterCache(
+        psd,
+        raster_loader=lambda layer_index: psd_layer_service.rasterize_layer(file_id, layer_index),
+        source_id=content_hash
+    )
+
+
+async def _content_hash(file_id: Optional[str], psd_path: str) -> str:
+    """內容哈希統一使用內容對象ID的形式，去重上傳的文件無需重新計算"""
+    content_id = await run_in_threadpool(psd_metadata_store.get_content_id, file_id) if file_id else None
+    return content_id or psd_content_store.content_id_for(await run_in_threadpool(hash_file, psd_path))
+
+
+def _write_resize_metadata(file_id: str, metadata: Dict[str, Any]) -> None:
+    metadata_path = os.path.join(PSD_DIR, f"{file_id}_metadata.json")
+    with open(metadata_path, 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+
+def _schedule_plan_upgrade(
+    psd,
+    layers_info: List[Dict[str, Any]],
+    content_hash: str,
+    temp_dir: str,
+    target_width: int,
+    target_height: int,
+    api_key: Optional[str],
+    on_upgrade: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+    base_image_loader: Optional[Callable[[], Image.Image]] = None,
+    result_file_id: Optional[str] = None,
+    notify_rooms: Optional[List[str]] = None
+) -> str:
+    """
+    混合模式：在後台請求Gemini方案，完成後執行 on_upgrade 並通過 socket.io 通知
+    notify_rooms（請求方的連接），任務結束時刪除 temp_dir
+
+    Returns:
+        升級任務ID（可通過 /plan-upgrade/{upgrade_id} 查詢）
+    """
+    upgrade_id = uuid.uuid4().hex
+    _plan_upgrades[upgrade_id] = {
+        "upgrade_id": upgrade_id,
+        "status": "pending",
+        "file_id": result_file_id,
+        "target_size": {"width": target_width, "height": target_height},
+    }
+    while len(_plan_upgrades) > MAX_PLAN_UPGRADES:
+        _plan_upgrades.popitem(last=False)
+    
+    async def run_upgrade():
+        state = _plan_upgrades.get(upgrade_id, {})
+        try:
+            new_positions, _ = await _get_resize_plan(
+                psd, layers_info, content_hash,
+                target_width, target_height, api_key, base_image_loader
+            )
+            if on_upgrade:
+                await run_in_threadpool(on_upgrade, new_positions)
+            state.update({"status": "done", "plan_source": "gemini", "new_positions": new_positions})
+            logger.info(f"縮放方案已升級為Gemini方案: {upgrade_id}")
+        except Exception as e:
+            state.update({"status": "failed", "error": str(e)})
+            logger.warning(f"縮放方案升級失敗，保留本地方案: {e}")
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        
+        if not notify_rooms:
+            return
+        try:
+            await sio.emit('psd_resize_plan_upgrade', state, room=notify_rooms)
+        except Exception as e:
+            logger.warning(f"推送縮放方案升級事件失敗: {e}")
+    
+    task = asyncio.create_task(run_upgrade())
+    _plan_upgrade_tasks.add(task)
+    task.add_done_callback(_plan_upgrade_tasks.discard)
+    return upgrade_id
+
 
 @router.post("/auto-resize")
 async def auto_resize_psd(
     psd_file: UploadFile = File(...),
     target_width: int = Form(...),
     target_height: int = Form(...),
-    api_key: Optional[str] = Form(None)
+    api_key: Optional[str] = Form(None),
+    mode: str = Form("gemini"),
+    socket_id: Optional[str] = Form(None),
+    current_user: Optional[Dict[str, Any]] = Depends(get_current_user_optional)
 ):
     """
     使用Gemini API自動縮放PSD文件
@@ -42,10 +317,14 @@ async def auto_resize_psd(
         target_width: 目標寬度
         target_height: 目標高度
         api_key: Gemini API密鑰（可選，如果不提供則使用環境變量）
+        mode: gemini / local（本地佈局引擎，無需API）/ hybrid（先返回本地結果，後台升級為Gemini結果）
+        socket_id: 請求方的 socket.io 連接ID（可選，混合模式的升級事件只推送給該連接，須為同一用戶的連接）
     
     Returns:
         縮放後的圖層信息和輸出文件URL
     """
+    _check_mode(mode)
+    upgrade_id = None
     try:
         # 驗證文件類型
         if not psd_file.filename.lower().endswith('.psd'):
@@ -55,15 +334,13 @@ async def auto_resize_psd(
         temp_dir = tempfile.mkdtemp()
         psd_path = os.path.join(temp_dir, psd_file.filename)
         
-        with open(psd_path, "wb") as buffer:
-            content = await psd_file.read()
-            buffer.write(content)
+        upload = await stream_upload_to_file(psd_file, psd_path)
         
         logger.info(f"PSD文件已保存到: {psd_path}")
         
         # 步驟1: 提取圖層信息
         logger.info("步驟1: 提取PSD圖層信息")
-        psd, layers_info = get_psd_layers_info(psd_path)
+        psd, layers_info = await run_in_threadpool(get_psd_layers_info, psd_path)
         original_width = psd.width
         original_height = psd.height
         
@@ -71,50 +348,26 @@ async def auto_resize_psd(
         logger.info(f"目標尺寸: {target_width}x{target_height}")
         logger.info(f"圖層數量: {len(layers_info)}")
         
-        # 生成檢測框圖像
-        detection_image_path = os.path.join(temp_dir, "detection.png")
-        draw_detection_boxes(psd, layers_info, detection_image_path)
-        
-        # 步驟2: 使用Gemini生成新位置
-        logger.info("步驟2: 調用Gemini API生成新位置")
-        service = GeminiPSDResizeService(api_key=api_key)
-        
-        new_positions = await service.resize_psd_layers(
-            layers_info=layers_info,
-            detection_image_path=detection_image_path,
-            original_width=original_width,
-            original_height=original_height,
-            target_width=target_width,
-            target_height=target_height
-        )
-        
-        # 保存新位置信息
-        positions_file = os.path.join(temp_dir, "new_positions.json")
-        with open(positions_file, 'w', encoding='utf-8') as f:
-            json.dump(new_positions, f, ensure_ascii=False, indent=2)
-        
-        # 步驟3: 重建PSD並渲染
-        logger.info("步驟3: 重建PSD並渲染")
-        output_png_path = os.path.join(temp_dir, "resized_output.png")
-        
-        result_image = resize_psd_with_new_positions(
-            psd_path,
-            positions_file,
-            output_png_path,
-            target_width,
-            target_height
+        # 步驟2: 生成新位置（按模式使用Gemini/方案緩存/本地佈局引擎）
+        logger.info("步驟2: 生成圖層調整方案")
+        content_hash = psd_content_store.content_id_for(upload.sha256)
+        raster_cache = _layer_raster_cache(psd, content_hash)
+        new_positions, plan_source = await _resolve_plan(
+            mode, psd, layers_info, content_hash,
+            target_width, target_height, api_key
         )
+        plan_cached = plan_source == "gemini-cache"
         
         # 生成文件ID
         import time
         file_id = f"resized_{int(time.time())}"
-        
-        # 移動文件到永久目錄
         final_png_path = os.path.join(PSD_DIR, f"{file_id}.png")
-        os.makedirs(PSD_DIR, exist_ok=True)
         
-        import shutil
-        shutil.move(output_png_path, final_png_path)
+        # 步驟3: 重建PSD並渲染
+        logger.info("步驟3: 重建PSD並渲染")
+        await run_in_threadpool(
+            _render_resized_png, psd_path, new_positions, temp_dir, target_width, target_height, final_png_path, raster_cache
+        )
         
         # 保存元數據
         metadata = {
@@ -124,12 +377,22 @@ async def auto_resize_psd(
             "target_size": {"width": target_width, "height": target_height},
             "layers_count": len(layers_info),
             "new_positions": new_positions,
+            "plan_source": plan_source,
             "output_url": f"/api/psd/resize/output/{file_id}"
         }
+        _write_resize_metadata(file_id, metadata)
         
-        metadata_path = os.path.join(PSD_DIR, f"{file_id}_metadata.json")
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        if plan_source == "local" and mode == "hybrid":
+            def upgrade_output(gemini_positions: List[Dict[str, Any]]) -> None:
+                _render_resized_png(psd_path, gemini_positions, temp_dir, target_width, target_height, final_png_path, raster_cache)
+                _write_resize_metadata(file_id, {**metadata, "new_positions": gemini_positions, "plan_source": "gemini"})
+            
+            upgrade_id = _schedule_plan_upgrade(
+                psd, layers_info, content_hash, temp_dir,
+                target_width, target_height, api_key,
+                on_upgrade=upgrade_output, result_file_id=file_id,
+                notify_rooms=await verified_requester_rooms(current_user, socket_id)
+            )
         
         logger.info("PSD自動縮放完成")
         
@@ -141,7 +404,10 @@ async def auto_resize_psd(
             "layers_count": len(layers_info),
             "output_url": f"/api/psd/resize/output/{file_id}",
             "metadata_url": f"/api/psd/resize/metadata/{file_id}",
-            "new_positions": new_positions
+            "new_positions": new_positions,
+            "plan_cached": plan_cached,
+            "plan_source": plan_source,
+            "upgrade_id": upgrade_id
         }
         
     except Exception as e:
@@ -149,17 +415,16 @@ async def auto_resize_psd(
         raise HTTPException(status_code=500, detail=f"PSD自動縮放失敗: {str(e)}")
     
     finally:
-        # 清理臨時文件
+        # 清理臨時文件（混合模式由後台升級任務負責清理）
         try:
-            import shutil
-            if 'temp_dir' in locals():
+            if 'temp_dir' in locals() and upgrade_id is None:
                 shutil.rmtree(temp_dir, ignore_errors=True)
         except Exception:
             pass
 
 
 @router.get("/output/{file_id}")
-async def get_resized_output(file_id: str):
+async def get_resized_output(request: Request, file_id: str):
     """
     獲取縮放後的輸出圖像
     
@@ -167,14 +432,20 @@ async def get_resized_output(file_id: str):
         file_id: 文件ID
     
     Returns:
-        縮放後的PNG圖像
+        縮放後的圖像（PNG，或按 Accept 頭協商的 WebP/AVIF）
     """
     png_path = os.path.join(PSD_DIR, f"{file_id}.png")
     
     if not os.path.exists(png_path):
         raise HTTPException(status_code=404, detail="輸出文件未找到")
     
-    return FileResponse(png_path, media_type="image/png")
+    # 按 Accept 頭協商 WebP/AVIF 替代版本
+    path, media_type = await run_in_threadpool(
+        image_encoder.negotiate, png_path, request.headers.get("accept")
+    )
+    response = FileResponse(path, media_type=media_type)
+    response.headers["Vary"] = "Accept"
+    return response
 
 
 @router.get("/metadata/{file_id}")
@@ -204,7 +475,10 @@ async def preview_resize(
     psd_file: UploadFile = File(...),
     target_width: int = Form(...),
     target_height: int = Form(...),
-    api_key: Optional[str] = Form(None)
+    api_key: Optional[str] = Form(None),
+    mode: str = Form("gemini"),
+    socket_id: Optional[str] = Form(None),
+    current_user: Optional[Dict[str, Any]] = Depends(get_current_user_optional)
 ):
     """
     預覽縮放效果（不保存文件，只返回調整方案）
@@ -214,10 +488,14 @@ async def preview_resize(
         target_width: 目標寬度
         target_height: 目標高度
         api_key: Gemini API密鑰
+        mode: gemini / local / hybrid
+        socket_id: 請求方的 socket.io 連接ID（可選，須為同一用戶的連接）
     
     Returns:
         縮放預覽信息
     """
+    _check_mode(mode)
+    upgrade_id = None
     try:
         # 驗證文件類型
         if not psd_file.filename.lower().endswith('.psd'):
@@ -227,29 +505,25 @@ async def preview_resize(
         temp_dir = tempfile.mkdtemp()
         psd_path = os.path.join(temp_dir, psd_file.filename)
         
-        with open(psd_path, "wb") as buffer:
-            content = await psd_file.read()
-            buffer.write(content)
+        upload = await stream_upload_to_file(psd_file, psd_path)
         
         # 提取圖層信息
-        psd, layers_info = get_psd_layers_info(psd_path)
+        psd, layers_info = await run_in_threadpool(get_psd_layers_info, psd_path)
         original_width = psd.width
         original_height = psd.height
         
-        # 生成檢測框圖像
-        detection_image_path = os.path.join(temp_dir, "detection.png")
-        draw_detection_boxes(psd, layers_info, detection_image_path)
-        
-        # 使用Gemini生成調整方案
-        service = GeminiPSDResizeService(api_key=api_key)
-        new_positions = await service.resize_psd_layers(
-            layers_info=layers_info,
-            detection_image_path=detection_image_path,
-            original_width=original_width,
-            original_height=original_height,
-            target_width=target_width,
-            target_height=target_height
+        # 生成調整方案（按模式使用Gemini/方案緩存/本地佈局引擎）
+        content_hash = psd_content_store.content_id_for(upload.sha256)
+        new_positions, plan_source = await _resolve_plan(
+            mode, psd, layers_info, content_hash,
+            target_width, target_height, api_key
         )
+        if plan_source == "local" and mode == "hybrid":
+            upgrade_id = _schedule_plan_upgrade(
+                psd, layers_info, content_hash, temp_dir,
+                target_width, target_height, api_key,
+                notify_rooms=await verified_requester_rooms(current_user, socket_id)
+            )
         
         # 生成預覽信息
         preview_info = {
@@ -266,7 +540,10 @@ async def preview_resize(
         
         return {
             "success": True,
-            "preview": preview_info
+            "preview": preview_info,
+            "plan_cached": plan_source == "gemini-cache",
+            "plan_source": plan_source,
+            "upgrade_id": upgrade_id
         }
         
     except Exception as e:
@@ -274,10 +551,9 @@ async def preview_resize(
         raise HTTPException(status_code=500, detail=f"預覽縮放失敗: {str(e)}")
     
     finally:
-        # 清理臨時文件
+        # 清理臨時文件（混合模式由後台升級任務負責清理）
         try:
-            import shutil
-            if 'temp_dir' in locals():
+            if 'temp_dir' in locals() and upgrade_id is None:
                 shutil.rmtree(temp_dir, ignore_errors=True)
         except Exception:
             pass
@@ -288,7 +564,10 @@ async def resize_psd_by_file_id(
     file_id: str = Form(...),
     target_width: int = Form(...),
     target_height: int = Form(...),
-    api_key: Optional[str] = Form(None)
+    api_key: Optional[str] = Form(None),
+    mode: str = Form("gemini"),
+    socket_id: Optional[str] = Form(None),
+    current_user: Optional[Dict[str, Any]] = Depends(get_current_user_optional)
 ):
     """
     通過file_id直接處理已上傳的PSD文件（無需前端下載）
@@ -300,10 +579,14 @@ async def resize_psd_by_file_id(
         target_width: 目標寬度
         target_height: 目標高度
         api_key: Gemini API密鑰（可選）
+        mode: gemini / local / hybrid
+        socket_id: 請求方的 socket.io 連接ID（可選，須為同一用戶的連接）
     
     Returns:
         縮放後的圖層信息和輸出文件URL
     """
+    _check_mode(mode)
+    upgrade_id = None
     try:
         # 檢查PSD文件是否存在
         psd_path = os.path.join(PSD_DIR, f'{file_id}.psd')
@@ -321,7 +604,7 @@ async def resize_psd_by_file_id(
         
         # 步驟1: 提取圖層信息
         logger.info("步驟1: 提取PSD圖層信息")
-        psd, layers_info = get_psd_layers_info(psd_path)
+        psd, layers_info = await run_in_threadpool(get_psd_layers_info, psd_path)
         original_width = psd.width
         original_height = psd.height
         
@@ -329,50 +612,31 @@ async def resize_psd_by_file_id(
         logger.info(f"目標尺寸: {target_width}x{target_height}")
         logger.info(f"圖層數量: {len(layers_info)}")
         
-        # 生成檢測框圖像
-        detection_image_path = os.path.join(temp_dir, "detection.png")
-        draw_detection_boxes(psd, layers_info, detection_image_path)
-        
-        # 步驟2: 使用Gemini生成新位置
-        logger.info("步驟2: 調用Gemini API生成新位置")
-        service = GeminiPSDResizeService(api_key=api_key)
-        
-        new_positions = await service.resize_psd_layers(
-            layers_info=layers_info,
-            detection_image_path=detection_image_path,
-            original_width=original_width,
-            original_height=original_height,
-            target_width=target_width,
-            target_height=target_height
-        )
+        content_hash = await _content_hash(file_id, psd_path)
+        raster_cache = _layer_raster_cache(psd, content_hash, file_id)
         
-        # 保存新位置信息
-        positions_file = os.path.join(temp_dir, "new_positions.json")
-        with open(positions_file, 'w', encoding='utf-8') as f:
-            json.dump(new_positions, f, ensure_ascii=False, indent=2)
+        # 步驟2: 生成新位置（按模式使用Gemini/方案緩存/本地佈局引擎，檢測框圖像復用已緩存的合成圖）
+        logger.info("步驟2: 生成圖層調整方案")
+        def base_image_loader() -> Image.Image:
+            return psd_composite_cache.get_image(file_id, psd)
         
-        # 步驟3: 重建PSD並渲染
-        logger.info("步驟3: 重建PSD並渲染")
-        output_png_path = os.path.join(temp_dir, "resized_output.png")
-        
-        result_image = resize_psd_with_new_positions(
-            psd_path,
-            positions_file,
-            output_png_path,
-            target_width,
-            target_height
+        new_positions, plan_source = await _resolve_plan(
+            mode, psd, layers_info, content_hash,
+            target_width, target_height, api_key,
+            base_image_loader=base_image_loader
         )
+        plan_cached = plan_source == "gemini-cache"
         
         # 生成文件ID
         import time
         result_file_id = f"resized_{int(time.time())}"
-        
-        # 移動文件到永久目錄
         final_png_path = os.path.join(PSD_DIR, f"{result_file_id}.png")
-        os.makedirs(PSD_DIR, exist_ok=True)
         
-        import shutil
-        shutil.move(output_png_path, final_png_path)
+        # 步驟3: 重建PSD並渲染
+        logger.info("步驟3: 重建PSD並渲染")
+        await run_in_threadpool(
+            _render_resized_png, psd_path, new_positions, temp_dir, target_width, target_height, final_png_path, raster_cache
+        )
         
         # 保存元數據
         metadata = {
@@ -382,12 +646,23 @@ async def resize_psd_by_file_id(
             "target_size": {"width": target_width, "height": target_height},
             "layers_count": len(layers_info),
             "new_positions": new_positions,
+            "plan_source": plan_source,
             "output_url": f"/api/psd/resize/output/{result_file_id}"
         }
+        _write_resize_metadata(result_file_id, metadata)
         
-        metadata_path = os.path.join(PSD_DIR, f"{result_file_id}_metadata.json")
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        if plan_source == "local" and mode == "hybrid":
+            def upgrade_output(gemini_positions: List[Dict[str, Any]]) -> None:
+                _render_resized_png(psd_path, gemini_positions, temp_dir, target_width, target_height, final_png_path, raster_cache)
+                _write_resize_metadata(result_file_id, {**metadata, "new_positions": gemini_positions, "plan_source": "gemini"})
+            
+            upgrade_id = _schedule_plan_upgrade(
+                psd, layers_info, content_hash, temp_dir,
+                target_width, target_height, api_key,
+                on_upgrade=upgrade_output, base_image_loader=base_image_loader,
+                result_file_id=result_file_id,
+                notify_rooms=await verified_requester_rooms(current_user, socket_id)
+            )
         
         logger.info(f"PSD自動縮放完成，文件大小: {file_size_mb:.2f} MB")
         
@@ -400,7 +675,10 @@ async def resize_psd_by_file_id(
             "layers_count": len(layers_info),
             "output_url": f"/api/psd/resize/output/{result_file_id}",
             "metadata_url": f"/api/psd/resize/metadata/{result_file_id}",
-            "new_positions": new_positions
+            "new_positions": new_positions,
+            "plan_cached": plan_cached,
+            "plan_source": plan_source,
+            "upgrade_id": upgrade_id
         }
         
     except HTTPException:
@@ -410,15 +688,389 @@ async def resize_psd_by_file_id(
         raise HTTPException(status_code=500, detail=f"PSD自動縮放失敗: {str(e)}")
     
     finally:
-        # 清理臨時文件
+        # 清理臨時文件（混合模式由後台升級任務負責清理）
         try:
-            import shutil
-            if 'temp_dir' in locals():
+            if 'temp_dir' in locals() and upgrade_id is None:
                 shutil.rmtree(temp_dir, ignore_errors=True)
         except Exception:
             pass
 
 
+def _parse_targets(targets: str) -> List[Tuple[int, int]]:
+    """解析目標尺寸列表，支持 [{"width": 300, "height": 250}, ...] 或 [[300, 250], ...]，重複尺寸只保留一個"""
+    try:
+        items = json.loads(targets)
+        sizes = []
+        for item in items:
+            if isinstance(item, dict):
+                width, height = int(item["width"]), int(item["height"])
+            else:
+                width, height = int(item[0]), int(item[1])
+            if width <= 0 or height <= 0:
+                raise ValueError(f"無效尺寸: {width}x{height}")
+            if (width, height) not in sizes:
+                sizes.append((width, height))
+    except (ValueError, TypeError, KeyError, IndexError) as e:
+        raise HTTPException(status_code=400, detail=f"目標尺寸列表格式錯誤: {e}")
+    
+    if not sizes:
+        raise HTTPException(status_code=400, detail="目標尺寸列表不能為空")
+    if len(sizes) > MAX_BATCH_TARGETS:
+        raise HTTPException(status_code=400, detail=f"一次最多處理 {MAX_BATCH_TARGETS} 個目標尺寸")
+    return sizes
+
+
+@router.post("/batch-resize-by-id")
+async def batch_resize_psd_by_file_id(
+    file_id: str = Form(...),
+    targets: str = Form(...),
+    api_key: Optional[str] = Form(None),
+    mode: str = Form("gemini")
+):
+    """
+    把已上傳的PSD一次縮放到多個目標尺寸
+    
+    PSD只解析一次，檢測框圖像只繪製一次，各尺寸的方案請求併發進行（受併發數限制），
+    渲染共用同一份圖層圖像緩存，每個圖層只合成一次。
+    
+    Args:
+        file_id: PSD文件ID
+        targets: 目標尺寸JSON列表，如 [{"width": 300, "height": 250}, {"width": 728, "height": 90}]
+        api_key: Gemini API密鑰（可選）
+        mode: gemini / local
+    
+    Returns:
+        批量結果清單，每個尺寸一項
+    """
+    if mode not in ("gemini", "local"):
+        raise HTTPException(status_code=400, detail=f"批量縮放不支持的模式: {mode}，可選: gemini, local")
+    sizes = _parse_targets(targets)
+    
+    psd_path = os.path.join(PSD_DIR, f'{file_id}.psd')
+    if not os.path.exists(psd_path):
+        raise HTTPException(status_code=404, detail=f"PSD文件未找到: {file_id}")
+    
+    temp_dir = tempfile.mkdtemp()
+    try:
+        import time
+        started = time.time()
+        batch_id = f"resized_batch_{uuid.uuid4().hex[:12]}"
+        logger.info(f"開始批量縮放: {file_id} -> {len(sizes)} 個尺寸")
+        
+        psd, layers_info = await run_in_threadpool(get_psd_layers_info, psd_path)
+        content_hash = await _content_hash(file_id, psd_path)
+        raster_cache = _layer_raster_cache(psd, content_hash, file_id)
+        
+        # 檢測框圖像與目標尺寸無關，首個未命中方案緩存的尺寸繪製後共用
+        detection: Dict[str, DetectionImage] = {}
+        detection_lock = asyncio.Lock()
+        
+        def draw_detection() -> DetectionImage:
+            with raster_cache.lock:
+                return render_detection_image(psd, planning_layers(layers_info, psd.width, psd.height),
+                                              base_image=psd_composite_cache.get_image(file_id, psd))
+        
+        async def get_detection_image() -> DetectionImage:
+            async with detection_lock:
+                if "image" not in detection:
+                    detection["image"] = await run_in_threadpool(draw_detection)
+            return detection["image"]
+        
+        plan_semaphore = asyncio.Semaphore(BATCH_PLAN_CONCURRENCY)
+        
+        async def process_target(target_width: int, target_height: int) -> Dict[str, Any]:
+            output_id = f"{batch_id}_{target_width}x{target_height}"
+            entry = {
+                "file_id": output_id,
+                "target_size": {"width": target_width, "height": target_height},
+            }
+            target_started = time.time()
+            try:
+                if mode == "local":
+                    new_positions = compute_local_layout(
+                        layers_info, psd.width, psd.height, target_width, target_height
+                    )
+                    plan_source = "local"
+                else:
+                    async with plan_semaphore:
+                        new_positions, cached = await _get_resize_plan(
+                            psd, layers_info, content_hash,
+                            target_width, target_height, api_key,
+                            detection_image_getter=get_detection_image
+                        )
+                    plan_source = "gemini-cache" if cached else "gemini"
+                
+                final_png_path = os.path.join(PSD_DIR, f"{output_id}.png")
+                await run_in_threadpool(
+                    _render_resized_png, psd_path, new_positions, temp_dir,
+                    target_width, target_height, final_png_path, raster_cache
+                )
+                _write_resize_metadata(output_id, {
+                    "file_id": output_id,
+                    "original_file_id": file_id,
+                    "batch_id": batch_id,
+                    "original_size": {"width": psd.width, "height": psd.height},
+                    "target_size": {"width": target_width, "height": target_height},
+                    "layers_count": len(layers_info),
+                    "new_positions": new_positions,
+                    "plan_source": plan_source,
+                    "output_url": f"/api/psd/resize/output/{output_id}"
+                })
+                entry.update({
+                    "success": True,
+                    "plan_source": plan_source,
+                    "output_url": f"/api/psd/resize/output/{output_id}",
+                    "metadata_url": f"/api/psd/resize/metadata/{output_id}",
+                })
+            except Exception as e:
+                logger.error(f"批量縮放 {target_width}x{target_height} 失敗: {e}")
+                entry.update({"success": False, "error": str(e)})
+            entry["elapsed_seconds"] = round(time.time() - target_started, 3)
+            return entry
+        
+        results = await asyncio.gather(*(process_target(w, h) for w, h in sizes))
+        
+        manifest = {
+            "success": any(item["success"] for item in results),
+            "batch_id": batch_id,
+            "original_file_id": file_id,
+            "original_size": {"width": psd.width, "height": psd.height},
+            "layers_count": len(layers_info),
+            "mode": mode,
+            "outputs": results,
+            "succeeded": sum(1 for item in results if item["success"]),
+            "failed": sum(1 for item in results if not item["success"]),
+            "elapsed_seconds": round(time.time() - started, 3),
+            "manifest_url": f"/api/psd/resize/metadata/{batch_id}"
+        }
+        _write_resize_metadata(batch_id, manifest)
+        logger.info(f"批量縮放完成: {manifest['succeeded']}/{len(sizes)} 成功，耗時 {manifest['elapsed_seconds']}s")
+        return manifest
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"批量縮放失敗: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"批量縮放失敗: {str(e)}")
+    
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+async def _run_resize_job(
+    job: ResizeJob,
+    psd_path: str,
+    temp_dir: str,
+    target_width: int,
+    target_height: int,
+    api_key: Optional[str],
+    mode: str,
+    source_file_id: Optional[str] = None,
+    original_filename: Optional[str] = None,
+    upload_sha256: Optional[str] = None
+) -> Dict[str, Any]:
+    """縮放任務流程，阻塞的解析和渲染都在線程池中執行，各階段結束時匯報進度"""
+    await job.report("parsing", 0.05)
+    psd, layers_info = await run_in_threadpool(get_psd_layers_info, psd_path)
+    
+    if upload_sha256:
+        content_hash = psd_content_store.content_id_for(upload_sha256)
+    else:
+        content_hash = await _content_hash(source_file_id, psd_path)
+    raster_cache = _layer_raster_cache(psd, content_hash, source_file_id)
+    
+    await job.report("planning", 0.2)
+    def load_base_image() -> Image.Image:
+        return psd_composite_cache.get_image(source_file_id, psd)
+    
+    base_image_loader = load_base_image if source_file_id else None
+    
+    # 流式方案：每個圖層的位置一確定就推送給前端，並在線程池中提前縮放該圖層；
+    # 整體後處理移動了已推送的圖層時會再次回調，以 correction 標記推送最終位置
+    prewarm_tasks: List[asyncio.Future] = []
+    placed_ids = set()
+    
+    async def on_layer(item: Dict[str, Any]) -> None:
+        job.check_cancelled()
+        correction = item.get('id') in placed_ids
+        placed_ids.add(item.get('id'))
+        prewarm_tasks.append(asyncio.ensure_future(
+            run_in_threadpool(_prewarm_layer, raster_cache, item, target_width, target_height)
+        ))
+        if not job.notify_rooms:
+            return
+        try:
+            await sio.emit('psd_resize_layer_placed', {
+                'job_id': job.job_id,
+                'layer': item,
+                'correction': correction,
+                'placed': len(placed_ids),
+                'total': len(layers_info),
+            }, room=job.notify_rooms)
+        except Exception as e:
+            logger.warning(f"推送圖層方案失敗: {e}")
+    
+    try:
+        new_positions, plan_source = await _resolve_plan(
+            mode, psd, layers_info, content_hash,
+            target_width, target_height, api_key,
+            base_image_loader=base_image_loader,
+            on_layer=on_layer
+        )
+        await job.report("rendering", 0.6)
+        if prewarm_tasks:
+            await asyncio.gather(*prewarm_tasks)
+    finally:
+        for task in prewarm_tasks:
+            task.cancel()
+    
+    result_file_id = f"resized_{job.job_id[:12]}"
+    final_png_path = os.path.join(PSD_DIR, f"{result_file_id}.png")
+    await run_in_threadpool(
+        _render_resized_png, psd_path, new_positions, temp_dir, target_width, target_height, final_png_path, raster_cache
+    )
+    
+    await job.report("saving", 0.95)
+    result = {
+        "file_id": result_file_id,
+        "original_size": {"width": psd.width, "height": psd.height},
+        "target_size": {"width": target_width, "height": target_height},
+        "layers_count": len(layers_info),
+        "plan_source": plan_source,
+        "output_url": f"/api/psd/resize/output/{result_file_id}",
+        "metadata_url": f"/api/psd/resize/metadata/{result_file_id}",
+    }
+    if source_file_id:
+        result["original_file_id"] = source_file_id
+    if original_filename:
+        result["original_filename"] = original_filename
+    _write_resize_metadata(result_file_id, {**result, "job_id": job.job_id, "new_positions": new_positions})
+    return result
+
+
+@router.post("/jobs")
+async def submit_resize_job(
+    target_width: int = Form(...),
+    target_height: int = Form(...),
+    file_id: Optional[str] = Form(None),
+    psd_file: Optional[UploadFile] = File(None),
+    api_key: Optional[str] = Form(None),
+    mode: str = Form("gemini"),
+    socket_id: Optional[str] = Form(None),
+    canvas_id: Optional[str] = Form(None),
+    current_user: Optional[Dict[str, Any]] = Depends(get_current_user_optional)
+):
+    """
+    提交異步縮放任務，立即返回 job_id
+    
+    進度通過 socket.io 的 'psd_resize_job' 事件推送給提交方，也可以輪詢 /jobs/{job_id}。
+    
+    Args:
+        target_width: 目標寬度
+        target_height: 目標高度
+        file_id: 已上傳的PSD文件ID（與 psd_file 二選一）
+        psd_file: PSD文件
+        api_key: Gemini API密鑰（可選）
+        mode: gemini / local
+        socket_id: 提交方的 socket.io 連接ID（可選，優先接收進度事件，須為同一用戶的連接）
+        canvas_id: 畫布ID（可選，沒有可用連接時推送給正在查看該畫布的客戶端，須有權訪問該畫布）
+    """
+    if mode not in ("gemini", "local"):
+        raise HTTPException(status_code=400, detail=f"縮放任務不支持的模式: {mode}，可選: gemini, local")
+    if target_width <= 0 or target_height <= 0:
+        raise HTTPException(status_code=400, detail="目標尺寸必須大於0")
+    if bool(file_id) == (psd_file is not None):
+        raise HTTPException(status_code=400, detail="請提供 file_id 或 psd_file 其中之一")
+    
+    temp_dir = tempfile.mkdtemp()
+    try:
+        upload_sha256 = None
+        if psd_file is not None:
+            if not psd_file.filename.lower().endswith('.psd'):
+                raise HTTPException(status_code=400, detail="只支持PSD文件格式")
+            psd_path = os.path.join(temp_dir, os.path.basename(psd_file.filename))
+            upload = await stream_upload_to_file(psd_file, psd_path)
+            upload_sha256 = upload.sha256
+        else:
+            psd_path = os.path.join(PSD_DIR, f'{file_id}.psd')
+            if not os.path.exists(psd_path):
+                raise HTTPException(status_code=404, detail=f"PSD文件未找到: {file_id}")
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    
+    params = {
+        "file_id": file_id,
+        "original_filename": psd_file.filename if psd_file is not None else None,
+        "target_size": {"width": target_width, "height": target_height},
+        "mode": mode,
+    }
+    notify_rooms = await verified_requester_rooms(current_user, socket_id, canvas_id)
+    job = await psd_resize_job_service.submit(
+        "auto-resize" if psd_file is not None else "resize-by-id",
+        params,
+        lambda job: _run_resize_job(
+            job, psd_path, temp_dir, target_width, target_height, api_key, mode,
+            source_file_id=file_id,
+            original_filename=params["original_filename"],
+            upload_sha256=upload_sha256
+        ),
+        cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True),
+        notify_rooms=notify_rooms
+    )
+    return {
+        "success": True,
+        "job_id": job.job_id,
+        "status": job.status,
+        "status_url": f"/api/psd/resize/jobs/{job.job_id}"
+    }
+
+
+@router.get("/jobs")
+async def list_resize_jobs(status: Optional[str] = None):
+    """列出縮放任務（最新的在前），可按狀態過濾"""
+    return {"jobs": psd_resize_job_service.list(status), "stats": psd_resize_job_service.get_stats()}
+
+
+@router.get("/jobs/{job_id}")
+async def get_resize_job(job_id: str):
+    """查詢縮放任務狀態和結果"""
+    job = psd_resize_job_service.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任務不存在或已過期")
+    return job.to_dict()
+
+
+@router.delete("/jobs/{job_id}")
+async def cancel_resize_job(job_id: str):
+    """取消排隊中或運行中的縮放任務"""
+    job = await psd_resize_job_service.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任務不存在或已過期")
+    return job.to_dict()
+
+
+@router.get("/plan-cache/stats")
+async def get_plan_cache_stats():
+    """縮放方案緩存的命中/未命中統計"""
+    return await run_in_threadpool(resize_plan_cache.get_stats)
+
+
+@router.get("/plan-upgrade/{upgrade_id}")
+async def get_plan_upgrade(upgrade_id: str):
+    """查詢混合模式下Gemini方案升級任務的狀態"""
+    state = _plan_upgrades.get(upgrade_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="升級任務不存在或已過期")
+    return state
+
+
+@router.get("/gemini-gateway/stats")
+async def get_gemini_gateway_stats():
+    """共享 Gemini 網關的調用、合併、重試和限流統計"""
+    return gemini_gateway.get_stats()
+
+
 @router.get("/health")
 async def health_check():
     """健康檢查端點"""
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Request
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.concurrency import run_in_threadpool
 from psd_tools import PSDImage
@@ -7,12 +7,18 @@ from io import BytesIO
 import os
 import json
 import uuid
-import numpy as np
 import asyncio
 from typing import List, Dict, Any, Optional
 from common import DEFAULT_PORT
 from tools.utils.image_canvas_utils import generate_file_id
 from services.config_service import FILES_DIR, SERVER_DIR
+from services.psd_layer_service import psd_layer_service, flatten_psd_layers, build_layer_info
+from services.psd_raster_engine import psd_raster_engine
+from services.psd_content_store import psd_content_store
+from services.psd_metadata_store import psd_metadata_store, LayerNotFoundError
+from services.psd_composite_cache import psd_composite_cache
+from utils.image_encoder import image_encoder
+from utils.upload_stream import stream_upload_to_file, open_psd_mmap
 from datetime import datetime
 
 router = APIRouter(prefix="/api/psd")
@@ -163,6 +169,28 @@ async def _create_psd_file_template(
         db.close()
 
 
+def _ingest_psd_content(content_id: str, upload_path: str, filename: str) -> None:
+    """把新内容归档为内容对象：解析图层树、生成缩略图，最后写入元数据作为完成标记"""
+    psd_path = os.path.join(PSD_DIR, f'{content_id}.psd')
+    os.replace(upload_path, psd_path)
+    
+    # 通过内存映射解析PSD文件
+    psd = open_psd_mmap(psd_path)
+    
+    # 只解析图层树，图层位图在首次请求时按需生成
+    layers_info = _parse_layers_tree(psd, content_id)
+    psd_layer_service.register_psd(content_id, psd)
+    
+    _generate_thumbnail(psd, content_id)
+    
+    psd_metadata_store.save_file(content_id, {
+        'width': psd.width,
+        'height': psd.height,
+        'layers': layers_info,
+        'original_filename': filename
+    })
+
+
 @router.post("/upload")
 async def upload_psd(file: UploadFile = File(...)):
     """
@@ -190,33 +218,28 @@ async def upload_psd(file: UploadFile = File(...)):
     file_id = generate_file_id()
     
     try:
-        # 读取文件内容
-        content = await file.read()
-        
-        # 保存原始PSD文件
-        psd_path = os.path.join(PSD_DIR, f'{file_id}.psd')
-        with open(psd_path, 'wb') as f:
-            f.write(content)
-        
-        # 解析PSD文件
-        psd = PSDImage.open(BytesIO(content))
-        width, height = psd.width, psd.height
-        
-        # 提取图层信息
-        layers_info = await run_in_threadpool(_extract_layers_info, psd, file_id)
-        
-        # 生成缩略图
-        thumbnail_url = await run_in_threadpool(_generate_thumbnail, psd, file_id)
+        # 分块流式保存原始PSD文件（同时计算内容哈希）
+        upload_path = os.path.join(PSD_DIR, f'{file_id}.upload')
+        upload = await stream_upload_to_file(file, upload_path)
+        print(f'📦 PSD已保存: {upload.size / (1024 * 1024):.2f} MB, sha256={upload.sha256[:16]}')
+        
+        # 按内容哈希去重：相同内容只解析一次，之后的上传只创建别名
+        content_id = psd_content_store.content_id_for(upload.sha256)
+        deduplicated = True
+        async with psd_content_store.ingest_lock(content_id):
+            if psd_content_store.has_content(content_id):
+                os.remove(upload_path)
+                print(f'♻️ 内容已存在，复用 {content_id}')
+            else:
+                deduplicated = False
+                await run_in_threadpool(_ingest_psd_content, content_id, upload_path, file.filename)
         
-        # 保存图层元数据
-        metadata_path = os.path.join(PSD_DIR, f'{file_id}_metadata.json')
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump({
-                'width': width,
-                'height': height,
-                'layers': layers_info,
-                'original_filename': file.filename
-            }, f, ensure_ascii=False, indent=2)
+        metadata = await run_in_threadpool(psd_content_store.create_alias, content_id, file_id, file.filename)
+        await run_in_threadpool(psd_composite_cache.share, content_id, file_id)
+        width, height = metadata['width'], metadata['height']
+        layers_info = metadata['layers']
+        thumbnail_exists = os.path.exists(os.path.join(PSD_DIR, f'{file_id}_thumbnail.png'))
+        thumbnail_url = f'/api/psd/thumbnail/{file_id}' if thumbnail_exists else ''
         
         # 自动创建PSD文件模板
         template_id = None
@@ -245,10 +268,14 @@ async def upload_psd(file: UploadFile = File(...)):
             'layers': layers_info,
             'thumbnail_url': f'/api/psd/thumbnail/{file_id}',
             'template_id': template_id,
-            'template_created': template_created
+            'template_created': template_created,
+            'deduplicated': deduplicated
         })
         
     except Exception as e:
+        upload_path = os.path.join(PSD_DIR, f'{file_id}.upload')
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
         print(f'❌ Error processing PSD: {e}')
         import traceback
         traceback.print_exc()
@@ -311,16 +338,13 @@ async def get_psd_composite(file_id: str):
         if not os.path.exists(psd_path):
             raise HTTPException(status_code=404, detail="PSD file not found")
         
-        # 加载PSD并合成
-        psd = PSDImage.open(psd_path)
-        merged_image = psd.composite()
+        # 合成图按原始文件的像素版本缓存，未命中时才调用 psd-tools
+        composite_path = await run_in_threadpool(psd_composite_cache.get_path, file_id)
         
-        # 保存合成图像
-        composite_path = os.path.join(PSD_DIR, f'{file_id}_composite.png')
-        merged_image.save(composite_path, format='PNG')
-        
-        return FileResponse(composite_path)
+        return FileResponse(composite_path, media_type='image/png')
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating composite: {str(e)}")
 
@@ -328,32 +352,57 @@ async def get_psd_composite(file_id: str):
 @router.get("/metadata/{file_id}")
 async def get_psd_metadata(file_id: str):
     """获取PSD文件的元数据"""
-    metadata_path = os.path.join(PSD_DIR, f'{file_id}_metadata.json')
-    if not os.path.exists(metadata_path):
+    metadata = await run_in_threadpool(psd_metadata_store.get_metadata, file_id)
+    if metadata is None:
         raise HTTPException(status_code=404, detail="PSD metadata not found")
-    
-    with open(metadata_path, 'r', encoding='utf-8') as f:
-        metadata = json.load(f)
     return JSONResponse(metadata)
 
 
+async def _negotiated_image_response(request: Request, png_path: str) -> FileResponse:
+    """按 Accept 头返回 PNG 或其 WebP/AVIF 替代版本"""
+    path, media_type = await run_in_threadpool(
+        image_encoder.negotiate, png_path, request.headers.get('accept')
+    )
+    response = FileResponse(path, media_type=media_type)
+    response.headers["Vary"] = "Accept"
+    return response
+
+
 @router.get("/layer/{file_id}/{layer_index}")
-async def get_layer_image(file_id: str, layer_index: int):
+async def get_layer_image(request: Request, file_id: str, layer_index: int):
     """
-    获取指定图层的图像
+    获取指定图层的图像（首次请求时按需栅格化并缓存）
     
     Args:
         file_id: PSD文件ID
         layer_index: 图层索引
     """
-    layer_path = os.path.join(PSD_DIR, f'{file_id}_layer_{layer_index}.png')
-    if not os.path.exists(layer_path):
+    layer_path = await run_in_threadpool(psd_layer_service.rasterize_layer, file_id, layer_index)
+    if not layer_path:
         raise HTTPException(status_code=404, detail="Layer image not found")
-    response = FileResponse(layer_path)
+    response = await _negotiated_image_response(request, layer_path)
     response.headers["Access-Control-Allow-Origin"] = "*"
     return response
 
 
+@router.get("/encoder_stats")
+async def get_encoder_stats():
+    """获取各图像格式的编码耗时与字节节省统计（进程池中的编码不计入）"""
+    return JSONResponse(image_encoder.get_stats())
+
+
+@router.get("/trim_stats/{file_id}")
+async def get_trim_stats(file_id: str):
+    """获取图层导出时的透明边裁剪统计（节省的字节数等）"""
+    stats_path = os.path.join(PSD_DIR, f'{file_id}_trim_stats.json')
+    if not os.path.exists(stats_path):
+        raise HTTPException(status_code=404, detail="Trim stats not found")
+    
+    with open(stats_path, 'r', encoding='utf-8') as f:
+        stats = json.load(f)
+    return JSONResponse(stats)
+
+
 @router.post("/update_layer/{file_id}/{layer_index}")
 async def update_layer(file_id: str, layer_index: int, file: UploadFile = File(...)):
     """
@@ -369,9 +418,11 @@ async def update_layer(file_id: str, layer_index: int, file: UploadFile = File(.
         content = await file.read()
         img = Image.open(BytesIO(content))
         
-        # 保存更新后的图层
+        # 保存更新后的图层（原子替换，不会改动与去重内容共享的硬链接文件）
         layer_path = os.path.join(PSD_DIR, f'{file_id}_layer_{layer_index}.png')
-        await run_in_threadpool(img.save, layer_path, format='PNG')
+        await run_in_threadpool(image_encoder.save_png, img, layer_path)
+        # 图层位图变化，使依赖图层状态版本的派生数据失效（合成图只来自原始PSD，不重新生成）
+        await run_in_threadpool(psd_metadata_store.bump_version, file_id)
         
         return JSONResponse({
             'success': True,
@@ -399,20 +450,20 @@ async def export_psd(file_id: str, format: str = "png"):
         if not os.path.exists(psd_path):
             raise HTTPException(status_code=404, detail="PSD file not found")
         
-        # 加载PSD并合成
-        psd = PSDImage.open(psd_path)
-        merged_image = psd.composite()
-        
         # 导出为指定格式
         export_id = generate_file_id()
         ext = format.lower()
         export_path = os.path.join(FILES_DIR, f'{export_id}.{ext}')
         
         if ext == 'jpg' or ext == 'jpeg':
+            merged_image = await run_in_threadpool(psd_composite_cache.get_image, file_id)
             merged_image = merged_image.convert('RGB')
             await run_in_threadpool(merged_image.save, export_path, format='JPEG', quality=95)
         else:
-            await run_in_threadpool(merged_image.save, export_path, format='PNG')
+            # PNG 直接复制缓存的合成图，无需重新编码
+            import shutil
+            composite_path = await run_in_threadpool(psd_composite_cache.get_path, file_id)
+            await run_in_threadpool(shutil.copyfile, composite_path, export_path)
         
         return JSONResponse({
             'export_id': f'{export_id}.{ext}',
@@ -423,276 +474,45 @@ async def export_psd(file_id: str, format: str = "png"):
         raise HTTPException(status_code=500, detail=f"Error exporting PSD: {str(e)}")
 
 
-def _composite_layer_with_transparency(layer) -> Optional[Image.Image]:
+def _parse_layers_tree(psd: PSDImage, file_id: str) -> List[Dict[str, Any]]:
     """
-    使用透明背景合成图层，确保保持PSD的原始透明度
-    """
-    try:
-        from PIL import Image
-        
-        # 获取图层尺寸
-        width = getattr(layer, 'width', 0)
-        height = getattr(layer, 'height', 0)
-        
-        if width <= 0 or height <= 0:
-            return None
-            
-        # 创建透明背景
-        transparent_bg = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-        
-        # 尝试多种合成方法
-        composed = None
-        
-        # 方法1: 直接合成
-        try:
-            composed = layer.composite()
-        except Exception as e:
-            print(f'⚠️ 直接合成失败: {e}')
-        
-        # 方法2: 如果直接合成失败，尝试使用透明背景
-        if composed is None:
-            try:
-                # 临时设置图层为可见
-                orig_visible = getattr(layer, 'visible', True)
-                if hasattr(layer, 'visible'):
-                    layer.visible = True
-                
-                # 在透明背景上合成
-                composed = layer.composite()
-                
-                # 恢复原始可见性
-                if hasattr(layer, 'visible'):
-                    layer.visible = orig_visible
-            except Exception as e:
-                print(f'⚠️ 透明背景合成失败: {e}')
-        
-        if composed is None:
-            return None
-            
-        # 确保合成结果是RGBA格式
-        if composed.mode != 'RGBA':
-            composed = composed.convert('RGBA')
-            
-        # 更精确的背景检测和移除
-        img_array = np.array(composed)
-        
-        if len(img_array.shape) == 3 and img_array.shape[2] == 4:
-            # RGBA图像
-            alpha_channel = img_array[:, :, 3]
-            rgb_channels = img_array[:, :, :3]
-            
-            # 检查是否为纯背景图层
-            # 1. 检查alpha通道是否全为255（完全不透明）
-            # 2. 检查RGB通道是否为纯色（白色、灰色等）
-            
-            if np.all(alpha_channel == 255):
-                # 检查是否为纯色背景
-                rgb_min = np.min(rgb_channels)
-                rgb_max = np.max(rgb_channels)
-                rgb_std = np.std(rgb_channels)
-                
-                # 如果RGB值变化很小（标准差小于10），认为是纯色背景
-                if rgb_std < 10:
-                    # 检查是否为白色或浅灰色背景
-                    if rgb_min > 240:  # 接近白色
-                        print(f'⚠️ 检测到白色/浅灰色背景，设为透明')
-                        return Image.new('RGBA', composed.size, (0, 0, 0, 0))
-                    elif rgb_min > 200:  # 浅灰色
-                        print(f'⚠️ 检测到浅灰色背景，设为透明')
-                        return Image.new('RGBA', composed.size, (0, 0, 0, 0))
-                
-                # 检查是否为特定灰色值（常见的PSD背景色）
-                gray_values = [128, 192, 224, 240]  # 常见的灰色值
-                for gray_val in gray_values:
-                    if np.all(np.abs(rgb_channels - gray_val) < 5):
-                        print(f'⚠️ 检测到灰色背景 (值: {gray_val})，设为透明')
-                        return Image.new('RGBA', composed.size, (0, 0, 0, 0))
-            
-            # 如果有透明度，检查是否大部分区域是透明的
-            transparent_pixels = np.sum(alpha_channel < 10)
-            total_pixels = alpha_channel.size
-            transparent_ratio = transparent_pixels / total_pixels
-            
-            if transparent_ratio > 0.8:  # 80%以上是透明的
-                print(f'⚠️ 图层 {transparent_ratio:.2%} 透明，可能为空图层')
-                return Image.new('RGBA', composed.size, (0, 0, 0, 0))
-            
-            return composed
-        else:
-            # 非RGBA图像，转换为RGBA
-            return composed.convert('RGBA')
-            
-    except Exception as e:
-        print(f'⚠️ 透明合成失败: {e}')
-        import traceback
-        traceback.print_exc()
-        return None
-
-
-def _extract_layers_info(psd: PSDImage, file_id: str) -> List[Dict[str, Any]]:
-    """
-    提取所有图层（含群組內子層、文字层）的信息並保存圖層圖像。
-    - 對所有非群組圖層輸出 image_url（含文字層轉為位圖）。
-    - 保留父子層關係（parent_index）。
+    只解析圖層樹和邊界框，不合成任何位圖。
+    - 有非零邊界框的圖層都給出 image_url，位圖在首次請求時由 psd_layer_service 按需生成。
+    - 索引順序與 psd_raster_engine 全量導出一致（先序深度優先）。
     """
     layers_info: List[Dict[str, Any]] = []
+    flat_layers = flatten_psd_layers(psd)
+    parent_of: Dict[int, Optional[int]] = {}
 
-    current_index = 0
-
-    def next_index() -> int:
-        nonlocal current_index
-        idx = current_index
-        current_index += 1
-        print(f'🔢 分配圖層索引: {idx}')
-        return idx
-
-    def process_layer_recursive(layer, parent_index: Optional[int] = None) -> int:
-        idx = next_index()
-        layer_name = getattr(layer, 'name', f'Layer {idx}')
+    for idx, layer in enumerate(flat_layers):
+        parent = getattr(layer, 'parent', None)
+        parent_index = parent_of.get(id(parent)) if parent is not None else None
+        parent_of[id(layer)] = idx
 
-        layer_type = 'group' if layer.is_group() else 'layer'
-        # 檢測文字層（psd-tools: layer.kind == 'type'）
-        if hasattr(layer, 'kind') and getattr(layer, 'kind', None) == 'type':
-            layer_type = 'text'
-
-        print(f'📋 處理圖層 {idx}: "{layer_name}" (類型: {layer_type}, 父層: {parent_index})')
-
-        layer_info: Dict[str, Any] = {
-            'index': idx,
-            'name': layer_name,
-            'visible': getattr(layer, 'visible', True),
-            'opacity': getattr(layer, 'opacity', 255),
-            'blend_mode': str(getattr(layer, 'blend_mode', 'normal')),
-            'left': getattr(layer, 'left', 0),
-            'top': getattr(layer, 'top', 0),
-            'width': getattr(layer, 'width', 0),
-            'height': getattr(layer, 'height', 0),
-            'parent_index': parent_index,
-            'type': layer_type,
-        }
-
-        # 文字層屬性（若存在）
-        if layer_type == 'text' and hasattr(layer, 'text_data'):
-            text_data = layer.text_data
-            layer_info.update({
-                'font_family': getattr(text_data, 'font_name', 'Arial'),
-                'font_size': getattr(text_data, 'font_size', 16),
-                'font_weight': getattr(text_data, 'font_weight', 'normal'),
-                'font_style': getattr(text_data, 'font_style', 'normal'),
-                'text_align': getattr(text_data, 'text_align', 'left'),
-                'text_color': getattr(text_data, 'text_color', '#000000'),
-                'text_content': getattr(text_data, 'text_content', ''),
-                'line_height': getattr(text_data, 'line_height', 1.2),
-                'letter_spacing': getattr(text_data, 'letter_spacing', 0),
-                'text_decoration': getattr(text_data, 'text_decoration', 'none'),
-            })
-
-        # 為所有圖層（包含群組）嘗試輸出合成位圖
-        try:
-            # 一律強制臨時可見以便輸出位圖（處理被隱藏的圖層）
-            orig_visible = getattr(layer, 'visible', True)
-            try:
-                if hasattr(layer, 'visible'):
-                    layer.visible = True  # type: ignore[attr-defined]
-            except Exception:
-                pass
-
-            # 使用专门的透明合成函数
-            composed = _composite_layer_with_transparency(layer)
-                
-            if composed is not None:
-                # 若原始寬高為 0（常見於群組），以合成圖像大小回填
-                if not layer_info['width'] or not layer_info['height']:
-                    w, h = composed.size
-                    layer_info['width'] = w
-                    layer_info['height'] = h
-
-                # 檢查圖像是否為空（全透明）
-                img_array = np.array(composed)
-                
-                # 檢查是否有非透明像素
-                has_content = False
-                if len(img_array.shape) == 3:  # RGB/RGBA
-                    if img_array.shape[2] == 4:  # RGBA
-                        # 檢查alpha通道，只考虑真正有内容的像素
-                        has_content = np.any(img_array[:, :, 3] > 10)  # 降低阈值，避免半透明像素被忽略
-                    else:  # RGB - 这种情况不应该出现，因为PSD图层应该有alpha通道
-                        # 如果只有RGB，检查是否有非白色像素
-                        has_content = not np.all(img_array == 255)
-                elif len(img_array.shape) == 2:  # Grayscale
-                    has_content = not np.all(img_array == 255)
-
-                if has_content:
-                    # 确保保存为PNG格式以保持透明度
-                    layer_path = os.path.join(PSD_DIR, f'{file_id}_layer_{idx}.png')
-                    
-                    # 如果图像没有alpha通道，转换为RGBA
-                    if composed.mode != 'RGBA':
-                        composed = composed.convert('RGBA')
-                    
-                    composed.save(layer_path, format='PNG')
-                    layer_info['image_url'] = f'/api/psd/layer/{file_id}/{idx}'
-                    print(f'✅ 成功生成圖層 {idx} ({getattr(layer, "name", "")}) 圖像: {composed.size}, 模式: {composed.mode}')
-                else:
-                    layer_info['image_url'] = None
-                    print(f'⚠️ 圖層 {idx} ({getattr(layer, "name", "")}) 為空圖像，跳過')
-            else:
-                layer_info['image_url'] = None
-                print(f'⚠️ 圖層 {idx} ({getattr(layer, "name", "")}) 無法合成，跳過')
-        except Exception as e:
-            print(f'❌ 生成圖層 {idx} ({getattr(layer, "name", "")}) 圖像失敗: {e}')
+        layer_info = build_layer_info(layer, idx, parent_index)
+        if layer_info['width'] and layer_info['height']:
+            layer_info['image_url'] = f'/api/psd/layer/{file_id}/{idx}'
+        else:
             layer_info['image_url'] = None
-        finally:
-            # 還原可見性
-            try:
-                if hasattr(layer, 'visible'):
-                    layer.visible = orig_visible  # type: ignore[attr-defined]
-            except Exception:
-                pass
-
         layers_info.append(layer_info)
 
-        # 遞迴處理群組
-        if layer.is_group():
-            try:
-                for child in layer:
-                    process_layer_recursive(child, parent_index=idx)
-            except Exception as e:
-                print(f'Warning: Failed to traverse group {idx}: {e}')
-
-        return idx
-
-    # 自頂向下遍歷所有最上層圖層
-    print(f'🎨 開始解析 PSD 文件，總圖層數: {len(list(psd))}')
-    try:
-        for i, top_layer in enumerate(psd):
-            print(f'🔄 處理頂層圖層 {i}: {getattr(top_layer, "name", f"Layer {i}")}')
-            process_layer_recursive(top_layer, parent_index=None)
-    except Exception as e:
-        print(f'❌ 遍歷 PSD 失敗: {e}')
-        import traceback
-        traceback.print_exc()
-
-    print(f'✅ PSD 解析完成，共提取 {len(layers_info)} 個圖層')
-    for layer in layers_info:
-        print(f'  - 圖層 {layer["index"]}: "{layer["name"]}" ({layer["type"]}) - 尺寸: {layer["width"]}x{layer["height"]} - 圖像: {bool(layer.get("image_url"))}')
-
+    print(f'✅ PSD 圖層樹解析完成，共 {len(layers_info)} 個圖層（位圖按需生成）')
     return layers_info
 
 
 def _generate_thumbnail(psd: PSDImage, file_id: str) -> str:
     """生成PSD缩略图"""
     try:
-        # 合成图像
-        composite = psd.composite()
+        # 合成图像（同时写入合成图缓存）
+        thumbnail = psd_composite_cache.get_image(file_id, psd)
         
         # 生成缩略图（最大400px）
-        thumbnail = composite.copy()
         thumbnail.thumbnail((400, 400), Image.Resampling.LANCZOS)
         
         # 保存缩略图
         thumbnail_path = os.path.join(PSD_DIR, f'{file_id}_thumbnail.png')
-        thumbnail.save(thumbnail_path, format='PNG')
+        image_encoder.save_png(thumbnail, thumbnail_path)
+        image_encoder.remove_variants(thumbnail_path)
         
         return f'/api/psd/thumbnail/{file_id}'
         
@@ -711,34 +531,16 @@ async def update_layer_order(file_id: str, layer_order: List[int]):
         layer_order: 新的图层顺序（图层索引列表）
     """
     try:
-        metadata_path = os.path.join(PSD_DIR, f'{file_id}_metadata.json')
-        if not os.path.exists(metadata_path):
-            raise HTTPException(status_code=404, detail="PSD metadata not found")
-        
-        # 读取现有元数据
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-        
-        # 重新排序图层
-        layers = metadata['layers']
-        ordered_layers = []
-        for index in layer_order:
-            layer = next((l for l in layers if l['index'] == index), None)
-            if layer:
-                ordered_layers.append(layer)
-        
-        # 更新元数据
-        metadata['layers'] = ordered_layers
-        
-        # 保存更新后的元数据
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        # 重新排序图层（只更新 position 列）
+        await run_in_threadpool(psd_metadata_store.reorder_layers, file_id, layer_order)
         
         return JSONResponse({
             'success': True,
             'message': 'Layer order updated successfully'
         })
         
+    except LayerNotFoundError:
+        raise HTTPException(status_code=404, detail="PSD metadata not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error updating layer order: {str(e)}")
 
@@ -753,48 +555,41 @@ async def duplicate_layer(file_id: str, layer_index: int):
         layer_index: 要复制的图层索引
     """
     try:
-        metadata_path = os.path.join(PSD_DIR, f'{file_id}_metadata.json')
-        if not os.path.exists(metadata_path):
+        if not await run_in_threadpool(psd_metadata_store.has_file, file_id):
             raise HTTPException(status_code=404, detail="PSD metadata not found")
         
-        # 读取现有元数据
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-        
         # 找到要复制的图层
-        original_layer = next((l for l in metadata['layers'] if l['index'] == layer_index), None)
+        original_layer = await run_in_threadpool(psd_metadata_store.get_layer, file_id, layer_index)
         if not original_layer:
             raise HTTPException(status_code=404, detail="Layer not found")
         
         # 创建新图层
-        new_layer_index = max([l['index'] for l in metadata['layers']]) + 1
+        new_layer_index = await run_in_threadpool(psd_metadata_store.allocate_layer_indices, file_id)
         new_layer = original_layer.copy()
         new_layer['index'] = new_layer_index
         new_layer['name'] = f"{original_layer['name']} 副本"
         new_layer['left'] = original_layer['left'] + 20
         new_layer['top'] = original_layer['top'] + 20
         
-        # 复制图层图像文件
-        original_layer_path = os.path.join(PSD_DIR, f'{file_id}_layer_{layer_index}.png')
+        # 复制图层图像文件（原图层可能尚未栅格化）
+        original_layer_path = await run_in_threadpool(psd_layer_service.rasterize_layer, file_id, layer_index)
         new_layer_path = os.path.join(PSD_DIR, f'{file_id}_layer_{new_layer_index}.png')
         
-        if os.path.exists(original_layer_path):
+        if original_layer_path:
             import shutil
             shutil.copy2(original_layer_path, new_layer_path)
             new_layer['image_url'] = f'http://localhost:{DEFAULT_PORT}/api/psd/layer/{file_id}/{new_layer_index}'
         
         # 添加新图层到元数据
-        metadata['layers'].append(new_layer)
-        
-        # 保存更新后的元数据
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        await run_in_threadpool(psd_metadata_store.append_layers, file_id, [new_layer])
         
         return JSONResponse({
             'success': True,
             'new_layer': new_layer
         })
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error duplicating layer: {str(e)}")
 
@@ -809,31 +604,19 @@ async def delete_layer(file_id: str, layer_index: int):
         layer_index: 要删除的图层索引
     """
     try:
-        metadata_path = os.path.join(PSD_DIR, f'{file_id}_metadata.json')
-        if not os.path.exists(metadata_path):
-            raise HTTPException(status_code=404, detail="PSD metadata not found")
-        
-        # 读取现有元数据
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-        
         # 删除图层
-        metadata['layers'] = [l for l in metadata['layers'] if l['index'] != layer_index]
+        await run_in_threadpool(psd_metadata_store.delete_layer, file_id, layer_index)
         
-        # 删除图层图像文件
-        layer_path = os.path.join(PSD_DIR, f'{file_id}_layer_{layer_index}.png')
-        if os.path.exists(layer_path):
-            os.remove(layer_path)
-        
-        # 保存更新后的元数据
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        # 删除图层图像文件，并标记为空图层以免按需栅格化时重新生成
+        await run_in_threadpool(psd_layer_service.discard_layer, file_id, layer_index)
         
         return JSONResponse({
             'success': True,
             'message': 'Layer deleted successfully'
         })
         
+    except LayerNotFoundError:
+        raise HTTPException(status_code=404, detail="PSD metadata not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting layer: {str(e)}")
 
@@ -853,41 +636,62 @@ async def update_layer_properties(
         properties: 要更新的属性字典
     """
     try:
-        metadata_path = os.path.join(PSD_DIR, f'{file_id}_metadata.json')
-        if not os.path.exists(metadata_path):
+        if not await run_in_threadpool(psd_metadata_store.has_file, file_id):
             raise HTTPException(status_code=404, detail="PSD metadata not found")
 
-        # 读取现有元数据
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-
-        # 找到要更新的图层
-        layer = next((l for l in metadata['layers'] if l['index'] == layer_index), None)
-        if not layer:
-            raise HTTPException(status_code=404, detail="Layer not found")
-
-        # 更新图层属性
-        for key, value in properties.items():
-            if key in layer:
-                layer[key] = value
-
-        # 保存更新后的元数据
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        # 只更新该图层所在的一行
+        await run_in_threadpool(psd_metadata_store.update_layer, file_id, layer_index, properties)
 
         return JSONResponse({"message": "Layer properties updated successfully"})
+    except LayerNotFoundError:
+        raise HTTPException(status_code=404, detail="Layer not found")
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to update layer properties: {str(e)}")
 
+@router.post("/layers_batch/{file_id}")
+async def batch_edit_layers(file_id: str, operations: List[Dict[str, Any]]):
+    """
+    在一个事务中批量编辑图层，任一操作失败则全部不生效
+    
+    Args:
+        file_id: PSD文件ID
+        operations: 操作列表，例如
+            [
+                {"op": "update", "index": 3, "properties": {"opacity": 128}},
+                {"op": "delete", "index": 5},
+                {"op": "reorder", "order": [0, 2, 1, 3]}
+            ]
+    """
+    try:
+        results = await run_in_threadpool(psd_metadata_store.apply_batch, file_id, operations)
+    except LayerNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid layer operation: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to apply layer operations: {str(e)}")
+    
+    # 事务提交后再删除被删图层的位图
+    for operation in operations:
+        if operation.get('op') == 'delete':
+            await run_in_threadpool(psd_layer_service.discard_layer, file_id, int(operation['index']))
+    
+    return JSONResponse({
+        'success': True,
+        'applied': len(operations),
+        'updated_layers': [result for result in results if result is not None]
+    })
+
+
 @router.get("/thumbnail/{file_id}")
-async def get_thumbnail(file_id: str):
+async def get_thumbnail(request: Request, file_id: str):
     """获取PSD缩略图"""
     thumbnail_path = os.path.join(PSD_DIR, f'{file_id}_thumbnail.png')
     if not os.path.exists(thumbnail_path):
         raise HTTPException(status_code=404, detail="Thumbnail not found")
-    return FileResponse(thumbnail_path)
+    return await _negotiated_image_response(request, thumbnail_path)
 
 
 @router.get("/template/{template_id}/layers")
@@ -917,13 +721,10 @@ async def get_psd_template_layers(template_id: str):
             raise HTTPException(status_code=404, detail="PSD file ID not found in template metadata")
         
         # 读取PSD元数据
-        metadata_path = os.path.join(PSD_DIR, f'{psd_file_id}_metadata.json')
-        if not os.path.exists(metadata_path):
+        metadata = await run_in_threadpool(psd_metadata_store.get_metadata, psd_file_id)
+        if metadata is None:
             raise HTTPException(status_code=404, detail="PSD metadata not found")
         
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-        
         return JSONResponse({
             "template_id": template_id,
             "template_name": template.name,
@@ -975,13 +776,10 @@ async def apply_psd_template(template_id: str, canvas_id: str = None):
             raise HTTPException(status_code=404, detail="PSD file ID not found in template metadata")
         
         # 读取PSD元数据
-        metadata_path = os.path.join(PSD_DIR, f'{psd_file_id}_metadata.json')
-        if not os.path.exists(metadata_path):
+        metadata = await run_in_threadpool(psd_metadata_store.get_metadata, psd_file_id)
+        if metadata is None:
             raise HTTPException(status_code=404, detail="PSD metadata not found")
         
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-        
         return JSONResponse({
             "success": True,
             "message": f"PSD模板 '{template.name}' 已应用到画布",
@@ -1250,8 +1048,8 @@ async def parse_psd_template(filename: str):
             psd = PSDImage.open(BytesIO(content))
             width, height = psd.width, psd.height
             
-            # 提取图层信息
-            layers_info = await run_in_threadpool(_extract_layers_info, psd, file_id)
+            # 提取图层信息（多进程并行栅格化所有图层）
+            layers_info = await psd_raster_engine.extract_layers_info(file_path, file_id)
             
             # 生成缩略图
             thumbnail_url = await run_in_threadpool(_generate_thumbnail, psd, file_id)
@@ -1315,22 +1113,11 @@ async def add_image_layer_to_psd(
     
     try:
         # 验证PSD文件是否存在
-        metadata_path = os.path.join(PSD_DIR, f'{file_id}_metadata.json')
-        if not os.path.exists(metadata_path):
+        if not await run_in_threadpool(psd_metadata_store.has_file, file_id):
             raise HTTPException(status_code=404, detail="PSD文件元数据未找到")
         
-        # 读取现有元数据
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-        
-        layers = metadata.get('layers', [])
-        
-        # 生成新图层索引，自动会读取并从psd元数据的最大索引开始
-        if layers:
-            max_index = max([layer['index'] for layer in layers])
-            new_layer_index = max_index + 1
-        else:
-            new_layer_index = 0
+        # 原子地分配新图层索引（从psd元数据的最大索引之后开始）
+        new_layer_index = await run_in_threadpool(psd_metadata_store.allocate_layer_indices, file_id)
         
         # 读取上传的图片
         content = await image.read()
@@ -1367,12 +1154,7 @@ async def add_image_layer_to_psd(
         }
         
         # 添加到图层列表
-        layers.append(new_layer)
-        metadata['layers'] = layers
-        
-        # 保存更新后的元数据
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        await run_in_threadpool(psd_metadata_store.append_layers, file_id, [new_layer])
         
         print(f'功添加图层: {layer_name} (索引: {new_layer_index})')
         
@@ -1429,22 +1211,11 @@ async def add_image_layers_batch_to_psd(
             raise HTTPException(status_code=400, detail="至少需要上传一张图片")
         
         # 验证PSD文件是否存在
-        metadata_path = os.path.join(PSD_DIR, f'{file_id}_metadata.json')
-        if not os.path.exists(metadata_path):
+        if not await run_in_threadpool(psd_metadata_store.has_file, file_id):
             raise HTTPException(status_code=404, detail="PSD文件元数据未找到")
         
-        # 读取现有元数据
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-        
-        layers = metadata.get('layers', [])
-        
-        # 生成起始图层索引
-        if layers:
-            max_index = max([layer['index'] for layer in layers])
-            start_index = max_index + 1
-        else:
-            start_index = 0
+        # 原子地分配一段连续的图层索引
+        start_index = await run_in_threadpool(psd_metadata_store.allocate_layer_indices, file_id, len(images))
         
         # 用于存储新图层信息
         new_layers = []
@@ -1528,13 +1299,8 @@ async def add_image_layers_batch_to_psd(
                 # 成功，添加到新图层列表
                 new_layers.append(result)
         
-        # 所有图片处理成功，更新元数据
-        layers.extend(new_layers)
-        metadata['layers'] = layers
-        
-        # 保存更新后的元数据
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        # 所有图片处理成功，在一个事务中写入元数据
+        await run_in_threadpool(psd_metadata_store.append_layers, file_id, new_layers)
         
         print(f'成功批量添加 {len(new_layers)} 个图层')
         
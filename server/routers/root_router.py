@@ -7,6 +7,7 @@ from models.tool_model import ToolInfoJson
 from services.tool_service import tool_service
 from services.config_service import config_service
 from services.db_service import db_service
+from services.message_writer import message_writer
 from utils.http_client import HttpClient
 # services
 from models.config_model import ModelInfo
@@ -139,6 +140,8 @@ async def list_chat_sessions(canvas_id: Optional[str] = None):
 
 @router.get("/chat_session/{session_id}")
 async def get_chat_session(session_id: str):
+    # 先写入该会话仍在缓冲区中的消息
+    await message_writer.flush(session_id)
     return JSONResponse(await db_service.get_chat_history(session_id))
 
 # 包含模板路由
@@ -1,15 +1,107 @@
 # routers/websocket_router.py
-from services.websocket_state import sio, add_connection, remove_connection
+from typing import Any, Dict, Optional
+
+from services.auth_service import auth_service
+from services.db_service import db_service
+from services.langgraph_service.message_sync import get_message_snapshot
+from services.websocket_service import can_access_canvas
+from services.websocket_state import (
+    sio, add_connection, remove_connection, get_connection, session_room, canvas_room
+)
+
+
+async def _authenticate(token: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not token:
+        return None
+    try:
+        return await auth_service.verify_token(token)
+    except Exception as e:
+        print(f"Socket auth failed: {e}")
+        return None
+
+
+async def _verified_session_canvas(user_info: Optional[Dict[str, Any]], session_id: str,
+                                   canvas_id: Optional[str]) -> Optional[str]:
+    """The canvas the session belongs to if the user may see it, otherwise None.
+    A session is visible to whoever may see the canvas it belongs to."""
+    try:
+        session_canvas_id = await db_service.get_session_canvas_id(session_id)
+    except Exception as e:
+        print(f"Failed to look up canvas of session {session_id}: {e}")
+        return None
+    if session_canvas_id is None:
+        # Not created yet (first message still in flight): only together with the canvas it is created on
+        return canvas_id
+    if canvas_id:
+        # canvas_id itself has already been checked
+        return canvas_id if session_canvas_id == canvas_id else None
+    return session_canvas_id if await can_access_canvas(user_info, session_canvas_id) else None
+
+
+async def _leave_rooms(sid: str, connection: Dict[str, Any]) -> None:
+    for room in connection.get('rooms', []):
+        await sio.leave_room(sid, room)
+    connection['rooms'] = []
+
+
+async def _subscribe(sid: str, session_id: Optional[str], canvas_id: Optional[str]) -> bool:
+    """Move the socket into the rooms of the session/canvas it is viewing (replacing previous ones).
+    A denied subscription leaves the socket in no room at all."""
+    connection = get_connection(sid)
+    if connection is None:
+        return False
+    user_info = connection.get('user')
+    allowed = bool(session_id or canvas_id)
+    if allowed and canvas_id:
+        allowed = await can_access_canvas(user_info, canvas_id)
+    session_canvas_id = None
+    if allowed and session_id:
+        session_canvas_id = await _verified_session_canvas(user_info, session_id, canvas_id)
+        allowed = session_canvas_id is not None
+    if not allowed:
+        print(f"Client {sid} denied access to session {session_id} / canvas {canvas_id}")
+        await _leave_rooms(sid, connection)
+        return False
+
+    rooms = []
+    if session_id:
+        rooms.append(session_room(session_id))
+    if canvas_id:
+        rooms.append(canvas_room(canvas_id))
+    if rooms == connection.get('rooms'):
+        return True
+
+    await _leave_rooms(sid, connection)
+    for room in rooms:
+        await sio.enter_room(sid, room)
+    connection['rooms'] = rooms
+
+    # Streams only send message diffs; a (re)subscribing client gets one full snapshot, and only
+    # once it has been verified against the canvas the streaming session actually belongs to
+    snapshot = get_message_snapshot(session_id, session_canvas_id) if session_id else None
+    if snapshot is not None:
+        await sio.emit('session_update', {'canvas_id': canvas_id, 'session_id': session_id, **snapshot}, room=sid)
+    return True
+
 
 @sio.event
 async def connect(sid, environ, auth):
     print(f"Client {sid} connected")
-    
-    user_info = auth or {}
-    add_connection(sid, user_info)
-    
+
+    auth = auth or {}
+    add_connection(sid, {'user': await _authenticate(auth.get('token')), 'rooms': []})
+    session_id, canvas_id = auth.get('session_id'), auth.get('canvas_id')
+    if session_id or canvas_id:
+        await _subscribe(sid, session_id, canvas_id)
+
     await sio.emit('connected', {'status': 'connected'}, room=sid)
 
+@sio.event
+async def subscribe(sid, data):
+    data = data or {}
+    ok = await _subscribe(sid, data.get('session_id'), data.get('canvas_id'))
+    return {'ok': ok}
+
 @sio.event
 async def disconnect(sid):
     print(f"Client {sid} disconnected")
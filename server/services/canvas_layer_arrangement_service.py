@@ -5,15 +5,19 @@
 """
 
 import base64
+import hashlib
 import json
 import os
 import re
 from pathlib import Path
-from typing import Dict, List, Any, Optional
-from google import genai
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Any, Optional, Tuple
+import numpy as np
 import logging
 
 from services.config_service import config_service
+from services.gemini_gateway import gemini_gateway
+from utils.incremental_json import IncrementalJSONArrayParser
+from utils.layout_geometry import fit_boxes, match_by_id, resolve_overlaps, xywh_to_boxes
 
 import logging
 import os
@@ -248,6 +252,29 @@ class CanvasLayerArrangementService:
         
         return "\n".join(lines)
     
+    def _build_request(self, prompt: str, temperature: float, max_tokens: int) -> Tuple[Any, List[Any], Any]:
+        """构建请求（复用网关中按密钥缓存的客户端），返回 (client, contents, config)"""
+        from google.genai import types
+        
+        client = gemini_gateway.get_client(api_key=self.api_key)
+        
+        # 构建内容
+        contents = [
+            types.Content(
+                role="user",
+                parts=[
+                    types.Part.from_text(text=prompt)
+                ],
+            ),
+        ]
+        
+        # 配置生成参数
+        generate_content_config = types.GenerateContentConfig(
+            temperature=temperature,
+            max_output_tokens=max_tokens,
+        )
+        return client, contents, generate_content_config
+    
     async def call_gemini_api(self, 
                             prompt: str, 
                             temperature: float = 0.1,
@@ -264,36 +291,21 @@ class CanvasLayerArrangementService:
             API响应文本
         """
         try:
-            from google.genai import types
-            
-            # 创建客户端实例
-            client = genai.Client(api_key=self.api_key)
-            
-            # 构建内容
-            contents = [
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_text(text=prompt)
-                    ],
-                ),
-            ]
-            
-            # 配置生成参数
-            generate_content_config = types.GenerateContentConfig(
-                temperature=temperature,
-                max_output_tokens=max_tokens,
-            )
-            
-            # 生成内容（非流式）
-            response_text = ""
-            for chunk in client.models.generate_content_stream(
+            client, contents, generate_content_config = self._build_request(prompt, temperature, max_tokens)
+            
+            # 生成内容（非流式，经网关异步调用，限流/合并相同请求/重试由网关统一处理）
+            coalesce_key = 'canvas_arrange:' + hashlib.sha256(
+                f'{self.model}:{temperature}:{max_tokens}:{prompt}'.encode('utf-8')
+            ).hexdigest()
+            response = await gemini_gateway.generate_content(
+                'canvas_arrange',
+                client,
                 model=self.model,
                 contents=contents,
                 config=generate_content_config,
-            ):
-                if hasattr(chunk, 'text') and chunk.text:
-                    response_text += chunk.text
+                coalesce_key=coalesce_key
+            )
+            response_text = response.text or ""
             
             if not response_text:
                 raise ValueError("Gemini API返回的响应中没有文本内容")
@@ -305,6 +317,45 @@ class CanvasLayerArrangementService:
             logger.error(f"Gemini API调用失败: {e}", exc_info=True)
             raise
     
+    async def stream_gemini_api(self,
+                              prompt: str,
+                              on_item: Callable[[Dict[str, Any]], Awaitable[None]],
+                              temperature: float = 0.1,
+                              max_tokens: int = 32000) -> Tuple[str, List[Dict[str, Any]], bool]:
+        """
+        流式调用Gemini API，边接收边解析JSON数组，每完成一个元素就回调 on_item
+        
+        Returns:
+            (完整响应文本, 已解析的元素列表, 数组是否完整闭合且没有解析失败的元素)
+        """
+        client, contents, generate_content_config = self._build_request(prompt, temperature, max_tokens)
+        parser = IncrementalJSONArrayParser()
+        chunks: List[str] = []
+        items: List[Dict[str, Any]] = []
+        try:
+            stream: AsyncIterator[str] = gemini_gateway.stream_text(
+                'canvas_arrange',
+                client,
+                model=self.model,
+                contents=contents,
+                config=generate_content_config
+            )
+            async for text in stream:
+                chunks.append(text)
+                for item in parser.feed(text):
+                    if isinstance(item, dict):
+                        items.append(item)
+                        await on_item(item)
+        except Exception as e:
+            logger.error(f"Gemini API流式调用失败: {e}", exc_info=True)
+            raise
+        
+        response_text = ''.join(chunks)
+        if not response_text:
+            raise ValueError("Gemini API返回的响应中没有文本内容")
+        logger.info(f"Gemini API流式调用完成，响应长度: {len(response_text)}，流式解析 {len(items)} 个元素")
+        return response_text, items, parser.complete and parser.errors == 0
+    
     def parse_gemini_response(self, response_text: str) -> List[Dict[str, Any]]:
         """
         解析Gemini的JSON响应
@@ -359,7 +410,8 @@ class CanvasLayerArrangementService:
                                     canvas_width: int,
                                     canvas_height: int,
                                     target_width: int,
-                                    target_height: int) -> List[Dict[str, Any]]:
+                                    target_height: int,
+                                    on_item: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None) -> List[Dict[str, Any]]:
         """
         完整的画布元素排列流程
         
@@ -369,6 +421,8 @@ class CanvasLayerArrangementService:
             canvas_height: 当前画布高度
             target_width: 目标宽度
             target_height: 目标高度
+            on_item: 提供时使用流式响应，每解析出一个元素的方案就以前端格式回调（已约束在目标画布内）；
+                重叠检查移动了已推送的元素时，以最终位置再次回调该元素
             
         Returns:
             调整后的元素信息列表
@@ -397,19 +451,45 @@ class CanvasLayerArrangementService:
             logger.info("生成提示词完成，准备调用Gemini API")
             
             # 调用Gemini API
-            response_text = await self.call_gemini_api(prompt)
+            complete = False
+            # 已推送元素的坐标，重叠检查后据此补发位置有变化的元素
+            pushed_coords: Dict[str, Dict[str, Any]] = {}
+            if on_item is not None:
+                async def push_item(item: Dict[str, Any]) -> None:
+                    for converted in self._convert_arrangements_format([item], selected_elements):
+                        pushed_coords[converted['id']] = dict(converted['new_coords'])
+                        await on_item(converted)
+                
+                response_text, streamed, complete = await self.stream_gemini_api(prompt, push_item)
+            else:
+                response_text = await self.call_gemini_api(prompt)
             
             logger.info("Gemini API调用完成，准备解析响应")
             logger.debug(f"Gemini API响应内容: {response_text[:50]}...")
             
-            # 解析响应
-            arrangements = self.parse_gemini_response(response_text)
+            # 解析响应（流式解析完整时直接使用，否则回退到整体解析并补发尚未回调的元素）
+            if complete:
+                arrangements = streamed
+            else:
+                arrangements = self.parse_gemini_response(response_text)
+                if on_item is not None:
+                    pushed = {str(item.get('id', '')).strip() for item in streamed}
+                    for item in arrangements:
+                        if isinstance(item, dict) and str(item.get('id', '')).strip() not in pushed:
+                            await push_item(item)
             
             logger.info(f"成功生成 {len(arrangements)} 个元素的调整方案")
             
             # 转换格式：将 left/top/right/bottom 转换为 x/y/width/height
             # 并确保 id 是字符串格式，匹配前端期望
             converted_arrangements = self._convert_arrangements_format(arrangements, selected_elements)
+            # 模型声称的重叠检查不可靠，转换后用空间索引实际检查一遍
+            self._resolve_overlaps(converted_arrangements, target_width, target_height)
+            if on_item is not None:
+                for arr in converted_arrangements:
+                    coords = pushed_coords.get(arr['id'])
+                    if coords is not None and coords != arr['new_coords']:
+                        await on_item(arr)
             
             logger.info(f"转换后的排列方案数量: {len(converted_arrangements)}")
             if converted_arrangements:
@@ -483,191 +563,111 @@ class CanvasLayerArrangementService:
         Returns:
             转换后的排列方案列表，格式为前端期望的 x/y/width/height
         """
-        converted = []
+        # 按 id 字典匹配原始元素（精确匹配，其次是规范化后唯一的匹配）
+        matched, unmatched = match_by_id(
+            [arr for arr in arrangements if isinstance(arr, dict)], original_elements
+        )
+        for arr in unmatched:
+            logger.warning(f"找不到对应的原始元素，id={arr.get('id')}。可用的原始元素ID: {[str(e.get('id', '')) for e in original_elements]}")
         
-        # 创建原始元素的 id 映射，以便匹配
-        element_id_map = {str(elem.get('id')): elem for elem in original_elements}
-        
-        for arr in arrangements:
+        rows = []
+        for arr, original_element in matched:
+            new_coords_data = arr.get('new_coords') or {}
             try:
-                # 获取 id（可能是数字或字符串）
-                arr_id = str(arr.get('id', '')).strip()
-                
-                # 查找原始元素以获取正确的 id 格式
-                # 首先尝试精确匹配
-                original_element = None
-                for elem in original_elements:
-                    elem_id = str(elem.get('id', '')).strip()
-                    if elem_id == arr_id:
-                        original_element = elem
-                        break
-                
-                # 如果精确匹配失败，尝试部分匹配（用于处理ID格式差异）
-                if not original_element:
-                    for elem in original_elements:
-                        elem_id = str(elem.get('id', '')).strip()
-                        # 如果arr_id是elem_id的后缀或包含关系，也认为匹配
-                        if arr_id in elem_id or elem_id in arr_id:
-                            logger.info(f"使用部分匹配找到元素: arr_id={arr_id}, elem_id={elem_id}")
-                            original_element = elem
-                            break
-                
-                if not original_element:
-                    logger.warning(f"找不到对应的原始元素，id={arr_id}。可用的原始元素ID: {[str(e.get('id', '')) for e in original_elements]}")
-                    continue
-                
-                # 获取原始坐标（前端发送的格式）
-                original_coords = {
-                    'x': original_element.get('x', 0),
-                    'y': original_element.get('y', 0),
-                    'width': abs(original_element.get('width', 0)),
-                    'height': abs(original_element.get('height', 0))
-                }
-                
-                # 转换新坐标
-                new_coords_data = arr.get('new_coords', {})
-                new_coords = {}
-                
                 # 检查是否是 left/top/right/bottom 格式
                 if 'left' in new_coords_data and 'top' in new_coords_data:
-                    # 转换 left/top/right/bottom 为 x/y/width/height
                     left = float(new_coords_data.get('left', 0))
                     top = float(new_coords_data.get('top', 0))
                     right = float(new_coords_data.get('right', 0))
                     bottom = float(new_coords_data.get('bottom', 0))
-                    
-                    new_coords = {
-                        'x': left,
-                        'y': top,
-                        'width': abs(right - left),
-                        'height': abs(bottom - top)
-                    }
+                    rect = (left, top, abs(right - left), abs(bottom - top))
                 elif 'x' in new_coords_data and 'y' in new_coords_data:
                     # 已经是 x/y/width/height 格式
-                    new_coords = {
-                        'x': float(new_coords_data.get('x', 0)),
-                        'y': float(new_coords_data.get('y', 0)),
-                        'width': abs(float(new_coords_data.get('width', 0))),
-                        'height': abs(float(new_coords_data.get('height', 0)))
-                    }
+                    rect = (float(new_coords_data.get('x', 0)),
+                            float(new_coords_data.get('y', 0)),
+                            abs(float(new_coords_data.get('width', 0))),
+                            abs(float(new_coords_data.get('height', 0))))
                 else:
                     logger.warning(f"无法识别的坐标格式: {new_coords_data}")
                     continue
-                
-                # 验证新坐标是否在目标画布范围内，并进行自动缩放调整
-                if hasattr(self, '_target_width') and hasattr(self, '_target_height'):
-                    target_width = self._target_width
-                    target_height = self._target_height
-                    
-                    current_width = new_coords.get('width', 0)
-                    current_height = new_coords.get('height', 0)
-                    current_x = new_coords.get('x', 0)
-                    current_y = new_coords.get('y', 0)
-                    
-                    needs_resize = False
-                    scale_factor = 1.0
-                    
-                    # 只有当宽度或高度大于0时才进行缩放计算，避免除以零
-                    if current_width > 0 and current_height > 0:
-                        # 检查是否需要缩放以适应目标画布
-                        if current_width > target_width or current_height > target_height:
-                            # 计算缩放因子：选择较小的缩放比例，以确保元素完全适应目标画布，并保持宽高比
-                            scale_w = target_width / current_width
-                            scale_h = target_height / current_height
-                            scale_factor = min(scale_w, scale_h)
-                            
-                            # 应用缩放
-                            new_coords['width'] = current_width * scale_factor
-                            new_coords['height'] = current_height * scale_factor
-                            needs_resize = True
-                            
-                            logger.info(f"📏 元素 {arr_id} 尺寸超出目标画布 ({current_width:.2f}x{current_height:.2f})，已按比例缩放至 {new_coords['width']:.2f}x{new_coords['height']:.2f} (缩放因子: {scale_factor:.3f})")
-                        
-                        # 首先确保坐标不为负数（必须在边界检查之前）
-                        if new_coords.get('x', 0) < 0:
-                            new_coords['x'] = 0
-                            logger.info(f"📍 元素 {arr_id} X坐标小于0，已调整为0: {current_x:.2f} -> 0")
-                        
-                        if new_coords.get('y', 0) < 0:
-                            new_coords['y'] = 0
-                            logger.info(f"📍 元素 {arr_id} Y坐标小于0，已调整为0: {current_y:.2f} -> 0")
-                        
-                        # 检查边界并调整位置（使用调整后的坐标和尺寸）
-                        right_edge = new_coords.get('x', 0) + new_coords['width']
-                        bottom_edge = new_coords.get('y', 0) + new_coords['height']
-                        
-                        # 调整X坐标：如果右边界超出，向左移动
-                        if right_edge > target_width:
-                            new_x = max(0, target_width - new_coords['width'])
-                            logger.info(f"📍 元素 {arr_id} 右边界超出，X坐标已调整: {new_coords.get('x', 0):.2f} -> {new_x:.2f}")
-                            new_coords['x'] = new_x
-                        
-                        # 调整Y坐标：如果下边界超出，向上移动
-                        if bottom_edge > target_height:
-                            new_y = max(0, target_height - new_coords['height'])
-                            logger.info(f"📍 元素 {arr_id} 下边界超出，Y坐标已调整: {new_coords.get('y', 0):.2f} -> {new_y:.2f}")
-                            new_coords['y'] = new_y
-                        
-                        # 最终验证：确保尺寸不超出目标画布（双重保险）
-                        if new_coords['width'] > target_width:
-                            new_coords['width'] = target_width
-                            logger.warning(f"⚠️ 元素 {arr_id} 宽度仍超出目标画布，强制设置为 {target_width}")
-                        
-                        if new_coords['height'] > target_height:
-                            new_coords['height'] = target_height
-                            logger.warning(f"⚠️ 元素 {arr_id} 高度仍超出目标画布，强制设置为 {target_height}")
-                        
-                        # 最终验证：确保坐标在有效范围内
-                        if new_coords.get('x', 0) < 0:
-                            new_coords['x'] = 0
-                        if new_coords.get('y', 0) < 0:
-                            new_coords['y'] = 0
-                        if new_coords.get('x', 0) + new_coords['width'] > target_width:
-                            new_coords['x'] = max(0, target_width - new_coords['width'])
-                        if new_coords.get('y', 0) + new_coords['height'] > target_height:
-                            new_coords['y'] = max(0, target_height - new_coords['height'])
-                        
-                        # 更新warnings信息
-                        if needs_resize:
-                            warnings = arr.get('warnings', [])
-                            warnings.append(f"元素尺寸超出目标画布 ({current_width:.2f}x{current_height:.2f})，已自动按比例缩放至 {new_coords['width']:.2f}x{new_coords['height']:.2f}")
-                            arr['warnings'] = warnings
-                    else:
-                        logger.warning(f"⚠️ 元素 {arr_id} 的新尺寸无效 (width: {current_width}, height: {current_height})，无法进行缩放。")
-                        warnings = arr.get('warnings', [])
-                        warnings.append(f"元素的新尺寸无效 (width: {current_width}, height: {current_height})，无法进行缩放")
-                        arr['warnings'] = warnings
-                
-                # 构建转换后的排列方案
-                # 使用更新后的warnings（如果被修改过）
-                final_warnings = arr.get('warnings', [])
-                
-                # 确定最终的scale_factor
-                final_scale_factor = arr.get('scale_factor', 1.0)
-                if needs_resize and scale_factor != 1.0:
-                    # 如果进行了缩放，使用计算出的缩放因子
-                    final_scale_factor = scale_factor
-                
-                converted_arr = {
-                    'id': str(original_element.get('id')),  # 确保 id 是字符串
-                    'type': arr.get('type', original_element.get('type', 'unknown')),
-                    'original_coords': original_coords,
-                    'new_coords': new_coords,
-                    'scale_factor': final_scale_factor,
-                    'adjustment_reason': arr.get('adjustment_reason', ''),
-                    'quality_check': arr.get('quality_check', ''),
-                    'warnings': final_warnings
-                }
-                
-                logger.debug(f"✅ 成功转换元素 {arr_id}: new_coords={new_coords}")
-                converted.append(converted_arr)
-                
-            except Exception as e:
+            except (TypeError, ValueError, AttributeError) as e:
                 logger.error(f"转换排列方案格式失败: {e}, arrangement: {arr}")
                 continue
+            rows.append((arr, original_element, rect))
+        
+        if not rows:
+            return []
+        
+        # 一次性完成所有元素的等比例缩小和边界约束
+        boxes = xywh_to_boxes([rect for _, _, rect in rows])
+        scales = np.ones(len(rows))
+        valid = np.ones(len(rows), dtype=bool)
+        target_width = getattr(self, '_target_width', None)
+        target_height = getattr(self, '_target_height', None)
+        if target_width and target_height:
+            boxes, scales, valid = fit_boxes(boxes, target_width, target_height)
+        
+        converted = []
+        for (arr, original_element, rect), box, scale_factor, is_valid in zip(rows, boxes.tolist(), scales.tolist(), valid.tolist()):
+            arr_id = str(arr.get('id', '')).strip()
+            warnings = list(arr.get('warnings') or [])
+            new_coords = {'x': box[0], 'y': box[1], 'width': box[2] - box[0], 'height': box[3] - box[1]}
+            
+            if not is_valid:
+                logger.warning(f"⚠️ 元素 {arr_id} 的新尺寸无效 (width: {rect[2]}, height: {rect[3]})，无法进行缩放。")
+                warnings.append(f"元素的新尺寸无效 (width: {rect[2]}, height: {rect[3]})，无法进行缩放")
+            elif scale_factor < 1.0:
+                logger.info(f"📏 元素 {arr_id} 尺寸超出目标画布 ({rect[2]:.2f}x{rect[3]:.2f})，已按比例缩放至 {new_coords['width']:.2f}x{new_coords['height']:.2f} (缩放因子: {scale_factor:.3f})")
+                warnings.append(f"元素尺寸超出目标画布 ({rect[2]:.2f}x{rect[3]:.2f})，已自动按比例缩放至 {new_coords['width']:.2f}x{new_coords['height']:.2f}")
+            if is_valid and (box[0] != rect[0] or box[1] != rect[1]):
+                logger.info(f"📍 元素 {arr_id} 超出画布边界，位置已调整: ({rect[0]:.2f}, {rect[1]:.2f}) -> ({box[0]:.2f}, {box[1]:.2f})")
+            
+            converted_arr = {
+                'id': str(original_element.get('id')),  # 确保 id 是字符串
+                'type': arr.get('type', original_element.get('type', 'unknown')),
+                'original_coords': {
+                    'x': original_element.get('x', 0),
+                    'y': original_element.get('y', 0),
+                    'width': abs(original_element.get('width', 0)),
+                    'height': abs(original_element.get('height', 0))
+                },
+                'new_coords': new_coords,
+                # 进行了缩放时使用计算出的缩放因子
+                'scale_factor': scale_factor if scale_factor != 1.0 else arr.get('scale_factor', 1.0),
+                'adjustment_reason': arr.get('adjustment_reason', ''),
+                'quality_check': arr.get('quality_check', ''),
+                'warnings': warnings
+            }
+            
+            logger.debug(f"✅ 成功转换元素 {arr_id}: new_coords={new_coords}")
+            converted.append(converted_arr)
         
         return converted
     
+    def _resolve_overlaps(self, arrangements: List[Dict[str, Any]], target_width: int, target_height: int) -> None:
+        """
+        检查模型方案中的重叠：原本不重叠、排列后重叠的元素，按优先级（文字优先、面积大的优先）推开
+        
+        直接修改 arrangements 中的 new_coords
+        """
+        if len(arrangements) < 2:
+            return
+        original = xywh_to_boxes([[arr['original_coords'][k] for k in ('x', 'y', 'width', 'height')] for arr in arrangements])
+        boxes = xywh_to_boxes([[arr['new_coords'][k] for k in ('x', 'y', 'width', 'height')] for arr in arrangements])
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        order = sorted(range(len(arrangements)),
+                       key=lambda i: (arrangements[i].get('type') != 'text', -areas[i]))
+        resolved, moved, unresolved = resolve_overlaps(original, boxes, target_width, target_height, order=order)
+        
+        for i in moved:
+            box = resolved[i].tolist()
+            arrangements[i]['new_coords'].update({'x': box[0], 'y': box[1]})
+            arrangements[i]['warnings'].append('与其他元素重叠，已移动避免重叠')
+        for i in unresolved:
+            arrangements[i]['warnings'].append('无法完全避免与其他元素重叠')
+        if moved or unresolved:
+            logger.info(f"重叠检查: 移动 {len(moved)} 个元素，{len(unresolved)} 个元素无法避免重叠")
+    
     def _clean_element_data(self, elements: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
         清理和验证元素数据，确保坐标和尺寸有效
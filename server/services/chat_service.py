@@ -8,6 +8,7 @@ from typing import Dict, Any, List, Optional
 # Import service modules
 from models.tool_model import ToolInfoJson
 from services.db_service import db_service
+from services.message_writer import message_writer
 from services.langgraph_service import langgraph_multi_agent
 from services.websocket_service import send_to_websocket
 from services.stream_service import add_stream_task, remove_stream_task
@@ -87,7 +88,8 @@ async def handle_chat(data: Dict[str, Any]) -> None:
         # TODO: Better way to determin when to create new chat session.
         await db_service.create_chat_session(session_id, text_model.get('model'), text_model.get('provider'), canvas_id, (prompt[:200] if isinstance(prompt, str) else ''))
 
-    await db_service.create_message(session_id, messages[-1].get('role', 'user'), json.dumps(messages[-1])) if len(messages) > 0 else None
+    if len(messages) > 0:
+        message_writer.enqueue(session_id, messages[-1].get('role', 'user'), json.dumps(messages[-1]))
 
     # Create and start langgraph_agent task for chat processing
     print(f'🚀 [启动任务] 开始 LangGraph 多智能体处理')
@@ -115,4 +117,6 @@ async def handle_chat(data: Dict[str, Any]) -> None:
         await send_to_websocket(session_id, {
             'type': 'done'
         })
+        # 本轮对话结束，写入缓冲的消息
+        await message_writer.flush(session_id)
         print('='*80)
@@ -1,6 +1,6 @@
 import json
 import os
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
 import asyncpg
 from .config_service import USER_DATA_DIR
@@ -148,6 +148,18 @@ class DatabaseService:
             logger.error(f"[DB] 查询画布所有者失败: canvas_id={canvas_id}, 错误: {str(e)}", exc_info=True)
             raise
 
+    async def get_session_canvas_id(self, session_id: str) -> Optional[str]:
+        """获取会话所属的画布ID（会话不存在时返回 None）"""
+        try:
+            return await self._fetchval("""
+                SELECT canvas_id
+                FROM chat_sessions
+                WHERE id = $1
+            """, session_id)
+        except Exception as e:
+            logger.error(f"[DB] 查询会话所属画布失败: session_id={session_id}, 错误: {str(e)}", exc_info=True)
+            raise
+
     async def create_chat_session(self, id: str, model: str, provider: str, canvas_id: str, title: Optional[str] = None):
         """保存新的聊天会话"""
         # 验证字段长度
@@ -174,6 +186,24 @@ class DatabaseService:
             VALUES ($1, $2, $3)
         """, session_id, role, message)
 
+    async def create_messages(self, rows: List[Tuple[str, str, str]]):
+        """批量保存聊天消息（在一个事务内 executemany，按给定顺序写入）
+
+        Args:
+            rows: [(session_id, role, message)]
+        """
+        if not rows:
+            return
+        await self._ensure_pool()
+        if not self.pool:
+            raise RuntimeError("資料庫連接池未初始化，請檢查 SUPABASE_DB_URL 配置")
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany("""
+                    INSERT INTO chat_messages (session_id, role, message)
+                    VALUES ($1, $2, $3)
+                """, rows)
+
     async def get_chat_history(self, session_id: str) -> List[Dict[str, Any]]:
         """Get chat history for a session"""
         rows = await self._fetch("""
@@ -0,0 +1,275 @@
+"""
+Gemini 调用网关
+
+PSD缩放、画布排列和图像生成共用的异步 Gemini 入口：
+- 按认证信息复用 genai.Client（使用 client.aio 异步接口，不阻塞事件循环）
+- 令牌桶限流，保证任意 60 秒内的请求数不超过配额（默认 15 RPM）
+- 相同请求合并：coalesce_key 相同且仍在进行中的调用共享同一个结果
+- 按调用方限制并发数，避免某一类任务占满配额
+- 统一的重试和退避（配额错误和临时性服务错误）
+- 流式文本输出（stream_text），收到第一段文本之前的失败同样会重试
+"""
+
+import asyncio
+import os
+import re
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+
+try:
+    from google import genai
+except ImportError:
+    # 仅安装旧版 google-generativeai 时，只能通过 call() 执行请求
+    genai = None
+
+# 每分钟请求配额（免费层为 15）
+DEFAULT_RPM = int(os.getenv('GEMINI_RPM', '15'))
+# 令牌桶容量（允许的突发请求数）
+DEFAULT_BURST = int(os.getenv('GEMINI_BURST', '5'))
+# 每个调用方的默认并发上限
+DEFAULT_CALLER_CONCURRENCY = int(os.getenv('GEMINI_CALLER_CONCURRENCY', '2'))
+DEFAULT_MAX_RETRIES = 3
+
+_TRANSIENT_PATTERN = re.compile(r'\b(500|502|503|504|UNAVAILABLE|INTERNAL|DEADLINE_EXCEEDED)\b')
+
+
+class GeminiQuotaError(Exception):
+    """重试后仍然超出 Gemini 配额"""
+
+
+def is_quota_error(error: Exception) -> bool:
+    message = str(error)
+    return (
+        '429' in message or
+        'RESOURCE_EXHAUSTED' in message or
+        'quota' in message.lower() or
+        'rate limit' in message.lower()
+    )
+
+
+def is_transient_error(error: Exception) -> bool:
+    message = str(error)
+    return (
+        isinstance(error, (asyncio.TimeoutError, ConnectionError)) or
+        _TRANSIENT_PATTERN.search(message) is not None
+    )
+
+
+class TokenBucket:
+    """
+    异步令牌桶
+
+    容量为 burst，补充速率为 (rpm - burst) / 60 个/秒，
+    因此任意 60 秒窗口内发出的请求数不超过 rpm。
+    """
+
+    def __init__(self, rpm: int = DEFAULT_RPM, burst: int = DEFAULT_BURST):
+        self.rpm = max(1, rpm)
+        self.capacity = max(1, min(burst, self.rpm))
+        self.rate = max(self.rpm - self.capacity, 1) / 60.0
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> float:
+        """获取一个令牌，返回等待的秒数"""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+
+class GeminiGateway:
+    """共享的异步 Gemini 调用网关"""
+
+    def __init__(self, rpm: int = DEFAULT_RPM, burst: int = DEFAULT_BURST,
+                 caller_concurrency: Optional[Dict[str, int]] = None):
+        self.rpm = rpm
+        self.burst = burst
+        self.caller_concurrency = caller_concurrency or {}
+        self._clients: Dict[Tuple[Any, ...], Any] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._semaphores: Dict[Tuple[int, str], asyncio.Semaphore] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._stats = {'calls': 0, 'coalesced': 0, 'retries': 0, 'failures': 0, 'throttle_wait_seconds': 0.0}
+        self._caller_active: Dict[str, int] = {}
+
+    # ---- 客户端池 ----
+
+    def get_client(self, api_key: Optional[str] = None, vertexai: bool = False,
+                   project: Optional[str] = None, location: Optional[str] = None) -> Any:
+        """按认证信息复用 genai.Client"""
+        if genai is None:
+            raise RuntimeError('未安装 google-genai SDK')
+        key = ('vertex', project, location) if vertexai else ('api_key', api_key)
+        client = self._clients.get(key)
+        if client is None:
+            if vertexai:
+                client = genai.Client(vertexai=True, project=project, location=location)
+            else:
+                client = genai.Client(api_key=api_key)
+            self._clients[key] = client
+        return client
+
+    # ---- 限流和并发 ----
+
+    def _loop_key(self) -> int:
+        # asyncio 原语绑定事件循环，按循环区分（测试或多循环场景）
+        return id(asyncio.get_running_loop())
+
+    def _bucket(self) -> TokenBucket:
+        loop_key = self._loop_key()
+        bucket = self._buckets.get(loop_key)
+        if bucket is None:
+            bucket = TokenBucket(self.rpm, self.burst)
+            self._buckets[loop_key] = bucket
+        return bucket
+
+    def _semaphore(self, caller: str) -> asyncio.Semaphore:
+        key = (self._loop_key(), caller)
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.caller_concurrency.get(caller, DEFAULT_CALLER_CONCURRENCY))
+            self._semaphores[key] = semaphore
+        return semaphore
+
+    # ---- 调用 ----
+
+    async def call(self, caller: str, request: Callable[[], Awaitable[Any]],
+                   coalesce_key: Optional[str] = None,
+                   max_retries: int = DEFAULT_MAX_RETRIES) -> Any:
+        """
+        通过网关执行一次 Gemini 请求
+
+        Args:
+            caller: 调用方名称（用于并发限制和统计）
+            request: 发起请求的协程函数，每次重试都会重新调用
+            coalesce_key: 请求合并键，相同键的并发调用共享结果
+            max_retries: 最大尝试次数
+        """
+        if coalesce_key is None:
+            return await self._call_with_retry(caller, request, max_retries)
+
+        task = self._inflight.get(coalesce_key)
+        if task is not None and not task.done():
+            self._stats['coalesced'] += 1
+            print(f'🔗 合并相同的 Gemini 请求 ({caller})')
+            return await asyncio.shield(task)
+
+        task = asyncio.ensure_future(self._call_with_retry(caller, request, max_retries))
+        self._inflight[coalesce_key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(coalesce_key, None))
+        return await asyncio.shield(task)
+
+    async def _acquire_slot(self, caller: str) -> None:
+        waited = await self._bucket().acquire()
+        if waited:
+            self._stats['throttle_wait_seconds'] += waited
+            print(f'⏳ Gemini 限流等待 {waited:.1f}s ({caller})')
+        self._stats['calls'] += 1
+
+    async def _backoff_or_raise(self, caller: str, error: Exception, attempt: int, max_retries: int) -> None:
+        """可重试的错误等待退避后返回，否则抛出（配额错误转换为 GeminiQuotaError）"""
+        quota = is_quota_error(error)
+        if (quota or is_transient_error(error)) and attempt < max_retries - 1:
+            # 指数退避重试
+            wait_time = (2 ** attempt) * 5  # 5秒, 10秒, 20秒...
+            self._stats['retries'] += 1
+            print(f'⚠️ Gemini 请求失败 ({caller})，{wait_time}秒后进行第{attempt + 2}次重试: {error}')
+            await asyncio.sleep(wait_time)
+            return
+
+        self._stats['failures'] += 1
+        if quota:
+            raise GeminiQuotaError(
+                f"Gemini API 配额已用尽。\n"
+                f"免费配额限制：每分钟 15 次，每天 1,500 次。\n"
+                f"解决方案：\n"
+                f"1. 等待一段时间后重试\n"
+                f"2. 访问 https://ai.dev/usage?tab=rate-limit 查看配额使用情况\n"
+                f"3. 考虑升级到付费计划以获得更高配额\n"
+                f"原始错误: {error}"
+            ) from error
+        raise error
+
+    async def _call_with_retry(self, caller: str, request: Callable[[], Awaitable[Any]],
+                               max_retries: int) -> Any:
+        async with self._semaphore(caller):
+            self._caller_active[caller] = self._caller_active.get(caller, 0) + 1
+            try:
+                for attempt in range(max_retries):
+                    await self._acquire_slot(caller)
+                    try:
+                        return await request()
+                    except Exception as e:
+                        await self._backoff_or_raise(caller, e, attempt, max_retries)
+            finally:
+                self._caller_active[caller] -= 1
+
+    async def stream_text(self, caller: str, client: Any, model: str,
+                          contents: Any, config: Any = None,
+                          max_retries: int = DEFAULT_MAX_RETRIES) -> AsyncIterator[str]:
+        """
+        流式调用 client.aio.models.generate_content_stream，逐段返回文本
+
+        流式请求不参与合并；已经输出文本后出错时直接抛出，避免调用方收到重复内容。
+        """
+        async with self._semaphore(caller):
+            self._caller_active[caller] = self._caller_active.get(caller, 0) + 1
+            try:
+                for attempt in range(max_retries):
+                    await self._acquire_slot(caller)
+                    started = False
+                    try:
+                        stream = await client.aio.models.generate_content_stream(
+                            model=model, contents=contents, config=config
+                        )
+                        async for chunk in stream:
+                            text = getattr(chunk, 'text', None)
+                            if text:
+                                started = True
+                                yield text
+                        return
+                    except Exception as e:
+                        if started:
+                            self._stats['failures'] += 1
+                            raise
+                        await self._backoff_or_raise(caller, e, attempt, max_retries)
+            finally:
+                self._caller_active[caller] -= 1
+
+    async def generate_content(self, caller: str, client: Any, model: str,
+                               contents: Any, config: Any = None,
+                               coalesce_key: Optional[str] = None,
+                               max_retries: int = DEFAULT_MAX_RETRIES) -> Any:
+        """异步调用 client.aio.models.generate_content"""
+        return await self.call(
+            caller,
+            lambda: client.aio.models.generate_content(model=model, contents=contents, config=config),
+            coalesce_key=coalesce_key,
+            max_retries=max_retries
+        )
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats['throttle_wait_seconds'] = round(stats['throttle_wait_seconds'], 2)
+        stats['rpm'] = self.rpm
+        stats['clients'] = len(self._clients)
+        stats['inflight'] = len(self._inflight)
+        stats['active_by_caller'] = {caller: n for caller, n in self._caller_active.items() if n}
+        return stats
+
+
+# 全局实例
+gemini_gateway = GeminiGateway()
@@ -4,22 +4,37 @@ Gemini PSD自動縮放服務
 整合Gemini 2.5 Pro API進行PSD圖層智能縮放
 """
 
-import base64
+import asyncio
+import hashlib
 import json
 import os
 import re
+import time
 from pathlib import Path
-from typing import Dict, List, Any, Optional
+from typing import Awaitable, Callable, Dict, List, Any, Optional, Tuple
 try:
     from google import genai
     from google.genai import types
 except ImportError:
     import google.generativeai as genai
     types = None
+import numpy as np
 import logging
 
+from services.gemini_gateway import gemini_gateway
+from utils.incremental_json import IncrementalJSONArrayParser
+from utils.layout_geometry import as_boxes, fit_boxes, match_by_id, resolve_overlaps
+from utils.psd_hierarchical_plan import UnitPlanExpander, select_plan_units, should_plan_hierarchically
+from utils.psd_layer_info import DetectionImage
+
 logger = logging.getLogger(__name__)
 
+_MIME_TYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.webp': 'image/webp'}
+
+# 流式模式下每解析出一個圖層方案就調用一次的協程函數。推送的坐標已做過單圖層的邊界約束；
+# 整體後處理（重疊檢查等）改變了已推送圖層的位置時，會以最終坐標再次回調該圖層
+LayerCallback = Callable[[Dict[str, Any]], Awaitable[None]]
+
 
 class GeminiPSDResizeService:
     """Gemini PSD自動縮放服務類"""
@@ -41,16 +56,19 @@ class GeminiPSDResizeService:
         
         # 初始化客户端
         try:
-            # 尝试使用新版 google-genai SDK
-            self.client = genai.Client(api_key=self.api_key)
+            # 尝试使用新版 google-genai SDK（客户端由网关按密钥复用）
+            self.client = gemini_gateway.get_client(api_key=self.api_key)
             self.use_new_sdk = True
             logger.info("使用 google-genai SDK (新版)")
-        except (AttributeError, TypeError):
+        except (AttributeError, TypeError, RuntimeError):
             # 回退到旧版 google-generativeai
             genai.configure(api_key=self.api_key)
             self.client = None
             self.use_new_sdk = False
             logger.info("使用 google-generativeai SDK (旧版)")
+        
+        # 最近一次API調用的圖像大小和耗時
+        self.last_call_stats: Optional[Dict[str, Any]] = None
     
     def _load_api_key_from_config(self) -> Optional[str]:
         """從配置文件加載API密鑰"""
@@ -88,7 +106,8 @@ class GeminiPSDResizeService:
                             original_width: int, 
                             original_height: int,
                             target_width: int, 
-                            target_height: int) -> str:
+                            target_height: int,
+                            detection_image: Optional[DetectionImage] = None) -> str:
         """
         生成Gemini API調用的完整提示詞
         
@@ -98,6 +117,7 @@ class GeminiPSDResizeService:
             original_height: 原始高度
             target_width: 目標寬度
             target_height: 目標高度
+            detection_image: 附帶的檢測框圖像（縮小時在提示詞中說明坐標換算）
             
         Returns:
             完整的提示詞字符串
@@ -106,6 +126,14 @@ class GeminiPSDResizeService:
         # 格式化圖層信息為表格
         layer_info_text = self._format_layers_info_table(layers_info)
         
+        detection_note = ""
+        if detection_image is not None and detection_image.scale < 1.0:
+            detection_note = (
+                f"\n> 附帶的檢測框圖像已按比例 {detection_image.scale:.4f} 縮小為 "
+                f"{detection_image.width}x{detection_image.height}，紅框標籤為圖層ID。"
+                f"輸出坐標一律使用上表中的原始PSD像素坐標系。\n"
+            )
+        
         prompt = f"""# PSD 圖層智能縮放任務
 
 ## 🎯 任務目標
@@ -115,7 +143,7 @@ class GeminiPSDResizeService:
 ```
 {layer_info_text}
 ```
-
+{detection_note}
 ## 🔧 縮放規則與策略
 
 ### 1. 核心原則
@@ -226,6 +254,64 @@ class GeminiPSDResizeService:
 
         return prompt
     
+    def generate_group_plan_prompt(self,
+                                   units: List[Dict[str, Any]],
+                                   descendant_counts: Dict[int, int],
+                                   total_layers: int,
+                                   original_width: int,
+                                   original_height: int,
+                                   target_width: int,
+                                   target_height: int,
+                                   detection_image: Optional[DetectionImage] = None) -> str:
+        """
+        生成分層方案的提示詞：只列出規劃單元，要求緊湊的輸出格式
+        
+        Args:
+            units: 規劃單元（頂層圖層和展開後的圖層組）
+            descendant_counts: 每個單元包含的子圖層數
+            total_layers: PSD中的圖層總數
+            
+        Returns:
+            完整的提示詞字符串
+        """
+        lines = [f"{'ID':<5} {'名稱':<30} {'類型':<12} {'子圖層':<7} {'位置(left,top,right,bottom)':<32}"]
+        for info in units:
+            position = f"({info['left']}, {info['top']}, {info['right']}, {info['bottom']})"
+            lines.append(f"{info['id']:<5} {info['name']:<30} {info['type']:<12} "
+                         f"{descendant_counts.get(info['id'], 0):<7} {position:<32}")
+        units_table = "\n".join(lines)
+        
+        detection_note = ""
+        if detection_image is not None and detection_image.scale < 1.0:
+            detection_note = (
+                f"\n> 附帶的檢測框圖像已按比例 {detection_image.scale:.4f} 縮小為 "
+                f"{detection_image.width}x{detection_image.height}，紅框標籤為單元ID。"
+                f"輸出坐標一律使用上表中的原始PSD像素坐標系。\n"
+            )
+        
+        return f"""# PSD 圖層智能縮放任務（按圖層組規劃）
+
+將 PSD 文件從 {original_width}x{original_height} 縮放至 {target_width}x{target_height}。
+文件共有 {total_layers} 個圖層，已歸併為下表 {len(units)} 個規劃單元。每個單元作為整體等比例縮放和移動，
+單元內的子圖層會自動跟隨，無需單獨規劃。
+
+## 規劃單元
+```
+{units_table}
+```
+{detection_note}
+## 規則
+- 每個單元保持原始寬高比，不得變形
+- 所有單元都在目標畫布 (0,0) 到 ({target_width},{target_height}) 範圍內
+- 覆蓋整個畫布的背景單元鋪滿目標畫布
+- 文字和產品單元完整可見，優先保證可讀性，彼此不要重疊
+- 保持原設計的視覺層次、對齊關係和邊距比例
+
+## 輸出格式
+只輸出JSON數組，每個單元一項，不要包含其他字段或說明文字：
+[{{"id": 單元ID, "box": [新left, 新top, 新right, 新bottom]}}]
+"""
+    
     def _format_layers_info_table(self, layers_info: List[Dict[str, Any]]) -> str:
         """格式化圖層信息為表格形式"""
         lines = []
@@ -250,105 +336,121 @@ class GeminiPSDResizeService:
     
     async def call_gemini_api(self, 
                             prompt: str, 
-                            image_base64: str,
+                            image_data: bytes,
+                            mime_type: str = 'image/png',
                             temperature: float = 0.1,
                             max_tokens: int = 32000,
                             max_retries: int = 3) -> str:
         """
-        調用Gemini API（带重试机制）
+        調用Gemini API（通過共享網關：異步、限流、合併相同請求、統一重試）
         
         Args:
             prompt: 提示詞
-            image_base64: 圖像的base64編碼
+            image_data: 已編碼的圖像字節（直接上傳，不經過base64和PIL）
+            mime_type: 圖像MIME類型
             temperature: 溫度參數
             max_tokens: 最大輸出token數
-            max_retries: 最大重试次数（针对配额错误）
+            max_retries: 最大嘗試次數（配額和臨時錯誤）
             
         Returns:
             API響應文本
         """
-        import time
-        import asyncio
+        # 相同模型、提示詞、圖像和參數的併發請求只發送一次
+        digest = hashlib.sha256()
+        for part in (self.model_name, prompt, mime_type, f'{temperature}:{max_tokens}'):
+            digest.update(part.encode('utf-8'))
+        digest.update(image_data)
+        coalesce_key = f'psd_resize:{digest.hexdigest()}'
         
-        for attempt in range(max_retries):
-            try:
-                import base64
-                from PIL import Image
-                from io import BytesIO
-                
-                # 準備圖像數據
-                image_data = base64.b64decode(image_base64)
-                image = Image.open(BytesIO(image_data))
-                
-                if self.use_new_sdk and self.client:
-                    # 使用新版 google-genai SDK
-                    logger.info("使用新版SDK調用Gemini API")
-                    
-                    response = self.client.models.generate_content(
-                        model=self.model_name,
-                        contents=[prompt, image],
-                        config=types.GenerateContentConfig(
-                            temperature=temperature,
-                            max_output_tokens=max_tokens,
-                            response_modalities=["Text"]
-                        )
-                    )
-                    
-                    # 提取响应文本
-                    return response.candidates[0].content.parts[0].text
-                else:
-                    # 使用旧版 google-generativeai SDK
-                    logger.info("使用旧版SDK調用Gemini API")
-                    
-                    model = genai.GenerativeModel(self.model_name)
-                    
-                    # 生成內容
-                    response = model.generate_content(
-                        [prompt, image],
-                        generation_config={
-                            "temperature": temperature,
-                            "max_output_tokens": max_tokens,
-                        }
-                    )
-                    
-                    return response.text
-                
-            except Exception as e:
-                error_str = str(e)
-                error_type = type(e).__name__
+        try:
+            if self.use_new_sdk and self.client:
+                # 使用新版 google-genai SDK 的異步接口
+                logger.info("使用新版SDK調用Gemini API")
                 
-                # 检查是否是配额错误
-                is_quota_error = (
-                    '429' in error_str or 
-                    'RESOURCE_EXHAUSTED' in error_str or
-                    'quota' in error_str.lower() or
-                    'rate limit' in error_str.lower()
+                response = await gemini_gateway.generate_content(
+                    'psd_resize',
+                    self.client,
+                    model=self.model_name,
+                    contents=[prompt, types.Part.from_bytes(data=image_data, mime_type=mime_type)],
+                    config=types.GenerateContentConfig(
+                        temperature=temperature,
+                        max_output_tokens=max_tokens,
+                        response_modalities=["Text"]
+                    ),
+                    coalesce_key=coalesce_key,
+                    max_retries=max_retries
                 )
                 
-                if is_quota_error and attempt < max_retries - 1:
-                    # 指数退避重试
-                    wait_time = (2 ** attempt) * 5  # 5秒, 10秒, 20秒...
-                    logger.warning(f"配额限制错误，{wait_time}秒后进行第{attempt + 2}次重试...")
-                    await asyncio.sleep(wait_time)
-                    continue
-                
-                # 记录详细错误信息
-                logger.error(f"Gemini API調用失敗: {e}")
-                logger.error(f"错误详情: {error_type}: {error_str}")
-                
-                # 提供更友好的错误消息
-                if is_quota_error:
-                    raise Exception(
-                        f"Gemini API 配额已用尽。\n"
-                        f"免费配额限制：每分钟 15 次，每天 1,500 次。\n"
-                        f"解决方案：\n"
-                        f"1. 等待一段时间后重试\n"
-                        f"2. 访问 https://ai.dev/usage?tab=rate-limit 查看配额使用情况\n"
-                        f"3. 考虑升级到付费计划以获得更高配额\n"
-                        f"原始错误: {error_str}"
-                    )
-                
-                raise
+                # 提取响应文本
+                return response.candidates[0].content.parts[0].text
+            
+            # 使用旧版 google-generativeai SDK（同步接口放到線程中執行）
+            logger.info("使用旧版SDK調用Gemini API")
+            model = genai.GenerativeModel(self.model_name)
+            response = await gemini_gateway.call(
+                'psd_resize',
+                lambda: asyncio.to_thread(
+                    model.generate_content,
+                    [prompt, {"mime_type": mime_type, "data": image_data}],
+                    generation_config={
+                        "temperature": temperature,
+                        "max_output_tokens": max_tokens,
+                    }
+                ),
+                coalesce_key=coalesce_key,
+                max_retries=max_retries
+            )
+            return response.text
+        
+        except Exception as e:
+            logger.error(f"Gemini API調用失敗: {type(e).__name__}: {e}")
+            raise
+    
+    async def stream_gemini_api(self,
+                              prompt: str,
+                              image_data: bytes,
+                              mime_type: str,
+                              on_layer: LayerCallback,
+                              temperature: float = 0.1,
+                              max_tokens: int = 32000,
+                              max_retries: int = 3) -> Tuple[str, List[Dict[str, Any]], bool]:
+        """
+        流式調用Gemini API，邊接收邊解析JSON數組，每完成一個圖層就回調 on_layer
+        
+        Returns:
+            (完整響應文本, 已解析的圖層列表, 數組是否完整閉合且無解析失敗的元素)
+        """
+        async def text_chunks():
+            if self.use_new_sdk and self.client:
+                stream = gemini_gateway.stream_text(
+                    'psd_resize',
+                    self.client,
+                    model=self.model_name,
+                    contents=[prompt, types.Part.from_bytes(data=image_data, mime_type=mime_type)],
+                    config=types.GenerateContentConfig(
+                        temperature=temperature,
+                        max_output_tokens=max_tokens,
+                        response_modalities=["Text"]
+                    ),
+                    max_retries=max_retries
+                )
+                async for text in stream:
+                    yield text
+            else:
+                # 旧版SDK沒有異步流式接口，整體返回後再逐個回調
+                yield await self.call_gemini_api(prompt, image_data, mime_type, temperature, max_tokens, max_retries)
+        
+        parser = IncrementalJSONArrayParser()
+        chunks: List[str] = []
+        layers: List[Dict[str, Any]] = []
+        async for text in text_chunks():
+            chunks.append(text)
+            for item in parser.feed(text):
+                if isinstance(item, dict):
+                    layers.append(item)
+                    await on_layer(item)
+        
+        return ''.join(chunks), layers, parser.complete and parser.errors == 0
     
     def parse_gemini_response(self, response_text: str) -> List[Dict[str, Any]]:
         """
@@ -399,45 +501,201 @@ class GeminiPSDResizeService:
         logger.error("無法解析Gemini響應為JSON格式")
         raise ValueError(f"無法解析Gemini響應為JSON格式。原始響應: {response_text[:500]}...")
     
+    def postprocess_plan(self,
+                         layers_info: List[Dict[str, Any]],
+                         new_positions: List[Dict[str, Any]],
+                         target_width: int,
+                         target_height: int) -> List[Dict[str, Any]]:
+        """
+        校驗模型方案的幾何約束
+        
+        1. 按ID匹配原始圖層，統一為整數ID（渲染器按整數ID查找）
+        2. 超出目標畫布的圖層等比例縮小並平移進畫布（否則渲染時會被整層跳過）
+        3. 原本不重疊、方案中重疊的可見圖層按優先級（文字優先、面積大的優先）推開
+        """
+        matched, unmatched = match_by_id(
+            [item for item in new_positions if isinstance(item, dict)], layers_info
+        )
+        if unmatched:
+            logger.warning(f"方案中有 {len(unmatched)} 個圖層ID無法匹配，已忽略: {[item.get('id') for item in unmatched][:20]}")
+        
+        entries = []
+        for item, info in matched:
+            coords = item.get('new_coords')
+            try:
+                box = [float(coords[k]) for k in ('left', 'top', 'right', 'bottom')]
+            except (KeyError, TypeError, ValueError):
+                logger.warning(f"圖層 {info['id']} 的坐標格式無效: {coords}")
+                continue
+            entries.append(({**item, 'id': info['id']}, info, box))
+        if not entries:
+            return []
+        
+        fitted, scales, valid = fit_boxes([box for _, _, box in entries], target_width, target_height, integer=True)
+        original = as_boxes([[info[k] for k in ('left', 'top', 'right', 'bottom')] for _, info, _ in entries])
+        
+        # 圖層組不參與重疊檢查（渲染時跳過，位置由子圖層決定）
+        active = np.array([
+            info.get('type') != 'group' and item.get('visible', info.get('visible', True))
+            for item, info, _ in entries
+        ], dtype=bool)
+        areas = (fitted[:, 2] - fitted[:, 0]) * (fitted[:, 3] - fitted[:, 1])
+        order = sorted(range(len(entries)),
+                       key=lambda i: (entries[i][1].get('type') not in ('type', 'text'), -areas[i]))
+        boxes, moved, unresolved = resolve_overlaps(original, fitted, target_width, target_height,
+                                                    order=order, active=active)
+        moved, unresolved = set(moved), set(unresolved)
+        
+        result = []
+        for i, ((item, info, box), fitted_box, new_box) in enumerate(zip(entries, fitted.tolist(), boxes.tolist())):
+            warnings = list(item.get('warnings') or [])
+            if valid[i] and scales[i] < 1.0:
+                warnings.append(f'超出目標畫布，已等比例縮小 {scales[i]:.3f}')
+            elif valid[i] and [round(v) for v in box] != [round(v) for v in fitted_box]:
+                warnings.append('超出目標畫布，已移入畫布範圍')
+            if i in moved:
+                warnings.append('與其他圖層重疊，已移動避免重疊')
+            if i in unresolved:
+                warnings.append('無法完全避免與其他圖層重疊')
+            new_coords = dict(zip(('left', 'top', 'right', 'bottom'), (int(round(v)) for v in new_box)))
+            result.append({**item, 'new_coords': new_coords, 'warnings': warnings})
+        
+        if moved or unresolved or (scales < 1.0).any():
+            logger.info(
+                f"幾何校驗: 縮小 {int((scales < 1.0).sum())} 個、移動 {len(moved)} 個圖層，"
+                f"{len(unresolved)} 個圖層無法避免重疊"
+            )
+        return result
+    
     async def resize_psd_layers(self, 
                               layers_info: List[Dict[str, Any]],
-                              detection_image_path: str,
+                              detection_image_path: Optional[str],
                               original_width: int,
                               original_height: int,
                               target_width: int,
-                              target_height: int) -> List[Dict[str, Any]]:
+                              target_height: int,
+                              detection_image: Optional[DetectionImage] = None,
+                              on_layer: Optional[LayerCallback] = None) -> List[Dict[str, Any]]:
         """
         完整的PSD圖層縮放流程
         
         Args:
             layers_info: 圖層信息列表
-            detection_image_path: 檢測框圖像路徑
+            detection_image_path: 檢測框圖像路徑（與 detection_image 二選一）
             original_width: 原始寬度
             original_height: 原始高度
             target_width: 目標寬度
             target_height: 目標高度
+            detection_image: 已縮小並編碼的檢測框圖像
+            on_layer: 提供時使用流式響應，每解析出一個圖層方案立即回調
             
         Returns:
             調整後的圖層信息列表
         """
         try:
-            # 生成提示詞
-            prompt = self.generate_resize_prompt(
-                layers_info, original_width, original_height, 
-                target_width, target_height
-            )
+            # 圖層很多時按圖層組規劃，模型只返回規劃單元的邊界框，子圖層在本地跟隨變換
+            expander: Optional[UnitPlanExpander] = None
+            if should_plan_hierarchically(layers_info):
+                units = select_plan_units(layers_info, original_width, original_height)
+                expander = UnitPlanExpander(layers_info, units, original_width, original_height,
+                                            target_width, target_height)
+                prompt = self.generate_group_plan_prompt(
+                    units, {info['id']: expander.descendant_count(info['id']) for info in units},
+                    len(layers_info), original_width, original_height,
+                    target_width, target_height, detection_image
+                )
+                logger.info(f"分層規劃: {len(layers_info)} 個圖層歸併為 {len(units)} 個規劃單元")
+            else:
+                # 生成提示詞
+                prompt = self.generate_resize_prompt(
+                    layers_info, original_width, original_height, 
+                    target_width, target_height, detection_image
+                )
             
-            # 讀取檢測框圖像並轉換為base64
-            with open(detection_image_path, 'rb') as f:
-                image_data = f.read()
-            image_base64 = base64.b64encode(image_data).decode('utf-8')
+            if detection_image is not None:
+                image_data, mime_type = detection_image.data, detection_image.mime_type
+            else:
+                with open(detection_image_path, 'rb') as f:
+                    image_data = f.read()
+                mime_type = _MIME_TYPES.get(Path(detection_image_path).suffix.lower(), 'image/png')
             
-            # 調用Gemini API
-            response_text = await self.call_gemini_api(prompt, image_base64)
+            started = time.time()
+            first_layer_at: List[float] = []
+            emitted = set()
+            # 已推送圖層的坐標，整體後處理後據此補發位置有變化的圖層
+            pushed_coords: Dict[Any, Dict[str, int]] = {}
+            layers_by_id = {str(info['id']): info for info in layers_info}
+            
+            async def push(entry: Dict[str, Any]) -> None:
+                # 單個圖層先做邊界約束，避免前端和預渲染使用超出畫布的原始坐標
+                info = layers_by_id.get(str(entry.get('id', '')).strip())
+                fitted = self.postprocess_plan([info] if info else layers_info, [entry], target_width, target_height)
+                if not fitted:
+                    return
+                pushed_coords[fitted[0]['id']] = fitted[0]['new_coords']
+                if not first_layer_at:
+                    first_layer_at.append(time.time())
+                await on_layer(fitted[0])
+            
+            async def accept(item: Dict[str, Any]) -> None:
+                # 分層方案展開為單元及其子圖層，再逐個回調尚未推送的圖層
+                entries = expander.expand(item) if expander else [item]
+                if on_layer is None:
+                    return
+                for entry in entries:
+                    if entry.get('id') in emitted:
+                        continue
+                    emitted.add(entry.get('id'))
+                    await push(entry)
+            
+            # 調用Gemini API（圖像字節直接上傳）
+            if on_layer is not None:
+                response_text, streamed, complete = await self.stream_gemini_api(
+                    prompt, image_data, mime_type, accept
+                )
+            else:
+                response_text, streamed, complete = await self.call_gemini_api(prompt, image_data, mime_type), [], False
+            self.last_call_stats = {
+                "image_bytes": len(image_data),
+                "mime_type": mime_type,
+                "image_size": [detection_image.width, detection_image.height] if detection_image else None,
+                "prompt_chars": len(prompt),
+                "response_chars": len(response_text),
+                "latency_seconds": round(time.time() - started, 3),
+                "streamed": on_layer is not None,
+                "first_layer_seconds": round(first_layer_at[0] - started, 3) if first_layer_at else None,
+                "plan_units": len(expander.units) if expander else None,
+            }
+            logger.info(
+                f"Gemini調用完成: 圖像 {len(image_data) / 1024:.1f} KB ({mime_type})，"
+                f"提示詞 {len(prompt)} 字符，響應 {len(response_text)} 字符，"
+                f"耗時 {self.last_call_stats['latency_seconds']}s"
+            )
+            
+            # 解析響應（流式解析不完整時回退到整體解析，並補發尚未回調的圖層）
+            if complete:
+                new_positions = streamed
+            else:
+                new_positions = self.parse_gemini_response(response_text)
+                for item in new_positions:
+                    if isinstance(item, dict):
+                        await accept(item)
             
-            # 解析響應
-            new_positions = self.parse_gemini_response(response_text)
+            if expander:
+                if len(expander.planned_units) < len(expander.units):
+                    logger.warning(f"模型只返回了 {len(expander.planned_units)}/{len(expander.units)} 個規劃單元，其餘使用本地佈局")
+                new_positions = expander.finish()
+                for entry in new_positions:
+                    if on_layer is not None and entry['id'] not in emitted:
+                        emitted.add(entry['id'])
+                        await push(entry)
             
+            new_positions = self.postprocess_plan(layers_info, new_positions, target_width, target_height)
+            if on_layer is not None:
+                for item in new_positions:
+                    coords = pushed_coords.get(item['id'])
+                    if coords is not None and coords != item['new_coords']:
+                        await on_layer(item)
             logger.info(f"成功生成 {len(new_positions)} 個圖層的調整方案")
             return new_positions
             
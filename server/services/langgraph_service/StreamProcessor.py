@@ -1,46 +1,61 @@
 # type: ignore[import]
 import traceback
 from typing import Optional, List, Dict, Any, Callable, Awaitable
-from langchain_core.messages import AIMessageChunk, ToolCall, convert_to_messages, ToolMessage
-from langgraph.graph import StateGraph
+from langchain_core.messages import AIMessageChunk, ToolCall, convert_to_messages, convert_to_openai_messages, ToolMessage
+from langgraph.graph.state import CompiledStateGraph
 import json
 
+from .message_sync import MessageSync, active_message_syncs
+from .stream_output_buffer import StreamOutputBuffer
+
 
 class StreamProcessor:
     """流式处理器 - 负责处理智能体的流式输出"""
 
-    def __init__(self, session_id: str, db_service: Any, websocket_service: Callable[[str, Dict[str, Any]], Awaitable[None]]):
+    def __init__(self, session_id: str, message_writer: Any, websocket_service: Callable[[str, Dict[str, Any]], Awaitable[None]]):
         self.session_id = session_id
-        self.db_service = db_service
+        # 消息交给 message_writer 延迟批量写入，不在流式输出中等待数据库
+        self.message_writer = message_writer
         self.websocket_service = websocket_service
+        # delta 和工具参数片段经缓冲合并后发送，其余事件通过 output.send 立即发送
+        self.output = StreamOutputBuffer(session_id, websocket_service)
         self.tool_calls: List[ToolCall] = []
         self.last_saved_message_index = 0
         self.last_streaming_tool_call_id: Optional[str] = None
 
-    async def process_stream(self, swarm: StateGraph, messages: List[Dict[str, Any]], context: Dict[str, Any]) -> None:
+    async def process_stream(self, compiled_swarm: CompiledStateGraph, messages: List[Dict[str, Any]], context: Dict[str, Any]) -> None:
         """处理整个流式响应
 
         Args:
-            swarm: 智能体群组
+            compiled_swarm: 编译好的智能体群组
             messages: 消息列表
             context: 上下文信息
         """
         self.last_saved_message_index = len(messages) - 1
+        # 请求中的历史消息客户端已经有了，只同步之后新增或变化的消息
+        self.message_sync = MessageSync(self.session_id, known_count=len(messages),
+                                        canvas_id=context.get('canvas_id'))
+        active_message_syncs[self.session_id] = self.message_sync
 
-        compiled_swarm = swarm.compile()
-
-        async for chunk in compiled_swarm.astream(
-            {"messages": messages},
-            config=context,
-            stream_mode=["messages", "custom", 'values']
-        ):
-            await self._handle_chunk(chunk)
-
-        # 发送完成事件
-        print(f'📤 [WebSocket发送] done 事件')
-        await self.websocket_service(self.session_id, {
-            'type': 'done'
-        })
+        try:
+            async for chunk in compiled_swarm.astream(
+                {"messages": messages},
+                config=context,
+                stream_mode=["messages", "custom", 'values']
+            ):
+                await self._handle_chunk(chunk)
+
+            # 发送完成事件
+            print(f'📤 [WebSocket发送] done 事件')
+            await self.output.send({
+                'type': 'done'
+            })
+        finally:
+            if active_message_syncs.get(self.session_id) is self.message_sync:
+                del active_message_syncs[self.session_id]
+            # 出错或取消时也要发出缓冲区中已有的内容
+            await self.output.close()
+            print(f'📊 [WebSocket统计] {self.output.get_stats()}')
 
     async def _handle_chunk(self, chunk: Any) -> None:
         # print('👇chunk', chunk)
@@ -55,31 +70,26 @@ class StreamProcessor:
     async def _handle_values_chunk(self, chunk_data: Dict[str, Any]) -> None:
         """处理 values 类型的 chunk"""
         all_messages = chunk_data.get('messages', [])
-        oai_messages = convert_to_openai_messages(all_messages)
-        # 确保 oai_messages 是列表类型
-        if not isinstance(oai_messages, list):
-            oai_messages = [oai_messages] if oai_messages else []
-
-        # 发送所有消息到前端
-        ws_data = {
-            'type': 'all_messages',
-            'messages': oai_messages
-        }
-        print(f'📤 [WebSocket发送] all_messages: 共 {len(oai_messages)} 条消息')
-        if oai_messages:
-            last_msg = oai_messages[-1]
-            print(f'📤 [WebSocket发送] 最后一条消息: role={last_msg.get("role")}, content={str(last_msg.get("content"))[:200]}...')
-        await self.websocket_service(self.session_id, ws_data)
-
-        # 保存新消息到数据库
+        # 只转换新增或变化的消息
+        ws_data = self.message_sync.update(all_messages)
+        oai_messages = self.message_sync.messages
+
+        # 只发送从第一条变化的消息开始的部分
+        if ws_data is not None:
+            print(f'📤 [WebSocket发送] messages_delta: 从第 {ws_data["start"]} 条开始 {len(ws_data["messages"])} 条，共 {ws_data["total"]} 条')
+            if ws_data['messages']:
+                last_msg = ws_data['messages'][-1]
+                print(f'📤 [WebSocket发送] 最后一条消息: role={last_msg.get("role")}, content={str(last_msg.get("content"))[:200]}...')
+            await self.output.send(ws_data)
+
+        # 保存新消息到数据库（加入写入缓冲区）
         for i in range(self.last_saved_message_index + 1, len(oai_messages)):
             new_message = oai_messages[i]
-            if len(oai_messages) > 0:  # 确保有消息才保存
-                await self.db_service.create_message(
-                    self.session_id,
-                    new_message.get('role', 'user'),
-                    json.dumps(new_message)
-                )
+            self.message_writer.enqueue(
+                self.session_id,
+                new_message.get('role', 'user'),
+                json.dumps(new_message)
+            )
             self.last_saved_message_index = i
 
     async def _handle_message_chunk(self, ai_message_chunk: AIMessageChunk) -> None:
@@ -98,10 +108,10 @@ class StreamProcessor:
                     'message': oai_message
                 }
                 print(f'📤 [WebSocket发送] tool_call_result: {ws_data}')
-                await self.websocket_service(self.session_id, ws_data)
+                await self.output.send(ws_data)
             elif content:
                 # 发送文本内容
-                await self.websocket_service(self.session_id, {
+                await self.output.push({
                     'type': 'delta',
                     'text': content
                 })
@@ -142,7 +152,7 @@ class StreamProcessor:
                     f'🔄 Tool {tool_name} requires confirmation, skipping StreamProcessor event')
                 continue
             else:
-                await self.websocket_service(self.session_id, {
+                await self.output.send({
                     'type': 'tool_call',
                     'id': tool_call.get('id'),
                     'name': tool_name,
@@ -157,7 +167,7 @@ class StreamProcessor:
                 self.last_streaming_tool_call_id = tool_call_chunk.get('id')
             else:
                 if self.last_streaming_tool_call_id:
-                    await self.websocket_service(self.session_id, {
+                    await self.output.push({
                         'type': 'tool_call_arguments',
                         'id': self.last_streaming_tool_call_id,
                         'text': tool_call_chunk.get('args')
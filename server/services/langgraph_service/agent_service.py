@@ -1,10 +1,10 @@
 from models.tool_model import ToolInfoJson
-from services.db_service import db_service
+from services.message_writer import message_writer
 from .StreamProcessor import StreamProcessor
-from .agent_manager import AgentManager
+from .swarm_cache import swarm_cache
+import time
 import traceback
 from utils.http_client import HttpClient
-from langgraph_swarm import create_swarm  # type: ignore
 from langchain_openai import ChatOpenAI
 from langchain_ollama import ChatOllama
 from services.websocket_service import send_to_websocket  # type: ignore
@@ -104,32 +104,17 @@ async def langgraph_multi_agent(
         fixed_messages = _fix_chat_history(messages)
         print(f'🤖 修复后 messages 数量: {len(fixed_messages)}')
 
-        # 2. 文本模型
-        print(f'🤖 [创建模型] 创建 {text_model.get("provider")} 模型: {text_model.get("model")}')
-        text_model_instance = _create_text_model(text_model)
-        print(f'🤖 [创建模型] 模型实例创建成功: {type(text_model_instance).__name__}')
-
-        # 3. 创建智能体
-        print(f'🤖 [创建智能体] 开始创建智能体...')
-        agents = AgentManager.create_agents(
-            text_model_instance,
+        # 2-4. 文本模型、智能体和编译好的群组（按模型、工具和系统提示词缓存，跨轮次复用）
+        started = time.perf_counter()
+        compiled_swarm, default_agent = swarm_cache.get_swarm(
+            text_model,
             tool_list,  # 传入所有注册的工具
-            system_prompt or ""
-        )
-        agent_names = [agent.name for agent in agents]
-        print(f'🤖 [创建智能体] 创建的智能体: {agent_names}')
-        last_agent = AgentManager.get_last_active_agent(
-            fixed_messages, agent_names)
-
-        print(f'🤖 [创建智能体] 上次活跃智能体: {last_agent}')
-
-        # 4. 创建智能体群组
-        print(f'🤖 [创建群组] 创建智能体群组...')
-        swarm = create_swarm(
-            agents=agents,  # type: ignore
-            default_active_agent=last_agent if last_agent else agent_names[0]
+            system_prompt or "",
+            fixed_messages,
+            _create_text_model
         )
-        print(f'🤖 [创建群组] 群组创建成功，默认智能体: {last_agent if last_agent else agent_names[0]}')
+        print(f'🤖 [创建群组] {text_model.get("provider")} / {text_model.get("model")}，默认智能体: {default_agent}，'
+              f'耗时 {(time.perf_counter() - started) * 1000:.1f}ms，缓存: {swarm_cache.get_stats()}')
 
         # 5. 创建上下文
         context = {
@@ -142,8 +127,8 @@ async def langgraph_multi_agent(
         # 6. 流处理
         print(f'🤖 [开始处理] 开始处理流数据...')
         processor = StreamProcessor(
-            session_id, db_service, send_to_websocket)  # type: ignore
-        await processor.process_stream(swarm, fixed_messages, context)
+            session_id, message_writer, send_to_websocket)  # type: ignore
+        await processor.process_stream(compiled_swarm, fixed_messages, context)
         print(f'🤖 [处理完成] 流数据处理完成')
 
     except Exception as e:
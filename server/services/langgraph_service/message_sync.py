@@ -0,0 +1,96 @@
+"""
+会话消息增量同步
+
+每个 values chunk 都包含完整的消息列表，以前每次都整体转换并作为 all_messages 发送，
+长会话（尤其带图片的工具结果）每一步都要重发全部历史。现在：
+- 只转换新增或发生变化的消息（未变化的消息对象直接复用上次的转换结果）
+- 只发送从第一条变化的消息开始的部分：messages_delta {start, messages, total}，
+  客户端用 messages[:start] + 新消息 替换本地列表（重复收到同一个 delta 也是幂等的）
+- 客户端（重新）订阅正在流式输出的会话并通过权限检查后，才发送一次完整的 all_messages 快照；
+  快照只发给已验证可以访问该会话所属画布的订阅者
+"""
+
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import convert_to_openai_messages
+
+# 客户端已经拥有的历史消息（请求中带来的），首次比较时视为未变化
+_KNOWN = object()
+
+
+def _same_message(previous: Any, message: Any) -> bool:
+    if previous is message:
+        return True
+    message_id = getattr(message, 'id', None)
+    return bool(message_id) and getattr(previous, 'id', None) == message_id and previous == message
+
+
+class MessageSync:
+    """单个会话的消息同步状态"""
+
+    def __init__(self, session_id: str, known_count: int = 0, canvas_id: Optional[str] = None):
+        self.session_id = session_id
+        self.canvas_id = canvas_id
+        self._sources: List[Any] = [None] * known_count
+        self.messages: List[Any] = [_KNOWN] * known_count
+        # 已发送给客户端的消息数
+        self.sent_count = known_count
+
+    def update(self, all_messages: List[Any]) -> Optional[Dict[str, Any]]:
+        """
+        增量转换最新的消息列表
+
+        Returns:
+            messages_delta 事件；消息没有变化时返回 None
+        """
+        sources: List[Any] = []
+        converted: List[Any] = []
+        for index, message in enumerate(all_messages):
+            if index < len(self._sources) and self.messages[index] is not _KNOWN \
+                    and _same_message(self._sources[index], message):
+                converted.append(self.messages[index])
+            else:
+                result = convert_to_openai_messages([message])
+                converted.append(result[0] if isinstance(result, list) else result)
+            sources.append(message)
+
+        start = 0
+        for start, (previous, current) in enumerate(zip(self.messages, converted)):
+            if previous is not _KNOWN and previous is not current and previous != current:
+                break
+        else:
+            start = min(len(self.messages), len(converted))
+
+        self._sources, self.messages = sources, converted
+        if start == len(converted) and start == self.sent_count:
+            return None
+        self.sent_count = len(converted)
+        return {
+            'type': 'messages_delta',
+            'start': start,
+            'messages': converted[start:],
+            'total': len(converted),
+        }
+
+    def snapshot(self) -> Optional[Dict[str, Any]]:
+        """完整的消息列表（首次 values chunk 之前客户端已有的历史无法提供，返回 None）"""
+        if any(message is _KNOWN for message in self.messages):
+            return None
+        return {'type': 'all_messages', 'messages': list(self.messages)}
+
+
+# 正在流式输出的会话
+active_message_syncs: Dict[str, MessageSync] = {}
+
+
+def get_message_snapshot(session_id: str, canvas_id: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    正在流式输出的会话的完整消息快照
+
+    Args:
+        canvas_id: 订阅者已通过权限检查的画布，与会话所属画布不一致时不返回快照
+    """
+    sync = active_message_syncs.get(session_id)
+    if sync is None or sync.canvas_id != canvas_id:
+        return None
+    return sync.snapshot()
@@ -0,0 +1,157 @@
+"""
+会话输出缓冲 - 合并 LLM 流式输出的小帧
+
+- delta 文本和 tool_call_arguments 参数片段先进入缓冲区，相邻的同类事件直接拼接文本
+- 缓冲时间窗口（STREAM_BATCH_WINDOW_MS）到期或累计字节数达到 STREAM_BATCH_MAX_BYTES 时一次发出；
+  合并后只剩一个事件时原样发送，否则打包为一个 batch 帧
+- tool_call、tool_call_result、all_messages、done 等语义事件先清空缓冲区再立即发送，保证顺序
+- 每个会话统计帧数、事件数和发送字节数，可通过 stream_output_metrics.get_stats() 查看
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# 缓冲时间窗口（毫秒），0 表示不缓冲
+BATCH_WINDOW_MS = int(os.getenv('STREAM_BATCH_WINDOW_MS', '30'))
+# 缓冲区累计字节数达到该值时立即发送
+BATCH_MAX_BYTES = int(os.getenv('STREAM_BATCH_MAX_BYTES', '4096'))
+# 保留最近多少个会话的统计
+MAX_RECENT_SESSIONS = 100
+
+# 可以合并的事件类型（按 id 区分的纯文本片段）
+COALESCIBLE_TYPES = {'delta', 'tool_call_arguments'}
+
+SendFunc = Callable[[str, Dict[str, Any]], Awaitable[None]]
+
+
+class StreamOutputMetrics:
+    """按进程累计的流式输出统计"""
+
+    def __init__(self):
+        self._totals = {'sessions': 0, 'frames': 0, 'events': 0, 'bytes': 0}
+        self._active: Dict[str, 'StreamOutputBuffer'] = {}
+        self._recent: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+
+    def register(self, buffer: 'StreamOutputBuffer') -> None:
+        self._active[buffer.session_id] = buffer
+
+    def record(self, buffer: 'StreamOutputBuffer') -> None:
+        """会话输出结束时记录统计"""
+        if self._active.get(buffer.session_id) is buffer:
+            del self._active[buffer.session_id]
+        stats = buffer.get_stats()
+        self._totals['sessions'] += 1
+        for key in ('frames', 'events', 'bytes'):
+            self._totals[key] += stats[key]
+        self._recent[buffer.session_id] = stats
+        self._recent.move_to_end(buffer.session_id)
+        while len(self._recent) > MAX_RECENT_SESSIONS:
+            self._recent.popitem(last=False)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'window_ms': BATCH_WINDOW_MS,
+            'max_bytes': BATCH_MAX_BYTES,
+            'totals': dict(self._totals),
+            'active': {session_id: buffer.get_stats() for session_id, buffer in self._active.items()},
+            'recent': dict(self._recent),
+        }
+
+
+class StreamOutputBuffer:
+    """单个会话的输出缓冲区"""
+
+    def __init__(self, session_id: str, send: SendFunc,
+                 window_ms: int = BATCH_WINDOW_MS, max_bytes: int = BATCH_MAX_BYTES):
+        self.session_id = session_id
+        self._send = send
+        self.window = max(window_ms, 0) / 1000
+        self.max_bytes = max_bytes
+        self._pending: List[Dict[str, Any]] = []
+        self._pending_bytes = 0
+        self._timer: Optional[asyncio.Task] = None
+        # 定时发送和立即发送可能交错，用锁保证帧的发送顺序
+        self._lock = asyncio.Lock()
+        self._started = time.monotonic()
+        self._stats = {'frames': 0, 'events': 0, 'batches': 0, 'coalesced': 0, 'bytes': 0}
+        stream_output_metrics.register(self)
+
+    async def push(self, event: Dict[str, Any]) -> None:
+        """发送可合并的文本片段（delta / tool_call_arguments）"""
+        if event.get('type') not in COALESCIBLE_TYPES or not self.window:
+            await self.send(event)
+            return
+
+        text = event.get('text') or ''
+        self._stats['events'] += 1
+        last = self._pending[-1] if self._pending else None
+        if last is not None and last['type'] == event['type'] and last.get('id') == event.get('id'):
+            last['text'] += text
+            self._stats['coalesced'] += 1
+        else:
+            self._pending.append({**event, 'text': text})
+        self._pending_bytes += len(text)
+
+        if self._pending_bytes >= self.max_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def send(self, event: Dict[str, Any]) -> None:
+        """立即发送语义事件（先发出缓冲区中的内容）"""
+        self._stats['events'] += 1
+        async with self._lock:
+            await self._flush_pending()
+            await self._emit(event)
+
+    async def flush(self) -> None:
+        async with self._lock:
+            await self._flush_pending()
+
+    async def close(self) -> None:
+        """发出剩余内容并记录统计"""
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+        await self.flush()
+        stream_output_metrics.record(self)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        self._timer = None
+        await self.flush()
+
+    async def _flush_pending(self) -> None:
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        events, self._pending, self._pending_bytes = self._pending, [], 0
+        if len(events) == 1:
+            await self._emit(events[0])
+        else:
+            self._stats['batches'] += 1
+            await self._emit({'type': 'batch', 'events': events})
+
+    async def _emit(self, frame: Dict[str, Any]) -> None:
+        self._stats['frames'] += 1
+        # socket.io 默认使用 json.dumps 编码，长度即发送的字节数
+        self._stats['bytes'] += len(json.dumps(frame))
+        await self._send(self.session_id, frame)
+
+    def get_stats(self) -> Dict[str, Any]:
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        stats = dict(self._stats)
+        stats['seconds'] = round(elapsed, 3)
+        stats['frames_per_second'] = round(stats['frames'] / elapsed, 2)
+        stats['bytes_per_second'] = round(stats['bytes'] / elapsed, 2)
+        return stats
+
+
+# 全局实例
+stream_output_metrics = StreamOutputMetrics()
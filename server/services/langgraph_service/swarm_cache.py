@@ -0,0 +1,177 @@
+"""
+智能体群组缓存 - 跨对话轮次复用模型客户端和编译好的群组
+
+以前每次 /api/chat 都要重新创建文本模型（含新的 httpx 客户端）、所有智能体、
+create_swarm 和 compile。这里按配置缓存：
+- 文本模型：键为 (provider, model, url, api_key 哈希)，复用同一组 HTTP 连接池
+- 编译好的群组：键为 (模型键, 工具签名, system_prompt 哈希)，每个默认智能体各编译一次
+两者都按 LRU 淘汰。编译后的图不保存会话状态（没有 checkpointer），可以被并发的会话共用。
+淘汰模型时一并淘汰基于它的群组，并在一段延迟后关闭它的 HTTP 客户端，正在进行的对话可以先跑完。
+"""
+
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from langgraph_swarm import create_swarm  # type: ignore
+
+from models.config_model import ModelInfo
+from models.tool_model import ToolInfoJson
+from services.config_service import config_service
+from services.tool_service import tool_service
+from .agent_manager import AgentManager
+
+# 缓存的群组数量上限
+SWARM_CACHE_SIZE = int(os.getenv('SWARM_CACHE_SIZE', '16'))
+# 缓存的模型客户端数量上限
+MODEL_CACHE_SIZE = int(os.getenv('MODEL_CACHE_SIZE', '8'))
+# 被淘汰的模型客户端在多少秒后关闭
+MODEL_CLOSE_DELAY = float(os.getenv('MODEL_CLOSE_DELAY', '300'))
+
+
+def _digest(value: Optional[str]) -> str:
+    return hashlib.sha256((value or '').encode('utf-8')).hexdigest()[:16]
+
+
+def model_key(text_model: ModelInfo) -> Tuple[Any, ...]:
+    provider = text_model.get('provider')
+    api_key = config_service.app_config.get(provider, {}).get('api_key', '')  # type: ignore
+    return provider, text_model.get('model'), text_model.get('url'), _digest(api_key)
+
+
+def tool_signature(tool_list: List[ToolInfoJson]) -> Tuple[Any, ...]:
+    # 工具重新注册后对象会变化，签名中带上当前注册的工具对象，避免使用旧的工具
+    return tuple(sorted(
+        (str(tool.get('id')), str(tool.get('provider')), str(tool.get('type')), id(tool_service.get_tool(tool.get('id'))))
+        for tool in tool_list
+    ))
+
+
+class _SwarmEntry:
+    def __init__(self, agents: List[Any]):
+        self.agents = agents
+        self.agent_names = [agent.name for agent in agents]
+        self.compiled: Dict[str, Any] = {}
+
+
+class SwarmCache:
+    """模型客户端和编译好的群组的 LRU 缓存"""
+
+    def __init__(self, max_swarms: int = SWARM_CACHE_SIZE, max_models: int = MODEL_CACHE_SIZE,
+                 close_delay: float = MODEL_CLOSE_DELAY):
+        self.max_swarms = max(max_swarms, 1)
+        self.max_models = max(max_models, 1)
+        self.close_delay = close_delay
+        # 正在关闭的异步客户端，保持引用直到关闭完成
+        self._closing: Set[asyncio.Task] = set()
+        self._models: 'OrderedDict[Tuple[Any, ...], Any]' = OrderedDict()
+        self._swarms: 'OrderedDict[Tuple[Any, ...], _SwarmEntry]' = OrderedDict()
+        self._stats = {'model_hits': 0, 'model_misses': 0, 'swarm_hits': 0, 'swarm_misses': 0,
+                       'compiles': 0, 'evictions': 0, 'build_seconds': 0.0}
+
+    def get_model(self, text_model: ModelInfo, factory: Callable[[ModelInfo], Any]) -> Any:
+        key = model_key(text_model)
+        model = self._models.get(key)
+        if model is not None:
+            self._models.move_to_end(key)
+            self._stats['model_hits'] += 1
+            return model
+        self._stats['model_misses'] += 1
+        model = factory(text_model)
+        self._models[key] = model
+        while len(self._models) > self.max_models:
+            evicted_key, evicted = self._models.popitem(last=False)
+            self._stats['evictions'] += 1
+            # 基于被淘汰模型的群组也不能再用（其客户端即将关闭）
+            for swarm_key in [k for k in self._swarms if k[0] == evicted_key]:
+                del self._swarms[swarm_key]
+                self._stats['evictions'] += 1
+            self._schedule_close(evicted)
+        return model
+
+    def _schedule_close(self, model: Any) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or self.close_delay <= 0:
+            self._close_clients(model)
+        else:
+            loop.call_later(self.close_delay, self._close_clients, model)
+
+    def _close_clients(self, model: Any) -> None:
+        """关闭 _create_text_model 为模型创建的 httpx 同步/异步客户端"""
+        http_client = getattr(model, 'http_client', None)
+        if http_client is not None:
+            http_client.close()
+        http_async_client = getattr(model, 'http_async_client', None)
+        if http_async_client is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(http_async_client.aclose())
+            return
+        task = loop.create_task(http_async_client.aclose())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def get_swarm(self,
+                  text_model: ModelInfo,
+                  tool_list: List[ToolInfoJson],
+                  system_prompt: str,
+                  messages: List[Dict[str, Any]],
+                  model_factory: Callable[[ModelInfo], Any]) -> Tuple[Any, str]:
+        """
+        获取编译好的群组
+
+        Returns:
+            (编译好的群组, 默认智能体名称)
+        """
+        started = time.perf_counter()
+        key = (model_key(text_model), tool_signature(tool_list), _digest(system_prompt))
+        entry = self._swarms.get(key)
+        if entry is not None:
+            self._swarms.move_to_end(key)
+            self._stats['swarm_hits'] += 1
+        else:
+            self._stats['swarm_misses'] += 1
+            model = self.get_model(text_model, model_factory)
+            entry = _SwarmEntry(AgentManager.create_agents(model, tool_list, system_prompt))
+            self._swarms[key] = entry
+            while len(self._swarms) > self.max_swarms:
+                self._swarms.popitem(last=False)
+                self._stats['evictions'] += 1
+
+        last_agent = AgentManager.get_last_active_agent(messages, entry.agent_names)
+        default_agent = last_agent if last_agent else entry.agent_names[0]
+        compiled = entry.compiled.get(default_agent)
+        if compiled is None:
+            self._stats['compiles'] += 1
+            compiled = create_swarm(
+                agents=entry.agents,  # type: ignore
+                default_active_agent=default_agent
+            ).compile()
+            entry.compiled[default_agent] = compiled
+        self._stats['build_seconds'] += time.perf_counter() - started
+        return compiled, default_agent
+
+    def clear(self) -> None:
+        for model in self._models.values():
+            self._schedule_close(model)
+        self._models.clear()
+        self._swarms.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats['build_seconds'] = round(stats['build_seconds'], 3)
+        stats['models'] = len(self._models)
+        stats['swarms'] = len(self._swarms)
+        return stats
+
+
+# 全局实例
+swarm_cache = SwarmCache()
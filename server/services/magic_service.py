@@ -7,6 +7,7 @@ from typing import Dict, Any, List
 
 # Import service modules
 from services.db_service import db_service
+from services.message_writer import message_writer
 from services.OpenAIAgents_service import create_jaaz_response
 from services.websocket_service import send_to_websocket  # type: ignore
 from services.stream_service import add_stream_task, remove_stream_task
@@ -49,7 +50,7 @@ async def handle_magic(data: Dict[str, Any]) -> None:
 
     # Save user message to database
     if len(messages) > 0:
-        await db_service.create_message(
+        message_writer.enqueue(
             session_id, messages[-1].get('role', 'user'), json.dumps(messages[-1])
         )
 
@@ -68,6 +69,8 @@ async def handle_magic(data: Dict[str, Any]) -> None:
         remove_stream_task(session_id)
         # Notify frontend WebSocket that magic generation is done
         await send_to_websocket(session_id, {'type': 'done'})
+        # 本轮生成结束，写入缓冲的消息
+        await message_writer.flush(session_id)
 
     print('✨ magic_service 处理完成')
 
@@ -89,7 +92,7 @@ async def _process_magic_generation(
     ai_response = await create_jaaz_response(messages, session_id, canvas_id)
 
     # Save AI response to database
-    await db_service.create_message(session_id, 'assistant', json.dumps(ai_response))
+    message_writer.enqueue(session_id, 'assistant', json.dumps(ai_response))
 
     # Send messages to frontend immediately
     all_messages = messages + [ai_response]
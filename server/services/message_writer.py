@@ -0,0 +1,119 @@
+"""
+聊天消息的延迟批量写入
+
+流式输出过程中保存消息不再逐条等待数据库：
+- enqueue() 只把消息放入对应会话的缓冲区，立即返回
+- 定时（MESSAGE_FLUSH_INTERVAL_MS）或缓冲数量达到 MESSAGE_FLUSH_BATCH 时，
+  用一次 executemany 批量写入所有会话的消息
+- 一轮对话结束（包括取消和出错）时 flush(session_id)，服务关闭时 close() 写入剩余消息
+- 读取会话历史前先 flush 该会话，保证能读到刚产生的消息
+- 写入失败的消息放回缓冲区下次重试，连续失败 MAX_FLUSH_ATTEMPTS 次后丢弃并记录错误
+"""
+
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from services.db_service import db_service
+from utils.logger import get_logger
+
+logger = get_logger("services.message_writer")
+
+FLUSH_INTERVAL_MS = int(os.getenv('MESSAGE_FLUSH_INTERVAL_MS', '500'))
+FLUSH_BATCH = int(os.getenv('MESSAGE_FLUSH_BATCH', '50'))
+MAX_FLUSH_ATTEMPTS = 3
+
+
+class MessageWriter:
+    """按会话缓冲、批量写入聊天消息"""
+
+    def __init__(self, flush_interval_ms: int = FLUSH_INTERVAL_MS, max_batch: int = FLUSH_BATCH):
+        self.flush_interval = max(flush_interval_ms, 0) / 1000
+        self.max_batch = max(max_batch, 1)
+        self._pending: Dict[str, List[Tuple[str, str]]] = {}
+        self._pending_count = 0
+        self._attempts: Dict[str, int] = {}
+        self._timer: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+        # 写入按顺序进行，保证同一会话的消息 id 顺序与产生顺序一致
+        self._lock = asyncio.Lock()
+        self._stats = {'enqueued': 0, 'written': 0, 'batches': 0, 'failures': 0, 'dropped': 0}
+
+    def enqueue(self, session_id: str, role: str, message: str) -> None:
+        """缓冲一条消息（不等待数据库）"""
+        self._pending.setdefault(session_id, []).append((role, message))
+        self._pending_count += 1
+        self._stats['enqueued'] += 1
+        if self._pending_count >= self.max_batch:
+            self._spawn(self.flush())
+        elif self._timer is None:
+            self._timer = self._spawn(self._flush_later())
+
+    async def flush(self, session_id: Optional[str] = None) -> None:
+        """写入缓冲的消息（指定会话时只写该会话）"""
+        async with self._lock:
+            session_ids = [session_id] if session_id is not None else list(self._pending)
+            batch = {sid: self._pending.pop(sid) for sid in session_ids if self._pending.get(sid)}
+            if not batch:
+                return
+            rows = [(sid, role, message) for sid, messages in batch.items() for role, message in messages]
+            self._pending_count -= len(rows)
+            try:
+                await db_service.create_messages(rows)
+            except Exception as e:
+                self._stats['failures'] += 1
+                self._requeue(batch, e)
+                return
+            for sid in batch:
+                self._attempts.pop(sid, None)
+            self._stats['batches'] += 1
+            self._stats['written'] += len(rows)
+
+    async def close(self) -> None:
+        """服务关闭时写入所有剩余消息"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for _ in range(MAX_FLUSH_ATTEMPTS):
+            await self.flush()
+            if not self._pending:
+                return
+        logger.error(f"❌ 关闭时仍有 {self._pending_count} 条消息未能写入数据库")
+
+    def _requeue(self, batch: Dict[str, List[Tuple[str, str]]], error: Exception) -> None:
+        for sid, messages in batch.items():
+            attempts = self._attempts.get(sid, 0) + 1
+            if attempts >= MAX_FLUSH_ATTEMPTS:
+                self._attempts.pop(sid, None)
+                self._stats['dropped'] += len(messages)
+                logger.error(f"❌ 会话 {sid} 的 {len(messages)} 条消息写入失败 {attempts} 次，已丢弃: {error}")
+                continue
+            self._attempts[sid] = attempts
+            # 放回缓冲区最前面，保持顺序
+            self._pending[sid] = messages + self._pending.get(sid, [])
+            self._pending_count += len(messages)
+            logger.warning(f"⚠️ 会话 {sid} 的 {len(messages)} 条消息写入失败，稍后重试: {error}")
+        if self._pending and self._timer is None:
+            self._timer = self._spawn(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None
+        await self.flush()
+
+    def _spawn(self, coroutine: Any) -> asyncio.Task:
+        # 保留后台任务的引用，避免被垃圾回收
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats['pending'] = self._pending_count
+        stats['pending_sessions'] = len(self._pending)
+        return stats
+
+
+# 全局实例
+message_writer = MessageWriter()
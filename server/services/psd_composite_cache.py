@@ -0,0 +1,154 @@
+"""
+PSD合成图缓存
+
+合成图以 (file_id, 像素版本) 为键缓存在磁盘（{file_id}_composite_v{version}.png）
+和一个按字节数限制（PSD_COMPOSITE_CACHE_MB）的内存 LRU 中。上传解析时生成一次，
+之后的合成图预览、导出、缩略图和缩放检测图都直接复用，不再重新打开PSD调用 psd.composite()。
+合成图只反映原始PSD文件：只有重新导入文件才递增元数据库中的 composite_version，
+替换图层位图以及改名、移动、显隐、排序等编辑都不会触发重新合成。
+生成新版本后，旧版本的缓存文件延迟一段时间再删除，以免中断正在传输它的响应。
+"""
+
+import glob
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+from psd_tools import PSDImage
+
+from services.config_service import FILES_DIR
+from services.psd_content_store import link_or_copy
+from services.psd_metadata_store import psd_metadata_store
+from utils.image_encoder import image_encoder
+
+PSD_DIR = os.path.join(FILES_DIR, "psd")
+# 内存中缓存的合成图总字节数上限
+MEMORY_CACHE_BYTES = int(os.getenv('PSD_COMPOSITE_CACHE_MB', '256')) * 1024 * 1024
+# 旧版本缓存文件在新版本生成多少秒后删除
+STALE_FILE_GRACE_SECONDS = 60
+
+
+def _image_bytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+class PSDCompositeCache:
+    """按像素版本失效的PSD合成图缓存"""
+
+    def __init__(self, psd_dir: str = PSD_DIR, max_memory_bytes: int = MEMORY_CACHE_BYTES):
+        self.psd_dir = psd_dir
+        self.max_memory_bytes = max_memory_bytes
+        self._memory: "OrderedDict[Tuple[str, int], Image.Image]" = OrderedDict()
+        self._memory_bytes = 0
+        self._memory_guard = threading.Lock()
+        self._file_locks: Dict[str, threading.Lock] = {}
+        self._file_locks_guard = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_path(self, file_id: str, version: int) -> str:
+        return os.path.join(self.psd_dir, f'{file_id}_composite_v{version}.png')
+
+    def _get_file_lock(self, file_id: str) -> threading.Lock:
+        with self._file_locks_guard:
+            lock = self._file_locks.get(file_id)
+            if lock is None:
+                lock = threading.Lock()
+                self._file_locks[file_id] = lock
+            return lock
+
+    def _remember(self, key: Tuple[str, int], image: Image.Image) -> None:
+        size = _image_bytes(image)
+        with self._memory_guard:
+            # 同一文件只保留当前版本
+            for stale in [k for k in self._memory if k[0] == key[0]]:
+                self._memory_bytes -= _image_bytes(self._memory.pop(stale))
+            # 单张超过上限的合成图只保留在磁盘上
+            if size > self.max_memory_bytes:
+                return
+            self._memory[key] = image
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= _image_bytes(evicted)
+
+    def _remove_stale_files(self, file_id: str, version: int) -> None:
+        """删除早于 version 的缓存文件（更新的版本可能在等待期间生成，不能动）"""
+        pattern = re.compile(re.escape(file_id) + r'_composite_v(\d+)\.png$')
+        for path in glob.glob(os.path.join(self.psd_dir, f'{glob.escape(file_id)}_composite_v*.png')):
+            match = pattern.search(os.path.basename(path))
+            if match and int(match.group(1)) < version:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _schedule_stale_removal(self, file_id: str, version: int) -> None:
+        timer = threading.Timer(STALE_FILE_GRACE_SECONDS, self._remove_stale_files, (file_id, version))
+        timer.daemon = True
+        timer.start()
+
+    def _build(self, file_id: str, version: int, psd: Optional[PSDImage]) -> Image.Image:
+        if psd is None:
+            psd_path = os.path.join(self.psd_dir, f'{file_id}.psd')
+            if not os.path.exists(psd_path):
+                raise FileNotFoundError(f'PSD file not found: {file_id}')
+            psd = PSDImage.open(psd_path)
+        image = psd.composite()
+        image_encoder.save_png(image, self._cache_path(file_id, version))
+        self._schedule_stale_removal(file_id, version)
+        print(f'🖼️ 已缓存合成图 {file_id} (v{version})')
+        return image
+
+    def _load(self, file_id: str, psd: Optional[PSDImage]) -> Tuple[Image.Image, str]:
+        version = psd_metadata_store.get_composite_version(file_id)
+        key = (file_id, version)
+        path = self._cache_path(file_id, version)
+        with self._memory_guard:
+            image = self._memory.get(key)
+            if image is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return image, path
+
+        with self._get_file_lock(file_id):
+            if os.path.exists(path):
+                self.hits += 1
+                with Image.open(path) as cached:
+                    image = cached.copy()
+            else:
+                self.misses += 1
+                image = self._build(file_id, version, psd)
+        self._remember(key, image)
+        return image, path
+
+    def get_image(self, file_id: str, psd: Optional[PSDImage] = None) -> Image.Image:
+        """
+        获取合成图（返回副本，调用方可以直接修改）
+
+        Args:
+            file_id: PSD文件ID
+            psd: 已打开的PSD对象，缓存未命中时用它合成以免重新解析文件
+        """
+        return self._load(file_id, psd)[0].copy()
+
+    def get_path(self, file_id: str, psd: Optional[PSDImage] = None) -> str:
+        """获取合成图缓存文件路径（必要时先生成）"""
+        return self._load(file_id, psd)[1]
+
+    def share(self, source_id: str, file_id: str) -> None:
+        """去重别名直接共享内容对象的合成图（两者此时都处于初始版本）"""
+        source_path = self._cache_path(source_id, psd_metadata_store.get_composite_version(source_id))
+        if os.path.exists(source_path):
+            link_or_copy(source_path, self._cache_path(file_id, psd_metadata_store.get_composite_version(file_id)))
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes}
+
+
+# 全局实例
+psd_composite_cache = PSDCompositeCache()
@@ -0,0 +1,131 @@
+"""
+PSD内容寻址存储
+
+上传的PSD按内容的 SHA-256 归档为一份内部内容对象（content-<hash>），
+解析结果、缩略图和已栅格化的图层位图都挂在内容对象下。
+每次上传只生成一个轻量的 file_id 别名：原始文件和位图通过硬链接共享，
+图层元数据在元数据库中单独复制一份（图层 URL 指向别名），因此同一文件重复上传只需计算一次哈希。
+
+别名上的修改（替换图层、删除图层、修改属性）只作用于别名自己的文件：
+所有写入都通过“临时文件 + 原子替换”完成，会断开硬链接而不会影响内容对象。
+"""
+
+import asyncio
+import os
+import shutil
+import threading
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+from services.config_service import FILES_DIR
+from services.psd_metadata_store import psd_metadata_store
+
+PSD_DIR = os.path.join(FILES_DIR, "psd")
+CONTENT_ID_PREFIX = 'content-'
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """优先创建硬链接，文件系统不支持时退回到复制（经临时文件原子替换目标）"""
+    tmp_path = f'{dst}.{uuid.uuid4().hex}.tmp'
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class PSDContentStore:
+    """按内容哈希去重的PSD存储"""
+
+    def __init__(self, psd_dir: str = PSD_DIR):
+        self.psd_dir = psd_dir
+        # file_id -> content_id
+        self._aliases: Dict[str, str] = {}
+        self._aliases_guard = threading.Lock()
+        self._ingest_locks: Dict[str, asyncio.Lock] = {}
+        # 持有或等待各内容锁的上传数，归零时删除锁，字典不会随上传过的内容无限增长
+        self._ingest_waiters: Dict[str, int] = {}
+
+    @staticmethod
+    def content_id_for(sha256: str) -> str:
+        """由内容哈希得到内容对象ID"""
+        return f'{CONTENT_ID_PREFIX}{sha256[:32]}'
+
+    def _path(self, file_id: str, suffix: str) -> str:
+        return os.path.join(self.psd_dir, f'{file_id}{suffix}')
+
+    def has_content(self, content_id: str) -> bool:
+        """内容对象是否已完整入库（元数据最后写入，作为完成标记）"""
+        return os.path.exists(self._path(content_id, '.psd')) and psd_metadata_store.has_file(content_id)
+
+    @asynccontextmanager
+    async def ingest_lock(self, content_id: str) -> AsyncIterator[None]:
+        """同一内容的并发上传只解析一次"""
+        lock = self._ingest_locks.get(content_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._ingest_locks[content_id] = lock
+        self._ingest_waiters[content_id] = self._ingest_waiters.get(content_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._ingest_waiters[content_id] -= 1
+            if not self._ingest_waiters[content_id]:
+                del self._ingest_waiters[content_id]
+                del self._ingest_locks[content_id]
+
+    def create_alias(self, content_id: str, file_id: str, filename: str) -> Dict[str, Any]:
+        """
+        为内容对象创建 file_id 别名
+
+        Returns:
+            别名的元数据（图层 image_url 已指向别名）
+        """
+        link_or_copy(self._path(content_id, '.psd'), self._path(file_id, '.psd'))
+        thumbnail_path = self._path(content_id, '_thumbnail.png')
+        if os.path.exists(thumbnail_path):
+            link_or_copy(thumbnail_path, self._path(file_id, '_thumbnail.png'))
+
+        # 共享内容对象已经栅格化好的图层，其余图层在首次请求时由 resolve() 委托生成
+        old_prefix = f'/api/psd/layer/{content_id}/'
+        new_prefix = f'/api/psd/layer/{file_id}/'
+
+        def to_alias(metadata: Dict[str, Any]) -> Dict[str, Any]:
+            for layer in metadata.get('layers', []):
+                idx = layer.get('index')
+                for suffix in (f'_layer_{idx}.png', f'_layer_{idx}.empty'):
+                    src = self._path(content_id, suffix)
+                    if os.path.exists(src):
+                        link_or_copy(src, self._path(file_id, suffix))
+                if layer.get('image_url'):
+                    layer['image_url'] = layer['image_url'].replace(old_prefix, new_prefix)
+            metadata['original_filename'] = filename
+            metadata['content_id'] = content_id
+            return metadata
+
+        metadata = psd_metadata_store.clone_file(content_id, file_id, to_alias)
+
+        with self._aliases_guard:
+            self._aliases[file_id] = content_id
+        return metadata
+
+    def resolve(self, file_id: str) -> Optional[str]:
+        """查找 file_id 对应的内容对象ID（非别名返回 None）"""
+        with self._aliases_guard:
+            content_id = self._aliases.get(file_id)
+        if content_id is not None:
+            return content_id or None
+
+        if not psd_metadata_store.has_file(file_id):
+            return None
+        content_id = psd_metadata_store.get_content_id(file_id)
+        # 非别名也缓存下来（空字符串），避免每次都查库
+        with self._aliases_guard:
+            self._aliases[file_id] = content_id or ''
+        return content_id or None
+
+
+# 全局实例
+psd_content_store = PSDContentStore()
@@ -0,0 +1,414 @@
+"""
+PSD图层按需栅格化服务
+
+上传时只解析图层树和边界框，图层位图在首次被请求时才合成并写入磁盘缓存，
+之后的请求直接返回缓存文件。同一个PSD文件的栅格化通过文件锁串行执行
+（psd-tools 的图层对象不是线程安全的），不同文件之间互不阻塞。
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from psd_tools import PSDImage
+
+from services.config_service import FILES_DIR
+from services.psd_content_store import link_or_copy, psd_content_store
+from utils.image_encoder import image_encoder
+
+PSD_DIR = os.path.join(FILES_DIR, "psd")
+
+
+def flatten_psd_layers(psd: PSDImage) -> List[Any]:
+    """
+    按先序深度优先顺序展开所有图层（与图层元数据中的 index 一一对应）
+    """
+    flat_layers: List[Any] = []
+
+    def visit(layer) -> None:
+        flat_layers.append(layer)
+        if layer.is_group():
+            try:
+                for child in layer:
+                    visit(child)
+            except Exception as e:
+                print(f'Warning: Failed to traverse group {len(flat_layers) - 1}: {e}')
+
+    for top_layer in psd:
+        visit(top_layer)
+    return flat_layers
+
+
+def build_layer_info(layer, idx: int, parent_index: Optional[int]) -> Dict[str, Any]:
+    """
+    根據 psd-tools 圖層對象構建圖層元數據（不涉及像素合成）
+    """
+    layer_name = getattr(layer, 'name', f'Layer {idx}')
+
+    layer_type = 'group' if layer.is_group() else 'layer'
+    # 檢測文字層（psd-tools: layer.kind == 'type'）
+    if hasattr(layer, 'kind') and getattr(layer, 'kind', None) == 'type':
+        layer_type = 'text'
+
+    layer_info: Dict[str, Any] = {
+        'index': idx,
+        'name': layer_name,
+        'visible': getattr(layer, 'visible', True),
+        'opacity': getattr(layer, 'opacity', 255),
+        'blend_mode': str(getattr(layer, 'blend_mode', 'normal')),
+        'left': getattr(layer, 'left', 0),
+        'top': getattr(layer, 'top', 0),
+        'width': getattr(layer, 'width', 0),
+        'height': getattr(layer, 'height', 0),
+        'parent_index': parent_index,
+        'type': layer_type,
+    }
+
+    # 文字層屬性（若存在）
+    if layer_type == 'text' and hasattr(layer, 'text_data'):
+        text_data = layer.text_data
+        layer_info.update({
+            'font_family': getattr(text_data, 'font_name', 'Arial'),
+            'font_size': getattr(text_data, 'font_size', 16),
+            'font_weight': getattr(text_data, 'font_weight', 'normal'),
+            'font_style': getattr(text_data, 'font_style', 'normal'),
+            'text_align': getattr(text_data, 'text_align', 'left'),
+            'text_color': getattr(text_data, 'text_color', '#000000'),
+            'text_content': getattr(text_data, 'text_content', ''),
+            'line_height': getattr(text_data, 'line_height', 1.2),
+            'letter_spacing': getattr(text_data, 'letter_spacing', 0),
+            'text_decoration': getattr(text_data, 'text_decoration', 'none'),
+        })
+
+    return layer_info
+
+
+# 常见的PSD纯灰背景色
+_BACKGROUND_GRAY_VALUES = (128, 192, 224, 240)
+# 分块统计的行数，块足够小以留在CPU缓存中
+_CLASSIFY_CHUNK_ROWS = 256
+
+
+@dataclass
+class LayerPixelStats:
+    """图层像素分类结果"""
+    kind: str                                   # 'empty' | 'background' | 'content'
+    bbox: Optional[Tuple[int, int, int, int]]   # alpha > 10 的紧致边界框 (left, top, right, bottom)
+    transparent_ratio: float
+    reason: str = ''
+
+
+def classify_layer_pixels(image: Image.Image) -> LayerPixelStats:
+    """
+    单次遍历RGBA像素，判断图层是空图层、纯色背景还是有效内容，并给出alpha紧致边界框
+
+    按行分块累计所有统计量（alpha最小值、行/列最大值、近透明像素数、RGB最小/最大值、
+    和与平方和），每块数据只读取一次，替代原先多次整图 np.all/np.std/np.abs 扫描。
+    判定规则与原实现一致：
+    - 完全不透明且 RGB 标准差 < 10 且最小值 > 200：白色/浅灰色背景
+    - 完全不透明且所有像素与 128/192/224/240 之一相差 < 5：灰色背景
+    - alpha < 10 的像素超过 80%，或没有 alpha > 10 的像素：空图层
+    """
+    pixels = np.asarray(image)
+    height, width = pixels.shape[:2]
+    total = height * width
+    if total == 0:
+        return LayerPixelStats(kind='empty', bbox=None, transparent_ratio=1.0)
+
+    row_has_content = np.zeros(height, dtype=bool)
+    col_has_content = np.zeros(width, dtype=bool)
+    transparent = 0
+    opaque = True
+    rgb_min, rgb_max = 255, 0
+    rgb_sum = 0
+    rgb_sq_sum = 0
+
+    for r0 in range(0, height, _CLASSIFY_CHUNK_ROWS):
+        chunk = pixels[r0:r0 + _CLASSIFY_CHUNK_ROWS]
+        alpha = chunk[..., 3]
+
+        content_mask = alpha > 10
+        row_has_content[r0:r0 + chunk.shape[0]] = content_mask.any(axis=1)
+        col_has_content |= content_mask.any(axis=0)
+        transparent += int(np.count_nonzero(alpha < 10))
+
+        if opaque:
+            opaque = bool(alpha.min() == 255)
+        if opaque:
+            rgb = chunk[..., :3]
+            rgb_min = min(rgb_min, int(rgb.min()))
+            rgb_max = max(rgb_max, int(rgb.max()))
+            rgb_sum += int(rgb.sum(dtype=np.uint64))
+            rgb_sq_sum += int(np.einsum('ijk,ijk->', rgb, rgb, dtype=np.uint64))
+
+    transparent_ratio = transparent / total
+
+    bbox = None
+    if row_has_content.any():
+        rows = np.flatnonzero(row_has_content)
+        cols = np.flatnonzero(col_has_content)
+        bbox = (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+    if opaque:
+        count = total * 3
+        mean = rgb_sum / count
+        rgb_std = max(rgb_sq_sum / count - mean * mean, 0.0) ** 0.5
+        if rgb_std < 10 and rgb_min > 240:
+            return LayerPixelStats('background', bbox, transparent_ratio, '检测到白色/浅灰色背景')
+        if rgb_std < 10 and rgb_min > 200:
+            return LayerPixelStats('background', bbox, transparent_ratio, '检测到浅灰色背景')
+        for gray_val in _BACKGROUND_GRAY_VALUES:
+            if rgb_min > gray_val - 5 and rgb_max < gray_val + 5:
+                return LayerPixelStats('background', bbox, transparent_ratio, f'检测到灰色背景 (值: {gray_val})')
+
+    if transparent_ratio > 0.8:
+        return LayerPixelStats('empty', bbox, transparent_ratio, f'图层 {transparent_ratio:.2%} 透明，可能为空图层')
+    if bbox is None:
+        return LayerPixelStats('empty', None, transparent_ratio)
+    return LayerPixelStats('content', bbox, transparent_ratio)
+
+
+def composite_layer_with_transparency(layer) -> Optional[Image.Image]:
+    """
+    使用透明背景合成图层，确保保持PSD的原始透明度
+    """
+    try:
+        # 获取图层尺寸
+        width = getattr(layer, 'width', 0)
+        height = getattr(layer, 'height', 0)
+
+        if width <= 0 or height <= 0:
+            return None
+
+        # 尝试多种合成方法
+        composed = None
+
+        # 方法1: 直接合成
+        try:
+            composed = layer.composite()
+        except Exception as e:
+            print(f'⚠️ 直接合成失败: {e}')
+
+        # 方法2: 如果直接合成失败，尝试使用透明背景
+        if composed is None:
+            try:
+                # 临时设置图层为可见
+                orig_visible = getattr(layer, 'visible', True)
+                if hasattr(layer, 'visible'):
+                    layer.visible = True
+
+                # 在透明背景上合成
+                composed = layer.composite()
+
+                # 恢复原始可见性
+                if hasattr(layer, 'visible'):
+                    layer.visible = orig_visible
+            except Exception as e:
+                print(f'⚠️ 透明背景合成失败: {e}')
+
+        if composed is None:
+            return None
+
+        # 确保合成结果是RGBA格式
+        if composed.mode != 'RGBA':
+            composed = composed.convert('RGBA')
+        return composed
+
+    except Exception as e:
+        print(f'⚠️ 透明合成失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+def render_layer_image(layer) -> Optional[Image.Image]:
+    """
+    合成单个图层（含群组、文字层）的位图，空图层返回 None
+
+    渲染期间临时强制图层可见，以便被隐藏的图层也能输出位图。
+    """
+    orig_visible = getattr(layer, 'visible', True)
+    try:
+        try:
+            if hasattr(layer, 'visible'):
+                layer.visible = True  # type: ignore[attr-defined]
+        except Exception:
+            pass
+
+        composed = composite_layer_with_transparency(layer)
+        if composed is None:
+            return None
+        return finalize_layer_image(composed)
+    finally:
+        # 還原可見性
+        try:
+            if hasattr(layer, 'visible'):
+                layer.visible = orig_visible  # type: ignore[attr-defined]
+        except Exception:
+            pass
+
+
+def prepare_layer_image(composed: Image.Image) -> Tuple[Optional[Image.Image], LayerPixelStats]:
+    """
+    分类合成结果，返回 (可保存的RGBA位图或 None, 像素统计)；纯色背景和空图层位图为 None
+    """
+    if composed.mode != 'RGBA':
+        composed = composed.convert('RGBA')
+
+    stats = classify_layer_pixels(composed)
+    if stats.kind == 'background':
+        print(f'⚠️ {stats.reason}，设为透明')
+        return None, stats
+    if stats.kind == 'empty':
+        if stats.reason:
+            print(f'⚠️ {stats.reason}')
+        return None, stats
+    return composed, stats
+
+
+def finalize_layer_image(composed: Image.Image) -> Optional[Image.Image]:
+    """
+    把合成结果处理为可保存的图层位图：纯色背景和空图层返回 None
+    """
+    return prepare_layer_image(composed)[0]
+
+
+def trim_to_bbox(image: Image.Image, bbox: Optional[Tuple[int, int, int, int]]) -> Tuple[Image.Image, Tuple[int, int]]:
+    """
+    把位图裁剪到 alpha 边界框，返回 (裁剪后位图, 相对原位图左上角的偏移)
+    """
+    if bbox is None or bbox == (0, 0, image.width, image.height):
+        return image, (0, 0)
+    return image.crop(bbox), (bbox[0], bbox[1])
+
+
+class PSDLayerService:
+    """PSD图层按需栅格化服务"""
+
+    def __init__(self, psd_dir: str = PSD_DIR, max_open_files: int = 4):
+        self.psd_dir = psd_dir
+        # 同时保留在内存中的已解析PSD数量（LRU），避免每个图层请求都重新解析整个文件
+        self.max_open_files = max_open_files
+        self._file_locks: Dict[str, threading.Lock] = {}
+        self._file_locks_guard = threading.Lock()
+        self._open_files: "OrderedDict[str, List[Any]]" = OrderedDict()
+        self._open_files_guard = threading.Lock()
+
+    def layer_path(self, file_id: str, layer_index: int) -> str:
+        """图层位图缓存路径"""
+        return os.path.join(self.psd_dir, f'{file_id}_layer_{layer_index}.png')
+
+    def _empty_marker_path(self, file_id: str, layer_index: int) -> str:
+        """空图层标记文件路径（避免对空图层重复合成）"""
+        return os.path.join(self.psd_dir, f'{file_id}_layer_{layer_index}.empty')
+
+    def _get_file_lock(self, file_id: str) -> threading.Lock:
+        with self._file_locks_guard:
+            lock = self._file_locks.get(file_id)
+            if lock is None:
+                lock = threading.Lock()
+                self._file_locks[file_id] = lock
+            return lock
+
+    def register_psd(self, file_id: str, psd: PSDImage) -> None:
+        """登记刚解析好的PSD对象，首次图层请求时无需重新打开文件"""
+        self._remember_layers(file_id, flatten_psd_layers(psd))
+
+    def _remember_layers(self, file_id: str, flat_layers: List[Any]) -> None:
+        with self._open_files_guard:
+            self._open_files[file_id] = flat_layers
+            self._open_files.move_to_end(file_id)
+            while len(self._open_files) > self.max_open_files:
+                self._open_files.popitem(last=False)
+
+    def _get_flat_layers(self, file_id: str) -> Optional[List[Any]]:
+        """获取文件的展开图层列表（调用方需持有该文件的锁）"""
+        with self._open_files_guard:
+            flat_layers = self._open_files.get(file_id)
+            if flat_layers is not None:
+                self._open_files.move_to_end(file_id)
+                return flat_layers
+
+        psd_path = os.path.join(self.psd_dir, f'{file_id}.psd')
+        if not os.path.exists(psd_path):
+            return None
+        flat_layers = flatten_psd_layers(PSDImage.open(psd_path))
+        self._remember_layers(file_id, flat_layers)
+        return flat_layers
+
+    def rasterize_layer(self, file_id: str, layer_index: int) -> Optional[str]:
+        """
+        获取图层位图路径，首次请求时合成并持久化
+
+        Returns:
+            位图文件路径；图层不存在或为空图层时返回 None
+        """
+        layer_path = self.layer_path(file_id, layer_index)
+        if os.path.exists(layer_path):
+            return layer_path
+        marker_path = self._empty_marker_path(file_id, layer_index)
+        if os.path.exists(marker_path):
+            return None
+
+        # 去重别名：由内容对象生成后硬链接过来，重复上传的文件共享同一份栅格化结果
+        content_id = psd_content_store.resolve(file_id)
+        if content_id and content_id != file_id:
+            source_path = self.rasterize_layer(content_id, layer_index)
+            if source_path is None:
+                return None
+            link_or_copy(source_path, layer_path)
+            return layer_path
+
+        with self._get_file_lock(file_id):
+            # 等待锁期间可能已被其他请求生成
+            if os.path.exists(layer_path):
+                return layer_path
+            if os.path.exists(marker_path):
+                return None
+
+            flat_layers = self._get_flat_layers(file_id)
+            if flat_layers is None or not 0 <= layer_index < len(flat_layers):
+                return None
+
+            layer = flat_layers[layer_index]
+            try:
+                composed = render_layer_image(layer)
+            except Exception as e:
+                print(f'❌ 生成圖層 {layer_index} ({getattr(layer, "name", "")}) 圖像失敗: {e}')
+                return None
+
+            if composed is None:
+                with open(marker_path, 'w') as f:
+                    f.write('')
+                print(f'⚠️ 圖層 {layer_index} ({getattr(layer, "name", "")}) 為空圖像，跳過')
+                return None
+
+            # 先写临时文件再原子替换，避免并发读取到半截文件
+            image_encoder.save_png(composed, layer_path)
+            print(f'✅ 按需生成圖層 {layer_index} ({getattr(layer, "name", "")}) 圖像: {composed.size}')
+            return layer_path
+
+    def discard_layer(self, file_id: str, layer_index: int) -> None:
+        """
+        删除图层位图并写入空图层标记，之后不会再从PSD重新合成已删除的图层
+        """
+        layer_path = self.layer_path(file_id, layer_index)
+        with self._get_file_lock(file_id):
+            with open(self._empty_marker_path(file_id, layer_index), 'w') as f:
+                f.write('')
+            if os.path.exists(layer_path):
+                os.remove(layer_path)
+            image_encoder.remove_variants(layer_path)
+
+    def evict(self, file_id: str) -> None:
+        """释放内存中的PSD对象（磁盘缓存保留）"""
+        with self._open_files_guard:
+            self._open_files.pop(file_id, None)
+
+
+# 全局实例
+psd_layer_service = PSDLayerService()
@@ -0,0 +1,356 @@
+"""
+PSD图层元数据存储
+
+图层元数据保存在 SQLite 中，以 (file_id, layer_index) 为主键：
+- 单个图层的读取和修改只涉及一行，不再整份读写 {file_id}_metadata.json
+- 所有修改在 BEGIN IMMEDIATE 事务中完成，并发编辑不会互相覆盖
+- 图层顺序由 position 列维护，新图层索引由 next_index 计数器分配
+- 每次修改递增 version（图层状态版本），供派生数据判断是否过期；
+  只有重新导入整个文件才递增 composite_version，合成图缓存以它为键
+- 旧版本遗留的 {file_id}_metadata.json 在首次访问时自动导入
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from services.config_service import FILES_DIR
+
+PSD_DIR = os.path.join(FILES_DIR, "psd")
+
+# psd_files 表中单独成列的字段，其余顶层字段存入 extra
+_FILE_COLUMNS = ('width', 'height', 'original_filename', 'content_id')
+
+
+class LayerNotFoundError(LookupError):
+    """图层或PSD文件不存在"""
+
+
+class PSDMetadataStore:
+    """基于 SQLite 的PSD图层元数据存储"""
+
+    def __init__(self, psd_dir: str = PSD_DIR, db_path: Optional[str] = None):
+        self.psd_dir = psd_dir
+        self.db_path = db_path or os.path.join(psd_dir, 'psd_layers.db')
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        """每个线程一个连接（手动管理事务）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        if not self._schema_ready:
+            self._create_schema(conn)
+        return conn
+
+    def _create_schema(self, conn: sqlite3.Connection) -> None:
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS psd_files (
+                    file_id TEXT PRIMARY KEY,
+                    width INTEGER,
+                    height INTEGER,
+                    original_filename TEXT,
+                    content_id TEXT,
+                    extra TEXT NOT NULL DEFAULT '{}',
+                    next_index INTEGER NOT NULL DEFAULT 0,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    composite_version INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS psd_layers (
+                    file_id TEXT NOT NULL,
+                    layer_index INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (file_id, layer_index)
+                );
+                CREATE INDEX IF NOT EXISTS idx_psd_layers_position ON psd_layers(file_id, position);
+            """)
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(psd_files)')}
+            if 'version' not in columns:
+                conn.execute('ALTER TABLE psd_files ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+            if 'composite_version' not in columns:
+                conn.execute('ALTER TABLE psd_files ADD COLUMN composite_version INTEGER NOT NULL DEFAULT 0')
+            self._schema_ready = True
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """写事务：开始时即获取写锁，异常时回滚"""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    # ---------- 文件级操作 ----------
+
+    def _insert_file(self, conn: sqlite3.Connection, file_id: str, metadata: Dict[str, Any]) -> None:
+        layers = metadata.get('layers', [])
+        extra = {k: v for k, v in metadata.items() if k not in _FILE_COLUMNS and k != 'layers'}
+        next_index = max((layer['index'] for layer in layers), default=-1) + 1
+        # 整体替换已有文件时版本继续递增，避免派生缓存误用旧版本
+        row = conn.execute(
+            'SELECT version, composite_version FROM psd_files WHERE file_id = ?', (file_id,)
+        ).fetchone()
+        version, composite_version = (row[0] + 1, row[1] + 1) if row else (0, 0)
+        conn.execute('DELETE FROM psd_layers WHERE file_id = ?', (file_id,))
+        conn.execute(
+            'INSERT OR REPLACE INTO psd_files '
+            '(file_id, width, height, original_filename, content_id, extra, next_index, version, composite_version) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (file_id, metadata.get('width'), metadata.get('height'), metadata.get('original_filename'),
+             metadata.get('content_id'), json.dumps(extra, ensure_ascii=False), next_index, version,
+             composite_version)
+        )
+        conn.executemany(
+            'INSERT INTO psd_layers (file_id, layer_index, position, data) VALUES (?, ?, ?, ?)',
+            [(file_id, layer['index'], position, json.dumps(layer, ensure_ascii=False))
+             for position, layer in enumerate(layers)]
+        )
+
+    def _ensure_imported(self, conn: sqlite3.Connection, file_id: str) -> bool:
+        """文件是否在库中；不在库中但有旧版 JSON 元数据时导入"""
+        if conn.execute('SELECT 1 FROM psd_files WHERE file_id = ?', (file_id,)).fetchone():
+            return True
+        legacy_path = os.path.join(self.psd_dir, f'{file_id}_metadata.json')
+        if not os.path.exists(legacy_path):
+            return False
+        with open(legacy_path, 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if not conn.execute('SELECT 1 FROM psd_files WHERE file_id = ?', (file_id,)).fetchone():
+                self._insert_file(conn, file_id, metadata)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        print(f'📥 已导入旧版图层元数据: {file_id}')
+        return True
+
+    def save_file(self, file_id: str, metadata: Dict[str, Any]) -> None:
+        """写入（或整体替换）一个PSD文件的元数据"""
+        with self._transaction() as conn:
+            self._insert_file(conn, file_id, metadata)
+
+    def has_file(self, file_id: str) -> bool:
+        return self._ensure_imported(self._connect(), file_id)
+
+    def get_content_id(self, file_id: str) -> Optional[str]:
+        """去重别名对应的内容对象ID"""
+        conn = self._connect()
+        if not self._ensure_imported(conn, file_id):
+            return None
+        row = conn.execute('SELECT content_id FROM psd_files WHERE file_id = ?', (file_id,)).fetchone()
+        return row[0] if row else None
+
+    def get_version(self, file_id: str) -> int:
+        """图层状态版本（不在库中的文件视为 0）"""
+        conn = self._connect()
+        if not self._ensure_imported(conn, file_id):
+            return 0
+        row = conn.execute('SELECT version FROM psd_files WHERE file_id = ?', (file_id,)).fetchone()
+        return row[0] if row else 0
+
+    def get_composite_version(self, file_id: str) -> int:
+        """像素版本（只在影响像素的变化时递增，不在库中的文件视为 0）"""
+        conn = self._connect()
+        if not self._ensure_imported(conn, file_id):
+            return 0
+        row = conn.execute('SELECT composite_version FROM psd_files WHERE file_id = ?', (file_id,)).fetchone()
+        return row[0] if row else 0
+
+    def bump_version(self, file_id: str) -> None:
+        """图层位图等元数据之外的内容发生变化时手动递增版本（合成图只来自原始文件，不受影响）"""
+        conn = self._connect()
+        if not self._ensure_imported(conn, file_id):
+            return
+        with self._transaction() as conn:
+            self._bump_version(conn, file_id)
+
+    def _bump_version(self, conn: sqlite3.Connection, file_id: str) -> None:
+        conn.execute('UPDATE psd_files SET version = version + 1 WHERE file_id = ?', (file_id,))
+
+    def get_metadata(self, file_id: str) -> Optional[Dict[str, Any]]:
+        """组装与原 {file_id}_metadata.json 相同结构的元数据"""
+        conn = self._connect()
+        if not self._ensure_imported(conn, file_id):
+            return None
+        row = conn.execute(
+            'SELECT width, height, original_filename, content_id, extra FROM psd_files WHERE file_id = ?',
+            (file_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        layers = [
+            json.loads(data) for (data,) in conn.execute(
+                'SELECT data FROM psd_layers WHERE file_id = ? ORDER BY position', (file_id,)
+            )
+        ]
+        metadata: Dict[str, Any] = {
+            'width': row[0],
+            'height': row[1],
+            'layers': layers,
+            'original_filename': row[2],
+        }
+        if row[3]:
+            metadata['content_id'] = row[3]
+        metadata.update(json.loads(row[4]))
+        return metadata
+
+    def clone_file(self, source_id: str, file_id: str,
+                   transform: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+        """以 source_id 的元数据为基础创建新文件（transform 可修改元数据）"""
+        metadata = self.get_metadata(source_id)
+        if metadata is None:
+            raise LayerNotFoundError(f'PSD metadata not found: {source_id}')
+        metadata = transform(metadata)
+        self.save_file(file_id, metadata)
+        return metadata
+
+    # ---------- 图层级操作 ----------
+
+    def get_layer(self, file_id: str, layer_index: int) -> Optional[Dict[str, Any]]:
+        conn = self._connect()
+        if not self._ensure_imported(conn, file_id):
+            return None
+        row = conn.execute(
+            'SELECT data FROM psd_layers WHERE file_id = ? AND layer_index = ?', (file_id, layer_index)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def allocate_layer_indices(self, file_id: str, count: int = 1) -> int:
+        """原子地分配 count 个新图层索引，返回起始索引"""
+        conn = self._connect()
+        if not self._ensure_imported(conn, file_id):
+            raise LayerNotFoundError(f'PSD metadata not found: {file_id}')
+        with self._transaction() as conn:
+            row = conn.execute('SELECT next_index FROM psd_files WHERE file_id = ?', (file_id,)).fetchone()
+            start = row[0]
+            conn.execute('UPDATE psd_files SET next_index = ? WHERE file_id = ?', (start + count, file_id))
+        return start
+
+    def append_layers(self, file_id: str, layers: List[Dict[str, Any]]) -> None:
+        """把新图层追加到图层列表末尾（索引需事先通过 allocate_layer_indices 分配）"""
+        with self._transaction() as conn:
+            self._append_layers(conn, file_id, layers)
+            self._bump_version(conn, file_id)
+
+    def _append_layers(self, conn: sqlite3.Connection, file_id: str, layers: List[Dict[str, Any]]) -> None:
+        row = conn.execute(
+            'SELECT COALESCE(MAX(position), -1) FROM psd_layers WHERE file_id = ?', (file_id,)
+        ).fetchone()
+        position = row[0] + 1
+        conn.executemany(
+            'INSERT OR REPLACE INTO psd_layers (file_id, layer_index, position, data) VALUES (?, ?, ?, ?)',
+            [(file_id, layer['index'], position + offset, json.dumps(layer, ensure_ascii=False))
+             for offset, layer in enumerate(layers)]
+        )
+        max_index = max(layer['index'] for layer in layers) if layers else -1
+        conn.execute(
+            'UPDATE psd_files SET next_index = MAX(next_index, ?) WHERE file_id = ?', (max_index + 1, file_id)
+        )
+
+    def _update_layer(self, conn: sqlite3.Connection, file_id: str, layer_index: int,
+                      properties: Dict[str, Any]) -> Dict[str, Any]:
+        row = conn.execute(
+            'SELECT data FROM psd_layers WHERE file_id = ? AND layer_index = ?', (file_id, layer_index)
+        ).fetchone()
+        if row is None:
+            raise LayerNotFoundError(f'Layer not found: {layer_index}')
+        layer = json.loads(row[0])
+        # 只更新已有属性，与原先的行为一致
+        for key, value in properties.items():
+            if key in layer:
+                layer[key] = value
+        conn.execute(
+            'UPDATE psd_layers SET data = ? WHERE file_id = ? AND layer_index = ?',
+            (json.dumps(layer, ensure_ascii=False), file_id, layer_index)
+        )
+        return layer
+
+    def _delete_layer(self, conn: sqlite3.Connection, file_id: str, layer_index: int) -> None:
+        conn.execute('DELETE FROM psd_layers WHERE file_id = ? AND layer_index = ?', (file_id, layer_index))
+
+    def _reorder_layers(self, conn: sqlite3.Connection, file_id: str, layer_order: List[int]) -> None:
+        """按给定顺序重排；不在列表中的图层被移除（与原先的行为一致）"""
+        existing = {
+            index for (index,) in conn.execute(
+                'SELECT layer_index FROM psd_layers WHERE file_id = ?', (file_id,)
+            )
+        }
+        ordered = [index for index in dict.fromkeys(layer_order) if index in existing]
+        conn.executemany(
+            'UPDATE psd_layers SET position = ? WHERE file_id = ? AND layer_index = ?',
+            [(position, file_id, index) for position, index in enumerate(ordered)]
+        )
+        dropped = existing - set(ordered)
+        conn.executemany(
+            'DELETE FROM psd_layers WHERE file_id = ? AND layer_index = ?',
+            [(file_id, index) for index in dropped]
+        )
+
+    def update_layer(self, file_id: str, layer_index: int, properties: Dict[str, Any]) -> Dict[str, Any]:
+        """更新单个图层的属性，返回更新后的图层"""
+        return self.apply_batch(file_id, [
+            {'op': 'update', 'index': layer_index, 'properties': properties}
+        ])[0]
+
+    def delete_layer(self, file_id: str, layer_index: int) -> None:
+        self.apply_batch(file_id, [{'op': 'delete', 'index': layer_index}])
+
+    def reorder_layers(self, file_id: str, layer_order: List[int]) -> None:
+        self.apply_batch(file_id, [{'op': 'reorder', 'order': layer_order}])
+
+    def apply_batch(self, file_id: str, operations: List[Dict[str, Any]]) -> List[Any]:
+        """
+        在一个事务中执行多个图层操作，任一操作失败则全部回滚
+
+        支持的操作：
+            {'op': 'update', 'index': int, 'properties': dict}
+            {'op': 'delete', 'index': int}
+            {'op': 'reorder', 'order': [int, ...]}
+
+        Returns:
+            每个操作的结果（update 返回更新后的图层，其余为 None）
+        """
+        conn = self._connect()
+        if not self._ensure_imported(conn, file_id):
+            raise LayerNotFoundError(f'PSD metadata not found: {file_id}')
+
+        results: List[Any] = []
+        with self._transaction() as conn:
+            for operation in operations:
+                op = operation.get('op')
+                if op == 'update':
+                    results.append(self._update_layer(
+                        conn, file_id, int(operation['index']), operation.get('properties') or {}
+                    ))
+                elif op == 'delete':
+                    self._delete_layer(conn, file_id, int(operation['index']))
+                    results.append(None)
+                elif op == 'reorder':
+                    self._reorder_layers(conn, file_id, [int(i) for i in operation['order']])
+                    results.append(None)
+                else:
+                    raise ValueError(f'Unsupported layer operation: {op}')
+            self._bump_version(conn, file_id)
+        return results
+
+
+# 全局实例
+psd_metadata_store = PSDMetadataStore()
@@ -0,0 +1,400 @@
+"""
+PSD图层多进程栅格化引擎
+
+图层合成和PNG编码都是CPU密集型操作，受GIL限制多线程无法加速。
+本引擎把PSD图层树拆分为互相独立的工作单元（顶层图层/群组，过大的群组会继续拆分），
+分发到进程池中，每个工作进程自行打开PSD文件并自底向上栅格化自己负责的子树，
+被拆分的群组由主进程用工作进程返回的子图块合成，
+最后按图层索引汇总为与原先一致的 layers_info 结构。
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from psd_tools import PSDImage
+
+from services.psd_layer_service import PSD_DIR, build_layer_info, prepare_layer_image, trim_to_bbox
+from utils.image_encoder import image_encoder
+from utils.psd_compositor import LayerTile, composite_group, composite_leaf
+
+# 工作进程数，默认等于CPU核数
+DEFAULT_MAX_WORKERS = int(os.getenv('PSD_RASTER_WORKERS', '0')) or (os.cpu_count() or 1)
+# 图层数少于该值时直接在线程池中串行处理，避免进程启动和重复解析PSD的开销
+MIN_LAYERS_FOR_POOL = 16
+# 每个工作进程平均分到的工作单元数，用于平衡大小不一的群组
+UNITS_PER_WORKER = 4
+
+
+@dataclass
+class RasterUnit:
+    """一个独立的栅格化工作单元"""
+    path: Tuple[int, ...]          # 从PSD根节点到该图层的子节点下标路径
+    start_index: int               # 该图层在全局先序遍历中的索引
+    parent_index: Optional[int]    # 父图层索引
+    size: int                      # 子树图层数（含自身）
+    recurse: bool = True           # False 表示被拆分的群组：子图层由其他单元处理，群组本身由主进程合成
+
+
+def _count_subtree(layer) -> int:
+    """统计子树中的图层数（含自身）"""
+    count = 1
+    if layer.is_group():
+        try:
+            for child in layer:
+                count += _count_subtree(child)
+        except Exception:
+            pass
+    return count
+
+
+def _resolve_layer(psd: PSDImage, path: Tuple[int, ...]):
+    """根据子节点下标路径定位图层"""
+    node = psd
+    for child_pos in path:
+        node = list(node)[child_pos]
+    return node
+
+
+def _save_layer_tile(
+    layer_info: Dict[str, Any],
+    tile: Optional[LayerTile],
+    file_id: str,
+    psd_dir: str,
+) -> None:
+    """
+    把图块处理为图层位图并保存，回填 image_url
+
+    位图会裁剪到非透明区域，left/top/width/height 更新为裁剪后的位置，
+    原始范围和裁剪偏移记录在 layer_info['trim'] 中，画布按新位置放置即可与原图对齐。
+    """
+    idx = layer_info['index']
+    composed, stats = prepare_layer_image(tile.image) if tile is not None else (None, None)
+
+    if composed is None:
+        layer_info['image_url'] = None
+        return
+
+    trimmed, (offset_x, offset_y) = trim_to_bbox(composed, stats.bbox)
+    new_left = tile.left + offset_x
+    new_top = tile.top + offset_y
+    layer_info['trim'] = {
+        'offset_x': new_left - layer_info['left'],
+        'offset_y': new_top - layer_info['top'],
+        'original_left': layer_info['left'],
+        'original_top': layer_info['top'],
+        'original_width': layer_info['width'] or composed.width,
+        'original_height': layer_info['height'] or composed.height,
+    }
+    layer_info.update({
+        'left': new_left,
+        'top': new_top,
+        'width': trimmed.width,
+        'height': trimmed.height,
+    })
+
+    layer_path = os.path.join(psd_dir, f'{file_id}_layer_{idx}.png')
+    image_encoder.save_png(trimmed, layer_path)
+    layer_info['image_url'] = f'/api/psd/layer/{file_id}/{idx}'
+
+
+def build_trim_report(file_id: str, layers_info: List[Dict[str, Any]], psd_dir: str = PSD_DIR) -> Dict[str, Any]:
+    """
+    汇总裁剪统计：裁掉的像素数、对应的原始RGBA字节数以及实际写入的PNG字节数
+    """
+    layers = []
+    original_pixels = 0
+    trimmed_pixels = 0
+    png_bytes = 0
+    for info in layers_info:
+        trim = info.get('trim')
+        if not trim or not info.get('image_url'):
+            continue
+        layer_path = os.path.join(psd_dir, f'{file_id}_layer_{info["index"]}.png')
+        layer_png_bytes = os.path.getsize(layer_path) if os.path.exists(layer_path) else 0
+        layer_original = trim['original_width'] * trim['original_height']
+        layer_trimmed = info['width'] * info['height']
+
+        original_pixels += layer_original
+        trimmed_pixels += layer_trimmed
+        png_bytes += layer_png_bytes
+        layers.append({
+            'index': info['index'],
+            'name': info['name'],
+            'original_size': [trim['original_width'], trim['original_height']],
+            'trimmed_size': [info['width'], info['height']],
+            'offset': [trim['offset_x'], trim['offset_y']],
+            'raw_bytes_saved': (layer_original - layer_trimmed) * 4,
+            'png_bytes': layer_png_bytes,
+        })
+
+    return {
+        'file_id': file_id,
+        'layers_exported': len(layers),
+        'layers_trimmed': sum(1 for layer in layers if layer['raw_bytes_saved'] > 0),
+        'original_pixels': original_pixels,
+        'trimmed_pixels': trimmed_pixels,
+        'raw_bytes_saved': (original_pixels - trimmed_pixels) * 4,
+        'png_bytes': png_bytes,
+        'layers': layers,
+    }
+
+
+def rasterize_subtree(
+    layer,
+    start_index: int,
+    parent_index: Optional[int],
+    file_id: str,
+    psd_dir: str = PSD_DIR,
+) -> Tuple[List[Dict[str, Any]], Optional[LayerTile]]:
+    """
+    自底向上栅格化一个图层及其子图层，保存PNG
+
+    每个叶子图层只合成一次，群组位图由子图块叠加得到（见 utils.psd_compositor）。
+
+    Returns:
+        (先序排列的图层信息, 子树根图层的原始图块)
+    """
+    layers_info: List[Dict[str, Any]] = []
+    current_index = start_index
+
+    def process(node, node_parent: Optional[int]) -> Optional[LayerTile]:
+        nonlocal current_index
+        idx = current_index
+        current_index += 1
+
+        layer_info = build_layer_info(node, idx, node_parent)
+        # 先占位，保证输出为先序顺序
+        layers_info.append(layer_info)
+
+        tile: Optional[LayerTile] = None
+        try:
+            if node.is_group():
+                child_tiles = []
+                try:
+                    for child in node:
+                        child_tiles.append((child, process(child, idx)))
+                except Exception as e:
+                    print(f'Warning: Failed to traverse group {idx}: {e}')
+                tile = composite_group(node, child_tiles)
+            else:
+                tile = composite_leaf(node)
+            _save_layer_tile(layer_info, tile, file_id, psd_dir)
+        except Exception as e:
+            print(f'❌ 生成圖層 {idx} ({layer_info["name"]}) 圖像失敗: {e}')
+            layer_info['image_url'] = None
+
+        return tile
+
+    root_tile = process(layer, parent_index)
+    return layers_info, root_tile
+
+
+# 工作进程内最近打开的PSD（同一文件的多个工作单元只解析一次）
+_worker_psd: Dict[str, Any] = {}
+
+
+def _rasterize_unit_worker(
+    psd_path: str,
+    file_id: str,
+    psd_dir: str,
+    unit: RasterUnit,
+) -> Tuple[List[Dict[str, Any]], Optional[LayerTile]]:
+    """
+    工作进程入口：独立打开PSD并栅格化一个工作单元
+
+    若该单元的父群组被拆分到了多个单元，则一并返回根图块，供主进程合成父群组。
+    """
+    cache_key = (psd_path, os.path.getmtime(psd_path))
+    if _worker_psd.get('key') != cache_key:
+        _worker_psd['psd'] = PSDImage.open(psd_path)
+        _worker_psd['key'] = cache_key
+    psd = _worker_psd['psd']
+    layer = _resolve_layer(psd, unit.path)
+    layers_info, root_tile = rasterize_subtree(
+        layer, unit.start_index, unit.parent_index, file_id, psd_dir
+    )
+    return layers_info, (root_tile if unit.parent_index is not None else None)
+
+
+def _compose_split_groups(
+    psd: PSDImage,
+    split_units: List[RasterUnit],
+    tiles_by_index: Dict[int, Optional[LayerTile]],
+    file_id: str,
+    psd_dir: str,
+) -> List[Dict[str, Any]]:
+    """
+    在主进程中用工作进程返回的子图块合成被拆分的群组（从最深的群组开始）
+    """
+    layers_info = []
+    for unit in sorted(split_units, key=lambda u: u.start_index, reverse=True):
+        group = _resolve_layer(psd, unit.path)
+        layer_info = build_layer_info(group, unit.start_index, unit.parent_index)
+
+        child_tiles = []
+        child_index = unit.start_index + 1
+        for child in group:
+            child_tiles.append((child, tiles_by_index.get(child_index)))
+            child_index += _count_subtree(child)
+
+        tile = composite_group(group, child_tiles)
+        tiles_by_index[unit.start_index] = tile
+        try:
+            _save_layer_tile(layer_info, tile, file_id, psd_dir)
+        except Exception as e:
+            print(f'❌ 生成圖層 {unit.start_index} ({layer_info["name"]}) 圖像失敗: {e}')
+            layer_info['image_url'] = None
+        layers_info.append(layer_info)
+    return layers_info
+
+
+def plan_raster_units(psd: PSDImage, target_units: int) -> List[RasterUnit]:
+    """
+    把图层树拆分为工作单元
+
+    先以顶层图层为单元；若单元数不足且存在较大的群组，
+    则把最大的群组拆成“群组自身”+“每个子图层”多个单元，直到单元数足够。
+    """
+    def make_units(container, base_path: Tuple[int, ...], start_index: int,
+                   parent_index: Optional[int]) -> List[RasterUnit]:
+        units = []
+        index = start_index
+        for child_pos, child in enumerate(container):
+            size = _count_subtree(child)
+            units.append(RasterUnit(
+                path=base_path + (child_pos,),
+                start_index=index,
+                parent_index=parent_index,
+                size=size,
+            ))
+            index += size
+        return units
+
+    units = make_units(psd, (), 0, None)
+
+    while len(units) < target_units:
+        splittable = [u for u in units if u.recurse and u.size > 1]
+        if not splittable:
+            break
+        largest = max(splittable, key=lambda u: u.size)
+        group = _resolve_layer(psd, largest.path)
+        children = make_units(group, largest.path, largest.start_index + 1, largest.start_index)
+        position = units.index(largest)
+        units[position:position + 1] = [
+            RasterUnit(
+                path=largest.path,
+                start_index=largest.start_index,
+                parent_index=largest.parent_index,
+                size=1,
+                recurse=False,
+            ),
+            *children,
+        ]
+
+    return units
+
+
+class PSDRasterEngine:
+    """基于进程池的PSD图层栅格化引擎"""
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS, psd_dir: str = PSD_DIR):
+        self.max_workers = max(1, max_workers)
+        self.psd_dir = psd_dir
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # 服务进程是多线程的（uvicorn、线程池），直接 fork 可能复制其他线程持有的锁导致死锁。
+            # 支持时使用 forkserver：工作进程从单线程的 forkserver 进程 fork，
+            # 主模块和本模块只在 forkserver 中导入一次，不会像 spawn 那样在每个工作进程中重新导入 main.py 及全部路由。
+            mp_context = None
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                mp_context = multiprocessing.get_context('forkserver')
+                mp_context.set_forkserver_preload(['__main__', __name__])
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=mp_context,
+            )
+        return self._executor
+
+    def _extract_serial(self, psd: PSDImage, file_id: str) -> List[Dict[str, Any]]:
+        layers_info: List[Dict[str, Any]] = []
+        for unit in plan_raster_units(psd, 1):
+            layer = _resolve_layer(psd, unit.path)
+            unit_infos, _ = rasterize_subtree(layer, unit.start_index, None, file_id, self.psd_dir)
+            layers_info.extend(unit_infos)
+        return layers_info
+
+    async def extract_layers_info(self, psd_path: str, file_id: str) -> List[Dict[str, Any]]:
+        """
+        并行栅格化PSD的所有图层并返回图层信息列表（按图层索引排序）
+
+        Args:
+            psd_path: PSD文件路径
+            file_id: PSD文件ID（用于图层PNG命名）
+        """
+        loop = asyncio.get_running_loop()
+
+        psd = await loop.run_in_executor(None, PSDImage.open, psd_path)
+        total_layers = sum(_count_subtree(layer) for layer in psd)
+        print(f'🎨 開始解析 PSD 文件，總圖層數: {total_layers}')
+
+        if self.max_workers == 1 or total_layers < MIN_LAYERS_FOR_POOL:
+            layers_info = await loop.run_in_executor(None, self._extract_serial, psd, file_id)
+        else:
+            units = plan_raster_units(psd, self.max_workers * UNITS_PER_WORKER)
+            # 大单元优先提交，减少尾部等待
+            units.sort(key=lambda u: u.size, reverse=True)
+            print(f'🚀 使用 {self.max_workers} 個進程並行柵格化 {len(units)} 個工作單元')
+
+            worker_units = [u for u in units if u.recurse]
+            split_units = [u for u in units if not u.recurse]
+
+            executor = self._get_executor()
+            results = await asyncio.gather(*[
+                loop.run_in_executor(
+                    executor, _rasterize_unit_worker, psd_path, file_id, self.psd_dir, unit
+                )
+                for unit in worker_units
+            ])
+
+            layers_info = []
+            tiles_by_index: Dict[int, Optional[LayerTile]] = {}
+            for unit, (unit_infos, root_tile) in zip(worker_units, results):
+                layers_info.extend(unit_infos)
+                if root_tile is not None:
+                    tiles_by_index[unit.start_index] = root_tile
+
+            if split_units:
+                layers_info.extend(await loop.run_in_executor(
+                    None, _compose_split_groups, psd, split_units, tiles_by_index,
+                    file_id, self.psd_dir
+                ))
+            layers_info.sort(key=lambda info: info['index'])
+
+        await loop.run_in_executor(None, self._write_trim_report, file_id, layers_info)
+        print(f'✅ PSD 解析完成，共提取 {len(layers_info)} 個圖層')
+        return layers_info
+
+    def _write_trim_report(self, file_id: str, layers_info: List[Dict[str, Any]]) -> None:
+        report = build_trim_report(file_id, layers_info, self.psd_dir)
+        report_path = os.path.join(self.psd_dir, f'{file_id}_trim_stats.json')
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'✂️ 圖層裁剪: {report["layers_trimmed"]}/{report["layers_exported"]} 個圖層，'
+              f'節省 {report["raw_bytes_saved"] / (1024 * 1024):.2f} MB 原始像素數據')
+
+    def shutdown(self) -> None:
+        """关闭进程池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# 全局实例
+psd_raster_engine = PSDRasterEngine()
@@ -0,0 +1,235 @@
+"""
+PSD縮放任務隊列
+
+縮放流程（解析、合成檢測圖、方案請求、渲染）耗時較長，放在 HTTP 請求裡容易被代理超時。
+提交後立即返回 job_id，由固定數量的後台 worker 依次執行，每個階段的進度通過 socket.io
+推送 'psd_resize_job' 事件給提交方（notify_rooms），也可以通過 GET 輪詢、列出和取消任務。
+
+取消是協作式的：運行中的任務只做標記，在下一個階段邊界停止。線程池中的解析和渲染
+無法被中斷，強行取消協程會讓清理函數在渲染仍在讀寫臨時目錄時將其刪除。
+
+任務的具體流程由調用方傳入的 runner 協程實現，服務本身只負責排隊、併發、狀態和通知。
+"""
+
+import asyncio
+import os
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from services.websocket_state import sio
+
+# 同時執行的縮放任務數
+DEFAULT_WORKERS = int(os.getenv('PSD_RESIZE_WORKERS', '2'))
+# 保留的已結束任務記錄數
+MAX_FINISHED_JOBS = int(os.getenv('PSD_RESIZE_MAX_FINISHED_JOBS', '200'))
+# 服務關閉時等待運行中任務到達階段邊界的秒數
+SHUTDOWN_TIMEOUT = float(os.getenv('PSD_RESIZE_SHUTDOWN_TIMEOUT', '10'))
+
+JOB_EVENT = 'psd_resize_job'
+FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+
+
+class JobCancelledError(Exception):
+    """任務已被取消"""
+
+
+class ResizeJob:
+    """單個縮放任務的狀態"""
+
+    def __init__(self, job_id: str, kind: str, params: Dict[str, Any],
+                 runner: Callable[['ResizeJob'], Awaitable[Dict[str, Any]]],
+                 cleanup: Optional[Callable[[], None]] = None,
+                 notify_rooms: Optional[List[str]] = None):
+        self.job_id = job_id
+        self.kind = kind
+        self.params = params
+        self.runner = runner
+        self.cleanup = cleanup
+        self.notify_rooms = notify_rooms or []
+        self.status = 'queued'
+        self.stage = 'queued'
+        self.progress = 0.0
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.cancel_requested = False
+        self.task: Optional[asyncio.Task] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'params': self.params,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': round(self.progress, 3),
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+    def check_cancelled(self) -> None:
+        if self.cancel_requested:
+            raise JobCancelledError(self.job_id)
+
+    async def report(self, stage: str, progress: float) -> None:
+        """更新階段進度並推送給前端，階段之間調用可及時響應取消"""
+        self.check_cancelled()
+        self.stage = stage
+        self.progress = progress
+        await _emit(self)
+
+
+async def _emit(job: ResizeJob) -> None:
+    if not job.notify_rooms:
+        return
+    try:
+        await sio.emit(JOB_EVENT, job.to_dict(), room=job.notify_rooms)
+    except Exception as e:
+        print(f"⚠️ 推送縮放任務事件失敗: {e}")
+
+
+class PSDResizeJobService:
+    """有界 worker 池的縮放任務隊列"""
+
+    def __init__(self, workers: int = DEFAULT_WORKERS):
+        self.workers = max(1, workers)
+        self._jobs: "OrderedDict[str, ResizeJob]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+
+    def _ensure_workers(self) -> None:
+        # 首次提交時在當前事件循環中啟動 worker
+        if self._queue is None or any(task.done() for task in self._worker_tasks):
+            if self._queue is None:
+                self._queue = asyncio.Queue()
+            self._worker_tasks = [task for task in self._worker_tasks if not task.done()]
+            while len(self._worker_tasks) < self.workers:
+                self._worker_tasks.append(asyncio.create_task(self._worker()))
+
+    async def submit(self, kind: str, params: Dict[str, Any],
+                     runner: Callable[[ResizeJob], Awaitable[Dict[str, Any]]],
+                     cleanup: Optional[Callable[[], None]] = None,
+                     notify_rooms: Optional[List[str]] = None) -> ResizeJob:
+        """
+        提交任務
+
+        Args:
+            kind: 任務類型（如 resize-by-id、auto-resize）
+            params: 任務參數（僅用於展示）
+            runner: 執行任務的協程函數，返回結果字典
+            cleanup: 任務結束（含取消和失敗）後執行的清理函數
+            notify_rooms: 接收任務事件的 socket.io 房間（提交方的連接或畫布），為空時只能輪詢
+        """
+        self._ensure_workers()
+        job = ResizeJob(uuid.uuid4().hex, kind, params, runner, cleanup, notify_rooms)
+        self._jobs[job.job_id] = job
+        self._prune()
+        await self._queue.put(job)
+        await _emit(job)
+        print(f"📥 縮放任務已提交: {job.job_id} ({kind})，排隊中 {self._queue.qsize()} 個")
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.status == 'queued':
+                    job.task = asyncio.create_task(self._run(job))
+                    await asyncio.wait([job.task])
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: ResizeJob) -> None:
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            await job.report('started', 0.0)
+            job.result = await job.runner(job)
+            job.status = 'done'
+            job.stage = 'done'
+            job.progress = 1.0
+            print(f"✅ 縮放任務完成: {job.job_id}，耗時 {time.time() - job.started_at:.2f}s")
+        except (JobCancelledError, asyncio.CancelledError):
+            job.status = 'cancelled'
+            print(f"🛑 縮放任務已取消: {job.job_id}")
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            print(f"❌ 縮放任務失敗: {job.job_id}: {e}")
+            traceback.print_exc()
+        finally:
+            await self._finish(job)
+
+    async def _finish(self, job: ResizeJob) -> None:
+        job.finished_at = time.time()
+        if job.cleanup:
+            try:
+                job.cleanup()
+            except Exception as e:
+                print(f"⚠️ 縮放任務清理失敗: {e}")
+        await _emit(job)
+
+    def get(self, job_id: str) -> Optional[ResizeJob]:
+        return self._jobs.get(job_id)
+
+    def list(self, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        return [job.to_dict() for job in reversed(self._jobs.values())
+                if status is None or job.status == status]
+
+    async def cancel(self, job_id: str) -> Optional[ResizeJob]:
+        """取消任務：排隊中的直接標記取消，運行中的在當前階段結束後停止（不中斷線程池中的步驟）"""
+        job = self._jobs.get(job_id)
+        if job is None or job.status in FINISHED_STATUSES:
+            return job
+        job.cancel_requested = True
+        if job.status == 'queued':
+            job.status = 'cancelled'
+            await self._finish(job)
+        return job
+
+    async def close(self) -> None:
+        """服務關閉：取消所有任務，等待運行中的任務到達階段邊界後停止 worker"""
+        for job in list(self._jobs.values()):
+            if job.status not in FINISHED_STATUSES:
+                await self.cancel(job.job_id)
+        running = [job.task for job in self._jobs.values() if job.task is not None and not job.task.done()]
+        if running:
+            _, pending = await asyncio.wait(running, timeout=SHUTDOWN_TIMEOUT)
+            if pending:
+                print(f"⚠️ 關閉時仍有 {len(pending)} 個縮放任務未結束，強制停止")
+                for task in pending:
+                    task.cancel()
+                await asyncio.wait(pending)
+        for task in self._worker_tasks:
+            task.cancel()
+        if self._worker_tasks:
+            await asyncio.wait(self._worker_tasks)
+        self._worker_tasks = []
+        self._queue = None
+
+    def _prune(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED_STATUSES]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def get_stats(self) -> Dict[str, Any]:
+        counts: Dict[str, int] = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            'workers': self.workers,
+            'queued': self._queue.qsize() if self._queue else 0,
+            'jobs': counts,
+        }
+
+
+# 全局實例
+psd_resize_job_service = PSDResizeJobService()
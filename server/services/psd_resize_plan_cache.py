@@ -0,0 +1,160 @@
+"""
+PSD縮放方案緩存
+
+Gemini 生成的圖層調整方案只取決於 PSD 內容、圖層幾何和目標尺寸，
+同一模板縮放到同一尺寸時直接返回緩存的方案，不再調用 API。
+
+緩存鍵 = SHA-256(PSD內容哈希 + 圖層幾何表指紋 + 目標寬高 + 方案版本)，
+方案持久化在 SQLite 中，支持 TTL 過期和按最近訪問時間的 LRU 淘汰，
+命中/未命中等計數按進程累計。
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from services.config_service import FILES_DIR
+
+PSD_DIR = os.path.join(FILES_DIR, "psd")
+
+# 提示詞或解析邏輯變化時遞增，使舊方案失效
+PLAN_SCHEMA_VERSION = 2
+# 方案有效期（秒），默認 30 天
+DEFAULT_TTL_SECONDS = int(os.getenv('PSD_PLAN_CACHE_TTL', str(30 * 24 * 3600)))
+# 最多保留的方案數量
+DEFAULT_MAX_ENTRIES = int(os.getenv('PSD_PLAN_CACHE_MAX_ENTRIES', '2000'))
+
+# 參與指紋計算的圖層字段
+_GEOMETRY_FIELDS = ('id', 'name', 'type', 'level', 'visible', 'left', 'top', 'right', 'bottom')
+
+
+def layers_fingerprint(layers_info: List[Dict[str, Any]]) -> str:
+    """圖層幾何表指紋"""
+    rows = [[info.get(field) for field in _GEOMETRY_FIELDS] for info in layers_info]
+    payload = json.dumps(rows, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResizePlanCache:
+    """持久化的縮放方案緩存（TTL + LRU）"""
+
+    def __init__(self, db_path: Optional[str] = None,
+                 ttl_seconds: int = DEFAULT_TTL_SECONDS,
+                 max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.db_path = db_path or os.path.join(PSD_DIR, 'resize_plans.db')
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0, 'stored': 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS resize_plans (
+                    plan_key TEXT PRIMARY KEY,
+                    plan TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    hit_count INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_resize_plans_access ON resize_plans(last_access)')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    @staticmethod
+    def make_key(content_hash: str, layers_info: List[Dict[str, Any]],
+                 target_width: int, target_height: int) -> str:
+        """
+        計算緩存鍵
+
+        Args:
+            content_hash: PSD文件內容哈希
+            layers_info: get_psd_layers_info 返回的圖層信息
+            target_width: 目標寬度
+            target_height: 目標高度
+        """
+        raw = f'{PLAN_SCHEMA_VERSION}:{content_hash}:{layers_fingerprint(layers_info)}:{target_width}x{target_height}'
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, plan_key: str) -> Optional[List[Dict[str, Any]]]:
+        """查找方案，過期或不存在時返回 None"""
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT plan, created_at FROM resize_plans WHERE plan_key = ?', (plan_key,)
+        ).fetchone()
+        now = time.time()
+        if row is None:
+            self._count('misses')
+            return None
+        if now - row[1] > self.ttl_seconds:
+            conn.execute('DELETE FROM resize_plans WHERE plan_key = ?', (plan_key,))
+            self._count('expired')
+            self._count('misses')
+            return None
+
+        conn.execute(
+            'UPDATE resize_plans SET last_access = ?, hit_count = hit_count + 1 WHERE plan_key = ?',
+            (now, plan_key)
+        )
+        self._count('hits')
+        return json.loads(row[0])
+
+    def put(self, plan_key: str, plan: List[Dict[str, Any]]) -> None:
+        """保存方案並按需淘汰"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO resize_plans (plan_key, plan, created_at, last_access, hit_count) '
+            'VALUES (?, ?, ?, ?, 0)',
+            (plan_key, json.dumps(plan, ensure_ascii=False), now, now)
+        )
+        self._count('stored')
+        self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        expired = conn.execute(
+            'DELETE FROM resize_plans WHERE created_at < ?', (now - self.ttl_seconds,)
+        ).rowcount
+        if expired:
+            self._count('expired', expired)
+
+        total = conn.execute('SELECT COUNT(*) FROM resize_plans').fetchone()[0]
+        overflow = total - self.max_entries
+        if overflow > 0:
+            evicted = conn.execute(
+                'DELETE FROM resize_plans WHERE plan_key IN '
+                '(SELECT plan_key FROM resize_plans ORDER BY last_access ASC LIMIT ?)',
+                (overflow,)
+            ).rowcount
+            self._count('evicted', evicted)
+
+    def invalidate(self, plan_key: str) -> None:
+        self._connect().execute('DELETE FROM resize_plans WHERE plan_key = ?', (plan_key,))
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        stats['entries'] = self._connect().execute('SELECT COUNT(*) FROM resize_plans').fetchone()[0]
+        stats['ttl_seconds'] = self.ttl_seconds
+        stats['max_entries'] = self.max_entries
+        return stats
+
+
+# 全局實例
+resize_plan_cache = ResizePlanCache()
@@ -1,22 +1,48 @@
 # services/websocket_service.py
-from services.websocket_state import sio, get_all_socket_ids
+from services.db_service import db_service
+from services.websocket_state import sio, get_connection, requester_rooms, session_update_rooms
 import traceback
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
+
+
+async def can_access_canvas(user_info: Optional[Dict[str, Any]], canvas_id: str) -> bool:
+    # Same rule as GET /api/canvas/{id}: guests may watch, signed-in users only their own canvases
+    try:
+        owner = await db_service.get_canvas_owner(canvas_id)
+    except Exception as e:
+        print(f"Failed to check canvas owner for {canvas_id}: {e}")
+        return False
+    user_id = user_info.get('user_id') if user_info else None
+    return not (owner and user_id and owner != user_id)
+
+
+async def verified_requester_rooms(user_info: Optional[Dict[str, Any]], socket_id: Optional[str] = None,
+                                   canvas_id: Optional[str] = None) -> List[str]:
+    """requester_rooms for ids supplied by an HTTP caller: the socket only if the same user opened it,
+    the canvas only if the user may access it."""
+    user_id = user_info.get('user_id') if user_info else None
+    connection = get_connection(socket_id) if socket_id else None
+    if connection is not None:
+        socket_user = connection.get('user')
+        if (socket_user.get('user_id') if socket_user else None) == user_id:
+            return requester_rooms(socket_id)
+    if canvas_id and await can_access_canvas(user_info, canvas_id):
+        return requester_rooms(None, canvas_id)
+    return []
 
 
 async def broadcast_session_update(session_id: str, canvas_id: str | None, event: Dict[str, Any]):
-    socket_ids = get_all_socket_ids()
-    if socket_ids:
-        try:
-            for socket_id in socket_ids:
-                await sio.emit('session_update', {
-                    'canvas_id': canvas_id,
-                    'session_id': session_id,
-                    **event
-                }, room=socket_id)
-        except Exception as e:
-            print(f"Error broadcasting session update for {session_id}: {e}")
-            traceback.print_exc()
+    # One emit per event: the packet is encoded once and delivered only to sockets
+    # subscribed to the session or canvas
+    try:
+        await sio.emit('session_update', {
+            'canvas_id': canvas_id,
+            'session_id': session_id,
+            **event
+        }, room=session_update_rooms(session_id, canvas_id))
+    except Exception as e:
+        print(f"Error broadcasting session update for {session_id}: {e}")
+        traceback.print_exc()
 
 # compatible with legacy codes
 # TODO: All Broadcast should have a canvas_id
@@ -1,6 +1,6 @@
 # services/websocket_state.py
 import socketio
-from typing import Dict
+from typing import Dict, List, Optional
 
 sio = socketio.AsyncServer(
     cors_allowed_origins="*",
@@ -9,6 +9,33 @@ sio = socketio.AsyncServer(
 
 active_connections: Dict[str, dict] = {}
 
+def session_room(session_id: str) -> str:
+    return f'session:{session_id}'
+
+
+def canvas_room(canvas_id: str) -> str:
+    return f'canvas:{canvas_id}'
+
+
+def session_update_rooms(session_id: str, canvas_id: Optional[str] = None) -> List[str]:
+    """Only sockets subscribed to the session or its canvas receive its updates; a socket
+    that has not subscribed to anything receives none."""
+    rooms = [session_room(session_id)]
+    if canvas_id:
+        rooms.append(canvas_room(canvas_id))
+    return rooms
+
+
+def requester_rooms(socket_id: Optional[str] = None, canvas_id: Optional[str] = None) -> List[str]:
+    """Rooms for progress events of one HTTP request: the requesting socket if it is
+    connected, otherwise whoever is viewing the canvas. Empty means nobody to notify."""
+    if socket_id and socket_id in active_connections:
+        return [socket_id]
+    if canvas_id:
+        return [canvas_room(canvas_id)]
+    return []
+
+
 def add_connection(socket_id: str, user_info: dict = None):
     active_connections[socket_id] = user_info or {}
     print(f"New connection added: {socket_id}, total connections: {len(active_connections)}")
@@ -18,6 +45,9 @@ def remove_connection(socket_id: str):
         del active_connections[socket_id]
         print(f"Connection removed: {socket_id}, total connections: {len(active_connections)}")
 
+def get_connection(socket_id: str) -> Optional[dict]:
+    return active_connections.get(socket_id)
+
 def get_all_socket_ids():
     return list(active_connections.keys())
 
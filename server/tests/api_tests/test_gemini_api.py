@@ -105,7 +105,6 @@ def test_simple_api_call():
     try:
         from services.gemini_psd_resize_service import GeminiPSDResizeService
         from PIL import Image
-        import base64
         from io import BytesIO
         import asyncio
         
@@ -116,8 +115,7 @@ def test_simple_api_call():
         img = Image.new('RGB', (100, 100), color='red')
         buffer = BytesIO()
         img.save(buffer, format='PNG')
-        buffer.seek(0)
-        image_base64 = base64.b64encode(buffer.read()).decode('utf-8')
+        image_data = buffer.getvalue()
         
         # 简单的测试提示
         prompt = "Describe this image in one sentence."
@@ -127,7 +125,8 @@ def test_simple_api_call():
         async def test_call():
             response = await service.call_gemini_api(
                 prompt=prompt,
-                image_base64=image_base64,
+                image_data=image_data,
+                mime_type='image/png',
                 temperature=0.1,
                 max_tokens=100
             )
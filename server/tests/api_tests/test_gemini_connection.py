@@ -29,14 +29,13 @@ async def test_simple_api_call():
         # 创建一个简单的测试图像
         print("\n2️⃣ 创建测试图像...")
         from PIL import Image
-        import base64
         from io import BytesIO
         
         # 创建一个 100x100 的红色图像
         img = Image.new('RGB', (100, 100), color='red')
         buffer = BytesIO()
         img.save(buffer, format='PNG')
-        image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        image_data = buffer.getvalue()
         print("✅ 测试图像创建成功")
         
         # 调用 API
@@ -47,7 +46,8 @@ async def test_simple_api_call():
         
         response = await service.call_gemini_api(
             prompt=simple_prompt,
-            image_base64=image_base64,
+            image_data=image_data,
+            mime_type='image/png',
             temperature=0.1,
             max_tokens=100
         )
@@ -0,0 +1,221 @@
+"""
+Gemini 调用网关测试
+
+覆盖令牌桶的突发与补充速率、相同请求合并、重试与配额错误以及按调用方的并发限制。
+时间由假时钟驱动，asyncio.sleep 只推进假时钟，不会真正等待。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_gemini_gateway.py -q
+"""
+
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import services.gemini_gateway as gateway_module
+from services.gemini_gateway import GeminiGateway, GeminiQuotaError, TokenBucket
+
+_real_sleep = asyncio.sleep
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay, result=None):
+        self.sleeps.append(delay)
+        self.now += delay
+        await _real_sleep(0)
+        return result
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(gateway_module, 'time', types.SimpleNamespace(monotonic=fake.monotonic))
+    monkeypatch.setattr(asyncio, 'sleep', fake.sleep)
+    return fake
+
+
+# ---- 令牌桶 ----
+
+def test_bucket_allows_burst_then_waits_for_refill(clock):
+    bucket = TokenBucket(rpm=15, burst=5)
+
+    async def run():
+        return [await bucket.acquire() for _ in range(7)]
+
+    waits = asyncio.run(run())
+    assert waits[:5] == [0.0] * 5
+    # 补充速率 (15 - 5) / 60 = 1/6 个/秒
+    assert waits[5] == pytest.approx(6.0)
+    assert waits[6] == pytest.approx(6.0)
+
+
+def test_bucket_never_exceeds_rpm_in_any_minute(clock):
+    bucket = TokenBucket(rpm=15, burst=5)
+
+    async def run():
+        times = []
+        for _ in range(60):
+            await bucket.acquire()
+            times.append(clock.now)
+        return times
+
+    times = asyncio.run(run())
+    for start in times:
+        assert sum(1 for t in times if start <= t < start + 60) <= 15
+
+
+def test_bucket_burst_is_capped_by_rpm():
+    bucket = TokenBucket(rpm=3, burst=10)
+    assert bucket.capacity == 3
+    assert bucket.rate == pytest.approx(1 / 60)
+
+
+# ---- 请求合并 ----
+
+def test_concurrent_calls_with_same_key_share_one_request(clock):
+    gateway = GeminiGateway(rpm=100, burst=100)
+    calls = []
+
+    async def request():
+        calls.append(1)
+        await _real_sleep(0.01)
+        return 'plan'
+
+    async def run():
+        results = await asyncio.gather(*(gateway.call('resize', request, coalesce_key='k') for _ in range(3)))
+        return results, dict(gateway._inflight)
+
+    results, inflight = asyncio.run(run())
+    assert results == ['plan'] * 3
+    assert len(calls) == 1
+    assert gateway.get_stats()['coalesced'] == 2
+    assert inflight == {}
+
+
+def test_different_or_finished_keys_are_not_coalesced(clock):
+    gateway = GeminiGateway(rpm=100, burst=100)
+    calls = []
+
+    async def request():
+        calls.append(1)
+        return len(calls)
+
+    async def run():
+        first = await asyncio.gather(gateway.call('a', request, coalesce_key='x'),
+                                     gateway.call('a', request, coalesce_key='y'))
+        again = await gateway.call('a', request, coalesce_key='x')
+        return first, again
+
+    first, again = asyncio.run(run())
+    assert sorted(first) == [1, 2] and again == 3
+
+
+def test_coalesced_callers_all_receive_the_error(clock):
+    gateway = GeminiGateway(rpm=100, burst=100)
+
+    async def request():
+        await _real_sleep(0.01)
+        raise ValueError('bad request')
+
+    async def run():
+        return await asyncio.gather(*(gateway.call('a', request, coalesce_key='k') for _ in range(2)),
+                                    return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_cancelled_waiter_does_not_cancel_shared_request(clock):
+    gateway = GeminiGateway(rpm=100, burst=100)
+
+    async def request():
+        await _real_sleep(0.02)
+        return 'done'
+
+    async def run():
+        impatient = asyncio.ensure_future(gateway.call('a', request, coalesce_key='k'))
+        patient = asyncio.ensure_future(gateway.call('a', request, coalesce_key='k'))
+        await _real_sleep(0.005)
+        impatient.cancel()
+        return await patient
+
+    assert asyncio.run(run()) == 'done'
+
+
+# ---- 重试 ----
+
+def test_transient_errors_are_retried_with_backoff(clock):
+    gateway = GeminiGateway(rpm=100, burst=100)
+    attempts = []
+
+    async def request():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RuntimeError('503 UNAVAILABLE')
+        return 'ok'
+
+    assert asyncio.run(gateway.call('a', request)) == 'ok'
+    assert clock.sleeps == [5, 10]
+    assert gateway.get_stats()['retries'] == 2
+
+
+def test_quota_error_becomes_gemini_quota_error_after_retries(clock):
+    gateway = GeminiGateway(rpm=100, burst=100)
+
+    async def request():
+        raise RuntimeError('429 RESOURCE_EXHAUSTED')
+
+    with pytest.raises(GeminiQuotaError):
+        asyncio.run(gateway.call('a', request, max_retries=2))
+    assert gateway.get_stats()['failures'] == 1
+
+
+def test_other_errors_are_not_retried(clock):
+    gateway = GeminiGateway(rpm=100, burst=100)
+    attempts = []
+
+    async def request():
+        attempts.append(1)
+        raise ValueError('invalid argument')
+
+    with pytest.raises(ValueError):
+        asyncio.run(gateway.call('a', request))
+    assert len(attempts) == 1
+
+
+# ---- 并发限制 ----
+
+def test_caller_concurrency_limit(clock):
+    gateway = GeminiGateway(rpm=100, burst=100, caller_concurrency={'resize': 1})
+    active = {'resize': 0, 'arrange': 0}
+    peak = {'resize': 0, 'arrange': 0}
+
+    def request_for(caller):
+        async def request():
+            active[caller] += 1
+            peak[caller] = max(peak[caller], active[caller])
+            await _real_sleep(0.01)
+            active[caller] -= 1
+        return request
+
+    async def run():
+        await asyncio.gather(*(gateway.call('resize', request_for('resize')) for _ in range(3)),
+                             *(gateway.call('arrange', request_for('arrange')) for _ in range(3)))
+
+    asyncio.run(run())
+    assert peak == {'resize': 1, 'arrange': 2}
+    assert gateway.get_stats()['active_by_caller'] == {}
@@ -0,0 +1,100 @@
+"""
+增量 JSON 数组解析测试
+
+覆盖任意分块边界、字符串转义、嵌套结构以及解析失败的元素。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_incremental_json.py -q
+"""
+
+import json
+import os
+import sys
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from utils.incremental_json import IncrementalJSONArrayParser
+
+
+ITEMS = [
+    {'id': 1, 'name': 'plain', 'new_coords': {'left': 0, 'top': 0, 'right': 10, 'bottom': 10}},
+    {'id': 2, 'name': 'quote " and backslash \\ inside', 'warnings': []},
+    {'id': 3, 'name': 'brackets ] } [ { and comma , inside'},
+    {'id': 4, 'name': '中文名稱', 'tags': ['a', ['b', {'c': [1, 2]}]]},
+    {'id': 5, 'name': 'trailing backslash \\'},
+]
+
+
+def _feed_all(chunks):
+    parser = IncrementalJSONArrayParser()
+    items = []
+    for chunk in chunks:
+        items.extend(parser.feed(chunk))
+    return parser, items
+
+
+def test_whole_response_with_prose_and_code_fence():
+    text = 'Here is the plan:\n```json\n' + json.dumps(ITEMS, ensure_ascii=False, indent=2) + '\n```\nDone.'
+    parser, items = _feed_all([text])
+    assert items == ITEMS
+    assert parser.complete
+    assert parser.errors == 0
+
+
+def test_every_split_point_gives_same_items():
+    text = 'prefix ' + json.dumps(ITEMS, ensure_ascii=False)
+    for split in range(len(text) + 1):
+        parser, items = _feed_all([text[:split], text[split:]])
+        assert items == ITEMS, split
+        assert parser.complete
+
+
+def test_character_by_character():
+    text = json.dumps(ITEMS, ensure_ascii=False, indent=1)
+    parser, items = _feed_all(list(text))
+    assert items == ITEMS
+    assert parser.complete
+
+
+def test_items_are_returned_as_soon_as_they_close():
+    parser = IncrementalJSONArrayParser()
+    assert parser.feed('[{"id": 1}, {"id"') == [{'id': 1}]
+    assert parser.feed(': 2}') == [{'id': 2}]
+    assert not parser.complete
+    assert parser.feed(']') == []
+    assert parser.complete
+
+
+def test_escapes_split_across_chunks():
+    # 转义的反斜杠和引号正好落在分块边界上
+    text = r'[{"name": "a\\"}, {"name": "b\"]"}, {"name": "中"}]'
+    expected = [{'name': 'a\\'}, {'name': 'b"]'}, {'name': '中'}]
+    for split in range(len(text) + 1):
+        _, items = _feed_all([text[:split], text[split:]])
+        assert items == expected, split
+
+
+def test_scalar_elements_including_last_before_close():
+    _, items = _feed_all(['[1, "two", ', 'true, null, 3.5', ']'])
+    assert items == [1, 'two', True, None, 3.5]
+
+
+def test_invalid_element_is_skipped_and_counted():
+    parser, items = _feed_all(['[{"id": 1}, {"id": 2 "bad": 1}, {"id": 3}]'])
+    assert items == [{'id': 1}, {'id': 3}]
+    assert parser.errors == 1
+    assert parser.complete
+
+
+def test_truncated_stream_is_not_complete():
+    parser, items = _feed_all(['[{"id": 1}, {"id": 2'])
+    assert items == [{'id': 1}]
+    assert not parser.complete
+
+
+def test_input_after_close_is_ignored():
+    parser = IncrementalJSONArrayParser()
+    assert parser.feed('[{"id": 1}] trailing [{"id": 2}]') == [{'id': 1}]
+    assert parser.feed('[{"id": 3}]') == []
@@ -0,0 +1,130 @@
+"""
+图层像素分类测试
+
+覆盖空图层、纯色/灰色背景、有效内容的判定，以及跨分块边界的 alpha 紧致边界框。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_layer_pixels.py -q
+"""
+
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from services.psd_layer_service import _CLASSIFY_CHUNK_ROWS, classify_layer_pixels
+
+
+def _rgba(pixels):
+    return Image.fromarray(np.asarray(pixels, dtype=np.uint8), 'RGBA')
+
+
+def _reference_bbox(pixels):
+    ys, xs = np.nonzero(pixels[..., 3] > 10)
+    if len(xs) == 0:
+        return None
+    return int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+
+
+# ---- 空图层 ----
+
+def test_zero_size_image_is_empty():
+    stats = classify_layer_pixels(_rgba(np.zeros((0, 5, 4))))
+    assert stats.kind == 'empty' and stats.bbox is None and stats.transparent_ratio == 1.0
+
+
+def test_fully_transparent_is_empty():
+    stats = classify_layer_pixels(_rgba(np.zeros((20, 30, 4))))
+    assert stats.kind == 'empty'
+    assert stats.bbox is None
+    assert stats.transparent_ratio == 1.0
+
+
+def test_mostly_transparent_is_empty_but_keeps_bbox():
+    pixels = np.zeros((20, 20, 4))
+    pixels[2:4, 5:8] = (255, 0, 0, 255)
+    stats = classify_layer_pixels(_rgba(pixels))
+    assert stats.kind == 'empty'
+    assert stats.bbox == (5, 2, 8, 4)
+
+
+def test_alpha_threshold_boundaries():
+    # alpha == 10 既不算内容也不算透明
+    pixels = np.zeros((10, 10, 4))
+    pixels[..., 3] = 10
+    stats = classify_layer_pixels(_rgba(pixels))
+    assert stats.transparent_ratio == 0.0
+    assert stats.kind == 'empty' and stats.bbox is None
+
+
+# ---- 背景 ----
+
+def test_opaque_white_is_background():
+    pixels = np.full((16, 16, 4), 255)
+    stats = classify_layer_pixels(_rgba(pixels))
+    assert stats.kind == 'background'
+    assert stats.bbox == (0, 0, 16, 16)
+
+
+def test_opaque_light_gray_is_background():
+    pixels = np.full((16, 16, 4), 255)
+    pixels[..., :3] = 210
+    assert classify_layer_pixels(_rgba(pixels)).kind == 'background'
+
+
+def test_opaque_psd_gray_with_noise_is_background():
+    rng = np.random.default_rng(0)
+    pixels = np.full((32, 32, 4), 255)
+    pixels[..., :3] = 128 + rng.integers(-4, 5, size=(32, 32, 3))
+    stats = classify_layer_pixels(_rgba(pixels))
+    assert stats.kind == 'background'
+    assert '128' in stats.reason
+
+
+def test_background_rule_needs_fully_opaque_layer():
+    pixels = np.full((16, 16, 4), 255)
+    pixels[0, 0, 3] = 254
+    assert classify_layer_pixels(_rgba(pixels)).kind == 'content'
+
+
+def test_opaque_colorful_layer_is_content():
+    rng = np.random.default_rng(1)
+    pixels = np.full((40, 40, 4), 255)
+    pixels[..., :3] = rng.integers(0, 256, size=(40, 40, 3))
+    stats = classify_layer_pixels(_rgba(pixels))
+    assert stats.kind == 'content'
+    assert stats.bbox == (0, 0, 40, 40)
+
+
+# ---- 分块统计 ----
+
+def test_bbox_spans_chunk_boundary():
+    height = _CLASSIFY_CHUNK_ROWS * 2 + 17
+    pixels = np.zeros((height, 50, 4))
+    pixels[_CLASSIFY_CHUNK_ROWS - 3:_CLASSIFY_CHUNK_ROWS * 2 + 5, 7:49] = (0, 0, 0, 255)
+    stats = classify_layer_pixels(_rgba(pixels))
+    assert stats.kind == 'content'
+    assert stats.bbox == (7, _CLASSIFY_CHUNK_ROWS - 3, 49, _CLASSIFY_CHUNK_ROWS * 2 + 5)
+
+
+def test_transparency_in_a_later_chunk_disables_background_rule():
+    pixels = np.full((_CLASSIFY_CHUNK_ROWS + 10, 8, 4), 255)
+    pixels[-1, -1, 3] = 0
+    assert classify_layer_pixels(_rgba(pixels)).kind == 'content'
+
+
+def test_random_layers_match_reference_statistics():
+    rng = np.random.default_rng(2)
+    for _ in range(20):
+        height = int(rng.integers(1, _CLASSIFY_CHUNK_ROWS * 3))
+        width = int(rng.integers(1, 60))
+        pixels = rng.integers(0, 256, size=(height, width, 4))
+        pixels[..., 3] = np.where(rng.random((height, width)) < 0.5, 0, pixels[..., 3])
+        stats = classify_layer_pixels(_rgba(pixels))
+        assert stats.bbox == _reference_bbox(pixels)
+        assert stats.transparent_ratio == np.count_nonzero(pixels[..., 3] < 10) / (height * width)
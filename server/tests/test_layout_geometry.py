@@ -0,0 +1,183 @@
+"""
+布局几何后处理测试
+
+覆盖 ID 匹配、框的缩放与平移、重叠框对查找和重叠处理。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_layout_geometry.py -q
+"""
+
+import os
+import sys
+
+import numpy as np
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from utils.layout_geometry import (
+    GridIndex, find_overlapping_pairs, fit_boxes, match_by_id, normalize_id, resolve_overlaps, xywh_to_boxes
+)
+
+
+def _brute_force_pairs(boxes):
+    pairs = set()
+    for i in range(len(boxes)):
+        for j in range(i + 1, len(boxes)):
+            a, b = boxes[i], boxes[j]
+            if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                pairs.add((i, j))
+    return pairs
+
+
+def _random_boxes(rng, count, extent=500.0, max_size=80.0):
+    origin = rng.uniform(0, extent, size=(count, 2))
+    size = rng.uniform(1, max_size, size=(count, 2))
+    return np.hstack([origin, origin + size])
+
+
+# ---- ID 匹配 ----
+
+def test_normalize_id():
+    assert normalize_id(' "ID: Layer_1" ') == 'layer_1'
+    assert normalize_id('#42') == '42'
+    assert normalize_id(7) == '7'
+
+
+def test_match_by_id_exact_normalized_and_unmatched():
+    elements = [{'id': 'a1'}, {'id': 'B2'}, {'id': 3}]
+    items = [{'id': 'a1'}, {'id': 'id: b2'}, {'id': '3'}, {'id': 'zz'}]
+    matched, unmatched = match_by_id(items, elements)
+    assert [(item['id'], element['id']) for item, element in matched] == [('a1', 'a1'), ('id: b2', 'B2'), ('3', 3)]
+    assert unmatched == [{'id': 'zz'}]
+
+
+def test_match_by_id_ambiguous_normalized_id_is_not_guessed():
+    elements = [{'id': 'Logo'}, {'id': 'logo'}]
+    matched, unmatched = match_by_id([{'id': 'LOGO'}, {'id': 'logo'}], elements)
+    assert [(item['id'], element['id']) for item, element in matched] == [('logo', 'logo')]
+    assert unmatched == [{'id': 'LOGO'}]
+
+
+# ---- 缩放与平移 ----
+
+def test_fit_boxes_scales_oversized_box_keeping_aspect_ratio():
+    boxes, scales, valid = fit_boxes([[0, 0, 200, 100]], 100, 100)
+    assert valid.tolist() == [True]
+    assert scales[0] == 0.5
+    assert boxes.tolist() == [[0, 0, 100, 50]]
+
+
+def test_fit_boxes_moves_boxes_into_canvas():
+    boxes, scales, _ = fit_boxes([[-10, -5, 20, 25], [90, 95, 110, 105]], 100, 100)
+    assert scales.tolist() == [1.0, 1.0]
+    assert boxes.tolist() == [[0, 0, 30, 30], [80, 90, 100, 100]]
+
+
+def test_fit_boxes_leaves_invalid_boxes_untouched():
+    boxes, scales, valid = fit_boxes([[10, 10, 10, 50], [5, 5, 1, 1]], 100, 100)
+    assert valid.tolist() == [False, False]
+    assert scales.tolist() == [1.0, 1.0]
+    assert boxes.tolist() == [[10, 10, 10, 50], [5, 5, 1, 1]]
+
+
+def test_fit_boxes_integer_results_stay_inside_canvas():
+    rng = np.random.default_rng(0)
+    boxes = _random_boxes(rng, 200, extent=300, max_size=250) - 50
+    fitted, _, valid = fit_boxes(boxes, 97, 61, integer=True)
+    assert valid.all()
+    assert np.array_equal(fitted, np.round(fitted))
+    assert (fitted[:, :2] >= 0).all()
+    assert (fitted[:, 2] <= 97).all() and (fitted[:, 3] <= 61).all()
+    assert ((fitted[:, 2:] - fitted[:, :2]) >= 1).all()
+
+
+def test_xywh_to_boxes():
+    assert xywh_to_boxes([[1, 2, 3, 4]]).tolist() == [[1, 2, 4, 6]]
+
+
+# ---- 重叠框对 ----
+
+def test_find_overlapping_pairs_matches_brute_force():
+    rng = np.random.default_rng(1)
+    for count in (0, 1, 2, 50, 300):
+        boxes = _random_boxes(rng, count)
+        assert find_overlapping_pairs(boxes) == _brute_force_pairs(boxes.tolist())
+
+
+def test_touching_edges_do_not_overlap():
+    boxes = [[0, 0, 10, 10], [10, 0, 20, 10], [0, 10, 10, 20]]
+    assert find_overlapping_pairs(boxes) == set()
+
+
+def test_find_overlapping_pairs_respects_active_mask():
+    boxes = [[0, 0, 10, 10], [5, 5, 15, 15], [8, 8, 20, 20]]
+    assert find_overlapping_pairs(boxes) == {(0, 1), (0, 2), (1, 2)}
+    assert find_overlapping_pairs(boxes, np.array([True, False, True])) == {(0, 2)}
+
+
+def test_grid_index_query_matches_brute_force():
+    rng = np.random.default_rng(2)
+    boxes = _random_boxes(rng, 200)
+    index = GridIndex.for_boxes(boxes)
+    for i, box in enumerate(boxes.tolist()):
+        index.insert(i, box)
+    for query in _random_boxes(rng, 50).tolist():
+        expected = {i for i, box in enumerate(boxes.tolist()) if _brute_force_pairs([query, box])}
+        assert set(index.query(query)) == expected
+
+
+# ---- 重叠处理 ----
+
+def test_resolve_overlaps_pushes_apart_new_overlap():
+    original = [[0, 0, 10, 10], [50, 0, 60, 10]]
+    boxes = [[0, 0, 10, 10], [5, 0, 15, 10]]
+    resolved, moved, unresolved = resolve_overlaps(original, boxes, 100, 100)
+    assert moved == [1] and unresolved == []
+    assert resolved[0].tolist() == [0, 0, 10, 10]
+    assert resolved[1].tolist() == [10, 0, 20, 10]
+    assert find_overlapping_pairs(resolved) == set()
+
+
+def test_resolve_overlaps_keeps_original_overlaps():
+    # 原本文字就压在背景上，属于设计意图
+    original = [[0, 0, 100, 100], [10, 10, 30, 20]]
+    boxes = [[0, 0, 50, 50], [5, 5, 15, 10]]
+    resolved, moved, unresolved = resolve_overlaps(original, boxes, 50, 50)
+    assert moved == [] and unresolved == []
+    assert resolved.tolist() == boxes
+
+
+def test_resolve_overlaps_order_decides_who_moves():
+    original = [[0, 0, 10, 10], [50, 0, 60, 10]]
+    boxes = [[0, 0, 10, 10], [5, 0, 15, 10]]
+    resolved, moved, _ = resolve_overlaps(original, boxes, 100, 100, order=[1, 0])
+    assert moved == [0]
+    assert resolved[1].tolist() == [5, 0, 15, 10]
+
+
+def test_resolve_overlaps_reports_unresolved_when_no_room():
+    original = [[0, 0, 10, 10], [20, 0, 30, 10]]
+    boxes = [[0, 0, 10, 10], [0, 0, 10, 10]]
+    resolved, moved, unresolved = resolve_overlaps(original, boxes, 10, 10)
+    assert moved == [] and unresolved == [1]
+    assert resolved.tolist() == boxes
+
+
+def test_resolve_overlaps_ignores_inactive_boxes():
+    original = [[0, 0, 10, 10], [50, 0, 60, 10]]
+    boxes = [[0, 0, 10, 10], [5, 0, 15, 10]]
+    _, moved, unresolved = resolve_overlaps(original, boxes, 100, 100, active=np.array([True, False]))
+    assert moved == [] and unresolved == []
+
+
+def test_resolve_overlaps_random_layout_leaves_only_unresolved_overlaps():
+    rng = np.random.default_rng(3)
+    original = _random_boxes(rng, 80, extent=1000, max_size=40)
+    boxes = fit_boxes(original * 0.5 + rng.uniform(-15, 15, size=(80, 1)), 600, 600)[0]
+    resolved, moved, unresolved = resolve_overlaps(original, boxes, 600, 600)
+    assert moved
+    assert (resolved[:, :2] >= 0).all() and (resolved[:, 2:] <= 600).all()
+    new_pairs = find_overlapping_pairs(resolved) - find_overlapping_pairs(original)
+    assert all(i in unresolved or j in unresolved for i, j in new_pairs)
@@ -0,0 +1,144 @@
+"""
+会话消息增量同步测试
+
+覆盖 MessageSync.update 在追加、修改、截断消息时生成的 messages_delta，
+客户端已有历史（known_count）的处理、未变化时不发送，以及完整快照和画布检查。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_message_sync.py -q
+"""
+
+import os
+import sys
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from services.langgraph_service.message_sync import MessageSync, active_message_syncs, get_message_snapshot
+
+
+def _human(text, message_id):
+    return HumanMessage(content=text, id=message_id)
+
+
+def _ai(text, message_id):
+    return AIMessage(content=text, id=message_id)
+
+
+def _contents(delta):
+    return [message['content'] for message in delta['messages']]
+
+
+HISTORY = [_human('hi', 'm1'), _ai('hello', 'm2')]
+
+
+# ---- 增量 ----
+
+def test_first_update_sends_everything():
+    delta = MessageSync('s1').update(HISTORY)
+    assert delta['type'] == 'messages_delta'
+    assert delta['start'] == 0 and delta['total'] == 2
+    assert [message['role'] for message in delta['messages']] == ['user', 'assistant']
+    assert _contents(delta) == ['hi', 'hello']
+
+
+def test_appended_messages_only_send_the_tail():
+    sync = MessageSync('s1')
+    sync.update(HISTORY)
+    delta = sync.update(HISTORY + [_human('resize it', 'm3')])
+    assert delta['start'] == 2 and delta['total'] == 3
+    assert _contents(delta) == ['resize it']
+
+
+def test_unchanged_messages_send_nothing_and_reuse_conversion():
+    sync = MessageSync('s1')
+    sync.update(HISTORY)
+    converted = list(sync.messages)
+    # 同 id 同内容的新对象也视为未变化
+    assert sync.update([_human('hi', 'm1'), _ai('hello', 'm2')]) is None
+    assert all(a is b for a, b in zip(sync.messages, converted))
+
+
+def test_changed_message_resends_from_first_change():
+    sync = MessageSync('s1')
+    sync.update(HISTORY + [_ai('thinking', 'm3')])
+    delta = sync.update(HISTORY + [_ai('thinking harder', 'm3')])
+    assert delta['start'] == 2 and delta['total'] == 3
+    assert _contents(delta) == ['thinking harder']
+
+
+def test_change_in_the_middle_resends_everything_after_it():
+    sync = MessageSync('s1')
+    sync.update(HISTORY + [_human('more', 'm3')])
+    delta = sync.update([_human('hi', 'm1'), _ai('edited', 'm2'), _human('more', 'm3')])
+    assert delta['start'] == 1
+    assert _contents(delta) == ['edited', 'more']
+
+
+def test_truncated_list_sends_empty_tail_with_new_total():
+    sync = MessageSync('s1')
+    sync.update(HISTORY + [_human('more', 'm3')])
+    delta = sync.update(HISTORY)
+    assert delta == {'type': 'messages_delta', 'start': 2, 'messages': [], 'total': 2}
+    # 截断后再次收到同样的列表不再发送
+    assert sync.update(HISTORY) is None
+
+
+def test_client_can_replay_deltas():
+    sync = MessageSync('s1')
+    client = []
+    for messages in (HISTORY, HISTORY + [_ai('a', 'm3')], HISTORY + [_ai('ab', 'm3')], HISTORY[:1]):
+        delta = sync.update(messages)
+        client = client[:delta['start']] + delta['messages']
+    assert client == sync.messages
+    assert [message['content'] for message in client] == ['hi']
+
+
+# ---- 客户端已有的历史 ----
+
+def test_known_history_is_not_resent():
+    sync = MessageSync('s1', known_count=2)
+    delta = sync.update(HISTORY + [_human('new', 'm3')])
+    assert delta['start'] == 2
+    assert _contents(delta) == ['new']
+
+
+def test_known_history_only_is_unchanged():
+    sync = MessageSync('s1', known_count=2)
+    assert sync.update(HISTORY) is None
+    # 首次比较之后历史已转换，可以提供快照
+    assert sync.snapshot()['messages'][0]['content'] == 'hi'
+
+
+# ---- 快照 ----
+
+def test_snapshot_unavailable_before_known_history_is_converted():
+    sync = MessageSync('s1', known_count=1)
+    assert sync.snapshot() is None
+    sync.update(HISTORY)
+    snapshot = sync.snapshot()
+    assert snapshot['type'] == 'all_messages'
+    assert [message['content'] for message in snapshot['messages']] == ['hi', 'hello']
+    # 快照是副本，不会被之后的更新修改
+    snapshot['messages'].clear()
+    assert len(sync.messages) == 2
+
+
+@pytest.fixture
+def active_sync():
+    sync = MessageSync('s1', canvas_id='c1')
+    sync.update(HISTORY)
+    active_message_syncs['s1'] = sync
+    yield sync
+    active_message_syncs.clear()
+
+
+def test_get_message_snapshot_checks_canvas(active_sync):
+    assert get_message_snapshot('s1', 'c1') == active_sync.snapshot()
+    assert get_message_snapshot('s1', 'c2') is None
+    assert get_message_snapshot('s1', None) is None
+    assert get_message_snapshot('other', 'c1') is None
@@ -0,0 +1,193 @@
+"""
+聊天消息批量写入测试
+
+覆盖多个会话合并为一次写入、只写指定会话、数量上限和定时触发写入、
+写入失败后按原顺序放回缓冲区、连续失败后丢弃，以及关闭时写入剩余消息。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_message_writer.py -q
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import services.message_writer as message_writer_module
+from services.message_writer import MAX_FLUSH_ATTEMPTS, MessageWriter
+
+
+class FakeDB:
+    def __init__(self):
+        self.batches = []
+        self.failures = 0
+
+    async def create_messages(self, rows):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('database is locked')
+        self.batches.append(list(rows))
+
+    @property
+    def rows(self):
+        return [row for batch in self.batches for row in batch]
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDB()
+    monkeypatch.setattr(message_writer_module, 'db_service', fake)
+    return fake
+
+
+def _writer(**kwargs):
+    kwargs.setdefault('flush_interval_ms', 60000)
+    kwargs.setdefault('max_batch', 100)
+    return MessageWriter(**kwargs)
+
+
+# ---- 批量写入 ----
+
+def test_enqueue_does_not_write_until_flush(db):
+    async def run():
+        writer = _writer()
+        writer.enqueue('s1', 'user', 'hi')
+        writer.enqueue('s2', 'user', 'hey')
+        writer.enqueue('s1', 'assistant', 'hello')
+        assert db.batches == []
+        await writer.flush()
+        return writer
+
+    writer = asyncio.run(run())
+    assert db.batches == [[('s1', 'user', 'hi'), ('s1', 'assistant', 'hello'), ('s2', 'user', 'hey')]]
+    stats = writer.get_stats()
+    assert stats['written'] == 3 and stats['batches'] == 1 and stats['pending'] == 0
+
+
+def test_flush_single_session_keeps_others_pending(db):
+    async def run():
+        writer = _writer()
+        writer.enqueue('s1', 'user', 'hi')
+        writer.enqueue('s2', 'user', 'hey')
+        await writer.flush('s1')
+        await writer.flush('missing')
+        return writer
+
+    writer = asyncio.run(run())
+    assert db.rows == [('s1', 'user', 'hi')]
+    assert writer.get_stats()['pending'] == 1 and writer.get_stats()['pending_sessions'] == 1
+
+
+def test_max_batch_triggers_background_flush(db):
+    async def run():
+        writer = _writer(max_batch=2)
+        writer.enqueue('s1', 'user', 'a')
+        writer.enqueue('s1', 'assistant', 'b')
+        await asyncio.sleep(0)
+        return writer
+
+    asyncio.run(run())
+    assert db.batches == [[('s1', 'user', 'a'), ('s1', 'assistant', 'b')]]
+
+
+def test_interval_triggers_flush(db):
+    async def run():
+        writer = _writer(flush_interval_ms=10)
+        writer.enqueue('s1', 'user', 'a')
+        await asyncio.sleep(0.05)
+        return writer
+
+    writer = asyncio.run(run())
+    assert db.rows == [('s1', 'user', 'a')]
+    assert writer._timer is None
+
+
+# ---- 失败重试 ----
+
+def test_failed_batch_is_requeued_before_newer_messages(db):
+    db.failures = 1
+
+    async def run():
+        writer = _writer()
+        writer.enqueue('s1', 'user', 'first')
+        await writer.flush()
+        assert writer.get_stats()['pending'] == 1
+        writer.enqueue('s1', 'assistant', 'second')
+        await writer.flush()
+        return writer
+
+    writer = asyncio.run(run())
+    assert db.rows == [('s1', 'user', 'first'), ('s1', 'assistant', 'second')]
+    stats = writer.get_stats()
+    assert stats['failures'] == 1 and stats['dropped'] == 0
+    assert writer._attempts == {}
+
+
+def test_messages_dropped_after_max_attempts(db):
+    db.failures = MAX_FLUSH_ATTEMPTS
+
+    async def run():
+        writer = _writer()
+        writer.enqueue('s1', 'user', 'lost')
+        for _ in range(MAX_FLUSH_ATTEMPTS):
+            await writer.flush()
+        return writer
+
+    writer = asyncio.run(run())
+    assert db.rows == []
+    stats = writer.get_stats()
+    assert stats['dropped'] == 1 and stats['pending'] == 0
+    assert writer._attempts == {}
+
+
+def test_failure_schedules_a_retry(db):
+    db.failures = 1
+
+    async def run():
+        writer = _writer(flush_interval_ms=10)
+        writer.enqueue('s1', 'user', 'a')
+        await writer.flush()
+        assert writer._timer is not None
+        await asyncio.sleep(0.05)
+        return writer
+
+    asyncio.run(run())
+    assert db.rows == [('s1', 'user', 'a')]
+
+
+# ---- 关闭 ----
+
+def test_close_writes_remaining_messages_and_cancels_timer(db):
+    db.failures = 1
+
+    async def run():
+        writer = _writer()
+        writer.enqueue('s1', 'user', 'a')
+        writer.enqueue('s2', 'user', 'b')
+        timer = writer._timer
+        await writer.close()
+        return writer, timer
+
+    writer, timer = asyncio.run(run())
+    assert timer.cancelled()
+    assert sorted(db.rows) == [('s1', 'user', 'a'), ('s2', 'user', 'b')]
+    assert writer.get_stats()['pending'] == 0
+
+
+def test_close_gives_up_after_max_attempts(db):
+    db.failures = 100
+
+    async def run():
+        writer = _writer()
+        writer.enqueue('s1', 'user', 'a')
+        await writer.close()
+        return writer
+
+    writer = asyncio.run(run())
+    stats = writer.get_stats()
+    assert stats['failures'] == MAX_FLUSH_ATTEMPTS and stats['dropped'] == 1 and stats['pending'] == 0
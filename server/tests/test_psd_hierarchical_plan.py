@@ -0,0 +1,123 @@
+"""
+PSD分层缩放方案测试
+
+覆盖图层树还原、规划单元选择与展开、单元变换向子图层的传递、
+无效/重复单元的过滤以及未规划图层的本地补全和外层组的外接框。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_psd_hierarchical_plan.py -q
+"""
+
+import os
+import sys
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from utils.psd_hierarchical_plan import UnitPlanExpander, build_layer_tree, select_plan_units
+
+
+def _layer(layer_id, box, layer_type='pixel', level=0, visible=True):
+    left, top, right, bottom = box
+    return {'id': layer_id, 'name': f'layer {layer_id}', 'type': layer_type, 'level': level,
+            'visible': visible, 'left': left, 'top': top, 'right': right, 'bottom': bottom}
+
+
+def _box(entry):
+    coords = entry['new_coords']
+    return coords['left'], coords['top'], coords['right'], coords['bottom']
+
+
+# 外层组包住整个设计：0 -> (1 组 -> 2, 3), 4, 5；6 为顶层背景
+LAYERS = [
+    _layer(0, (0, 0, 1000, 800), 'group', level=0),
+    _layer(1, (100, 100, 300, 200), 'group', level=1),
+    _layer(2, (100, 100, 200, 150), level=2),
+    _layer(3, (200, 150, 300, 200), 'type', level=2),
+    _layer(4, (500, 400, 700, 600), level=1),
+    _layer(5, (800, 700, 900, 750), level=1, visible=False),
+    _layer(6, (0, 0, 1000, 800), level=0),
+]
+
+
+def test_build_layer_tree_from_preorder_levels():
+    assert build_layer_tree(LAYERS) == {-1: [0, 6], 0: [1, 4, 5], 1: [2, 3], 2: [], 3: [], 4: [], 5: [], 6: []}
+
+
+def test_select_plan_units_expands_covering_group_and_skips_hidden():
+    units = select_plan_units(LAYERS, 1000, 800)
+    # 外层组覆盖整个画布被展开；单元仍少于下限，最大的组 1 也被展开；隐藏图层 5 不参与规划
+    assert [unit['id'] for unit in units] == [2, 3, 4, 6]
+
+
+def test_select_plan_units_respects_max_units():
+    units = select_plan_units(LAYERS, 1000, 800, max_units=3)
+    assert [unit['id'] for unit in units] == [1, 4, 6]
+
+
+def _expander(units):
+    return UnitPlanExpander(LAYERS, [next(info for info in LAYERS if info['id'] == i) for i in units],
+                            1000, 800, 500, 400)
+
+
+def test_expand_propagates_unit_transform_to_children():
+    expander = _expander([1, 4, 6])
+    entries = expander.expand({'id': 1, 'box': [50, 50, 150, 100]})
+    by_id = {entry['id']: entry for entry in entries}
+    assert set(by_id) == {1, 2, 3}
+    assert _box(by_id[1]) == (50, 50, 150, 100)
+    assert _box(by_id[2]) == (50, 50, 100, 75)
+    assert _box(by_id[3]) == (100, 75, 150, 100)
+    assert by_id[2]['scale_factor'] == 0.5
+    assert by_id[1]['warnings'] == []
+
+
+def test_expand_accepts_new_coords_and_string_ids_and_warns_on_aspect_change():
+    expander = _expander([1, 4, 6])
+    entries = expander.expand({'id': ' 4 ', 'new_coords': {'left': 0, 'top': 0, 'right': 100, 'bottom': 50}})
+    assert [entry['id'] for entry in entries] == [4]
+    assert entries[0]['warnings']
+
+
+def test_expand_rejects_unknown_duplicate_and_invalid_units():
+    expander = _expander([1, 4, 6])
+    assert expander.expand({'id': 2, 'box': [0, 0, 10, 10]}) == []        # 不是规划单元
+    assert expander.expand({'id': 4, 'box': [10, 10, 10, 20]}) == []       # 空框
+    assert expander.expand({'id': 4, 'box': ['a', 0, 1, 1]}) == []         # 格式无效
+    assert expander.expand('not a dict') == []
+    assert expander.expand({'id': 4, 'box': [0, 0, 50, 50]})
+    assert expander.expand({'id': 4, 'box': [0, 0, 60, 60]}) == []         # 重复
+
+
+def test_expand_clamps_children_into_target_canvas():
+    expander = _expander([1, 4, 6])
+    entries = expander.expand({'id': 1, 'box': [450, 380, 650, 480]})
+    for entry in entries:
+        left, top, right, bottom = _box(entry)
+        assert 0 <= left <= right <= 500 and 0 <= top <= bottom <= 400
+
+
+def test_finish_fills_missing_layers_and_wraps_expanded_groups():
+    expander = _expander([1, 4, 6])
+    expander.expand({'id': 1, 'box': [50, 50, 150, 100]})
+    expander.expand({'id': 4, 'box': [250, 200, 350, 300]})
+    results = expander.finish()
+    assert [entry['id'] for entry in results] == [entry['id'] for entry in LAYERS]
+    by_id = {entry['id']: entry for entry in results}
+    # 模型没返回背景，由本地布局补全
+    assert by_id[6]['adjustment_reason'].startswith('本地佈局')
+    assert _box(by_id[6]) == (0, 0, 500, 400)
+    # 外层组取子图层新位置的外接框（隐藏图层 5 由本地布局定位，也包含在内）
+    children = [_box(by_id[i]) for i in (1, 4, 5) if by_id[i]['new_coords']['right'] > by_id[i]['new_coords']['left']]
+    assert _box(by_id[0]) == (min(b[0] for b in children), min(b[1] for b in children),
+                              max(b[2] for b in children), max(b[3] for b in children))
+    # 规划单元内的组保持模型给出的框
+    assert _box(by_id[1]) == (50, 50, 150, 100)
+
+
+def test_descendant_count():
+    expander = _expander([1, 4, 6])
+    assert expander.descendant_count(0) == 5
+    assert expander.descendant_count(1) == 2
+    assert expander.descendant_count(6) == 0
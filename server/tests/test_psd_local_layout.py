@@ -0,0 +1,133 @@
+"""
+PSD本地布局引擎测试
+
+覆盖背景铺满、空图层、边缘锚定与中心定位、文字最小高度、重叠避让以及图层组外接框。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_psd_local_layout.py -q
+"""
+
+import os
+import random
+import sys
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from utils.psd_local_layout import MIN_TEXT_HEIGHT, compute_local_layout
+
+
+def _layer(layer_id, box, layer_type='pixel', name=None, level=0, visible=True):
+    left, top, right, bottom = box
+    return {'id': layer_id, 'name': name or f'layer {layer_id}', 'type': layer_type, 'level': level,
+            'visible': visible, 'left': left, 'top': top, 'right': right, 'bottom': bottom}
+
+
+def _box(result):
+    coords = result['new_coords']
+    return coords['left'], coords['top'], coords['right'], coords['bottom']
+
+
+def _overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _by_id(results):
+    return {result['id']: result for result in results}
+
+
+def test_results_follow_input_order_and_structure():
+    layers = [_layer(3, (10, 10, 50, 50)), _layer(1, (0, 0, 1000, 800), name='Background'), _layer(2, (0, 0, 0, 0))]
+    results = compute_local_layout(layers, 1000, 800, 500, 400)
+    assert [result['id'] for result in results] == [3, 1, 2]
+    for result in results:
+        assert {'original_coords', 'new_coords', 'scale_factor', 'adjustment_reason', 'warnings'} <= set(result)
+
+
+def test_background_fills_target_and_warns_on_aspect_change():
+    layers = [_layer(1, (0, 0, 1000, 800), name='背景')]
+    same_ratio = compute_local_layout(layers, 1000, 800, 500, 400)[0]
+    assert _box(same_ratio) == (0, 0, 500, 400) and same_ratio['warnings'] == []
+    stretched = compute_local_layout(layers, 1000, 800, 400, 400)[0]
+    assert _box(stretched) == (0, 0, 400, 400) and stretched['warnings']
+
+
+def test_layer_covering_most_of_canvas_is_background():
+    layers = [_layer(1, (0, 0, 960, 780))]
+    assert _box(compute_local_layout(layers, 1000, 800, 300, 300)[0]) == (0, 0, 300, 300)
+
+
+def test_empty_layer_gets_empty_box():
+    result = compute_local_layout([_layer(1, (5, 5, 5, 40))], 100, 100, 50, 50)[0]
+    assert _box(result) == (0, 0, 0, 0) and result['scale_factor'] == 0.0
+
+
+def test_edge_layers_keep_scaled_margin_and_others_are_centered():
+    layers = [
+        _layer(1, (20, 20, 120, 60)),      # 左上角
+        _layer(2, (880, 740, 980, 780)),   # 右下角
+        _layer(3, (450, 350, 550, 450)),   # 中间
+    ]
+    results = _by_id(compute_local_layout(layers, 1000, 800, 500, 400))
+    assert _box(results[1]) == (10, 10, 60, 30)
+    assert _box(results[2]) == (440, 370, 490, 390)
+    assert _box(results[3]) == (225, 175, 275, 225)
+
+
+def test_small_text_keeps_minimum_height():
+    layers = [_layer(1, (400, 300, 600, 320), layer_type='type')]
+    result = compute_local_layout(layers, 1000, 800, 250, 200)[0]
+    left, top, right, bottom = _box(result)
+    assert bottom - top == MIN_TEXT_HEIGHT
+    assert result['scale_factor'] == MIN_TEXT_HEIGHT / 20
+
+
+def test_newly_overlapping_layers_are_separated_or_warned():
+    rng = random.Random(0)
+    for _ in range(30):
+        layers = []
+        for layer_id in range(12):
+            left, top = rng.randrange(0, 900), rng.randrange(0, 700)
+            layers.append(_layer(layer_id, (left, top, left + rng.randrange(10, 100), top + rng.randrange(10, 100)),
+                                 layer_type=rng.choice(['type', 'pixel', 'shape'])))
+        target = (rng.randrange(100, 600), rng.randrange(100, 600))
+        results = compute_local_layout(layers, 1000, 800, *target)
+        for i, a in enumerate(results):
+            box = _box(a)
+            assert 0 <= box[0] <= box[2] <= target[0] and 0 <= box[1] <= box[3] <= target[1]
+            for b in results[i + 1:]:
+                original_a = tuple(a['original_coords'].values())
+                original_b = tuple(b['original_coords'].values())
+                if _overlaps(box, _box(b)) and not _overlaps(original_a, original_b):
+                    assert a['warnings'] or b['warnings']
+
+
+def test_layout_is_deterministic():
+    layers = [_layer(i, (i * 37 % 900, i * 53 % 700, i * 37 % 900 + 80, i * 53 % 700 + 60)) for i in range(20)]
+    assert compute_local_layout(layers, 1000, 800, 300, 500) == compute_local_layout(layers, 1000, 800, 300, 500)
+
+
+def test_overlap_caused_by_text_minimum_is_pushed_aside_unless_hidden():
+    # 文字保证最小高度后变宽，压到左侧的图片上
+    text = _layer(2, (910, 390, 1000, 410), layer_type='type')
+    visible = _by_id(compute_local_layout([_layer(1, (100, 300, 900, 500)), text], 1000, 800, 200, 600))
+    assert not _overlaps(_box(visible[1]), _box(visible[2]))
+    assert '已移動避免重疊' in visible[1]['adjustment_reason']
+
+    hidden = _by_id(compute_local_layout([_layer(1, (100, 300, 900, 500), visible=False), text], 1000, 800, 200, 600))
+    assert _overlaps(_box(hidden[1]), _box(hidden[2]))
+    assert _box(hidden[1]) == (20, 280, 180, 320)
+
+
+def test_group_box_wraps_children():
+    layers = [
+        _layer(1, (100, 100, 400, 300), layer_type='group'),
+        _layer(2, (100, 100, 200, 150), level=1),
+        _layer(3, (300, 250, 400, 300), level=1),
+        _layer(4, (700, 600, 800, 700)),
+    ]
+    results = _by_id(compute_local_layout(layers, 1000, 800, 500, 400))
+    children = [_box(results[2]), _box(results[3])]
+    assert _box(results[1]) == (min(b[0] for b in children), min(b[1] for b in children),
+                                max(b[2] for b in children), max(b[3] for b in children))
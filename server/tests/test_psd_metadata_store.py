@@ -0,0 +1,138 @@
+"""
+PSD图层元数据存储测试
+
+覆盖批量操作的事务回滚、版本号递增、重排规则、图层索引分配和旧版 JSON 元数据导入。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_psd_metadata_store.py -q
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from services.psd_metadata_store import LayerNotFoundError, PSDMetadataStore
+
+
+def _metadata(count=3):
+    return {
+        'width': 100,
+        'height': 80,
+        'original_filename': 'poster.psd',
+        'thumbnail_url': '/api/psd/thumbnail/f1',
+        'layers': [{'index': i, 'name': f'layer {i}', 'opacity': 255, 'visible': True} for i in range(count)],
+    }
+
+
+def _store(tmp_path, file_id='f1', count=3):
+    store = PSDMetadataStore(psd_dir=str(tmp_path))
+    store.save_file(file_id, _metadata(count))
+    return store
+
+
+def _names(store, file_id='f1'):
+    return [layer['name'] for layer in store.get_metadata(file_id)['layers']]
+
+
+# ---- 文件级操作 ----
+
+def test_save_and_get_metadata_round_trip(tmp_path):
+    store = _store(tmp_path)
+    assert store.get_metadata('f1') == _metadata()
+    assert store.get_version('f1') == 0 and store.get_composite_version('f1') == 0
+    assert store.get_metadata('missing') is None
+    assert store.get_version('missing') == 0
+
+
+def test_replacing_file_bumps_both_versions(tmp_path):
+    store = _store(tmp_path)
+    store.save_file('f1', _metadata(2))
+    assert store.get_version('f1') == 1
+    assert store.get_composite_version('f1') == 1
+    assert _names(store) == ['layer 0', 'layer 1']
+
+
+def test_legacy_json_metadata_is_imported_on_first_access(tmp_path):
+    with open(tmp_path / 'old_metadata.json', 'w', encoding='utf-8') as f:
+        json.dump(_metadata(2), f)
+    store = PSDMetadataStore(psd_dir=str(tmp_path))
+    assert store.has_file('old')
+    assert store.get_layer('old', 1)['name'] == 'layer 1'
+
+
+# ---- 批量操作 ----
+
+def test_apply_batch_results_and_single_version_bump(tmp_path):
+    store = _store(tmp_path, count=4)
+    results = store.apply_batch('f1', [
+        {'op': 'update', 'index': 1, 'properties': {'opacity': 128, 'unknown': 'ignored'}},
+        {'op': 'delete', 'index': 3},
+        {'op': 'reorder', 'order': [2, 1, 0]},
+    ])
+    assert results == [{'index': 1, 'name': 'layer 1', 'opacity': 128, 'visible': True}, None, None]
+    assert _names(store) == ['layer 2', 'layer 1', 'layer 0']
+    assert store.get_version('f1') == 1
+    # 元数据编辑不影响合成图版本
+    assert store.get_composite_version('f1') == 0
+
+
+def test_failed_operation_rolls_back_whole_batch(tmp_path):
+    store = _store(tmp_path)
+    before = store.get_metadata('f1')
+    with pytest.raises(LayerNotFoundError):
+        store.apply_batch('f1', [
+            {'op': 'update', 'index': 0, 'properties': {'opacity': 0}},
+            {'op': 'delete', 'index': 1},
+            {'op': 'update', 'index': 99, 'properties': {'opacity': 0}},
+        ])
+    assert store.get_metadata('f1') == before
+    assert store.get_version('f1') == 0
+
+
+def test_unsupported_operation_rolls_back(tmp_path):
+    store = _store(tmp_path)
+    with pytest.raises(ValueError):
+        store.apply_batch('f1', [{'op': 'delete', 'index': 0}, {'op': 'explode'}])
+    assert _names(store) == ['layer 0', 'layer 1', 'layer 2']
+    assert store.get_version('f1') == 0
+
+
+def test_batch_on_missing_file_raises(tmp_path):
+    store = _store(tmp_path)
+    with pytest.raises(LayerNotFoundError):
+        store.apply_batch('missing', [{'op': 'delete', 'index': 0}])
+
+
+def test_reorder_drops_unlisted_and_ignores_unknown_or_duplicate_indices(tmp_path):
+    store = _store(tmp_path, count=4)
+    store.reorder_layers('f1', [3, 42, 1, 3])
+    assert _names(store) == ['layer 3', 'layer 1']
+    assert store.get_layer('f1', 0) is None
+
+
+def test_single_layer_helpers_go_through_batches(tmp_path):
+    store = _store(tmp_path)
+    assert store.update_layer('f1', 2, {'visible': False})['visible'] is False
+    store.delete_layer('f1', 0)
+    assert _names(store) == ['layer 1', 'layer 2']
+    assert store.get_version('f1') == 2
+
+
+# ---- 新图层 ----
+
+def test_allocate_and_append_layers(tmp_path):
+    store = _store(tmp_path)
+    start = store.allocate_layer_indices('f1', 2)
+    assert start == 3
+    assert store.allocate_layer_indices('f1') == 5
+    store.append_layers('f1', [{'index': start, 'name': 'copy a'}, {'index': start + 1, 'name': 'copy b'}])
+    assert _names(store)[-2:] == ['copy a', 'copy b']
+    assert store.get_version('f1') == 1
+    with pytest.raises(LayerNotFoundError):
+        store.allocate_layer_indices('missing')
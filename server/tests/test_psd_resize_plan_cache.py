@@ -0,0 +1,133 @@
+"""
+PSD缩放方案缓存测试
+
+覆盖缓存键的组成、TTL 过期、按最近访问时间的 LRU 淘汰以及命中统计。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_psd_resize_plan_cache.py -q
+"""
+
+import os
+import sys
+
+import pytest
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import services.psd_resize_plan_cache as plan_cache_module
+from services.psd_resize_plan_cache import ResizePlanCache
+
+LAYERS = [
+    {'id': 1, 'name': 'bg', 'type': 'pixel', 'level': 0, 'visible': True, 'left': 0, 'top': 0, 'right': 100, 'bottom': 80},
+    {'id': 2, 'name': 'title', 'type': 'text', 'level': 0, 'visible': True, 'left': 10, 'top': 5, 'right': 90, 'bottom': 20},
+]
+PLAN = [{'id': 2, 'new_left': 5, 'new_top': 3, 'new_right': 45, 'new_bottom': 10}]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(plan_cache_module.time, 'time', fake.time)
+    return fake
+
+
+def _cache(tmp_path, **kwargs):
+    return ResizePlanCache(db_path=str(tmp_path / 'plans.db'), **kwargs)
+
+
+# ---- 缓存键 ----
+
+def test_key_depends_on_content_geometry_and_target_size():
+    key = ResizePlanCache.make_key('hash', LAYERS, 50, 40)
+    assert key == ResizePlanCache.make_key('hash', [dict(layer) for layer in LAYERS], 50, 40)
+    assert key != ResizePlanCache.make_key('other', LAYERS, 50, 40)
+    assert key != ResizePlanCache.make_key('hash', LAYERS, 40, 50)
+    moved = [dict(LAYERS[0]), dict(LAYERS[1], left=11)]
+    assert key != ResizePlanCache.make_key('hash', moved, 50, 40)
+
+
+def test_key_ignores_fields_outside_geometry():
+    extra = [dict(layer, opacity=10, thumbnail='x') for layer in LAYERS]
+    assert ResizePlanCache.make_key('hash', extra, 50, 40) == ResizePlanCache.make_key('hash', LAYERS, 50, 40)
+
+
+# ---- 读写与 TTL ----
+
+def test_put_then_get_counts_hits_and_misses(tmp_path, clock):
+    cache = _cache(tmp_path)
+    assert cache.get('k') is None
+    cache.put('k', PLAN)
+    assert cache.get('k') == PLAN
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses'], stats['stored'], stats['entries']) == (1, 1, 1, 1)
+    assert stats['hit_rate'] == 0.5
+
+
+def test_expired_plan_is_dropped_on_lookup(tmp_path, clock):
+    cache = _cache(tmp_path, ttl_seconds=60)
+    cache.put('k', PLAN)
+    clock.now += 60
+    assert cache.get('k') == PLAN
+    clock.now += 1
+    assert cache.get('k') is None
+    stats = cache.get_stats()
+    assert stats['expired'] == 1 and stats['entries'] == 0
+
+
+def test_access_does_not_extend_ttl(tmp_path, clock):
+    cache = _cache(tmp_path, ttl_seconds=60)
+    cache.put('k', PLAN)
+    for _ in range(3):
+        clock.now += 30
+        cache.get('k')
+    assert cache.get('k') is None
+
+
+def test_put_sweeps_expired_plans(tmp_path, clock):
+    cache = _cache(tmp_path, ttl_seconds=60)
+    cache.put('old', PLAN)
+    clock.now += 61
+    cache.put('new', PLAN)
+    stats = cache.get_stats()
+    assert stats['entries'] == 1 and stats['expired'] == 1
+
+
+# ---- LRU ----
+
+def test_least_recently_accessed_plan_is_evicted(tmp_path, clock):
+    cache = _cache(tmp_path, max_entries=2)
+    cache.put('a', PLAN)
+    clock.now += 1
+    cache.put('b', PLAN)
+    clock.now += 1
+    assert cache.get('a') == PLAN
+    clock.now += 1
+    cache.put('c', PLAN)
+    assert cache.get('b') is None
+    assert cache.get('a') == PLAN and cache.get('c') == PLAN
+    assert cache.get_stats()['evicted'] == 1
+
+
+def test_replacing_a_plan_does_not_evict(tmp_path, clock):
+    cache = _cache(tmp_path, max_entries=1)
+    cache.put('a', PLAN)
+    cache.put('a', [])
+    assert cache.get('a') == []
+    assert cache.get_stats()['evicted'] == 0
+
+
+def test_invalidate(tmp_path, clock):
+    cache = _cache(tmp_path)
+    cache.put('a', PLAN)
+    cache.invalidate('a')
+    assert cache.get('a') is None
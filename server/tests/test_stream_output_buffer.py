@@ -0,0 +1,181 @@
+"""
+会话输出缓冲测试
+
+覆盖相邻文本片段的合并、不同片段打包为 batch 帧、语义事件先清空缓冲区再发送、
+字节数上限触发立即发送、时间窗口到期发送、关闭时发出剩余内容以及统计记录。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_stream_output_buffer.py -q
+"""
+
+import asyncio
+import os
+import sys
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from services.langgraph_service.stream_output_buffer import StreamOutputBuffer, stream_output_metrics
+
+
+class Recorder:
+    def __init__(self):
+        self.frames = []
+
+    async def __call__(self, session_id, frame):
+        self.frames.append((session_id, frame))
+
+
+def _delta(text, tool_call_id=None):
+    return {'type': 'delta', 'text': text, 'id': tool_call_id}
+
+
+def _args(text, tool_call_id):
+    return {'type': 'tool_call_arguments', 'text': text, 'id': tool_call_id}
+
+
+def _run(steps, window_ms=1000, max_bytes=4096):
+    """按顺序执行 steps(buffer)，返回发送的帧和缓冲区"""
+    recorder = Recorder()
+
+    async def run():
+        buffer = StreamOutputBuffer('s1', recorder, window_ms=window_ms, max_bytes=max_bytes)
+        await steps(buffer)
+        return buffer
+
+    buffer = asyncio.run(run())
+    return [frame for _, frame in recorder.frames], buffer
+
+
+# ---- 合并 ----
+
+def test_adjacent_deltas_are_concatenated_into_one_frame():
+    async def steps(buffer):
+        for text in ('Hel', 'lo', ', ', 'world'):
+            await buffer.push(_delta(text))
+        await buffer.close()
+
+    frames, buffer = _run(steps)
+    assert frames == [{'type': 'delta', 'text': 'Hello, world', 'id': None}]
+    stats = buffer.get_stats()
+    assert stats['events'] == 4 and stats['coalesced'] == 3 and stats['frames'] == 1
+
+
+def test_different_fragments_are_batched_in_order():
+    async def steps(buffer):
+        await buffer.push(_delta('thinking'))
+        await buffer.push(_args('{"a":', 'call-1'))
+        await buffer.push(_args(' 1}', 'call-1'))
+        await buffer.push(_args('{}', 'call-2'))
+        await buffer.push(_delta(' more'))
+        await buffer.flush()
+
+    frames, buffer = _run(steps)
+    assert frames == [{'type': 'batch', 'events': [
+        {'type': 'delta', 'text': 'thinking', 'id': None},
+        {'type': 'tool_call_arguments', 'text': '{"a": 1}', 'id': 'call-1'},
+        {'type': 'tool_call_arguments', 'text': '{}', 'id': 'call-2'},
+        {'type': 'delta', 'text': ' more', 'id': None},
+    ]}]
+    assert buffer.get_stats()['batches'] == 1
+
+
+def test_pushed_events_are_not_mutated():
+    event = _delta('a')
+
+    async def steps(buffer):
+        await buffer.push(event)
+        await buffer.push(_delta('b'))
+        await buffer.close()
+
+    frames, _ = _run(steps)
+    assert frames[0]['text'] == 'ab'
+    assert event == _delta('a')
+
+
+# ---- 发送顺序 ----
+
+def test_semantic_event_flushes_pending_text_first():
+    async def steps(buffer):
+        await buffer.push(_delta('calling tool'))
+        await buffer.send({'type': 'tool_call', 'id': 'call-1', 'name': 'resize'})
+        await buffer.push(_args('{}', 'call-1'))
+        await buffer.send({'type': 'done'})
+
+    frames, _ = _run(steps)
+    assert [frame['type'] for frame in frames] == ['delta', 'tool_call', 'tool_call_arguments', 'done']
+
+
+def test_non_coalescible_push_is_sent_immediately_in_order():
+    async def steps(buffer):
+        await buffer.push(_delta('before'))
+        await buffer.push({'type': 'tool_call_result', 'id': 'call-1', 'content': 'ok'})
+
+    frames, _ = _run(steps)
+    assert [frame['type'] for frame in frames] == ['delta', 'tool_call_result']
+
+
+def test_max_bytes_flushes_without_waiting_for_window():
+    recorder = Recorder()
+
+    async def run():
+        buffer = StreamOutputBuffer('s1', recorder, window_ms=60000, max_bytes=10)
+        await buffer.push(_delta('12345'))
+        await buffer.push(_delta('67890'))
+        sent = list(recorder.frames)
+        await buffer.close()
+        return sent
+
+    sent = asyncio.run(run())
+    assert sent == [('s1', _delta('1234567890'))]
+    assert len(recorder.frames) == 1
+
+
+def test_window_expiry_sends_pending_fragments():
+    recorder = Recorder()
+
+    async def run():
+        buffer = StreamOutputBuffer('s1', recorder, window_ms=10)
+        await buffer.push(_delta('a'))
+        await buffer.push(_delta('b'))
+        assert recorder.frames == []
+        await asyncio.sleep(0.05)
+        sent = list(recorder.frames)
+        await buffer.close()
+        return sent
+
+    sent = asyncio.run(run())
+    assert sent == [('s1', _delta('ab'))]
+    assert len(recorder.frames) == 1
+
+
+def test_zero_window_sends_every_fragment_immediately():
+    async def steps(buffer):
+        await buffer.push(_delta('a'))
+        await buffer.push(_delta('b'))
+
+    frames, buffer = _run(steps, window_ms=0)
+    assert frames == [_delta('a'), _delta('b')]
+    assert buffer.get_stats()['coalesced'] == 0
+
+
+# ---- 关闭与统计 ----
+
+def test_close_cancels_timer_and_records_stats():
+    recorder = Recorder()
+
+    async def run():
+        buffer = StreamOutputBuffer('s-close', recorder, window_ms=60000)
+        await buffer.push(_delta('tail'))
+        assert 's-close' in stream_output_metrics.get_stats()['active']
+        await buffer.close()
+        return buffer
+
+    buffer = asyncio.run(run())
+    assert [frame for _, frame in recorder.frames] == [_delta('tail')]
+    assert buffer._timer is None
+    stats = stream_output_metrics.get_stats()
+    assert 's-close' not in stats['active']
+    assert stats['recent']['s-close']['frames'] == 1
+    assert stats['recent']['s-close']['bytes'] > 0
@@ -0,0 +1,203 @@
+"""
+智能体群组缓存测试
+
+覆盖模型和群组的缓存键（提供商、模型、地址、api_key、工具、system_prompt）、
+LRU 淘汰、淘汰模型时一并淘汰基于它的群组、关闭被淘汰模型的 HTTP 客户端，
+以及按最后活跃的智能体分别编译群组。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_swarm_cache.py -q
+"""
+
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import services.langgraph_service.swarm_cache as swarm_cache_module
+from services.langgraph_service.swarm_cache import SwarmCache, model_key
+
+
+class FakeHttpClient:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeAsyncHttpClient:
+    def __init__(self):
+        self.closed = False
+
+    async def aclose(self):
+        self.closed = True
+
+
+class FakeModel:
+    def __init__(self, text_model):
+        self.text_model = text_model
+        self.http_client = FakeHttpClient()
+        self.http_async_client = FakeAsyncHttpClient()
+
+    @property
+    def closed(self):
+        return self.http_client.closed and self.http_async_client.closed
+
+
+class FakeSwarm:
+    def __init__(self, agents, default_active_agent):
+        self.agents = agents
+        self.default_active_agent = default_active_agent
+
+    def compile(self):
+        return ('compiled', self.default_active_agent, id(self))
+
+
+@pytest.fixture(autouse=True)
+def fakes(monkeypatch):
+    monkeypatch.setattr(swarm_cache_module.config_service, 'app_config',
+                        {'openai': {'api_key': 'sk-1'}, 'ollama': {}})
+    monkeypatch.setattr(swarm_cache_module.tool_service, 'get_tool', lambda tool_id: None)
+    monkeypatch.setattr(swarm_cache_module, 'create_swarm', FakeSwarm)
+    created = []
+
+    def create_agents(model, tool_list, system_prompt):
+        agents = [types.SimpleNamespace(name='planner'), types.SimpleNamespace(name='image_designer')]
+        created.append((model, tool_list, system_prompt))
+        return agents
+
+    monkeypatch.setattr(swarm_cache_module.AgentManager, 'create_agents', staticmethod(create_agents))
+    return created
+
+
+def _text_model(model='gpt-4o', provider='openai', url='https://api.openai.com/v1'):
+    return {'provider': provider, 'model': model, 'url': url}
+
+
+TOOLS = [{'id': 'generate_image', 'provider': 'openai', 'type': 'image'}]
+
+
+# ---- 缓存键 ----
+
+def test_model_key_includes_api_key_digest_but_not_the_key(fakes):
+    key = model_key(_text_model())
+    assert key[:3] == ('openai', 'gpt-4o', 'https://api.openai.com/v1')
+    assert 'sk-1' not in key[3]
+    swarm_cache_module.config_service.app_config['openai']['api_key'] = 'sk-2'
+    assert model_key(_text_model()) != key
+    # 没有配置的提供商也能生成键
+    assert model_key(_text_model(provider='ollama'))[0] == 'ollama'
+
+
+def test_get_model_reuses_client_for_same_config():
+    cache = SwarmCache(close_delay=0)
+    first = cache.get_model(_text_model(), FakeModel)
+    assert cache.get_model(_text_model(), FakeModel) is first
+    assert cache.get_model(_text_model(url='http://proxy/v1'), FakeModel) is not first
+    stats = cache.get_stats()
+    assert stats['model_hits'] == 1 and stats['model_misses'] == 2 and stats['models'] == 2
+
+
+# ---- 淘汰 ----
+
+def test_least_recently_used_model_is_evicted_and_closed():
+    cache = SwarmCache(max_models=2, close_delay=0)
+    a = cache.get_model(_text_model('a'), FakeModel)
+    b = cache.get_model(_text_model('b'), FakeModel)
+    cache.get_model(_text_model('a'), FakeModel)
+    cache.get_model(_text_model('c'), FakeModel)
+    assert b.closed and not a.closed
+    assert cache.get_model(_text_model('a'), FakeModel) is a
+    assert cache.get_stats()['evictions'] == 1
+
+
+def test_evicting_a_model_evicts_swarms_built_on_it():
+    cache = SwarmCache(max_models=1, close_delay=0)
+    cache.get_swarm(_text_model('a'), TOOLS, 'prompt', [], FakeModel)
+    cache.get_swarm(_text_model('a'), [], 'prompt', [], FakeModel)
+    assert cache.get_stats()['swarms'] == 2
+    cache.get_swarm(_text_model('b'), TOOLS, 'prompt', [], FakeModel)
+    stats = cache.get_stats()
+    assert stats['models'] == 1 and stats['swarms'] == 1
+    assert stats['evictions'] == 3
+
+
+def test_least_recently_used_swarm_is_evicted(fakes):
+    cache = SwarmCache(max_swarms=2, close_delay=0)
+    for prompt in ('p1', 'p2', 'p1', 'p3'):
+        cache.get_swarm(_text_model(), TOOLS, prompt, [], FakeModel)
+    assert [system_prompt for _, _, system_prompt in fakes] == ['p1', 'p2', 'p3']
+    cache.get_swarm(_text_model(), TOOLS, 'p1', [], FakeModel)
+    assert len(fakes) == 3
+    cache.get_swarm(_text_model(), TOOLS, 'p2', [], FakeModel)
+    assert len(fakes) == 4
+
+
+# ---- 关闭客户端 ----
+
+def test_close_is_delayed_inside_event_loop():
+    async def run():
+        cache = SwarmCache(max_models=1, close_delay=0.01)
+        old = cache.get_model(_text_model('a'), FakeModel)
+        cache.get_model(_text_model('b'), FakeModel)
+        closed_immediately = old.closed
+        await asyncio.sleep(0.05)
+        return old, closed_immediately, cache
+
+    old, closed_immediately, cache = asyncio.run(run())
+    assert not closed_immediately
+    assert old.closed
+    assert cache._closing == set()
+
+
+def test_clear_closes_all_models():
+    cache = SwarmCache(close_delay=0)
+    models = [cache.get_model(_text_model(name), FakeModel) for name in ('a', 'b')]
+    cache.get_swarm(_text_model('a'), TOOLS, 'prompt', [], FakeModel)
+    cache.clear()
+    assert all(model.closed for model in models)
+    assert cache.get_stats()['models'] == 0 and cache.get_stats()['swarms'] == 0
+
+
+def test_models_without_http_clients_are_ignored():
+    cache = SwarmCache(max_models=1, close_delay=0)
+    cache.get_model(_text_model('a'), lambda text_model: object())
+    cache.get_model(_text_model('b'), lambda text_model: object())
+    assert cache.get_stats()['evictions'] == 1
+
+
+# ---- 群组 ----
+
+def test_swarm_reused_and_compiled_per_default_agent(fakes):
+    cache = SwarmCache(close_delay=0)
+    first, agent = cache.get_swarm(_text_model(), TOOLS, 'prompt', [], FakeModel)
+    assert agent == 'planner'
+    again, _ = cache.get_swarm(_text_model(), TOOLS, 'prompt', [{'role': 'user', 'content': 'hi'}], FakeModel)
+    assert again is first
+
+    history = [{'role': 'assistant', 'name': 'image_designer', 'content': 'done'}]
+    designer, agent = cache.get_swarm(_text_model(), TOOLS, 'prompt', history, FakeModel)
+    assert agent == 'image_designer' and designer is not first
+    assert len(fakes) == 1
+    stats = cache.get_stats()
+    assert stats['swarm_hits'] == 2 and stats['swarm_misses'] == 1 and stats['compiles'] == 2
+
+
+def test_swarm_key_includes_tools_and_prompt(fakes):
+    cache = SwarmCache(close_delay=0)
+    cache.get_swarm(_text_model(), TOOLS, 'prompt', [], FakeModel)
+    cache.get_swarm(_text_model(), list(reversed(TOOLS + [{'id': 'x', 'provider': 'p', 'type': 'image'}])),
+                    'prompt', [], FakeModel)
+    cache.get_swarm(_text_model(), TOOLS, 'other prompt', [], FakeModel)
+    assert len(fakes) == 3
+    # 工具顺序不影响键；同一模型只创建一个客户端
+    cache.get_swarm(_text_model(), [{'id': 'x', 'provider': 'p', 'type': 'image'}] + TOOLS, 'prompt', [], FakeModel)
+    assert len(fakes) == 3
+    assert len({id(model) for model, _, _ in fakes}) == 1
@@ -0,0 +1,168 @@
+"""
+socket.io 订阅权限测试
+
+覆盖 _subscribe 的允许/拒绝规则（画布所有者、游客、会话与画布是否匹配、尚未创建的会话）、
+拒绝时退出已有房间，以及只向通过验证的订阅者发送一次完整消息快照。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_websocket_router.py -q
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import routers.websocket_router as websocket_router
+import services.websocket_service as websocket_service
+from services.langgraph_service.message_sync import MessageSync, active_message_syncs
+from services.websocket_state import add_connection, get_connection, remove_connection
+
+CANVAS_OWNERS = {'c1': 'u1', 'c2': 'u2', 'public': None}
+SESSION_CANVASES = {'s1': 'c1', 's2': 'c2'}
+
+
+class FakeDB:
+    async def get_canvas_owner(self, canvas_id):
+        if canvas_id == 'broken':
+            raise RuntimeError('db down')
+        return CANVAS_OWNERS.get(canvas_id)
+
+    async def get_session_canvas_id(self, session_id):
+        if session_id == 'broken':
+            raise RuntimeError('db down')
+        return SESSION_CANVASES.get(session_id)
+
+
+class FakeSio:
+    def __init__(self):
+        self.rooms = {}
+        self.emitted = []
+
+    async def enter_room(self, sid, room):
+        self.rooms.setdefault(sid, set()).add(room)
+
+    async def leave_room(self, sid, room):
+        self.rooms.get(sid, set()).discard(room)
+
+    async def emit(self, event, data, room=None):
+        self.emitted.append((event, data, room))
+
+
+@pytest.fixture
+def sio(monkeypatch):
+    fake = FakeSio()
+    monkeypatch.setattr(websocket_router, 'sio', fake)
+    monkeypatch.setattr(websocket_router, 'db_service', FakeDB())
+    monkeypatch.setattr(websocket_service, 'db_service', FakeDB())
+    yield fake
+    for sid in ('sock-u1', 'sock-guest'):
+        remove_connection(sid)
+    active_message_syncs.clear()
+
+
+def _connect(sid, user_id):
+    add_connection(sid, {'user': {'user_id': user_id} if user_id else None, 'rooms': []})
+
+
+def _subscribe(sid, session_id=None, canvas_id=None):
+    return asyncio.run(websocket_router._subscribe(sid, session_id, canvas_id))
+
+
+def _rooms(sid):
+    return get_connection(sid)['rooms']
+
+
+# ---- 允许 ----
+
+@pytest.mark.parametrize('session_id, canvas_id, rooms', [
+    (None, 'c1', ['canvas:c1']),
+    (None, 'public', ['canvas:public']),
+    ('s1', 'c1', ['session:s1', 'canvas:c1']),
+    ('s1', None, ['session:s1']),
+    # 首条消息还在处理中的新会话只能连同它所在的画布一起订阅
+    ('new', 'c1', ['session:new', 'canvas:c1']),
+])
+def test_owner_may_subscribe(sio, session_id, canvas_id, rooms):
+    _connect('sock-u1', 'u1')
+    assert _subscribe('sock-u1', session_id, canvas_id) is True
+    assert _rooms('sock-u1') == rooms
+    assert sio.rooms['sock-u1'] == set(rooms)
+
+
+def test_guest_may_watch_any_canvas(sio):
+    _connect('sock-guest', None)
+    assert _subscribe('sock-guest', 's2', 'c2') is True
+    assert _rooms('sock-guest') == ['session:s2', 'canvas:c2']
+
+
+# ---- 拒绝 ----
+
+@pytest.mark.parametrize('session_id, canvas_id', [
+    (None, None),
+    (None, 'c2'),            # 别人的画布
+    ('s2', None),            # 别人画布上的会话
+    ('s2', 'c1'),            # 会话不属于声明的画布
+    ('new', None),           # 尚未创建的会话必须带画布
+    (None, 'broken'),        # 查询失败时拒绝
+    ('broken', 'c1'),
+])
+def test_subscription_denied(sio, session_id, canvas_id):
+    _connect('sock-u1', 'u1')
+    assert _subscribe('sock-u1', session_id, canvas_id) is False
+    assert _rooms('sock-u1') == []
+
+
+def test_denied_subscription_leaves_previous_rooms(sio):
+    _connect('sock-u1', 'u1')
+    assert _subscribe('sock-u1', 's1', 'c1')
+    assert _subscribe('sock-u1', 's2', 'c2') is False
+    assert _rooms('sock-u1') == []
+    assert sio.rooms['sock-u1'] == set()
+
+
+def test_switching_subscription_replaces_rooms(sio):
+    _connect('sock-u1', 'u1')
+    _subscribe('sock-u1', 's1', 'c1')
+    assert _subscribe('sock-u1', None, 'public')
+    assert sio.rooms['sock-u1'] == {'canvas:public'}
+
+
+def test_unknown_socket_is_rejected(sio):
+    assert _subscribe('sock-missing', 's1', 'c1') is False
+
+
+# ---- 消息快照 ----
+
+def _streaming_session(session_id, canvas_id):
+    sync = MessageSync(session_id, canvas_id=canvas_id)
+    sync.messages = [{'role': 'user', 'content': 'hi'}]
+    active_message_syncs[session_id] = sync
+
+
+def test_snapshot_sent_once_to_verified_subscriber(sio):
+    _streaming_session('s1', 'c1')
+    _connect('sock-u1', 'u1')
+    assert _subscribe('sock-u1', 's1', 'c1')
+    assert sio.emitted == [('session_update', {
+        'canvas_id': 'c1', 'session_id': 's1', 'type': 'all_messages',
+        'messages': [{'role': 'user', 'content': 'hi'}],
+    }, 'sock-u1')]
+    # 房间没有变化的重复订阅不再发送快照
+    assert _subscribe('sock-u1', 's1', 'c1')
+    assert len(sio.emitted) == 1
+
+
+def test_no_snapshot_when_denied_or_session_streams_on_another_canvas(sio):
+    _streaming_session('s2', 'c2')
+    _streaming_session('new', 'c2')
+    _connect('sock-u1', 'u1')
+    assert _subscribe('sock-u1', 's2', None) is False
+    # 尚未落库的会话声明在 c1 上，但实际在 c2 上流式输出
+    assert _subscribe('sock-u1', 'new', 'c1') is True
+    assert sio.emitted == []
@@ -0,0 +1,67 @@
+"""
+进度事件接收房间测试
+
+覆盖 verified_requester_rooms：调用方提供的 socket 只有属于同一用户时才使用，
+否则退回到调用方有权访问的画布房间；session_update 只发给会话和画布房间。
+
+使用方法：
+    cd server
+    python -m pytest tests/test_websocket_service.py -q
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+# 添加 server 目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import services.websocket_service as websocket_service
+from services.websocket_service import verified_requester_rooms
+from services.websocket_state import add_connection, remove_connection, session_update_rooms
+
+U1 = {'user_id': 'u1'}
+
+
+class FakeDB:
+    async def get_canvas_owner(self, canvas_id):
+        return {'c1': 'u1', 'c2': 'u2'}.get(canvas_id)
+
+
+@pytest.fixture(autouse=True)
+def connections(monkeypatch):
+    monkeypatch.setattr(websocket_service, 'db_service', FakeDB())
+    add_connection('sock-u1', {'user': U1, 'rooms': []})
+    add_connection('sock-guest', {'user': None, 'rooms': []})
+    yield
+    remove_connection('sock-u1')
+    remove_connection('sock-guest')
+
+
+def _rooms(user_info, socket_id=None, canvas_id=None):
+    return asyncio.run(verified_requester_rooms(user_info, socket_id, canvas_id))
+
+
+def test_own_socket_is_preferred():
+    assert _rooms(U1, 'sock-u1', 'c1') == ['sock-u1']
+    assert _rooms(None, 'sock-guest') == ['sock-guest']
+
+
+def test_someone_elses_socket_is_ignored():
+    assert _rooms(None, 'sock-u1') == []
+    assert _rooms(U1, 'sock-guest') == []
+    assert _rooms({'user_id': 'u2'}, 'sock-u1', 'c2') == ['canvas:c2']
+
+
+def test_falls_back_to_accessible_canvas():
+    assert _rooms(U1, 'sock-gone', 'c1') == ['canvas:c1']
+    assert _rooms(U1, None, 'c2') == []
+    # 游客可以查看任何画布
+    assert _rooms(None, None, 'c2') == ['canvas:c2']
+
+
+def test_session_updates_only_go_to_subscribed_rooms():
+    assert session_update_rooms('s1') == ['session:s1']
+    assert session_update_rooms('s1', 'c1') == ['session:s1', 'canvas:c1']
@@ -23,6 +23,7 @@ from google.genai import types
 from .image_base_provider import ImageProviderBase
 from ..utils.image_utils import generate_image_id
 from services.config_service import FILES_DIR, config_service
+from services.gemini_gateway import gemini_gateway
 
 
 class GeminiImageProvider(ImageProviderBase):
@@ -51,7 +52,7 @@ class GeminiImageProvider(ImageProviderBase):
 
     def _get_client(self) -> genai.Client:
         """
-        创建并返回 Gemini API 客户端
+        获取 Gemini API 客户端（由网关按认证信息复用）
 
         根据配置自动选择：
         - Google AI Studio API (个人用户，使用 api_key)
@@ -81,7 +82,7 @@ class GeminiImageProvider(ImageProviderBase):
                 )
 
             print(f"🔵 Using Gemini Vertex AI (project: {project}, location: {location})")
-            return genai.Client(
+            return gemini_gateway.get_client(
                 vertexai=True,
                 project=project,
                 location=location,
@@ -97,7 +98,7 @@ class GeminiImageProvider(ImageProviderBase):
                 )
 
             print(f"🟢 Using Gemini AI Studio API")
-            return genai.Client(api_key=api_key)
+            return gemini_gateway.get_client(api_key=api_key)
 
     def _prepare_contents(
         self,
@@ -289,10 +290,12 @@ class GeminiImageProvider(ImageProviderBase):
             ),
         )
 
-        # 4. 调用 Gemini API
+        # 4. 调用 Gemini API（经网关异步调用，限流和重试由网关统一处理）
         try:
             print(f"📡 Calling Gemini API...")
-            response = client.models.generate_content(
+            response = await gemini_gateway.generate_content(
+                'image_generation',
+                client,
                 model=model,
                 contents=contents,
                 config=generate_config,
@@ -0,0 +1,190 @@
+"""
+PSD 子系统图像编码层
+
+统一图层、缩略图、合成图和缩放输出的编码参数，并按请求的 Accept 头协商输出格式：
+- PNG：中间产物使用较快的 zlib 压缩级别（PSD_PNG_FAST_LEVEL，默认 1），
+  最终输出使用 PSD_PNG_FINAL_LEVEL（默认 6）
+- WebP（无损）/ AVIF：在浏览器声明支持时从 PNG 按需转码并缓存在 PNG 旁边
+  （PSD_IMAGE_WEBP / PSD_IMAGE_AVIF 控制是否启用）
+- 每种格式的编码耗时、输出字节数及相对 PNG 的节省量按进程累计，可通过 get_stats() 查看
+
+使用示例：
+    image_encoder.save_png(image, path)                    # 中间产物，快速压缩
+    image_encoder.save_png(image, path, final=True)        # 最终输出
+    path, media_type = image_encoder.negotiate(png_path, request.headers.get('accept'))
+"""
+
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image, features
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _tmp_path(path: str) -> str:
+    # 每次写入使用唯一的临时文件名，避免并发写同一目标时互相覆盖
+    return f'{path}.{uuid.uuid4().hex}.tmp'
+
+
+# 格式 -> (文件扩展名, MIME 类型)
+_FORMATS = {
+    'png': ('png', 'image/png'),
+    'webp': ('webp', 'image/webp'),
+    'avif': ('avif', 'image/avif'),
+}
+
+
+class ImageEncoder:
+    """可配置的图像编码器（带格式协商和编码统计）"""
+
+    def __init__(self):
+        self.png_fast_level = int(os.getenv('PSD_PNG_FAST_LEVEL', '1'))
+        self.png_final_level = int(os.getenv('PSD_PNG_FINAL_LEVEL', '6'))
+        self.webp_enabled = _env_flag('PSD_IMAGE_WEBP', True) and features.check('webp')
+        self.avif_enabled = _env_flag('PSD_IMAGE_AVIF', False) and features.check('avif')
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._stats_lock = threading.Lock()
+
+    def _record(self, fmt: str, seconds: float, output_bytes: int, png_bytes: Optional[int] = None) -> None:
+        with self._stats_lock:
+            stats = self._stats.setdefault(fmt, {
+                'count': 0,
+                'encode_ms': 0.0,
+                'bytes': 0,
+                'png_bytes': 0,
+            })
+            stats['count'] += 1
+            stats['encode_ms'] += seconds * 1000
+            stats['bytes'] += output_bytes
+            stats['png_bytes'] += png_bytes if png_bytes is not None else output_bytes
+
+    def save_png(self, image: Image.Image, path: str, final: bool = False, **params: Any) -> str:
+        """
+        保存 PNG（先写临时文件再原子替换）
+
+        Args:
+            image: 要保存的图像
+            path: 输出路径
+            final: True 表示最终输出（使用较高压缩级别），否则为中间产物
+            params: 额外的 PIL 保存参数（如 dpi）
+        """
+        level = self.png_final_level if final else self.png_fast_level
+        tmp_path = _tmp_path(path)
+        start = time.perf_counter()
+        try:
+            image.save(tmp_path, format='PNG', compress_level=level, **params)
+            elapsed = time.perf_counter() - start
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._record('png', elapsed, os.path.getsize(path))
+        return path
+
+    def _accepted_formats(self, accept_header: Optional[str]):
+        accept = (accept_header or '').lower()
+        if self.avif_enabled and 'image/avif' in accept:
+            yield 'avif'
+        if self.webp_enabled and 'image/webp' in accept:
+            yield 'webp'
+
+    def _encode_variant(self, png_path: str, fmt: str) -> Optional[str]:
+        """
+        从 PNG 转码出替代格式并缓存，PNG 更新后自动重新生成
+
+        替代格式不比 PNG 小时同样保留文件（作为"不划算"的记录，避免重复转码），
+        但返回 None，由调用方回退到 PNG。
+        """
+        ext, _ = _FORMATS[fmt]
+        variant_path = f'{os.path.splitext(png_path)[0]}.{ext}'
+        if os.path.exists(variant_path) and os.path.getmtime(variant_path) >= os.path.getmtime(png_path):
+            if os.path.getsize(variant_path) >= os.path.getsize(png_path):
+                return None
+            return variant_path
+
+        tmp_path = _tmp_path(variant_path)
+        try:
+            with Image.open(png_path) as image:
+                image.load()
+                start = time.perf_counter()
+                if fmt == 'webp':
+                    image.save(tmp_path, format='WEBP', lossless=True, method=4)
+                else:
+                    image.save(tmp_path, format='AVIF', quality=100)
+                elapsed = time.perf_counter() - start
+            os.replace(tmp_path, variant_path)
+        except Exception as e:
+            print(f'⚠️ {fmt} 轉碼失敗 ({png_path}): {e}')
+            return None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        variant_bytes = os.path.getsize(variant_path)
+        png_bytes = os.path.getsize(png_path)
+        self._record(fmt, elapsed, variant_bytes, png_bytes)
+        if variant_bytes >= png_bytes:
+            # 替代格式反而更大时不使用
+            return None
+        return variant_path
+
+    def negotiate(self, png_path: str, accept_header: Optional[str]) -> Tuple[str, str]:
+        """
+        根据 Accept 头选择响应文件
+
+        Returns:
+            (文件路径, MIME 类型)；客户端不支持替代格式或转码不划算时返回原 PNG
+        """
+        for fmt in self._accepted_formats(accept_header):
+            variant_path = self._encode_variant(png_path, fmt)
+            if variant_path:
+                return variant_path, _FORMATS[fmt][1]
+        return png_path, 'image/png'
+
+    def remove_variants(self, png_path: str) -> None:
+        """删除 PNG 对应的替代格式缓存"""
+        base = os.path.splitext(png_path)[0]
+        for ext, _ in _FORMATS.values():
+            if ext == 'png':
+                continue
+            variant_path = f'{base}.{ext}'
+            if os.path.exists(variant_path):
+                os.remove(variant_path)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """按格式汇总编码耗时和字节节省（当前进程内累计）"""
+        with self._stats_lock:
+            formats = {}
+            for fmt, stats in self._stats.items():
+                count = stats['count'] or 1
+                saved = stats['png_bytes'] - stats['bytes']
+                formats[fmt] = {
+                    'count': int(stats['count']),
+                    'total_encode_ms': round(stats['encode_ms'], 2),
+                    'avg_encode_ms': round(stats['encode_ms'] / count, 2),
+                    'bytes': int(stats['bytes']),
+                    'bytes_saved_vs_png': int(saved),
+                    'saving_ratio': round(saved / stats['png_bytes'], 4) if stats['png_bytes'] else 0.0,
+                }
+        return {
+            'config': {
+                'png_fast_level': self.png_fast_level,
+                'png_final_level': self.png_final_level,
+                'webp_enabled': self.webp_enabled,
+                'avif_enabled': self.avif_enabled,
+            },
+            'formats': formats,
+        }
+
+
+# 全局实例
+image_encoder = ImageEncoder()
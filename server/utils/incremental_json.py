@@ -0,0 +1,99 @@
+"""
+增量JSON數組解析
+
+模型流式輸出一個 JSON 數組時，每收到一段文本就調用 feed()，
+返回這段文本中新完成的頂層數組元素，無需等待完整響應。
+數組前的說明文字和 ```json 代碼塊標記會被跳過。
+"""
+
+import json
+from typing import Any, List
+
+
+class IncrementalJSONArrayParser:
+    """逐元素解析流式到達的頂層 JSON 數組"""
+
+    def __init__(self):
+        self._buffer = ''
+        self._pos = 0              # 下一個待掃描字符
+        self._started = False      # 是否已進入頂層數組
+        self._depth = 0            # 相對頂層數組內部的嵌套深度
+        self._in_string = False
+        self._escape = False
+        self._element_start = -1   # 當前元素在 buffer 中的起點
+        self.complete = False      # 頂層數組是否已閉合
+        self.errors = 0            # 解析失敗而被跳過的元素數
+
+    def feed(self, text: str) -> List[Any]:
+        """追加文本，返回新完成的元素"""
+        if self.complete or not text:
+            return []
+        self._buffer += text
+        items: List[Any] = []
+        buffer = self._buffer
+        i = self._pos
+
+        while i < len(buffer):
+            ch = buffer[i]
+            if not self._started:
+                if ch == '[':
+                    self._started = True
+                i += 1
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                i += 1
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._mark_start(i)
+            elif ch in '{[':
+                self._mark_start(i)
+                self._depth += 1
+            elif ch in '}]':
+                if self._depth == 0:
+                    # 頂層數組結束（可能留有最後一個標量元素）
+                    self._emit(buffer[self._element_start:i] if self._element_start >= 0 else '', items)
+                    self.complete = True
+                    i += 1
+                    break
+                self._depth -= 1
+                if self._depth == 0:
+                    self._emit(buffer[self._element_start:i + 1], items)
+            elif ch == ',' and self._depth == 0:
+                if self._element_start >= 0:
+                    self._emit(buffer[self._element_start:i], items)
+            elif not ch.isspace():
+                self._mark_start(i)
+            i += 1
+
+        # 已完成的部分不再保留，避免長響應反復拷貝
+        if self._element_start >= 0:
+            self._buffer = buffer[self._element_start:]
+            self._pos = i - self._element_start
+            self._element_start = 0
+        else:
+            self._buffer = ''
+            self._pos = 0
+        return items
+
+    def _mark_start(self, index: int) -> None:
+        if self._depth == 0 and self._element_start < 0:
+            self._element_start = index
+
+    def _emit(self, raw: str, items: List[Any]) -> None:
+        self._element_start = -1
+        raw = raw.strip()
+        if not raw:
+            return
+        try:
+            items.append(json.loads(raw))
+        except json.JSONDecodeError:
+            self.errors += 1
@@ -0,0 +1,251 @@
+"""
+布局几何后处理
+
+画布排列和 PSD 缩放共用：模型返回的方案先在这里完成 ID 匹配、边界约束和重叠检查，
+再交给前端或渲染器。框统一使用 numpy 数组 [x0, y0, x1, y1]，形状为 (n, 4)。
+
+- match_by_id：基于字典的 ID 匹配（精确匹配，其次是规范化后唯一的匹配）
+- fit_boxes：对所有框一次性完成等比例缩小和平移进画布
+- find_overlapping_pairs：按 x 排序后向量化扫描，一次找出所有重叠的框对
+- GridIndex：均匀网格空间索引，逐个放置框时只检查框覆盖的网格
+- resolve_overlaps：推开原本不重叠、处理后重叠的框
+"""
+
+import re
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+# 默认网格最多按每边 64 格划分，避免覆盖整个画布的大框占用过多网格
+MAX_GRID_CELLS_PER_SIDE = 64
+
+_ID_PREFIX = re.compile(r'^(?:id[\s:_#-]+|#)')
+
+
+def normalize_id(value: Any) -> str:
+    """规范化 ID：去掉空白、引号、大小写差异以及 "id:"、"#" 之类的前缀"""
+    text = str(value).strip().strip('"\'').strip().lower()
+    return _ID_PREFIX.sub('', text)
+
+
+def match_by_id(items: Iterable[Dict[str, Any]],
+                elements: Sequence[Dict[str, Any]]) -> Tuple[List[Tuple[Dict[str, Any], Dict[str, Any]]], List[Dict[str, Any]]]:
+    """
+    按 ID 把模型输出匹配到原始元素
+
+    Returns:
+        ([(模型输出项, 原始元素)], 未匹配的输出项)
+    """
+    exact: Dict[str, Dict[str, Any]] = {}
+    normalized: Dict[str, Dict[str, Any]] = {}
+    ambiguous: Set[str] = set()
+    for element in elements:
+        exact.setdefault(str(element.get('id', '')).strip(), element)
+        key = normalize_id(element.get('id', ''))
+        if key in normalized and normalized[key] is not element:
+            ambiguous.add(key)
+        normalized.setdefault(key, element)
+
+    matched = []
+    unmatched = []
+    for item in items:
+        raw = str(item.get('id', '')).strip()
+        element = exact.get(raw)
+        if element is None:
+            key = normalize_id(raw)
+            if key not in ambiguous:
+                element = normalized.get(key)
+        if element is None:
+            unmatched.append(item)
+        else:
+            matched.append((item, element))
+    return matched, unmatched
+
+
+def as_boxes(boxes: Any) -> np.ndarray:
+    return np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+
+def xywh_to_boxes(rects: Any) -> np.ndarray:
+    rects = as_boxes(rects)
+    return np.hstack([rects[:, :2], rects[:, :2] + rects[:, 2:]])
+
+
+def fit_boxes(boxes: Any, width: float, height: float,
+              integer: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    等比例缩小超出画布的框，并把所有框平移进画布
+
+    Args:
+        boxes: (n, 4) 的框
+        width: 画布宽度
+        height: 画布高度
+        integer: 结果取整（尺寸向下取整，保证不超出画布）
+
+    Returns:
+        (处理后的框, 每个框的缩放比例, 尺寸是否有效)；尺寸无效（宽或高不大于0）的框保持不变
+    """
+    boxes = as_boxes(boxes)
+    sizes = boxes[:, 2:] - boxes[:, :2]
+    valid = (sizes > 0).all(axis=1)
+    safe_sizes = np.where(sizes > 0, sizes, 1.0)
+    scale = np.minimum(1.0, np.minimum(width / safe_sizes[:, 0], height / safe_sizes[:, 1]))
+    scale = np.where(valid, scale, 1.0)
+
+    sizes = sizes * scale[:, None]
+    origin = boxes[:, :2]
+    if integer:
+        sizes = np.maximum(np.floor(sizes + 1e-9), 1.0)
+        origin = np.round(origin)
+    limit = np.array([width, height], dtype=np.float64)
+    origin = np.maximum(np.minimum(np.maximum(origin, 0.0), limit - sizes), 0.0)
+
+    fitted = np.hstack([origin, origin + sizes])
+    fitted[~valid] = boxes[~valid]
+    return fitted, scale, valid
+
+
+class GridIndex:
+    """
+    均匀网格空间索引
+
+    每个框登记到它覆盖的所有网格中，查询时只需要检查查询框覆盖的网格里的候选框。
+    """
+
+    def __init__(self, cell_size: float):
+        self.cell_size = max(float(cell_size), 1.0)
+        self._cells: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+        self._boxes: Dict[int, Tuple[float, float, float, float]] = {}
+
+    @classmethod
+    def for_boxes(cls, boxes: np.ndarray) -> 'GridIndex':
+        """按框的典型尺寸选择网格大小"""
+        boxes = as_boxes(boxes)
+        if not len(boxes):
+            return cls(1.0)
+        sizes = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+        extent = max(float(boxes[:, 2].max() - boxes[:, 0].min()),
+                     float(boxes[:, 3].max() - boxes[:, 1].min()), 1.0)
+        return cls(max(float(np.median(sizes)), extent / MAX_GRID_CELLS_PER_SIDE))
+
+    def _cells_for(self, box: Sequence[float]) -> Iterable[Tuple[int, int]]:
+        size = self.cell_size
+        for cx in range(int(box[0] // size), int(box[2] // size) + 1):
+            for cy in range(int(box[1] // size), int(box[3] // size) + 1):
+                yield cx, cy
+
+    def insert(self, index: int, box: Sequence[float]) -> None:
+        box = tuple(float(value) for value in box)
+        self._boxes[index] = box
+        for cell in self._cells_for(box):
+            self._cells[cell].append(index)
+
+    def query(self, box: Sequence[float]) -> List[int]:
+        """返回与 box 有正面积交集的已登记框"""
+        x0, y0, x1, y1 = (float(value) for value in box)
+        candidates: Set[int] = set()
+        for cell in self._cells_for((x0, y0, x1, y1)):
+            candidates.update(self._cells.get(cell, ()))
+        # 候选框通常很少，逐个比较比构造数组更快
+        result = []
+        for index in candidates:
+            other = self._boxes[index]
+            if other[0] < x1 and x0 < other[2] and other[1] < y1 and y0 < other[3]:
+                result.append(index)
+        return result
+
+
+def find_overlapping_pairs(boxes: Any, active: Optional[np.ndarray] = None) -> Set[Tuple[int, int]]:
+    """找出所有有正面积交集的框对 (i, j)，i < j"""
+    boxes = as_boxes(boxes)
+    indices = np.arange(len(boxes)) if active is None else np.flatnonzero(active)
+    if len(indices) < 2:
+        return set()
+
+    # 按左边界排序，每个框只需要和左边界落在它 [x0, x1) 范围内的后续框比较
+    order = indices[np.argsort(boxes[indices, 0], kind='stable')]
+    sorted_boxes = boxes[order]
+    ends = np.searchsorted(sorted_boxes[:, 0], sorted_boxes[:, 2], side='left')
+    starts = np.arange(len(order)) + 1
+    counts = np.maximum(ends - starts, 0)
+    total = int(counts.sum())
+    if total == 0:
+        return set()
+
+    first = np.repeat(np.arange(len(order)), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    second = first + 1 + offsets
+    a, b = sorted_boxes[first], sorted_boxes[second]
+    hit = (b[:, 0] < a[:, 2]) & (a[:, 1] < b[:, 3]) & (b[:, 1] < a[:, 3]) & (a[:, 0] < b[:, 2])
+    i, j = order[first[hit]], order[second[hit]]
+    return set(zip(np.minimum(i, j).tolist(), np.maximum(i, j).tolist()))
+
+
+def _push_candidates(box: Sequence[float], obstacles: Sequence[Sequence[float]]) -> List[List[float]]:
+    """把 box 推到每个障碍物上下左右四侧的候选位置，按位移从小到大排序"""
+    moves = []
+    for obstacle in obstacles:
+        moves.extend([
+            (obstacle[2] - box[0], 0.0),   # 向右
+            (obstacle[0] - box[2], 0.0),   # 向左
+            (0.0, obstacle[3] - box[1]),   # 向下
+            (0.0, obstacle[1] - box[3]),   # 向上
+        ])
+    moves.sort(key=lambda move: abs(move[0]) + abs(move[1]))
+    return [[box[0] + dx, box[1] + dy, box[2] + dx, box[3] + dy] for dx, dy in moves]
+
+
+def resolve_overlaps(original_boxes: Any,
+                     boxes: Any,
+                     width: float,
+                     height: float,
+                     order: Optional[Sequence[int]] = None,
+                     active: Optional[np.ndarray] = None) -> Tuple[np.ndarray, List[int], List[int]]:
+    """
+    推开原本不重叠、但在新方案中重叠的框
+
+    按 order 的顺序依次放置（靠前的优先级高、位置不变），与已放置的框产生新重叠时，
+    沿位移最小的方向推到障碍物旁边；原本就重叠的框对（如文字压在背景上）视为设计意图，不处理。
+
+    Args:
+        original_boxes: 原始框（用于判断原本是否重叠）
+        boxes: 新方案的框
+        width: 画布宽度
+        height: 画布高度
+        order: 放置顺序（框的下标），默认按下标顺序
+        active: 参与检查的框，默认为全部尺寸有效的框
+
+    Returns:
+        (处理后的框, 被移动的下标, 无法避免重叠的下标)
+    """
+    original_boxes = as_boxes(original_boxes)
+    boxes = as_boxes(boxes).copy()
+    valid = ((boxes[:, 2:] - boxes[:, :2]) > 0).all(axis=1)
+    active = valid if active is None else (np.asarray(active, dtype=bool) & valid)
+    original_pairs = find_overlapping_pairs(original_boxes, active)
+
+    def is_new_conflict(i: int, j: int) -> bool:
+        return ((j, i) if j < i else (i, j)) not in original_pairs
+
+    index = GridIndex.for_boxes(boxes[active])
+    box_list = boxes.tolist()
+    moved: List[int] = []
+    unresolved: List[int] = []
+    for i in (order if order is not None else range(len(boxes))):
+        if not active[i]:
+            continue
+        conflicts = [j for j in index.query(box_list[i]) if is_new_conflict(i, j)]
+        if conflicts:
+            for candidate in _push_candidates(box_list[i], [box_list[j] for j in conflicts]):
+                if candidate[0] < 0 or candidate[1] < 0 or candidate[2] > width or candidate[3] > height:
+                    continue
+                if not any(is_new_conflict(i, j) for j in index.query(candidate)):
+                    box_list[i] = candidate
+                    boxes[i] = candidate
+                    moved.append(i)
+                    break
+            else:
+                unresolved.append(i)
+        index.insert(i, box_list[i])
+    return boxes, moved, unresolved
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+PSD群組自底向上合成工具
+
+每個葉子圖層只調用一次 psd-tools 合成並緩存其 RGBA 圖塊，
+群組位圖由已緩存的子圖塊按子圖層的混合模式疊加後再乘以群組不透明度得到，
+不再對每一層群組重新合成其全部子圖層。
+無法用圖塊疊加精確還原的情況（剪貼蒙版、調整圖層、群組蒙版/效果、未支持的混合模式）
+回退到 psd-tools 的 group.composite()。
+"""
+
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+@dataclass
+class LayerTile:
+    """圖層合成結果：RGBA 圖塊及其在畫布上的左上角坐標"""
+    image: Image.Image
+    left: int
+    top: int
+
+    @property
+    def right(self) -> int:
+        return self.left + self.image.width
+
+    @property
+    def bottom(self) -> int:
+        return self.top + self.image.height
+
+
+# 可分離混合函數，輸入/輸出均為 [0, 1] 浮點 RGB（Cb: 背景, Cs: 當前圖層）
+def _overlay(cb: np.ndarray, cs: np.ndarray) -> np.ndarray:
+    return np.where(cb <= 0.5, 2 * cb * cs, 1 - 2 * (1 - cb) * (1 - cs))
+
+
+_BLEND_FUNCS: Dict[str, Callable[[np.ndarray, np.ndarray], np.ndarray]] = {
+    'normal': lambda cb, cs: cs,
+    'pass_through': lambda cb, cs: cs,
+    'multiply': lambda cb, cs: cb * cs,
+    'screen': lambda cb, cs: cb + cs - cb * cs,
+    'darken': np.minimum,
+    'lighten': np.maximum,
+    'overlay': _overlay,
+    'difference': lambda cb, cs: np.abs(cb - cs),
+    'linear_dodge': lambda cb, cs: np.minimum(cb + cs, 1.0),
+}
+
+# psd-tools 中會影響下方像素或依賴上下文的圖層類型
+_CONTEXT_DEPENDENT_KINDS = {'adjustment', 'brightnesscontrast', 'curves', 'levels'}
+
+
+def blend_mode_key(blend_mode) -> str:
+    """把 psd-tools 的 BlendMode 轉為小寫名稱（如 BlendMode.MULTIPLY -> 'multiply'）"""
+    name = getattr(blend_mode, 'name', None) or str(blend_mode)
+    return name.split('.')[-1].lower()
+
+
+def composite_leaf(layer) -> Optional[LayerTile]:
+    """
+    合成單個葉子圖層（結果已包含圖層自身不透明度），合成期間強制可見
+    """
+    orig_visible = getattr(layer, 'visible', True)
+    try:
+        if hasattr(layer, 'visible'):
+            layer.visible = True
+        composed = layer.composite()
+    except Exception as e:
+        print(f'⚠️ 圖層合成失敗 ({getattr(layer, "name", "")}): {e}')
+        return None
+    finally:
+        try:
+            if hasattr(layer, 'visible'):
+                layer.visible = orig_visible
+        except Exception:
+            pass
+
+    if composed is None or composed.width == 0 or composed.height == 0:
+        return None
+    if composed.mode != 'RGBA':
+        composed = composed.convert('RGBA')
+    return LayerTile(image=composed, left=layer.left, top=layer.top)
+
+
+def can_blend_children(group) -> bool:
+    """判斷群組位圖能否由子圖塊直接疊加得到"""
+    if getattr(group, 'has_mask', lambda: False)() or getattr(group, 'has_vector_mask', lambda: False)():
+        return False
+    if getattr(group, 'has_effects', lambda: False)():
+        return False
+    for child in group:
+        if not child.visible:
+            continue
+        # 新版 psd-tools 使用 clipping，舊版為 clipping_layer
+        clipping = getattr(child, 'clipping', None)
+        if clipping is None:
+            clipping = getattr(child, 'clipping_layer', False)
+        if clipping or getattr(child, 'has_clip_layers', lambda: False)():
+            return False
+        if getattr(child, 'kind', None) in _CONTEXT_DEPENDENT_KINDS:
+            return False
+        if blend_mode_key(child.blend_mode) not in _BLEND_FUNCS:
+            return False
+    return True
+
+
+def _blend_onto(canvas: np.ndarray, tile: LayerTile, origin: Tuple[int, int], mode: str) -> None:
+    """把圖塊按混合模式疊加到浮點畫布（原地修改，預乘前的 RGBA，範圍 [0, 1]）"""
+    x0 = tile.left - origin[0]
+    y0 = tile.top - origin[1]
+    h, w = canvas.shape[:2]
+    # 裁剪到畫布範圍
+    sx0, sy0 = max(0, -x0), max(0, -y0)
+    dx0, dy0 = max(0, x0), max(0, y0)
+    dx1 = min(w, x0 + tile.image.width)
+    dy1 = min(h, y0 + tile.image.height)
+    if dx1 <= dx0 or dy1 <= dy0:
+        return
+
+    src = np.asarray(tile.image, dtype=np.float32)[sy0:sy0 + dy1 - dy0, sx0:sx0 + dx1 - dx0] / 255.0
+    dst = canvas[dy0:dy1, dx0:dx1]
+
+    cs, a_s = src[..., :3], src[..., 3:4]
+    cb, a_b = dst[..., :3], dst[..., 3:4]
+    blended = _BLEND_FUNCS[mode](cb, cs)
+
+    a_o = a_s + a_b * (1 - a_s)
+    numerator = a_s * (1 - a_b) * cs + a_s * a_b * blended + (1 - a_s) * a_b * cb
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c_o = np.where(a_o > 0, numerator / np.maximum(a_o, 1e-8), 0.0)
+
+    dst[..., :3] = c_o
+    dst[..., 3:4] = a_o
+
+
+def blend_group(group, child_tiles: List[Tuple[object, Optional[LayerTile]]]) -> Optional[LayerTile]:
+    """
+    用已緩存的子圖塊合成群組位圖
+
+    Args:
+        group: psd-tools 群組對象（提供不透明度）
+        child_tiles: [(子圖層, 子圖塊)]，按 psd-tools 迭代順序（自底向上）
+
+    Returns:
+        群組圖塊（已乘以群組不透明度）；沒有可見內容時返回 None
+    """
+    visible = [
+        (child, tile) for child, tile in child_tiles
+        if tile is not None and child.visible
+    ]
+    if not visible:
+        return None
+
+    left = min(tile.left for _, tile in visible)
+    top = min(tile.top for _, tile in visible)
+    right = max(tile.right for _, tile in visible)
+    bottom = max(tile.bottom for _, tile in visible)
+
+    canvas = np.zeros((bottom - top, right - left, 4), dtype=np.float32)
+    for child, tile in visible:
+        _blend_onto(canvas, tile, (left, top), blend_mode_key(child.blend_mode))
+
+    canvas[..., 3] *= getattr(group, 'opacity', 255) / 255.0
+    pixels = np.clip(canvas * 255.0 + 0.5, 0, 255).astype(np.uint8)
+    return LayerTile(image=Image.fromarray(pixels, 'RGBA'), left=left, top=top)
+
+
+def composite_group(group, child_tiles: List[Tuple[object, Optional[LayerTile]]]) -> Optional[LayerTile]:
+    """群組合成入口：能疊加時使用子圖塊，否則回退到 psd-tools"""
+    if can_blend_children(group):
+        return blend_group(group, child_tiles)
+    print(f'ℹ️ 群組 "{getattr(group, "name", "")}" 含剪貼/調整/蒙版等效果，回退到 psd-tools 合成')
+    return composite_leaf(group)
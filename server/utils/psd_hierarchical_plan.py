@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+PSD分層縮放方案
+
+圖層很多時，只把頂層圖層和圖層組（規劃單元）交給模型，模型只返回每個單元的新邊界框，
+再在本地把單元的縮放和平移傳遞給它的所有子圖層。
+提示詞和輸出長度取決於設計的結構（規劃單元數），而不是圖層總數。
+
+規則：
+1. 圖層數達到 HIERARCHICAL_MIN_LAYERS 時才使用分層方案，較小的文件仍逐層規劃
+2. 規劃單元從頂層可見圖層開始；單元少於 MIN_PLAN_UNITS 時，或圖層組覆蓋大部分畫布時
+   （例如包住整個設計的外層組），從面積最大的組開始展開為其子圖層，單元總數不超過 MAX_PLAN_UNITS
+3. 子圖層按所屬單元的變換（縮放比例 + 平移）定位，模型未返回的單元使用本地佈局引擎的結果
+4. 被展開的圖層組取子圖層新位置的外接框
+"""
+
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+try:
+    from utils.psd_local_layout import compute_local_layout
+except ImportError:
+    # 作為腳本直接運行時
+    from psd_local_layout import compute_local_layout
+
+Box = Tuple[int, int, int, int]
+
+# 達到該圖層數時使用分層方案
+HIERARCHICAL_MIN_LAYERS = int(os.getenv('PSD_HIERARCHICAL_MIN_LAYERS', '40'))
+# 交給模型的規劃單元數上限（展開大圖層組時不超過該值）
+MAX_PLAN_UNITS = int(os.getenv('PSD_MAX_PLAN_UNITS', '40'))
+# 規劃單元少於該值時繼續展開最大的圖層組
+MIN_PLAN_UNITS = int(os.getenv('PSD_MIN_PLAN_UNITS', '8'))
+# 覆蓋原畫布面積比例超過該值的圖層組會被展開
+EXPAND_COVERAGE = 0.5
+
+
+def _box(info: Dict[str, Any]) -> Box:
+    return int(info['left']), int(info['top']), int(info['right']), int(info['bottom'])
+
+
+def _area(box: Box) -> int:
+    return max(0, box[2] - box[0]) * max(0, box[3] - box[1])
+
+
+def build_layer_tree(layers_info: List[Dict[str, Any]]) -> Dict[int, List[int]]:
+    """按先序遍歷順序和層級還原圖層樹，返回 {圖層ID: 直接子圖層ID列表}（頂層圖層掛在 -1 下）"""
+    children: Dict[int, List[int]] = {-1: []}
+    stack: List[Tuple[int, int]] = []  # (層級, 圖層ID)
+    for info in layers_info:
+        level = info.get('level', 0)
+        while stack and stack[-1][0] >= level:
+            stack.pop()
+        parent = stack[-1][1] if stack else -1
+        children.setdefault(parent, []).append(info['id'])
+        children[info['id']] = []
+        stack.append((level, info['id']))
+    return children
+
+
+def should_plan_hierarchically(layers_info: List[Dict[str, Any]]) -> bool:
+    return len(layers_info) >= HIERARCHICAL_MIN_LAYERS
+
+
+def select_plan_units(layers_info: List[Dict[str, Any]],
+                      original_width: int,
+                      original_height: int,
+                      max_units: int = MAX_PLAN_UNITS) -> List[Dict[str, Any]]:
+    """
+    選出交給模型規劃的圖層（按先序遍歷順序）
+
+    Returns:
+        規劃單元的圖層信息列表
+    """
+    info_by_id = {info['id']: info for info in layers_info}
+    order = {info['id']: position for position, info in enumerate(layers_info)}
+    children = build_layer_tree(layers_info)
+
+    def plannable(layer_ids: List[int]) -> List[int]:
+        return [layer_id for layer_id in layer_ids
+                if info_by_id[layer_id].get('visible', True) and _area(_box(info_by_id[layer_id]))]
+
+    units = plannable(children[-1])
+    canvas_area = original_width * original_height
+    expanded: Set[int] = set()
+    while True:
+        candidates = [
+            layer_id for layer_id in units
+            if layer_id not in expanded and info_by_id[layer_id].get('type') == 'group'
+            and (len(units) < MIN_PLAN_UNITS or
+                 _area(_box(info_by_id[layer_id])) >= EXPAND_COVERAGE * canvas_area)
+            and plannable(children[layer_id])
+        ]
+        if not candidates:
+            break
+        group_id = max(candidates, key=lambda layer_id: _area(_box(info_by_id[layer_id])))
+        expanded.add(group_id)
+        replacement = plannable(children[group_id])
+        if len(units) - 1 + len(replacement) > max_units:
+            continue
+        units = sorted([layer_id for layer_id in units if layer_id != group_id] + replacement,
+                       key=order.__getitem__)
+    return [info_by_id[layer_id] for layer_id in units]
+
+
+def planning_layers(layers_info: List[Dict[str, Any]],
+                    original_width: int,
+                    original_height: int) -> List[Dict[str, Any]]:
+    """實際交給模型的圖層（用於提示詞和檢測框圖像）"""
+    if should_plan_hierarchically(layers_info):
+        return select_plan_units(layers_info, original_width, original_height)
+    return layers_info
+
+
+def _unit_box(item: Dict[str, Any]) -> Optional[Box]:
+    """讀取模型返回的單元邊界框，支持緊湊格式 box: [l, t, r, b] 和 new_coords 對象"""
+    try:
+        if 'box' in item:
+            left, top, right, bottom = item['box']
+        else:
+            coords = item['new_coords']
+            left, top, right, bottom = coords['left'], coords['top'], coords['right'], coords['bottom']
+        return round(float(left)), round(float(top)), round(float(right)), round(float(bottom))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class UnitPlanExpander:
+    """把規劃單元的新邊界框展開為所有圖層的調整方案"""
+
+    def __init__(self,
+                 layers_info: List[Dict[str, Any]],
+                 units: List[Dict[str, Any]],
+                 original_width: int,
+                 original_height: int,
+                 target_width: int,
+                 target_height: int):
+        self.layers_info = layers_info
+        self.info_by_id = {info['id']: info for info in layers_info}
+        self.units = {info['id']: info for info in units}
+        self.original_width = original_width
+        self.original_height = original_height
+        self.target_width = target_width
+        self.target_height = target_height
+        self.children = build_layer_tree(layers_info)
+        self.results: Dict[int, Dict[str, Any]] = {}
+        self.planned_units: Set[int] = set()
+
+    def descendant_count(self, layer_id: int) -> int:
+        return sum(1 + self.descendant_count(child) for child in self.children.get(layer_id, []))
+
+    def _subtree(self, layer_id: int) -> List[int]:
+        ids = [layer_id]
+        for child in self.children.get(layer_id, []):
+            ids.extend(self._subtree(child))
+        return ids
+
+    def _record(self, info: Dict[str, Any], box: Box, scale: float, reason: str,
+                warnings: Optional[List[str]] = None) -> Dict[str, Any]:
+        warnings = warnings or []
+        entry = {
+            'id': info['id'],
+            'name': info['name'],
+            'type': info.get('type', 'unknown'),
+            'level': info.get('level', 0),
+            'visible': info.get('visible', True),
+            'original_coords': {
+                'left': info['left'], 'top': info['top'],
+                'right': info['right'], 'bottom': info['bottom'],
+            },
+            'new_coords': {'left': box[0], 'top': box[1], 'right': box[2], 'bottom': box[3]},
+            'scale_factor': round(scale, 4),
+            'adjustment_reason': reason,
+            'quality_check': '通過' if not warnings else '需要人工確認',
+            'warnings': warnings,
+        }
+        self.results[info['id']] = entry
+        return entry
+
+    def expand(self, item: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        展開模型返回的一個單元方案
+
+        Returns:
+            該單元及其所有子圖層的調整方案；不是規劃單元、重複或格式無效時返回空列表
+        """
+        unit_id = item.get('id') if isinstance(item, dict) else None
+        if isinstance(unit_id, str) and unit_id.strip().isdigit():
+            unit_id = int(unit_id)
+        if unit_id not in self.units or unit_id in self.planned_units:
+            return []
+        new_box = _unit_box(item)
+        if new_box is None or new_box[2] <= new_box[0] or new_box[3] <= new_box[1]:
+            return []
+
+        unit = self.units[unit_id]
+        left, top, right, bottom = _box(unit)
+        scale_x = (new_box[2] - new_box[0]) / max(1, right - left)
+        scale_y = (new_box[3] - new_box[1]) / max(1, bottom - top)
+        warnings = []
+        if abs(scale_x - scale_y) > 0.01 * max(scale_x, scale_y):
+            warnings.append('模型返回的單元寬高比與原始不同')
+
+        def transform(box: Box) -> Box:
+            if not _area(box):
+                return 0, 0, 0, 0
+            new_left = new_box[0] + round((box[0] - left) * scale_x)
+            new_top = new_box[1] + round((box[1] - top) * scale_y)
+            new_right = new_box[0] + round((box[2] - left) * scale_x)
+            new_bottom = new_box[1] + round((box[3] - top) * scale_y)
+            return (min(max(0, new_left), self.target_width),
+                    min(max(0, new_top), self.target_height),
+                    min(max(0, new_right), self.target_width),
+                    min(max(0, new_bottom), self.target_height))
+
+        self.planned_units.add(unit_id)
+        entries = [self._record(unit, transform(_box(unit)), scale_x, '模型規劃單元', warnings)]
+        for layer_id in self._subtree(unit_id)[1:]:
+            info = self.info_by_id[layer_id]
+            entries.append(self._record(info, transform(_box(info)), scale_x, f"跟隨 {unit['name']} 變換"))
+        return entries
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """補全模型未返回的圖層（使用本地佈局引擎），並重新計算被展開圖層組的外接框"""
+        missing = [info for info in self.layers_info if info['id'] not in self.results]
+        if missing:
+            local_plan = compute_local_layout(self.layers_info, self.original_width, self.original_height,
+                                              self.target_width, self.target_height)
+            for entry in local_plan:
+                if entry['id'] not in self.results:
+                    self.results[entry['id']] = {**entry, 'adjustment_reason': '本地佈局：' + entry['adjustment_reason']}
+
+        # 不屬於任何規劃單元的圖層組（被展開的組）取子圖層新位置的外接框，自底向上計算
+        covered = set()
+        for unit_id in self.planned_units:
+            covered.update(self._subtree(unit_id))
+        for info in reversed(self.layers_info):
+            if info.get('type') != 'group' or info['id'] in covered:
+                continue
+            boxes = [_box(self.results[child]['new_coords']) for child in self.children.get(info['id'], [])]
+            boxes = [box for box in boxes if _area(box)]
+            if boxes:
+                box = (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                       max(b[2] for b in boxes), max(b[3] for b in boxes))
+                self._record(info, box, self.results[info['id']].get('scale_factor', 0.0), '圖層組：子圖層外接框')
+
+        return [self.results[info['id']] for info in self.layers_info]
@@ -5,10 +5,27 @@ PSD圖層信息提取工具
 """
 
 from psd_tools import PSDImage
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, features
+from dataclasses import dataclass
+from io import BytesIO
+import os
 import random
 from typing import List, Dict, Any, Tuple, Optional
 
+# 發送給模型的檢測框圖像最長邊（像素），印刷級PSD的合成圖按比例縮小
+DETECTION_MAX_EDGE = int(os.getenv('PSD_DETECTION_MAX_EDGE', '1536'))
+DETECTION_QUALITY = int(os.getenv('PSD_DETECTION_QUALITY', '80'))
+
+
+@dataclass
+class DetectionImage:
+    """已編碼的檢測框圖像，坐標 × scale 即為圖像上的像素位置"""
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    scale: float
+
 
 def get_psd_layers_info(psd_file_path: str) -> Tuple[PSDImage, List[Dict[str, Any]]]:
     """
@@ -77,7 +94,8 @@ def get_psd_layers_info(psd_file_path: str) -> Tuple[PSDImage, List[Dict[str, An
     return psd, layers_info
 
 
-def draw_detection_boxes(psd: PSDImage, layers_info: List[Dict[str, Any]], output_path: str) -> Image.Image:
+def draw_detection_boxes(psd: PSDImage, layers_info: List[Dict[str, Any]], output_path: str,
+                         base_image: Optional[Image.Image] = None) -> Image.Image:
     """
     在圖像上繪製檢測框
 
@@ -85,47 +103,87 @@ def draw_detection_boxes(psd: PSDImage, layers_info: List[Dict[str, Any]], outpu
         psd: PSD對象
         layers_info: 圖層信息列表
         output_path: 輸出圖像路徑
+        base_image: 已緩存的合成圖（會被直接繪製），未提供時由 psd 合成
     """
     # 將PSD轉換為PIL Image
-    image = psd.composite()
+    image = base_image if base_image is not None else psd.composite()
+
+    _annotate_boxes(image, layers_info)
+
+    # 保存圖像
+    image.save(output_path)
+    print(f"檢測框圖像已保存到: {output_path}")
+
+    return image
+
+
+def render_detection_image(psd: PSDImage, layers_info: List[Dict[str, Any]],
+                           base_image: Optional[Image.Image] = None,
+                           max_long_edge: int = DETECTION_MAX_EDGE) -> DetectionImage:
+    """
+    生成發送給模型的檢測框圖像：先把合成圖縮小到最長邊不超過 max_long_edge，
+    再按比例繪製檢測框，並一次性編碼為 WebP（不支持時使用 JPEG）
 
+    參數:
+        psd: PSD對象
+        layers_info: 圖層信息列表
+        base_image: 已緩存的合成圖，未提供時由 psd 合成
+        max_long_edge: 最長邊像素數
+    """
+    image = base_image if base_image is not None else psd.composite()
+    scale = min(1.0, max_long_edge / max(image.width, image.height))
+    if scale < 1.0:
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                             Image.Resampling.LANCZOS)
+    image = image.convert('RGB')
+
+    _annotate_boxes(image, layers_info, scale)
+
+    buffer = BytesIO()
+    if features.check('webp'):
+        image.save(buffer, format='WEBP', quality=DETECTION_QUALITY, method=4)
+        mime_type = 'image/webp'
+    else:
+        image.save(buffer, format='JPEG', quality=DETECTION_QUALITY, optimize=True)
+        mime_type = 'image/jpeg'
+    return DetectionImage(buffer.getvalue(), mime_type, image.width, image.height, scale)
+
+
+def _annotate_boxes(image: Image.Image, layers_info: List[Dict[str, Any]], scale: float = 1.0) -> None:
+    """在圖像上繪製每個圖層的檢測框和ID標籤（坐標按 scale 換算）"""
     # 創建繪圖對象
     draw = ImageDraw.Draw(image)
 
     # 嘗試加載字體，如果失敗使用默認字體
+    font_size = max(14, round(40 * scale))
     try:
-        font = ImageFont.truetype("/System/Library/Fonts/PingFang.ttc", 40)
+        font = ImageFont.truetype("/System/Library/Fonts/PingFang.ttc", font_size)
     except:
         try:
-            font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 40)
+            font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", font_size)
         except:
             font = ImageFont.load_default()
+    box_width = max(2, round(3 * scale))
+    label_offset = round(font_size * 1.25)
 
     # 使用紅色作為統一的檢測框顏色
     color = (255, 0, 0)  # 紅色
 
     # 為每個圖層繪製檢測框
     for info in layers_info:
-        # 繪製矩形框
-        left, top, right, bottom = info['left'], info['top'], info['right'], info['bottom']
-
         # 只繪製有效的框（寬度和高度大於0）
-        if right > left and bottom > top:
-            draw.rectangle([left, top, right, bottom], outline=color, width=3)
+        if info['right'] > info['left'] and info['bottom'] > info['top']:
+            # 繪製矩形框
+            left, top, right, bottom = (round(info[key] * scale) for key in ('left', 'top', 'right', 'bottom'))
+            draw.rectangle([left, top, right, bottom], outline=color, width=box_width)
 
             # 繪製標籤背景
             label = f"{info['id']}"
-            bbox = draw.textbbox((left, top - 50), label, font=font)
+            bbox = draw.textbbox((left, top - label_offset), label, font=font)
             draw.rectangle(bbox, fill=color)
 
             # 繪製標籤文字
-            draw.text((left, top - 50), label, fill='white', font=font)
-
-    # 保存圖像
-    image.save(output_path)
-    print(f"檢測框圖像已保存到: {output_path}")
-
-    return image
+            draw.text((left, top - label_offset), label, fill='white', font=font)
 
 
 def print_layers_info(layers_info: List[Dict[str, Any]]) -> None:
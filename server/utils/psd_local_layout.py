@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+PSD本地佈局引擎
+
+不依賴 Gemini 的確定性縮放方案生成器，輸入與 GeminiPSDResizeService 相同的 layers_info，
+輸出相同結構的 new_coords 列表，可直接交給 resize_psd_with_new_positions 渲染。
+
+規則：
+1. 背景圖層（覆蓋畫布大部分面積）直接鋪滿目標畫布
+2. 其餘圖層按 min(寬比, 高比) 等比例縮放，文字圖層保證最小可讀高度
+3. 靠近邊緣的圖層保持與該邊緣的（縮放後）距離，其餘按中心點比例定位
+4. 按優先級（文字 > 圖像 > 形狀 > 其他）依次放置，原本不重疊的圖層
+   若縮放後重疊，則沿位移最小的方向推開，推不開時逐步縮小
+5. 所有結果限制在目標畫布範圍內，圖層組取子圖層的外接框
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+Box = Tuple[int, int, int, int]
+
+# 覆蓋原畫布面積比例超過該值視為背景
+BACKGROUND_COVERAGE = 0.85
+# 距離邊緣小於畫布尺寸的該比例時錨定到邊緣
+EDGE_ANCHOR_RATIO = 0.12
+# 文字圖層縮放後的最小高度（像素）
+MIN_TEXT_HEIGHT = 12
+# 避讓重疊時允許的最小縮放（相對初始縮放）
+MIN_SHRINK = 0.6
+SHRINK_STEP = 0.9
+
+_PRIORITY = {'type': 0, 'text': 0, 'smartobject': 1, 'pixel': 1, 'shape': 2}
+
+
+def _box(info: Dict[str, Any]) -> Box:
+    return int(info['left']), int(info['top']), int(info['right']), int(info['bottom'])
+
+
+def _area(box: Box) -> int:
+    return max(0, box[2] - box[0]) * max(0, box[3] - box[1])
+
+
+def _overlap(a: Box, b: Box) -> int:
+    return _area((max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])))
+
+
+def _is_background(info: Dict[str, Any], original_width: int, original_height: int) -> bool:
+    name = str(info.get('name', '')).lower()
+    if info.get('level', 0) == 0 and ('背景' in name or 'background' in name):
+        return True
+    return _area(_box(info)) >= BACKGROUND_COVERAGE * original_width * original_height
+
+
+def _anchor_axis(start: int, end: int, original: int, target: int, size: int, scale: float) -> Tuple[int, str]:
+    """計算單個軸向的新起點，返回 (起點, 錨定方式)"""
+    before = start
+    after = original - end
+    if before <= after and before <= EDGE_ANCHOR_RATIO * original:
+        return round(before * scale), 'start'
+    if after < before and after <= EDGE_ANCHOR_RATIO * original:
+        return target - round(after * scale) - size, 'end'
+    center = (start + end) / 2 / original * target
+    return round(center - size / 2), 'center'
+
+
+def _clamp_into(box: Box, target_width: int, target_height: int) -> Box:
+    """平移進畫布範圍（尺寸不變，尺寸已保證不超過畫布）"""
+    left, top, right, bottom = box
+    width, height = right - left, bottom - top
+    left = min(max(0, left), target_width - width)
+    top = min(max(0, top), target_height - height)
+    return left, top, left + width, top + height
+
+
+def _push_apart(box: Box, obstacle: Box, target_width: int, target_height: int) -> Optional[Box]:
+    """沿位移最小的方向把 box 推離 obstacle，推出畫布時返回 None"""
+    left, top, right, bottom = box
+    width, height = right - left, bottom - top
+    candidates = [
+        (obstacle[2] - left, 0),     # 向右
+        (obstacle[0] - right, 0),    # 向左
+        (0, obstacle[3] - top),      # 向下
+        (0, obstacle[1] - bottom),   # 向上
+    ]
+    for dx, dy in sorted(candidates, key=lambda d: abs(d[0]) + abs(d[1])):
+        moved = (left + dx, top + dy, left + dx + width, top + dy + height)
+        if moved[0] >= 0 and moved[1] >= 0 and moved[2] <= target_width and moved[3] <= target_height:
+            return moved
+    return None
+
+
+def _scaled_box(info: Dict[str, Any], scale: float, original_width: int, original_height: int,
+                target_width: int, target_height: int) -> Tuple[Box, str]:
+    left, top, right, bottom = _box(info)
+    width = max(1, round((right - left) * scale))
+    height = max(1, round((bottom - top) * scale))
+    # 超出畫布時等比例縮小
+    fit = min(1.0, target_width / width, target_height / height)
+    width, height = max(1, int(width * fit)), max(1, int(height * fit))
+
+    new_left, h_anchor = _anchor_axis(left, right, original_width, target_width, width, scale)
+    new_top, v_anchor = _anchor_axis(top, bottom, original_height, target_height, height, scale)
+    box = _clamp_into((new_left, new_top, new_left + width, new_top + height), target_width, target_height)
+    return box, f'{h_anchor}/{v_anchor}'
+
+
+def compute_local_layout(layers_info: List[Dict[str, Any]],
+                         original_width: int,
+                         original_height: int,
+                         target_width: int,
+                         target_height: int) -> List[Dict[str, Any]]:
+    """
+    生成本地縮放方案
+
+    Args:
+        layers_info: get_psd_layers_info 返回的圖層信息
+        original_width: 原始寬度
+        original_height: 原始高度
+        target_width: 目標寬度
+        target_height: 目標高度
+
+    Returns:
+        與 Gemini 方案相同結構的圖層調整列表
+    """
+    scale = min(target_width / original_width, target_height / original_height)
+    results: Dict[int, Dict[str, Any]] = {}
+    placed: List[Tuple[int, Box, Box]] = []  # (id, 原始框, 新框)
+
+    def record(info: Dict[str, Any], box: Box, layer_scale: float, reason: str, warnings: List[str]) -> None:
+        results[info['id']] = {
+            'id': info['id'],
+            'name': info['name'],
+            'type': info.get('type', 'unknown'),
+            'level': info.get('level', 0),
+            'visible': info.get('visible', True),
+            'original_coords': {
+                'left': info['left'], 'top': info['top'],
+                'right': info['right'], 'bottom': info['bottom'],
+            },
+            'new_coords': {'left': box[0], 'top': box[1], 'right': box[2], 'bottom': box[3]},
+            'scale_factor': round(layer_scale, 4),
+            'adjustment_reason': reason,
+            'quality_check': '通過' if not warnings else '需要人工確認',
+            'warnings': warnings,
+        }
+
+    groups = [info for info in layers_info if info.get('type') == 'group']
+    leaves = [info for info in layers_info if info.get('type') != 'group']
+
+    # 空圖層和背景先處理
+    content = []
+    for info in leaves:
+        if _area(_box(info)) == 0:
+            record(info, (0, 0, 0, 0), 0.0, '空圖層', [])
+        elif _is_background(info, original_width, original_height):
+            warnings = []
+            src_ratio = (info['right'] - info['left']) / max(1, info['bottom'] - info['top'])
+            if abs(src_ratio - target_width / target_height) / src_ratio > 0.01:
+                warnings.append('背景寬高比與目標畫布不同，已拉伸鋪滿')
+            record(info, (0, 0, target_width, target_height), scale, '背景鋪滿目標畫布', warnings)
+        else:
+            content.append(info)
+
+    # 按優先級放置：文字 > 圖像 > 形狀 > 其他，同級按面積從大到小
+    content.sort(key=lambda info: (_PRIORITY.get(info.get('type'), 3), -_area(_box(info))))
+    for info in content:
+        original_box = _box(info)
+        layer_scale = scale
+        warnings: List[str] = []
+        if info.get('type') in ('type', 'text'):
+            original_height_px = original_box[3] - original_box[1]
+            if original_height_px * layer_scale < MIN_TEXT_HEIGHT <= original_height_px:
+                layer_scale = MIN_TEXT_HEIGHT / original_height_px
+
+        box, anchor = _scaled_box(info, layer_scale, original_width, original_height, target_width, target_height)
+        reason = f'等比例縮放 {layer_scale:.3f}，錨定 {anchor}'
+
+        # 只避讓原本不重疊、縮放後重疊的可見圖層
+        if info.get('visible', True):
+            shrink = 1.0
+            while True:
+                conflict = next(
+                    (new_box for _, old_box, new_box in placed
+                     if _overlap(box, new_box) and not _overlap(original_box, old_box)),
+                    None
+                )
+                if conflict is None:
+                    break
+                moved = _push_apart(box, conflict, target_width, target_height)
+                if moved is not None and not any(
+                    _overlap(moved, new_box) and not _overlap(original_box, old_box)
+                    for _, old_box, new_box in placed
+                ):
+                    box = moved
+                    reason += '，已移動避免重疊'
+                    break
+                shrink *= SHRINK_STEP
+                if shrink < MIN_SHRINK:
+                    warnings.append('無法完全避免與其他圖層重疊')
+                    break
+                box, anchor = _scaled_box(info, layer_scale * shrink, original_width, original_height,
+                                          target_width, target_height)
+            if shrink < 1.0:
+                layer_scale *= shrink
+                reason += f'，縮小至 {layer_scale:.3f} 以避免重疊'
+            placed.append((info['id'], original_box, box))
+
+        record(info, box, layer_scale, reason, warnings)
+
+    # 圖層組取子圖層新位置的外接框（按先序遍歷，子圖層緊跟在組之後且層級更深）
+    order = {info['id']: position for position, info in enumerate(layers_info)}
+    for group in groups:
+        start = order[group['id']] + 1
+        children = []
+        for info in layers_info[start:]:
+            if info.get('level', 0) <= group.get('level', 0):
+                break
+            result = results.get(info['id'])
+            if result and _area(_box(result['new_coords'])):
+                children.append(_box(result['new_coords']))
+        if children:
+            box = (min(b[0] for b in children), min(b[1] for b in children),
+                   max(b[2] for b in children), max(b[3] for b in children))
+        else:
+            box, _ = _scaled_box(group, scale, original_width, original_height, target_width, target_height) \
+                if _area(_box(group)) else ((0, 0, 0, 0), '')
+        record(group, box, scale, '圖層組：子圖層外接框', [])
+
+    return [results[info['id']] for info in layers_info]
@@ -7,15 +7,151 @@ PSD圖層縮放和重建工具
 from psd_tools import PSDImage
 from PIL import Image
 import json
+import os
 import sys
-from typing import List, Dict, Any, Optional
+import threading
+import uuid
+from collections import OrderedDict
+
+try:
+    from utils.image_encoder import image_encoder
+except ImportError:
+    # 作為腳本直接運行時
+    from image_encoder import image_encoder
+from typing import Callable, List, Dict, Any, Optional, Tuple
+
+
+# 縮放後圖層變體的進程級緩存上限（像素數 × 4 字節）
+SCALED_VARIANT_CACHE_BYTES = int(os.getenv('PSD_SCALED_LAYER_CACHE_MB', '256')) * 1024 * 1024
+
+# (圖層來源鍵, 寬, 高) -> (裁掉透明邊後的圖像, 相對新位置的偏移)，None 表示縮放後完全透明
+_scaled_variants: "OrderedDict[Tuple[Any, int, int], Optional[Tuple[Image.Image, Tuple[int, int]]]]" = OrderedDict()
+_scaled_variants_bytes = 0
+_scaled_variants_lock = threading.Lock()
+
+
+def _variant_bytes(variant: Optional[Tuple[Image.Image, Tuple[int, int]]]) -> int:
+    return variant[0].width * variant[0].height * 4 if variant else 0
+
+
+class LayerRasterCache:
+    """
+    按圖層ID緩存圖層圖像
+
+    優先使用 raster_loader 返回的磁盤位圖（已上傳文件的圖層柵格緩存），
+    沒有時才由 layer.composite() 合成，每個圖層只讀取/合成一次。
+    縮放後的變體放在進程級 LRU 中，磁盤位圖按文件和修改時間、現場合成的圖層按
+    source_id（PSD內容哈希）復用，重複渲染同一尺寸時無需再次縮放。沒有 source_id 時
+    使用本實例獨有的隨機鍵，不會與其他PSD的圖層混淆。
+    可在多個線程中同時渲染。psd-tools 對象不是線程安全的，
+    共用同一個PSD對象的其他操作也應在 lock 內進行。
+    """
+
+    def __init__(self, psd: PSDImage, raster_loader: Optional[Callable[[int], Optional[str]]] = None,
+                 source_id: Optional[str] = None):
+        self.psd = psd
+        self.raster_loader = raster_loader
+        self.source_id = source_id or uuid.uuid4().hex
+        self.layers: Dict[int, Any] = {}
+        self._rasters: Dict[int, Optional[Image.Image]] = {}
+        self._source_keys: Dict[int, Any] = {}
+        self.lock = threading.Lock()
+        self.loaded_from_disk = 0
+        self.composited = 0
+
+        # 與 get_psd_layers_info 相同的先序遍歷編號
+        def collect_layers(layer):
+            self.layers[len(self.layers)] = layer
+            if hasattr(layer, '__iter__'):
+                for child in layer:
+                    collect_layers(child)
+
+        for layer in psd:
+            collect_layers(layer)
+
+    def _load_from_disk(self, layer_id: int) -> Optional[Image.Image]:
+        if self.raster_loader is None:
+            return None
+        try:
+            path = self.raster_loader(layer_id)
+        except Exception as e:
+            print(f"ID {layer_id}: 讀取圖層柵格緩存失敗: {e}")
+            return None
+        if not path:
+            return None
+        stat = os.stat(path)
+        with Image.open(path) as cached:
+            image = cached.convert('RGBA') if cached.mode != 'RGBA' else cached.copy()
+        self._source_keys[layer_id] = (path, stat.st_mtime_ns, stat.st_size)
+        self.loaded_from_disk += 1
+        return image
+
+    def get(self, layer_id: int) -> Optional[Image.Image]:
+        """獲取圖層的RGBA圖像，無法渲染時返回 None（返回的圖像不可修改）"""
+        if layer_id in self._rasters:
+            return self._rasters[layer_id]
+
+        layer_image = self._load_from_disk(layer_id)
+        with self.lock:
+            if layer_id not in self._rasters:
+                if layer_image is None:
+                    # 柵格緩存中沒有（空圖層、純色背景）時，使用最大質量渲染當前圖層
+                    layer_image = self.layers[layer_id].composite()
+                    self.composited += 1
+                    if layer_image is None or layer_image.size[0] == 0 or layer_image.size[1] == 0:
+                        layer_image = None
+                    elif layer_image.mode != 'RGBA':
+                        layer_image = layer_image.convert('RGBA')
+                    self._source_keys[layer_id] = (self.source_id, layer_id)
+                self._rasters[layer_id] = layer_image
+            return self._rasters[layer_id]
+
+    def get_scaled(self, layer_id: int, width: int, height: int) -> Optional[Tuple[Image.Image, Tuple[int, int]]]:
+        """
+        獲取縮放到指定尺寸、並裁掉透明邊的圖層圖像
+
+        Returns:
+            (圖像, 相對目標位置左上角的偏移)；圖層無法渲染或完全透明時返回 None
+        """
+        global _scaled_variants_bytes
+        layer_image = self.get(layer_id)
+        if layer_image is None:
+            return None
+
+        key = (self._source_keys[layer_id], width, height)
+        with _scaled_variants_lock:
+            if key in _scaled_variants:
+                _scaled_variants.move_to_end(key)
+                return _scaled_variants[key]
+
+        if layer_image.size != (width, height):
+            # 使用LANCZOS插值進行高質量縮放
+            layer_image = layer_image.resize((width, height), Image.Resampling.LANCZOS)
+        # 只合成不透明區域
+        bbox = layer_image.getchannel('A').getbbox()
+        if bbox is None:
+            variant = None
+        elif bbox == (0, 0, width, height):
+            variant = (layer_image, (0, 0))
+        else:
+            variant = (layer_image.crop(bbox), (bbox[0], bbox[1]))
+
+        with _scaled_variants_lock:
+            if key not in _scaled_variants:
+                _scaled_variants[key] = variant
+                _scaled_variants_bytes += _variant_bytes(variant)
+                while _scaled_variants_bytes > SCALED_VARIANT_CACHE_BYTES and len(_scaled_variants) > 1:
+                    _, evicted = _scaled_variants.popitem(last=False)
+                    _scaled_variants_bytes -= _variant_bytes(evicted)
+        return variant
 
 
 def resize_psd_with_new_positions(psd_file_path: str, 
                                  new_pos_json_path: str, 
                                  output_path: str,
                                  target_width: int,
-                                 target_height: int) -> Image.Image:
+                                 target_height: int,
+                                 raster_cache: Optional[LayerRasterCache] = None) -> Image.Image:
     """
     根據新的位置信息對每個圖層進行resize和repositioning
 
@@ -25,14 +161,47 @@ def resize_psd_with_new_positions(psd_file_path: str,
         output_path: 輸出文件路徑
         target_width: 目標寬度
         target_height: 目標高度
+        raster_cache: 已有的圖層圖像緩存（批量渲染時共用，不再重新打開PSD）
     """
-    # 讀取PSD文件
-    psd = PSDImage.open(psd_file_path)
-
     # 讀取新位置信息
     with open(new_pos_json_path, 'r', encoding='utf-8') as f:
         new_positions = json.load(f)
 
+    if raster_cache is None:
+        stat = os.stat(psd_file_path)
+        raster_cache = LayerRasterCache(
+            PSDImage.open(psd_file_path),
+            source_id=f'{os.path.abspath(psd_file_path)}:{stat.st_mtime_ns}:{stat.st_size}'
+        )
+
+    new_canvas = render_resized_canvas(raster_cache, new_positions, target_width, target_height)
+
+    # 保存為高質量PNG（最終輸出，使用編碼層配置的壓縮級別）
+    output_png = output_path.rsplit('.', 1)[0] + '.png'
+    image_encoder.save_png(new_canvas, output_png, final=True, dpi=(300, 300))
+    image_encoder.remove_variants(output_png)
+
+    print(f"\n輸出圖像已保存到: {output_png}")
+    print(f"最終尺寸: {new_canvas.width} x {new_canvas.height}")
+
+    return new_canvas
+
+
+def render_resized_canvas(raster_cache: LayerRasterCache,
+                          new_positions: List[Dict[str, Any]],
+                          target_width: int,
+                          target_height: int) -> Image.Image:
+    """
+    按新位置把圖層圖像縮放並合成到目標尺寸的畫布上
+
+    參數:
+        raster_cache: 圖層圖像緩存
+        new_positions: 圖層調整方案（new_coords 格式）
+        target_width: 目標寬度
+        target_height: 目標高度
+    """
+    psd = raster_cache.psd
+
     # 創建ID到新位置的映射，轉換新的JSON格式
     pos_map = {}
     
@@ -59,28 +228,11 @@ def resize_psd_with_new_positions(psd_file_path: str,
     # 創建新畫布，使用指定的目標尺寸
     new_canvas = Image.new('RGBA', (target_width, target_height), (0, 0, 0, 0))
 
-    # 收集所有圖層
-    all_layers = []
-    layer_id = 0
-
-    def collect_layers(layer):
-        """遞歸收集所有圖層"""
-        nonlocal layer_id
-        all_layers.append((layer_id, layer))
-        layer_id += 1
-
-        if hasattr(layer, '__iter__'):
-            for child in layer:
-                collect_layers(child)
-
-    for layer in psd:
-        collect_layers(layer)
-
-    print(f"收集到 {len(all_layers)} 個圖層\n")
+    print(f"收集到 {len(raster_cache.layers)} 個圖層\n")
 
     # 處理每個圖層
     processed_count = 0
-    for layer_id, layer in all_layers:
+    for layer_id, layer in raster_cache.layers.items():
         if layer_id not in pos_map:
             continue
 
@@ -102,17 +254,6 @@ def resize_psd_with_new_positions(psd_file_path: str,
             continue
 
         try:
-            # 渲染當前圖層為圖像（使用最大質量）
-            layer_image = layer.composite()
-
-            if layer_image is None or layer_image.size[0] == 0 or layer_image.size[1] == 0:
-                print(f"ID {layer_id}: {layer.name} - 跳過（無法渲染）")
-                continue
-
-            # 確保圖像是RGBA模式
-            if layer_image.mode != 'RGBA':
-                layer_image = layer_image.convert('RGBA')
-
             old_bbox = layer.bbox
             old_width = old_bbox[2] - old_bbox[0]
             old_height = old_bbox[3] - old_bbox[1]
@@ -122,48 +263,37 @@ def resize_psd_with_new_positions(psd_file_path: str,
             new_width = new_pos['width']
             new_height = new_pos['height']
 
-            # 如果尺寸發生變化，使用高質量插值進行resize
+            # 確保新位置在畫布範圍內
+            if not (new_left >= 0 and new_top >= 0 and
+                    new_left + new_width <= target_width and
+                    new_top + new_height <= target_height):
+                print(f"ID {layer_id}: {layer.name} - 位置超出畫布範圍，跳過")
+                continue
+
+            # 縮放（尺寸變化時使用高質量插值，結果跨渲染復用）並裁掉透明邊
+            scaled = raster_cache.get_scaled(layer_id, new_width, new_height)
+            if scaled is None:
+                print(f"ID {layer_id}: {layer.name} - 跳過（無法渲染或完全透明）")
+                continue
+
             if old_width != new_width or old_height != new_height:
-                if new_width > 0 and new_height > 0:
-                    # 使用LANCZOS插值進行高質量縮放
-                    layer_image = layer_image.resize(
-                        (new_width, new_height),
-                        Image.Resampling.LANCZOS
-                    )
-
-                    print(f"ID {layer_id}: {layer.name}")
-                    print(f"  原始尺寸: {old_width}x{old_height}")
-                    print(f"  新尺寸: {new_width}x{new_height}")
-                    print(f"  新位置: ({new_left}, {new_top})")
+                print(f"ID {layer_id}: {layer.name}")
+                print(f"  原始尺寸: {old_width}x{old_height}")
+                print(f"  新尺寸: {new_width}x{new_height}")
+                print(f"  新位置: ({new_left}, {new_top})")
             else:
                 print(f"ID {layer_id}: {layer.name} - 尺寸未變化，位置: ({new_left}, {new_top})")
 
-            # 確保新位置在畫布範圍內
-            if (new_left >= 0 and new_top >= 0 and 
-                new_left + new_width <= target_width and 
-                new_top + new_height <= target_height):
-                
-                # 粘貼到新畫布上（使用alpha通道進行合成）
-                if layer_image.mode == 'RGBA':
-                    new_canvas.alpha_composite(layer_image, (new_left, new_top))
-                else:
-                    new_canvas.paste(layer_image, (new_left, new_top), layer_image)
-                processed_count += 1
-            else:
-                print(f"ID {layer_id}: {layer.name} - 位置超出畫布範圍，跳過")
+            # 只在不透明區域的邊界框內合成（使用alpha通道）
+            layer_image, (offset_x, offset_y) = scaled
+            new_canvas.alpha_composite(layer_image, (new_left + offset_x, new_top + offset_y))
+            processed_count += 1
 
         except Exception as e:
             print(f"ID {layer_id}: {layer.name} - 處理失敗: {e}")
 
     print(f"\n成功處理 {processed_count} 個圖層")
 
-    # 保存為高質量PNG
-    output_png = output_path.rsplit('.', 1)[0] + '.png'
-    new_canvas.save(output_png, 'PNG', optimize=False, compress_level=0, dpi=(300, 300))
-
-    print(f"\n輸出圖像已保存到: {output_png}")
-    print(f"最終尺寸: {new_canvas.width} x {new_canvas.height}")
-
     return new_canvas
 
 
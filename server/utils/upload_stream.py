@@ -0,0 +1,98 @@
+"""
+上传文件流式落盘工具
+
+按固定大小分块读取 UploadFile 并写入磁盘，同时增量计算内容哈希，
+单次上传的内存占用只与分块大小有关，与文件大小无关。
+落盘后的 PSD 通过内存映射交给 psd-tools 解析，避免再把整个文件读入内存。
+"""
+
+import hashlib
+import mmap
+import os
+from dataclasses import dataclass
+
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+from psd_tools import PSDImage
+
+# 每次从上传流读取的字节数
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(1024 * 1024)))
+
+
+@dataclass
+class StreamedUpload:
+    """流式保存结果"""
+    path: str
+    size: int
+    sha256: str
+
+
+def _write_chunk(f, hasher, chunk: bytes) -> None:
+    f.write(chunk)
+    hasher.update(chunk)
+
+
+async def stream_upload_to_file(upload: UploadFile, dest_path: str,
+                                chunk_size: int = UPLOAD_CHUNK_SIZE) -> StreamedUpload:
+    """
+    把上传文件分块写入 dest_path 并计算 SHA-256
+
+    先写入同目录下的临时文件，完成后原子替换，失败时不会留下半截文件。
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    tmp_path = f'{dest_path}.part'
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                await run_in_threadpool(_write_chunk, f, hasher, chunk)
+        os.replace(tmp_path, dest_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return StreamedUpload(path=dest_path, size=size, sha256=hasher.hexdigest())
+
+
+def hash_file(path: str, chunk_size: int = UPLOAD_CHUNK_SIZE) -> str:
+    """分块计算已落盘文件的 SHA-256"""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class _MmapReader:
+    """mmap 的只读文件接口包装（mmap.seek 在 Python 3.13 之前不返回新位置）"""
+
+    def __init__(self, mapped: mmap.mmap):
+        self._mapped = mapped
+
+    def read(self, size: int = -1) -> bytes:
+        return self._mapped.read(size)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        self._mapped.seek(offset, whence)
+        return self._mapped.tell()
+
+    def tell(self) -> int:
+        return self._mapped.tell()
+
+
+def open_psd_mmap(psd_path: str) -> PSDImage:
+    """
+    通过内存映射解析PSD文件
+
+    页面由操作系统按需换入换出，解析期间不需要额外的整文件缓冲区；
+    psd-tools 解析完成后不再引用源数据，映射可以立即关闭。
+    """
+    with open(psd_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError('PSD file is empty')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return PSDImage.open(_MmapReader(mapped))